@@ -1,30 +1,57 @@
 # app.py
-from flask import Flask, request, jsonify, session, render_template, flash, redirect, url_for, send_from_directory, Response
+import time
+_T0_IMPORTACION = time.perf_counter()  # presupuesto de arranque (ver final del módulo)
+
+from flask import Flask, request, jsonify, session, render_template, stream_template, flash, get_flashed_messages, redirect, url_for, make_response, Response, g
 from flask_cors import CORS
+from flask.json.tag import TaggedJSONSerializer
+from flask.sessions import SecureCookieSession
+from werkzeug.middleware.proxy_fix import ProxyFix
 import config
 import handlers
 import utils
 import database
 import email_manager
+import whatsapp_manager
+import notificaciones
+import disponibilidad
+import horarios
+import recursos
+import lista_espera
+import eventos
+import estaticos
+import limitador
+import sesion
+import metrics
+import log_manager
 import os
 import io
 import csv
+import json
+import base64
+import hashlib
+import hmac
+import secrets
+import re
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta, date
-import locale
 import threading
-import time
+import uuid
 
-# ---------- Locale español (si está disponible) ----------
-try:
-    locale.setlocale(locale.LC_TIME, 'es_ES.UTF-8')
-except locale.Error:
-    try:
-        locale.setlocale(locale.LC_TIME, 'esp')
-    except locale.Error:
-        print("Advertencia: No se pudo establecer el locale en español en app.py.")
+log = log_manager.get_logger("app")
+log_scheduler = log_manager.get_logger("scheduler")
 
 app = Flask(__name__, template_folder="templates", static_folder="static")
 app.secret_key = getattr(config, "SECRET_KEY", "dev-secret")
+app.session_interface = sesion.SesionCompacta()
+# Detrás de N proxies (p.ej. el router de la plataforma), la IP real viene en X-Forwarded-For
+_PROXIES = int(getattr(config, "TRUSTED_PROXIES", os.getenv("TRUSTED_PROXIES", 0)))
+if _PROXIES:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=_PROXIES, x_proto=_PROXIES)
+# /static con ETag, compresión y caché larga para URLs versionadas (ver estaticos.py)
+app.view_functions["static"] = lambda filename: estaticos.enviar(app.static_folder, filename)
+app.jinja_env.globals["static_url"] = estaticos.url_estatica
 
 CORS(app, resources={r"/mensaje": {"origins": list(getattr(config, "CORS_ALLOWED_ORIGINS", ["*"]))}}, supports_credentials=True)
 
@@ -38,6 +65,7 @@ ESTADO_HANDLERS = {
     'pidiendo_empleado': handlers.handle_peticion_empleado,
     'pidiendo_hora': handlers.handle_peticion_hora,
     'esperando_pre_confirmacion': handlers.handle_esperando_pre_confirmacion,
+    'eligiendo_hueco_sugerido': handlers.handle_eleccion_hueco_sugerido,
     'procesando_confirmacion': handlers.handle_procesando_confirmacion,
     'gestion_pide_telefono': handlers.handle_gestion_pide_telefono,
     'gestion_esperando_accion': handlers.handle_gestion_esperando_accion,
@@ -49,35 +77,152 @@ ESTADO_HANDLERS = {
 # =====================================================
 # Chat del bot
 # =====================================================
+IDEMPOTENCIA_TTL_SEGUNDOS = int(getattr(config, "IDEMPOTENCIA_TTL_SEGUNDOS", os.getenv("IDEMPOTENCIA_TTL_SEGUNDOS", 600)))
+IDEMPOTENCIA_ESPERA_SEGUNDOS = 5  # cuánto espera un duplicado a que termine el original
+_CLAVE_IDEMPOTENCIA_RE = re.compile(r"^[A-Za-z0-9_-]{8,64}$")
+_serializador_sesion = TaggedJSONSerializer()
+
+# Mensajes procesándose a la vez en este worker; por encima se descarta con 503
+# en lugar de encolar hilos esperando conexión.
+MENSAJE_CONCURRENCIA_MAX = int(getattr(config, "MENSAJE_CONCURRENCIA_MAX", os.getenv("MENSAJE_CONCURRENCIA_MAX", database.DB_POOL_MAX)))
+_mensajes_en_curso = threading.BoundedSemaphore(MENSAJE_CONCURRENCIA_MAX)
+
+def _demasiadas_peticiones(retry_after, codigo, texto):
+    metrics.PETICIONES_RECHAZADAS.inc(str(codigo))
+    resp = jsonify({"respuesta": texto})
+    resp.status_code = codigo
+    resp.headers["Retry-After"] = str(retry_after)
+    return resp
+
 @app.route("/mensaje", methods=["POST"])
 def mensaje():
-    negocio = None
-    slug_negocio_url = request.args.get("business")
-    
-    if slug_negocio_url or 'negocio_id' not in session:
-        session.clear()
-        if slug_negocio_url:
-            slug_limpio = slug_negocio_url.strip().lower()
-            negocio = database.obtener_negocio_por_slug(slug_limpio)
-        if not negocio:
-            todos_los_negocios = database.listar_negocios()
-            if todos_los_negocios:
-                primer_negocio_id = todos_los_negocios[0]['id']
-                negocio = database.obtener_negocio_por_id(primer_negocio_id)
+    """
+    Antes de tocar la base de datos: límite de tasa por IP y por negocio (429) y
+    límite de concurrencia del worker (503).
+
+    Con cabecera Idempotency-Key (una por acción del usuario), un reenvío de la
+    misma acción desde la misma conversación devuelve la respuesta guardada
+    sin volver a ejecutar el handler (ni guardar la cita o notificar dos veces).
+    La clave se acota a la conversación de la cookie: conocer la clave de otro
+    no da acceso a su respuesta, y nunca se devuelve una sesión guardada.
+    """
+    slug_url = (request.args.get("business") or "").strip().lower()
+    if 'negocio_id' in session and (not slug_url or slug_url == session.get('business_slug')):
+        negocio_id = session['negocio_id']
     else:
-        negocio = database.obtener_negocio_por_id(session['negocio_id'])
+        negocio_id = limitador.id_de_slug(slug_url) if slug_url else None
+    retry_after = limitador.comprobar(request.remote_addr, negocio_id)
+    if retry_after:
+        return _demasiadas_peticiones(retry_after, 429, "Estás enviando mensajes muy rápido. Espera unos segundos, por favor.")
+
+    if not _mensajes_en_curso.acquire(blocking=False):
+        return _demasiadas_peticiones(1, 503, "Ahora mismo hay mucha actividad. Inténtalo de nuevo en un momento.")
+    try:
+        return _mensaje_idempotente()
+    finally:
+        _mensajes_en_curso.release()
+
+def _conversacion_actual():
+    """Id aleatorio de la conversación de este navegador, guardado en su cookie de sesión."""
+    if 'conversacion' not in session:
+        session['conversacion'] = secrets.token_urlsafe(12)
+    return session['conversacion']
+
+def _mensaje_idempotente():
+    clave = request.headers.get("Idempotency-Key", "")
+    if not _CLAVE_IDEMPOTENCIA_RE.match(clave):
+        return jsonify(_procesar_mensaje())
+    conversacion = _conversacion_actual()
+    clave = f"{conversacion}:{clave}"
+
+    try:
+        nueva = database.reclamar_clave_idempotente(clave, IDEMPOTENCIA_TTL_SEGUNDOS)
+    except Exception as e:
+        log.warning("Idempotencia no disponible, se procesa sin ella: %s", e)
+        return jsonify(_procesar_mensaje())
+    if not nueva:
+        return _repetir_respuesta(clave)
+
+    try:
+        respuesta_dict = _procesar_mensaje()
+    except Exception:
+        database.liberar_clave_idempotente(clave)
+        raise
+    # Los handlers pueden vaciar la sesión (reinicio): la conversación sigue siendo la misma
+    session['conversacion'] = conversacion
+    try:
+        database.guardar_respuesta_idempotente(clave, respuesta_dict)
+    except Exception as e:
+        log.warning("No se pudo guardar la respuesta idempotente: %s", e)
+    return jsonify(respuesta_dict)
 
+def _repetir_respuesta(clave):
+    limite = time.monotonic() + IDEMPOTENCIA_ESPERA_SEGUNDOS
+    while True:
+        guardada = database.obtener_respuesta_idempotente(clave)
+        if guardada is not None and guardada['respuesta'] is not None:
+            metrics.IDEMPOTENCIA_REPETICIONES.inc()
+            resp = jsonify(guardada['respuesta'])
+            resp.headers["Idempotent-Replayed"] = "true"
+            return resp
+        if guardada is None or time.monotonic() >= limite:
+            break
+        # El original sigue en curso: esperamos su respuesta en lugar de duplicarlo
+        time.sleep(0.2)
+    return jsonify({"respuesta": "Seguimos procesando tu mensaje anterior, inténtalo de nuevo en un momento."}), 409
+
+def _buscar_negocio(slug_url):
+    """Negocio del slug o, si no existe, el primero dado de alta (None si no hay ninguno)."""
+    negocio = database.obtener_negocio_por_slug(slug_url) if slug_url else None
     if not negocio:
-        return jsonify({"respuesta": "Error: No se pudo cargar ningún negocio válido."})
+        primero = database.listar_negocios(limite=1)
+        if primero:
+            negocio = database.obtener_negocio_por_id(primero[0]['id'])
+    return negocio
+
+def _fijar_negocio(slug_url, buscar_negocio=_buscar_negocio):
+    """
+    Resuelve el negocio una vez por conversación y lo deja fijado en la sesión.
+    Solo consulta la base de datos si no hay negocio fijado o si ?business=
+    apunta a otro distinto. Devuelve el negocio_id o None.
+    """
+    if 'negocio_id' in session and (not slug_url or slug_url == session.get('business_slug')):
+        return session['negocio_id']
 
+    if session.get('hora_retenida'):
+        # Cambio de negocio: la hora retenida en el anterior no debe quedar bloqueada hasta caducar
+        database.liberar_retenciones(session.get('titular_reserva'))
+    session.clear()
+    negocio = buscar_negocio(slug_url)
+    if not negocio:
+        return None
+    if slug_url:
+        limitador.recordar_slug(slug_url, negocio['id'])
     session['negocio_id'] = negocio['id']
     session['business_slug'] = negocio['slug']
     session['negocio_nombre'] = negocio['nombre']
-    
-    texto_usuario = request.json.get("mensaje", "").strip()
+    return negocio['id']
+
+def _procesar_mensaje():
+    slug_url = (request.args.get("business") or "").strip().lower()
+    return _procesar_texto(request.json.get("mensaje", "").strip(), slug_url)
+
+def _procesar_texto(texto_usuario, slug_url, buscar_negocio=_buscar_negocio):
+    """Pasa un mensaje por la máquina de estados sobre la sesión actual. Devuelve el dict de respuesta."""
+    negocio_id = _fijar_negocio(slug_url, buscar_negocio)
+    if not negocio_id:
+        return {"respuesta": "Error: No se pudo cargar ningún negocio válido."}
+
+    # El widget abre cada carga de página con ?business= y un mensaje vacío:
+    # con el negocio ya fijado, eso reinicia la conversación (sin re-resolverlo)
+    if slug_url and not texto_usuario and 'estado' in session:
+        del session['estado']
+
     texto_normalizado = utils.normalizar_texto(texto_usuario)
     estado_actual = session.get('estado')
+    log_manager.vincular(negocio_id=negocio_id, estado=estado_actual or "inicio")
 
+    t0 = time.perf_counter()
     if any(keyword in texto_normalizado for keyword in REINICIO_KEYWORDS):
         respuesta_dict = handlers.handle_bienvenida(texto_usuario)
     else:
@@ -86,21 +231,248 @@ def mensaje():
             respuesta_dict = handler_func(texto_usuario)
         else:
             respuesta_dict = handlers.handle_bienvenida(texto_usuario)
+    metrics.ESTADO_LATENCIA.observar(time.perf_counter() - t0, estado_actual or "inicio")
 
     if not respuesta_dict.get("respuesta"):
         respuesta_dict = {"respuesta": "Lo siento, no te he entendido."}
     
-    if 'nuevo_estado' in respuesta_dict:
-        session['estado'] = respuesta_dict.pop('nuevo_estado')
+    # Solo se reescribe la cookie si el estado cambia de verdad
+    nuevo_estado = respuesta_dict.pop('nuevo_estado', None)
+    if nuevo_estado is not None and session.get('estado') != nuevo_estado:
+        session['estado'] = nuevo_estado
         
-    return jsonify(respuesta_dict)
+    return respuesta_dict
+
+# =====================================================
+# Mensajes en lote (integraciones)
+# =====================================================
+INTEGRACION_TOKEN = getattr(config, "INTEGRACION_TOKEN", os.getenv("INTEGRACION_TOKEN", ""))
+BATCH_MAX_MENSAJES = int(getattr(config, "BATCH_MAX_MENSAJES", os.getenv("BATCH_MAX_MENSAJES", 500)))
+# Conversaciones del lote procesándose a la vez: deja pool libre para el chat interactivo
+BATCH_HILOS = int(getattr(config, "BATCH_HILOS", os.getenv("BATCH_HILOS", max(1, database.DB_POOL_MAX // 2))))
+CONVERSACIONES_RETENCION_DIAS = int(getattr(config, "CONVERSACIONES_RETENCION_DIAS", os.getenv("CONVERSACIONES_RETENCION_DIAS", 30)))
+# Meses de citas que quedan en la tabla activa; las particiones anteriores pasan al esquema de archivo (0: nunca)
+CITAS_MESES_ACTIVOS = int(getattr(config, "CITAS_MESES_ACTIVOS", os.getenv("CITAS_MESES_ACTIVOS", 24)))
+
+@app.route("/mensajes/batch", methods=["POST"])
+def mensajes_batch():
+    """
+    Lote de mensajes de canales externos (webhook de WhatsApp, importador del CRM).
+    Cuerpo: [{"conversation_id", "mensaje", "business"?}, ...] o {"mensajes": [...]};
+    cabecera 'Authorization: Bearer <INTEGRACION_TOKEN>'. 'business' (o
+    ?business=) es el slug del negocio, como en /mensaje.
+
+    No hay cookie: la sesión de cada conversación se guarda en la tabla
+    conversaciones. Los negocios se resuelven una vez por slug para todo el
+    lote, las sesiones se leen y se guardan con una consulta cada una, y las
+    conversaciones se procesan en paralelo (los mensajes de una misma
+    conversación, en orden). Devuelve {"resultados": [...]} en el orden de entrada.
+    """
+    if not INTEGRACION_TOKEN or not hmac.compare_digest(request.headers.get("Authorization", ""), f"Bearer {INTEGRACION_TOKEN}"):
+        return jsonify({"error": "No autorizado."}), 401
+    datos = request.get_json(silent=True)
+    items = datos.get("mensajes") if isinstance(datos, dict) else datos
+    if not isinstance(items, list) or not all(isinstance(i, dict) and i.get("conversation_id") for i in items):
+        return jsonify({"error": "Se esperaba una lista de {conversation_id, mensaje}."}), 400
+    if len(items) > BATCH_MAX_MENSAJES:
+        return jsonify({"error": f"Máximo {BATCH_MAX_MENSAJES} mensajes por lote."}), 413
+
+    slug_defecto = (request.args.get("business") or "").strip().lower()
+    conversaciones = {}  # conversation_id -> [(posición, texto, slug)] en orden de llegada
+    for pos, item in enumerate(items):
+        slug = (str(item.get("business") or "") or slug_defecto).strip().lower()
+        conversaciones.setdefault(str(item["conversation_id"]), []).append((pos, str(item.get("mensaje") or "").strip(), slug))
+    return jsonify({"resultados": _procesar_conversaciones(conversaciones, len(items))})
+
+def _procesar_conversaciones(conversaciones, total, procesar=_procesar_texto):
+    """
+    Núcleo de los lotes: {conversation_id: [(posición, texto, slug)]} -> lista
+    de 'total' resultados por posición. procesar(texto, slug, buscar_negocio)
+    se ejecuta con la sesión de esa conversación ya cargada.
+    """
+    # Datos compartidos del lote: un negocio por slug distinto y todas las sesiones de golpe
+    negocios = {slug: _buscar_negocio(slug) for slug in {m[2] for mensajes in conversaciones.values() for m in mensajes}}
+    guardadas = database.obtener_sesiones_conversacion(list(conversaciones))
+
+    resultados = [None] * total
+    sesiones = {}
+
+    def _conversacion(conversation_id, mensajes):
+        previa = guardadas.get(conversation_id)
+        try:
+            datos = _serializador_sesion.loads(previa) if previa else {}
+        except Exception as e:
+            # Una sesión guardada ilegible no tumba el lote: esa conversación empieza de cero
+            log.warning("Lote: sesión ilegible de la conversación %s, se reinicia: %s", conversation_id, e)
+            datos = {}
+        ctx = app.test_request_context()
+        ctx.session = SecureCookieSession(datos)
+        with ctx:
+            for pos, texto, slug in mensajes:
+                try:
+                    resultados[pos] = {"conversation_id": conversation_id, **procesar(texto, slug, negocios.get)}
+                except Exception as e:
+                    log.exception("Lote: error en la conversación %s: %s", conversation_id, e)
+                    resultados[pos] = {"conversation_id": conversation_id, "error": "No se pudo procesar el mensaje."}
+            sesiones[conversation_id] = _serializador_sesion.dumps(dict(session))
+
+    if conversaciones:
+        with ThreadPoolExecutor(max_workers=min(BATCH_HILOS, len(conversaciones)), thread_name_prefix="batch") as ejecutor:
+            # Cada conversación con su copia del contexto de log (request_id del lote)
+            for futuro in [ejecutor.submit(contextvars.copy_context().run, _conversacion, cid, mensajes)
+                           for cid, mensajes in conversaciones.items()]:
+                futuro.result()
+        database.guardar_sesiones_conversacion(sesiones)
+    return resultados
+
+# =====================================================
+# WhatsApp entrante (webhook de Twilio)
+# =====================================================
+WHATSAPP_VALIDAR_FIRMA = str(getattr(config, "WHATSAPP_VALIDAR_FIRMA", os.getenv("WHATSAPP_VALIDAR_FIRMA", "1"))) not in ("", "0")
+# Hilos por worker que procesan la bandeja; cada uno tiene una conversación a la vez
+WHATSAPP_HILOS = int(getattr(config, "WHATSAPP_HILOS", os.getenv("WHATSAPP_HILOS", 2)))
+WHATSAPP_SONDEO_SEGUNDOS = 2  # pendientes de otros workers o de antes de un reinicio
+_TWIML_VACIO = '<?xml version="1.0" encoding="UTF-8"?><Response></Response>'
+
+_whatsapp_pendiente = threading.Event()
+_whatsapp_pid = None
+_whatsapp_lock = threading.Lock()
+
+@app.route("/whatsapp/webhook", methods=["POST"])
+def whatsapp_webhook():
+    """
+    Mensajes entrantes de WhatsApp (POST de Twilio: From, Body...). ?business=
+    elige el negocio, como en el widget: una URL de webhook por número.
+
+    El mensaje se guarda en la tabla whatsapp_entrantes antes de contestar a
+    Twilio con TwiML vacío, así que un reinicio no lo pierde (y un reintento
+    de Twilio con el mismo MessageSid no lo duplica). Los hilos de
+    _consumir_whatsapp de cualquier worker lo pasan por la misma máquina de
+    estados que /mensaje (conversación 'wa:<E.164>' en la tabla
+    conversaciones) y contestan por la API de Twilio. Sin TWILIO_AUTH_TOKEN
+    no se comprueba la firma, para poder probarlo en local con un POST normal.
+    """
+    if whatsapp_manager.TW_TOK and WHATSAPP_VALIDAR_FIRMA and not whatsapp_manager.firma_valida(
+            request.url, request.form, request.headers.get("X-Twilio-Signature", "")):
+        metrics.WHATSAPP_ENTRANTES.inc("firma_invalida")
+        return "Firma no válida.", 403
+    telefono = whatsapp_manager._to_e164(request.form.get("From", "").removeprefix("whatsapp:"))
+    texto = request.form.get("Body", "").strip()
+    # Sin texto (solo adjuntos) no hay nada que pasar a los handlers; en el widget
+    # un mensaje vacío significa "reiniciar", aquí no.
+    if telefono and texto:
+        slug = (request.args.get("business") or "").strip().lower()
+        try:
+            database.guardar_whatsapp_entrante(f"wa:{telefono}", texto, slug, request.form.get("MessageSid"))
+        except Exception as e:
+            # Sin guardar no se confirma: Twilio lo da por fallido en lugar de perderlo en silencio
+            metrics.WHATSAPP_ENTRANTES.inc("descartado")
+            log.error("No se pudo guardar el mensaje de WhatsApp de %s: %s", telefono, e)
+            return _TWIML_VACIO, 500, {"Content-Type": "text/xml"}
+        metrics.WHATSAPP_ENTRANTES.inc("encolado")
+        _iniciar_whatsapp()
+        _whatsapp_pendiente.set()
+    return _TWIML_VACIO, 200, {"Content-Type": "text/xml"}
+
+def _iniciar_whatsapp():
+    # Consumidores por proceso, arrancados en el worker (nunca en el master de --preload)
+    global _whatsapp_pid
+    with _whatsapp_lock:
+        if _whatsapp_pid != os.getpid():
+            _whatsapp_pid = os.getpid()
+            for i in range(max(1, WHATSAPP_HILOS)):
+                threading.Thread(target=_consumir_whatsapp, name=f"whatsapp-entrante-{i}", daemon=True).start()
+
+def _consumir_whatsapp():
+    """Procesa conversaciones de la bandeja mientras haya; si no, espera un aviso del webhook o el sondeo."""
+    while True:
+        try:
+            procesada = _procesar_whatsapp_pendiente()
+        except Exception as e:
+            log.exception("Error procesando WhatsApp entrante: %s", e)
+            procesada = False
+        if not procesada:
+            _whatsapp_pendiente.wait(WHATSAPP_SONDEO_SEGUNDOS)
+            _whatsapp_pendiente.clear()
+
+def _procesar_texto_whatsapp(texto_usuario, slug_url, buscar_negocio):
+    # "2" se refiere a la segunda opción numerada que se le envió
+    texto_usuario = whatsapp_manager.traducir_opcion(texto_usuario, session.pop('wa_opciones', None))
+    cuerpo, opciones = whatsapp_manager.formatear_respuesta(_procesar_texto(texto_usuario, slug_url, buscar_negocio))
+    if opciones:
+        session['wa_opciones'] = opciones
+    return {"cuerpo": cuerpo}
+
+def _procesar_whatsapp_pendiente():
+    """
+    Procesa los mensajes pendientes de una conversación y le contesta, con esa
+    conversación tomada (database.conversacion_whatsapp_pendiente): ningún otro
+    hilo o worker la toca a la vez y las respuestas salen en orden, desde este
+    hilo. False si no había ninguna libre.
+    """
+    with database.conversacion_whatsapp_pendiente() as pendiente:
+        if pendiente is None:
+            return False
+        conversation_id, mensajes = pendiente
+        log_manager.nuevo_contexto(request_id=uuid.uuid4().hex[:16])
+        conversaciones = {conversation_id: [(pos, texto, slug) for pos, (texto, slug) in enumerate(mensajes)]}
+        respuestas = []
+        for resultado in _procesar_conversaciones(conversaciones, len(mensajes), _procesar_texto_whatsapp):
+            cuerpo = resultado.get("cuerpo") or ("Lo siento, ha habido un problema. Inténtalo de nuevo en un momento." if "error" in resultado else None)
+            if cuerpo:
+                respuestas.append(cuerpo)
+        if respuestas:
+            whatsapp_manager.enviar_respuestas({"telefono": conversation_id[3:], "mensajes": respuestas})
+        return True
 
 # =====================================================
 # Estáticos
 # =====================================================
 @app.route("/index.html")
 def servir_index():
-    return send_from_directory(os.getcwd(), "index.html")
+    return estaticos.enviar(os.getcwd(), "index.html")
+
+# =====================================================
+# Caché HTTP de las vistas de agenda
+# =====================================================
+def _huella_plantillas():
+    h = hashlib.sha1()
+    carpetas = (os.path.join(app.root_path, app.template_folder), os.path.join(app.static_folder, "js"))
+    for carpeta in carpetas:
+        for base, _, nombres in sorted(os.walk(carpeta)):
+            for nombre in sorted(nombres):
+                with open(os.path.join(base, nombre), "rb") as f:
+                    h.update(f.read())
+    return h.hexdigest()[:12]
+
+# Un despliegue con plantillas o scripts nuevos invalida los ETag anteriores: una
+# página en caché del navegador apunta a static_url() con la huella vieja
+_VERSION_PLANTILLAS = _huella_plantillas()
+
+def _etag_agenda(vista, negocio_id, desde, hasta=None, *extra):
+    """ETag a partir de la versión de (negocio, días); None si no se puede leer."""
+    try:
+        version = database.obtener_version_agenda(negocio_id, desde, hasta)
+    except Exception as e:
+        log.warning("Agenda sin versión, se sirve sin ETag: %s", e)
+        return None
+    g.version_agenda = version  # el panel se la pasa a su stream (eventos.stream)
+    partes = [vista, _VERSION_PLANTILLAS, str(negocio_id), desde.isoformat(), (hasta or desde).isoformat(), version]
+    partes.extend(str(x) for x in extra)
+    return hashlib.sha1("|".join(partes).encode()).hexdigest()[:20]
+
+def _no_modificado(etag):
+    # Con mensajes flash pendientes la página cambia aunque la agenda no
+    return bool(etag) and '_flashes' not in session and request.if_none_match.contains_weak(etag)
+
+def _con_etag(resp, etag):
+    if etag:
+        resp.set_etag(etag, weak=True)
+        resp.headers["Cache-Control"] = "private, no-cache"
+    return resp
+
+def _respuesta_304(etag):
+    return _con_etag(app.response_class(status=304), etag)
 
 # =====================================================
 # Admin básico
@@ -140,43 +512,120 @@ def admin_panel():
             database.crear_negocio_completo(datos_negocio)
             flash(f"¡Negocio '{datos_negocio['nombre']}' creado con éxito!", 'success')
         except Exception as e:
-            print(f"Error al crear negocio: {e}")
+            log.exception("Error al crear negocio: %s", e)
             flash(f"Error al crear el negocio: {e}", 'error')
         return redirect(url_for('admin_panel', password=password_ingresada))
     return render_template('admin.html', password=password_ingresada)
 
+# =====================================================
+# Listados de administración: páginas por clave con ?cursor= opaco
+# =====================================================
+LISTADO_PAGINA = int(getattr(config, "LISTADO_PAGINA", os.getenv("LISTADO_PAGINA", 50)))
+
+def _pagina_pedida():
+    """(cursor, limite) de la petición: cursor con los valores de la clave (lista) o None; ValueError si no es válido."""
+    limite = min(max(1, request.args.get('limite', LISTADO_PAGINA, type=int)), database.LISTADO_PAGINA_MAX)
+    cursor = request.args.get('cursor')
+    if not cursor:
+        return None, limite
+    try:
+        valores = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+    except (ValueError, TypeError) as e:
+        raise ValueError("cursor no válido") from e
+    if not isinstance(valores, list):
+        raise ValueError("cursor no válido")
+    return valores, limite
+
+def _cursor_siguiente(filas, limite, *claves):
+    """Cursor de la página que sigue a 'filas' (None si es la última)."""
+    if len(filas) < limite:
+        return None
+    valores = [filas[-1][k] for k in claves]
+    return base64.urlsafe_b64encode(json.dumps(valores, default=str).encode()).decode('ascii')
+
+def _pagina_negocios():
+    """(negocios, cursor siguiente) según ?filtro_nombre=, ?cursor= y ?limite=."""
+    despues, limite = _pagina_pedida()
+    if despues is not None:
+        if len(despues) != 2 or not isinstance(despues[0], str) or not isinstance(despues[1], int):
+            raise ValueError("cursor no válido")
+    negocios = database.listar_negocios(request.args.get('filtro_nombre', '').strip(), despues, limite)
+    return negocios, _cursor_siguiente(negocios, limite, 'nombre', 'id')
+
+def _pagina_citas(negocio_id):
+    """(citas, cursor siguiente) de un negocio según ?cursor= y ?limite=."""
+    despues, limite = _pagina_pedida()
+    if despues is not None:
+        try:
+            fecha, hora, cita_id = despues
+            despues = (date.fromisoformat(fecha), datetime.strptime(hora, "%H:%M:%S").time(), int(cita_id))
+        except (ValueError, TypeError) as e:
+            raise ValueError("cursor no válido") from e
+    citas = database.listar_citas(negocio_id, despues, limite)
+    return citas, _cursor_siguiente(citas, limite, 'fecha', 'hora', 'id')
+
 @app.route("/admin/negocios")
 def lista_negocios_ruta():
     password_ingresada = request.args.get('password')
     if password_ingresada != getattr(config, "ADMIN_PASSWORD", ""):
         return "Acceso denegado.", 403
-    filtro = request.args.get('filtro_nombre', '')
-    negocios_existentes = database.listar_negocios(filtro)
-    return render_template('lista_negocios.html', negocios=negocios_existentes, password=password_ingresada)
+    try:
+        negocios_existentes, siguiente = _pagina_negocios()
+    except ValueError as e:
+        return str(e), 400
+    # Los avisos se leen antes: la sesión ya no se guarda una vez empezado el streaming
+    return stream_template('lista_negocios.html', negocios=negocios_existentes, siguiente=siguiente,
+                           mensajes=get_flashed_messages(with_categories=True), password=password_ingresada)
+
+@app.route("/admin/api/negocios")
+def api_negocios():
+    if request.args.get('password') != getattr(config, "ADMIN_PASSWORD", ""):
+        return jsonify({"error": "Acceso denegado"}), 403
+    try:
+        negocios, siguiente = _pagina_negocios()
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    return jsonify({"negocios": [dict(n) for n in negocios], "siguiente": siguiente})
+
+@app.route("/admin/api/citas/<int:negocio_id>")
+def api_citas(negocio_id):
+    if request.args.get('password') != getattr(config, "ADMIN_PASSWORD", ""):
+        return jsonify({"error": "Acceso denegado"}), 403
+    try:
+        citas, siguiente = _pagina_citas(negocio_id)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    return jsonify({
+        "citas": [
+            {"id": c['id'], "fecha": c['fecha'].isoformat(), "hora": c['hora'].strftime('%H:%M'),
+             "nombre_cliente": c['nombre_cliente'], "telefono": c['telefono']}
+            for c in citas
+        ],
+        "siguiente": siguiente,
+    })
 
 @app.route("/debug-negocios")
 def debug_negocios():
     password_ingresada = request.args.get('password')
     if password_ingresada != getattr(config, "ADMIN_PASSWORD", ""):
         return "Acceso denegado.", 403
-    todos_los_negocios = database.listar_negocios()
-    html_respuesta = "<h1>Contenido Real de la Tabla 'negocios'</h1><table border='1'><tr><th>ID</th><th>Nombre</th><th>Slug</th></tr>"
-    for negocio in todos_los_negocios:
-        html_respuesta += f"<tr><td>{negocio['id']}</td><td>{negocio['nombre']}</td><td>{negocio['slug']}</td></tr>"
-    html_respuesta += "</table>"
-    return html_respuesta
+    try:
+        negocios, siguiente = _pagina_negocios()
+    except ValueError as e:
+        return str(e), 400
+    return stream_template('debug_negocios.html', negocios=negocios, siguiente=siguiente, password=password_ingresada)
 
 @app.route("/debug-citas/<int:negocio_id>")
 def debug_citas(negocio_id):
     password_ingresada = request.args.get('password')
     if password_ingresada != getattr(config, "ADMIN_PASSWORD", ""):
         return "Acceso denegado.", 403
-    todas_las_citas = database.obtener_todas_las_citas(negocio_id)
-    html_respuesta = f"<h1>Contenido Real de la Tabla 'citas' para Negocio ID: {negocio_id}</h1><table border='1'><tr><th>Fecha</th><th>Hora</th><th>Cliente</th><th>Teléfono</th></tr>"
-    for cita in todas_las_citas:
-        html_respuesta += f"<tr><td>{cita['fecha']}</td><td>{cita['hora']}</td><td>{cita['nombre_cliente']}</td><td>{cita['telefono']}</td></tr>"
-    html_respuesta += "</table>"
-    return html_respuesta
+    try:
+        citas, siguiente = _pagina_citas(negocio_id)
+    except ValueError as e:
+        return str(e), 400
+    return stream_template('debug_citas.html', negocio_id=negocio_id, citas=citas, siguiente=siguiente,
+                           password=password_ingresada)
 
 @app.route("/admin/borrar/<int:negocio_id>", methods=["POST"])
 def borrar_negocio_ruta(negocio_id):
@@ -187,7 +636,7 @@ def borrar_negocio_ruta(negocio_id):
         database.borrar_negocio(negocio_id)
         flash(f"Negocio ID {negocio_id} borrado con éxito.", 'success')
     except Exception as e:
-        print(f"Error al borrar negocio: {e}")
+        log.exception("Error al borrar negocio %s: %s", negocio_id, e)
         flash(f"Error al borrar negocio ID {negocio_id}: {e}", 'error')
     return redirect(url_for('lista_negocios_ruta', password=password_ingresada))
 
@@ -206,14 +655,14 @@ def editar_negocio_ruta(negocio_id):
                 'email': request.form.get('email'),
                 'servicios': [],
                 'empleados': [],
-                'horario_lunes': request.form.get('horario_lunes'),
-                'horario_martes': request.form.get('horario_martes'),
-                'horario_miercoles': request.form.get('horario_miercoles'),
-                'horario_jueves': request.form.get('horario_jueves'),
-                'horario_viernes': request.form.get('horario_viernes'),
-                'horario_sabado': request.form.get('horario_sabado'),
-                'horario_domingo': request.form.get('horario_domingo')
+                'horario': {
+                    i: horarios.parsear_tramos(request.form.get(f'horario_{dia}'))
+                    for i, dia in enumerate(horarios.DIAS_SEMANA)
+                },
+                'horizonte_reserva_dias': request.form.get('horizonte_reserva_dias', type=int),
+                'recursos': recursos.parsear_recursos(request.form.get('recursos')),
             }
+            nombres_recursos = {nombre for nombre, _ in datos_negocio['recursos']}
             i = 0
             while f'servicio_nombre_{i}' in request.form:
                 nombre = request.form[f'servicio_nombre_{i}']
@@ -221,23 +670,41 @@ def editar_negocio_ruta(negocio_id):
                 duracion = request.form[f'servicio_duracion_{i}']
                 if nombre and precio and duracion:
                     datos_negocio['servicios'].append({
-                        'nombre': nombre, 'precio': float(precio), 'duracion': int(duracion)
+                        'nombre': nombre, 'precio': float(precio), 'duracion': int(duracion),
+                        'recursos': recursos.parsear_necesidades(
+                            request.form.get(f'servicio_recursos_{i}'), nombres_recursos
+                        ),
                     })
                 i += 1
             i = 0
             while f'empleado_nombre_{i}' in request.form:
                 nombre = request.form[f'empleado_nombre_{i}']
                 if nombre:
-                    datos_negocio['empleados'].append({'nombre': nombre})
+                    datos_negocio['empleados'].append({
+                        'nombre': nombre,
+                        'horario': horarios.parsear_semana(request.form.get(f'empleado_horario_{i}')),
+                    })
                 i += 1
+            datos_negocio['excepciones'] = horarios.parsear_excepciones(
+                request.form.get('excepciones'), {e['nombre'] for e in datos_negocio['empleados']}
+            )
             database.modificar_negocio_completo(negocio_id, datos_negocio)
             flash(f"Negocio '{datos_negocio['nombre']}' actualizado con éxito.", 'success')
         except Exception as e:
-            print(f"Error al modificar negocio: {e}")
+            log.exception("Error al modificar negocio %s: %s", negocio_id, e)
             flash(f"Error al modificar negocio: {e}", 'error')
         return redirect(url_for('lista_negocios_ruta', password=password_ingresada))
     negocio_a_editar = database.obtener_negocio_por_id(negocio_id)
-    return render_template('editar_negocio.html', negocio=negocio_a_editar, password=password_ingresada)
+    if not negocio_a_editar:
+        return "Negocio no encontrado", 404
+    return render_template(
+        'editar_negocio.html',
+        negocio=negocio_a_editar,
+        horario=horarios.textos_formulario(negocio_id, negocio_a_editar['empleados']),
+        recursos=recursos.textos_formulario(negocio_id),
+        horizonte_defecto=disponibilidad.HORIZONTE_BUSQUEDA_DIAS,
+        password=password_ingresada
+    )
 
 # =====================================================
 # Export CSV
@@ -254,7 +721,7 @@ def exportar_citas_csv(negocio_id):
     citas = database.obtener_citas_para_exportar(negocio_id, inicio_mes, fin_mes)
     output = io.StringIO()
     writer = csv.writer(output, delimiter=';')
-    writer.writerow(['Fecha', 'Hora', 'Cliente', 'Telefono', 'Servicio', 'Profesional', 'Precio'])
+    writer.writerow(['Fecha', 'Hora', 'Cliente', 'Telefono', 'Servicio', 'Profesional', 'Precio', 'Duracion'])
     for cita in citas:
         hora_formateada = cita['hora'].strftime('%H:%M') if cita['hora'] else ''
         writer.writerow([
@@ -264,7 +731,8 @@ def exportar_citas_csv(negocio_id):
             cita['telefono'],
             cita['servicio_nombre'],
             cita['empleado_nombre'] or 'No asignado',
-            cita['precio']
+            cita['precio'],
+            cita['duracion_min'] or ''
         ])
     csv_final = output.getvalue().encode('utf-8-sig')
     return Response(
@@ -278,18 +746,28 @@ def exportar_citas_csv(negocio_id):
 # =====================================================
 @app.route("/cliente/panel/<int:negocio_id>")
 def panel_cliente(negocio_id):
-    negocio = database.obtener_negocio_por_id(negocio_id)
-    if not negocio:
-        return "Negocio no encontrado", 404
-    
     fecha_str = request.args.get('fecha', default=date.today().isoformat())
     try:
         fecha_obj = date.fromisoformat(fecha_str)
     except ValueError:
         fecha_obj = date.today()
 
-    horas_jornada = handlers._get_horas_jornada_para_dia(fecha_obj.weekday(), negocio_id=negocio_id)
+    # Petición condicional: si nada cambió ese día, 304 sin consultar la agenda
+    etag = _etag_agenda("panel", negocio_id, fecha_obj)
+    if _no_modificado(etag):
+        return _respuesta_304(etag)
+
+    negocio = database.obtener_negocio_por_id(negocio_id)
+    if not negocio:
+        return "Negocio no encontrado", 404
+
+    horas_jornada = handlers._get_horas_jornada(fecha_obj, negocio_id=negocio_id)
     citas_del_dia = database.obtener_citas_del_dia(negocio_id, fecha_obj)
+    horas_bloqueadas = {
+        b['hora'].strftime('%H:%M')
+        for b in database.obtener_horas_bloqueadas(negocio_id, fecha_obj)
+        if b['empleado_id'] is None
+    }
 
     grupos = {}
     for c in citas_del_dia:
@@ -306,17 +784,87 @@ def panel_cliente(negocio_id):
         lista = grupos.get(hora, [])
         if lista:
             agenda_completa.append({'hora': hora, 'status': 'ocupada', 'citas': lista})
+        elif hora in horas_bloqueadas:
+            agenda_completa.append({'hora': hora, 'status': 'bloqueada', 'citas': []})
         else:
             agenda_completa.append({'hora': hora, 'status': 'disponible', 'citas': []})
     
-    return render_template(
+    return _con_etag(make_response(render_template(
         'cliente_panel.html',
         negocio=negocio,
         agenda=agenda_completa,
         fecha_seleccionada=fecha_obj,
+        version_agenda=g.get("version_agenda"),
         ADMIN_PASSWORD=getattr(config, "ADMIN_PASSWORD", "")
+    )), etag)
+
+@app.route("/cliente/panel/<int:negocio_id>/stream")
+def panel_cliente_stream(negocio_id):
+    """
+    Server-Sent Events con las altas/bajas de citas y bloqueos del día mostrado.
+    Al reconectar, Last-Event-ID dice hasta qué versión llegó el panel.
+    """
+    fecha_str = request.args.get('fecha', default=date.today().isoformat())
+    try:
+        fecha_str = date.fromisoformat(fecha_str).isoformat()
+    except ValueError:
+        fecha_str = date.today().isoformat()
+    return Response(
+        eventos.stream(negocio_id, fecha_str, request.headers.get("Last-Event-ID") or request.args.get("version")),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
     )
 
+# =====================================================
+# Agenda semanal / mensual (una consulta por rango)
+# =====================================================
+def _parametros_agenda():
+    vista = request.args.get('vista', 'semana')
+    if vista not in ('semana', 'mes'):
+        vista = 'semana'
+    try:
+        fecha_obj = date.fromisoformat(request.args.get('fecha', ''))
+    except ValueError:
+        fecha_obj = date.today()
+    empleado_id = request.args.get('empleado_id', type=int)
+    return vista, fecha_obj, empleado_id
+
+def _datos_agenda(negocio_id, vista, fecha_obj, empleado_id):
+    desde, hasta, anterior, siguiente = disponibilidad.rango_vista(vista, fecha_obj)
+    datos = disponibilidad.agenda_rango(negocio_id, desde, hasta, empleado_id=empleado_id)
+    datos.update({
+        "vista": vista,
+        "fecha": fecha_obj.isoformat(),
+        "anterior": anterior.isoformat(),
+        "siguiente": siguiente.isoformat(),
+    })
+    return datos
+
+@app.route("/cliente/panel/<int:negocio_id>/agenda")
+def agenda_cliente(negocio_id):
+    vista, fecha_obj, empleado_id = _parametros_agenda()
+    desde, hasta, _, _ = disponibilidad.rango_vista(vista, fecha_obj)
+    etag = _etag_agenda("agenda", negocio_id, desde, hasta, vista, fecha_obj.isoformat(), empleado_id)
+    if _no_modificado(etag):
+        return _respuesta_304(etag)
+    negocio = database.obtener_negocio_por_id(negocio_id)
+    if not negocio:
+        return "Negocio no encontrado", 404
+    return _con_etag(make_response(render_template(
+        'agenda.html',
+        negocio=negocio,
+        agenda=_datos_agenda(negocio_id, vista, fecha_obj, empleado_id)
+    )), etag)
+
+@app.route("/cliente/panel/<int:negocio_id>/agenda.json")
+def agenda_cliente_json(negocio_id):
+    vista, fecha_obj, empleado_id = _parametros_agenda()
+    desde, hasta, _, _ = disponibilidad.rango_vista(vista, fecha_obj)
+    etag = _etag_agenda("agenda.json", negocio_id, desde, hasta, vista, fecha_obj.isoformat(), empleado_id)
+    if _no_modificado(etag):
+        return _respuesta_304(etag)
+    return _con_etag(jsonify(_datos_agenda(negocio_id, vista, fecha_obj, empleado_id)), etag)
+
 # =====================================================
 # Cancelación desde panel — notifica negocio + cliente
 # =====================================================
@@ -338,6 +886,8 @@ def cliente_cancelar_cita(cita_id, negocio_id):
                 "nombre": detalle_prev.get('nombre_cliente'),
                 "telefono": detalle_prev.get('telefono'),
                 "servicio": detalle_prev.get('servicio_nombre'),
+                "lineas": detalle_prev.get('lineas'),
+                "duracion": detalle_prev.get('duracion_min'),
                 "empleado_nombre": detalle_prev.get('empleado_nombre'),
                 "fecha": detalle_prev.get('fecha').strftime('%Y-%m-%d') if detalle_prev.get('fecha') else None,
                 "hora": detalle_prev.get('hora').strftime('%H:%M') if detalle_prev.get('hora') else None,
@@ -345,43 +895,60 @@ def cliente_cancelar_cita(cita_id, negocio_id):
                 "cita_id": detalle_prev.get('id'),
                 "negocio_id": negocio_id,
             }
-            email_manager.enviar_notificacion_cancelacion(datos_email)
+            notificaciones.enviar(email_manager.enviar_notificacion_cancelacion, datos_email)
             flash("La cita ha sido cancelada con éxito.", "success")
         else:
             flash("No se encontró la cita o ya había sido cancelada.", "error")
     except Exception as e:
-        print(f"Error al cancelar cita desde panel cliente: {e}")
+        log.exception("Error al cancelar cita %s desde panel cliente: %s", cita_id, e)
         flash("Hubo un error al intentar cancelar la cita.", "error")
     
     fecha_a_redirigir = request.form.get('fecha_actual', date.today().isoformat())
     return redirect(url_for('panel_cliente', negocio_id=negocio_id, fecha=fecha_a_redirigir))
 
+# =====================================================
+# Lista de espera — aceptar el hueco ofrecido
+# =====================================================
+@app.route("/espera/<token>", methods=["GET", "POST"])
+def aceptar_oferta_espera(token):
+    if request.method == "POST":
+        try:
+            oferta = lista_espera.aceptar(token)
+        except Exception as e:
+            log.exception("Error aceptando oferta de lista de espera: %s", e)
+            oferta = None
+        return render_template("lista_espera.html", oferta=oferta, reservada=bool(oferta))
+    return render_template("lista_espera.html", oferta=lista_espera.oferta(token), reservada=False)
+
 # =====================================================
 # Gestión de disponibilidad
 # =====================================================
 @app.route("/cliente/panel/<int:negocio_id>/disponibilidad", methods=['GET', 'POST'])
 def gestion_disponibilidad(negocio_id):
-    negocio = database.obtener_negocio_por_id(negocio_id)
-    if not negocio:
-        return "Negocio no encontrado", 404
-
     fecha_str = request.args.get('fecha', default=date.today().isoformat())
     try:
         fecha_obj = date.fromisoformat(fecha_str)
     except ValueError:
         fecha_obj = date.today()
 
+    etag = None
+    if request.method == 'GET':
+        etag = _etag_agenda("disponibilidad", negocio_id, fecha_obj)
+        if _no_modificado(etag):
+            return _respuesta_304(etag)
+
+    negocio = database.obtener_negocio_por_id(negocio_id)
+    if not negocio:
+        return "Negocio no encontrado", 404
+
     if request.method == 'POST':
         horas_bloqueadas_form = request.form.getlist('horas_bloqueadas')
-        horas_jornada = handlers._get_horas_jornada_para_dia(fecha_obj.weekday(), negocio_id=negocio_id)
-        for hora in horas_jornada:
-            database.eliminar_bloqueo(negocio_id, fecha_obj, hora)
-        for hora_str in horas_bloqueadas_form:
-            database.crear_bloqueo(negocio_id, fecha_obj, hora_str)
+        horas_jornada = handlers._get_horas_jornada(fecha_obj, negocio_id=negocio_id)
+        database.guardar_bloqueos_dia(negocio_id, fecha_obj, horas_jornada, horas_bloqueadas_form)
         flash('Disponibilidad actualizada correctamente.', 'success')
         return redirect(url_for('gestion_disponibilidad', negocio_id=negocio_id, fecha=fecha_obj.isoformat()))
 
-    horas_jornada = handlers._get_horas_jornada_para_dia(fecha_obj.weekday(), negocio_id=negocio_id)
+    horas_jornada = handlers._get_horas_jornada(fecha_obj, negocio_id=negocio_id)
     citas_del_dia = database.obtener_citas_del_dia(negocio_id, fecha_obj)
     bloqueos_del_dia = database.obtener_horas_bloqueadas(negocio_id, fecha_obj)
 
@@ -397,25 +964,80 @@ def gestion_disponibilidad(negocio_id):
             status = 'bloqueada'
         estado_horas.append({'hora': hora, 'status': status})
 
-    return render_template(
+    return _con_etag(make_response(render_template(
         'disponibilidad.html',
         negocio=negocio,
         fecha_seleccionada=fecha_obj,
         estado_horas=estado_horas
-    )
+    )), etag)
 
 # =====================================================
 # Recordatorios 2h antes (email + WhatsApp) — Scheduler
 # =====================================================
 REMINDERS_ENABLED = getattr(config, "REMINDERS_ENABLED", True)
 
-_scheduler_started = False
+_scheduler_pid = None  # proceso que ya lanzó su hilo (tras un fork hay que lanzarlo de nuevo)
+
+def _enviar_recordatorio(c):
+    datos = {
+        "negocio_id": c["negocio_id"],
+        "negocio_nombre": c["negocio_nombre"],
+        "negocio_slug": c.get("negocio_slug"),
+        "email_negocio": c.get("negocio_email"),
+        "email_cliente": c.get("cliente_email"),
+        "direccion": c.get("direccion"),
+        "cita_id": c["id"],
+        "nombre": c["nombre_cliente"],
+        "telefono": c["telefono"],
+        "servicio": c.get("servicio_nombre"),
+        "lineas": c.get("lineas"),
+        "duracion": c.get("duracion_min"),
+        "empleado_nombre": c.get("empleado_nombre") or "No asignado",
+        "fecha": c["fecha"].strftime("%Y-%m-%d"),
+        "hora": c["hora"].strftime("%H:%M"),
+    }
+    try:
+        email_manager.enviar_recordatorio_cita(datos)
+        log_scheduler.info("Email recordatorio enviado")
+    except Exception as e:
+        log_scheduler.error("Error email recordatorio: %s", e)
+    try:
+        whatsapp_manager.enviar_recordatorio_whatsapp(datos)
+        log_scheduler.info("WhatsApp recordatorio enviado")
+    except Exception as e:
+        # Silenciar si no está configurado Twilio
+        log_scheduler.warning("WhatsApp no enviado: %s", e)
+    try:
+        database.marcar_recordatorio_enviado(c["id"], "2h")
+        metrics.RECORDATORIOS_PENDIENTES.dec()
+    except Exception as e:
+        log_scheduler.error("Error marcando recordatorio: %s", e)
+
 def _scheduler_loop():
-    print("[Scheduler] Recordatorios 2h: iniciado.")
+    log_scheduler.info("Recordatorios 2h: iniciado.")
     try:
         database.ensure_tabla_recordatorios()
+        database.ensure_tabla_reservas_temporales()
+        database.ensure_tablas_lineas_cita()
+        database.ensure_tablas_recursos()
+        database.ensure_notificaciones_agenda()
+        database.ensure_particiones_citas(disponibilidad.HORIZONTE_BUSQUEDA_DIAS)
+        database.ensure_tabla_respuestas_idempotentes()
+        database.ensure_tabla_conversaciones()
+        database.ensure_tabla_whatsapp_entrantes()
+        database.ensure_tablas_horario()
+        database.ensure_indices_listados()
+        database.ensure_tabla_lista_espera()
+        database.ensure_telefonos_e164()
+        if limitador.RATE_LIMIT_BACKEND == "postgres":
+            database.ensure_tabla_limites_tasa()
     except Exception as e:
-        print(f"[Scheduler] Error creando tabla recordatorios: {e}")
+        log_scheduler.error("Error creando tablas del scheduler: %s", e)
+    # Huecos liberados -> lista de espera, por avisos de agenda (no en cada ciclo)
+    lista_espera.iniciar()
+    if whatsapp_manager.TW_TOK:
+        _iniciar_whatsapp()  # lo que quedó en la bandeja antes del reinicio
+    mantenimiento_citas = utils.now_spain().date()  # las particiones ya se han creado al arrancar
     while True:
         try:
             ahora = utils.now_spain() if hasattr(utils, "now_spain") else datetime.now()
@@ -426,54 +1048,77 @@ def _scheduler_loop():
             hasta = base + timedelta(minutes=5)
 
             citas = database.obtener_citas_para_recordatorio_2h(desde, hasta)
+            metrics.RECORDATORIOS_PENDIENTES.set(len(citas))
             if citas:
-                print(f"[Scheduler] Ventana {desde}..{hasta} -> {len(citas)} cita(s)")
+                log_scheduler.info("Ventana %s..%s -> %d cita(s)", desde, hasta, len(citas))
 
             for c in citas:
-                datos = {
-                    "negocio_id": c["negocio_id"],
-                    "negocio_nombre": c["negocio_nombre"],
-                    "negocio_slug": c.get("negocio_slug"),
-                    "email_negocio": c.get("negocio_email"),
-                    "email_cliente": c.get("cliente_email"),
-                    "direccion": c.get("direccion"),
-                    "cita_id": c["id"],
-                    "nombre": c["nombre_cliente"],
-                    "telefono": c["telefono"],
-                    "servicio": c.get("servicio_nombre"),
-                    "empleado_nombre": c.get("empleado_nombre") or "No asignado",
-                    "fecha": c["fecha"].strftime("%Y-%m-%d"),
-                    "hora": c["hora"].strftime("%H:%M"),
-                }
-                try:
-                    email_manager.enviar_recordatorio_cita(datos)
-                    print(f"[Scheduler] Email recordatorio enviado (cita {c['id']})")
-                except Exception as e:
-                    print(f"[Scheduler] Error email recordatorio {c['id']}: {e}")
-                try:
-                    import whatsapp_manager
-                    whatsapp_manager.enviar_recordatorio_whatsapp(datos)
-                    print(f"[Scheduler] WhatsApp recordatorio enviado (cita {c['id']})")
-                except Exception as e:
-                    # Silenciar si no está configurado Twilio
-                    print(f"[Scheduler] WhatsApp no enviado (cita {c['id']}): {e}")
-                try:
-                    database.marcar_recordatorio_enviado(c["id"], "2h")
-                except Exception as e:
-                    print(f"[Scheduler] Error marcando recordatorio {c['id']}: {e}")
+                with log_manager.contexto(negocio_id=c["negocio_id"], cita_id=c["id"]):
+                    _enviar_recordatorio(c)
+            # Retenciones de huecos caducadas: un único DELETE por ciclo
+            purgadas = database.purgar_reservas_temporales()
+            if purgadas:
+                log_scheduler.debug("Retenciones caducadas purgadas: %d", purgadas)
+            purgadas = database.purgar_respuestas_idempotentes()
+            if purgadas:
+                log_scheduler.debug("Respuestas idempotentes caducadas purgadas: %d", purgadas)
+            if limitador.RATE_LIMIT_BACKEND == "postgres":
+                database.purgar_limites_tasa()
+            database.purgar_conversaciones(CONVERSACIONES_RETENCION_DIAS)
+            if lista_espera.activa():
+                lista_espera.caducar_ofertas()
+                database.purgar_lista_espera()
+            # Una vez al día: particiones del mes que entra en el horizonte y archivo de las antiguas
+            if ahora.date() != mantenimiento_citas:
+                mantenimiento_citas = ahora.date()
+                database.ensure_particiones_citas(disponibilidad.HORIZONTE_BUSQUEDA_DIAS)
+                database.archivar_citas_antiguas(CITAS_MESES_ACTIVOS)
+            metrics.volcar_si_toca()
         except Exception as e:
-            print(f"[Scheduler] Error ciclo: {e}")
+            log_scheduler.exception("Error ciclo: %s", e)
         time.sleep(60)
 
 # Flask 3.x: no existe before_first_request. Arrancamos el scheduler la primera vez que llega cualquier request.
+# Así nunca arranca en el master de gunicorn --preload (no atiende peticiones),
+# sino en cada worker ya forkeado.
 @app.before_request
 def _start_scheduler_once():
-    global _scheduler_started
-    if REMINDERS_ENABLED and not _scheduler_started:
-        _scheduler_started = True
+    global _scheduler_pid
+    if REMINDERS_ENABLED and _scheduler_pid != os.getpid():
+        _scheduler_pid = os.getpid()
         t = threading.Thread(target=_scheduler_loop, daemon=True)
         t.start()
 
+# =====================================================
+# Métricas (Prometheus)
+# =====================================================
+@app.before_request
+def _metrics_inicio_peticion():
+    g._metrics_t0 = time.perf_counter()
+    log_manager.nuevo_contexto(
+        request_id=request.headers.get("X-Request-ID") or uuid.uuid4().hex[:16],
+        negocio_id=session.get('negocio_id'),
+    )
+
+@app.after_request
+def _metrics_fin_peticion(response):
+    t0 = getattr(g, "_metrics_t0", None)
+    if t0 is not None:
+        ruta = request.url_rule.rule if request.url_rule else "<sin_ruta>"
+        metrics.HTTP_LATENCIA.observar(time.perf_counter() - t0, ruta, request.method, str(response.status_code))
+    metrics.volcar_si_toca()
+    return response
+
+@app.errorhandler(database.PoolAgotado)
+def _pool_agotado(e):
+    # Pool sin conexiones: mejor un 503 rápido que hilos esperando en cola
+    log.warning("Petición descartada: %s", e)
+    return _demasiadas_peticiones(1, 503, "Servicio saturado, inténtalo de nuevo en un momento.")
+
+@app.route("/metrics")
+def metrics_endpoint():
+    return Response(metrics.exportar(), mimetype="text/plain; version=0.0.4")
+
 # =====================================================
 # Otros
 # =====================================================
@@ -481,5 +1126,20 @@ def _start_scheduler_once():
 def politica_privacidad():
     return render_template('politica_privacidad.html')
 
+# =====================================================
+# Presupuesto de arranque
+# =====================================================
+# Importar la app no debe abrir conexiones ni cargar dependencias opcionales
+# (twilio, Jinja de emails, psycopg2.extras): eso llega con el primer uso.
+# tests/test_arranque.py lo comprueba en un proceso aparte; aquí solo se avisa.
+ARRANQUE_PRESUPUESTO_MS = float(getattr(config, "ARRANQUE_PRESUPUESTO_MS", os.getenv("ARRANQUE_PRESUPUESTO_MS", 500)))
+
+_importacion_ms = (time.perf_counter() - _T0_IMPORTACION) * 1000
+metrics.ARRANQUE_IMPORTACION.set(_importacion_ms / 1000)
+if _importacion_ms > ARRANQUE_PRESUPUESTO_MS:
+    log.warning("Importar app llevó %.0f ms (presupuesto %.0f ms)", _importacion_ms, ARRANQUE_PRESUPUESTO_MS)
+else:
+    log.info("App importada en %.0f ms", _importacion_ms)
+
 if __name__ == "__main__":
     app.run(host="0.0.0.0", port=int(getattr(config, "FLASK_PORT", 5001)), debug=True)
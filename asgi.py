@@ -0,0 +1,173 @@
+# asgi.py
+"""
+Modo de servicio ASGI (opcional), para muchos paneles y chats abiertos por proceso:
+
+    uvicorn asgi:app --workers 2
+    gunicorn -k uvicorn.workers.UvicornWorker -w 2 asgi:app
+
+- Los streams SSE del panel (/cliente/panel/<id>/stream) se atienden en el
+  bucle de eventos: un panel abierto es una corrutina esperando en su cola,
+  no un hilo bloqueado, así que caben miles por proceso.
+- Todo lo demás (/mensaje, paneles, admin) es la app Flask de siempre, con los
+  mismos ESTADO_HANDLERS, sesión y pool de conexiones, ejecutada en un pool de
+  ASGI_HILOS hilos. Emails y WhatsApp ya salen en segundo plano
+  (notificaciones.py), así que ningún hilo se queda esperando a SMTP.
+
+El modo WSGI (gunicorn gthread, ver Procfile) sigue siendo el de por defecto.
+"""
+import io
+import os
+import re
+import sys
+import asyncio
+from contextlib import aclosing
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date
+from urllib.parse import parse_qs
+import config
+import eventos
+import log_manager
+from app import app as app_flask
+
+log = log_manager.get_logger("asgi")
+
+ASGI_HILOS = int(getattr(config, "ASGI_HILOS", os.getenv("ASGI_HILOS", 32)))
+
+_RUTA_STREAM = re.compile(r"^/cliente/panel/(\d+)/stream$")
+_CABECERAS_SSE = [
+    (b"content-type", b"text/event-stream; charset=utf-8"),
+    (b"cache-control", b"no-cache"),
+    (b"x-accel-buffering", b"no"),
+]
+
+_ejecutor = ThreadPoolExecutor(max_workers=ASGI_HILOS, thread_name_prefix="asgi-wsgi")
+
+# -------------------------
+# Puente hacia la app Flask (WSGI) en hilos
+# -------------------------
+
+def _environ(scope, cuerpo):
+    servidor = scope.get("server") or ("localhost", 80)
+    cliente = scope.get("client") or ("", 0)
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": scope.get("root_path", "").encode("utf-8").decode("latin1"),
+        "PATH_INFO": scope["path"].encode("utf-8").decode("latin1"),
+        "QUERY_STRING": scope["query_string"].decode("latin1"),
+        "SERVER_NAME": servidor[0],
+        "SERVER_PORT": str(servidor[1]),
+        "SERVER_PROTOCOL": f"HTTP/{scope.get('http_version', '1.1')}",
+        "REMOTE_ADDR": cliente[0],
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": io.BytesIO(cuerpo),
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": True,
+        "wsgi.run_once": False,
+    }
+    for nombre, valor in scope["headers"]:
+        nombre = nombre.decode("latin1")
+        valor = valor.decode("latin1")
+        if nombre == "content-type":
+            clave = "CONTENT_TYPE"
+        elif nombre == "content-length":
+            clave = "CONTENT_LENGTH"
+        else:
+            clave = "HTTP_" + nombre.upper().replace("-", "_")
+        if clave in environ:
+            valor = environ[clave] + ("; " if clave == "HTTP_COOKIE" else ",") + valor
+        environ[clave] = valor
+    return environ
+
+def _llamar_wsgi(environ):
+    """Ejecuta la app Flask y devuelve (status, cabeceras ASGI, cuerpo completo)."""
+    inicio = {}
+
+    def start_response(status, cabeceras, exc_info=None):
+        inicio["status"] = int(status.split(" ", 1)[0])
+        inicio["cabeceras"] = [(k.lower().encode("latin1"), v.encode("latin1")) for k, v in cabeceras]
+
+    resultado = app_flask(environ, start_response)
+    try:
+        cuerpo = b"".join(resultado)
+    finally:
+        if hasattr(resultado, "close"):
+            resultado.close()
+    return inicio["status"], inicio["cabeceras"], cuerpo
+
+async def _leer_cuerpo(receive):
+    trozos = []
+    while True:
+        mensaje = await receive()
+        if mensaje["type"] == "http.disconnect":
+            break
+        trozos.append(mensaje.get("body", b""))
+        if not mensaje.get("more_body"):
+            break
+    return b"".join(trozos)
+
+async def _http_wsgi(scope, receive, send):
+    environ = _environ(scope, await _leer_cuerpo(receive))
+    status, cabeceras, cuerpo = await asyncio.get_running_loop().run_in_executor(_ejecutor, _llamar_wsgi, environ)
+    await send({"type": "http.response.start", "status": status, "headers": cabeceras})
+    await send({"type": "http.response.body", "body": cuerpo})
+
+# -------------------------
+# Stream SSE nativo
+# -------------------------
+
+async def _stream_panel(negocio_id, scope, receive, send):
+    consulta = parse_qs(scope["query_string"].decode("latin1"))
+    fecha_str = consulta.get("fecha", [""])[0]
+    cabeceras = dict(scope["headers"])
+    version = (cabeceras.get(b"last-event-id", b"").decode("latin1")
+               or consulta.get("version", [None])[0])
+    try:
+        fecha_str = date.fromisoformat(fecha_str).isoformat()
+    except ValueError:
+        fecha_str = date.today().isoformat()
+
+    async def _esperar_desconexion():
+        while (await receive())["type"] != "http.disconnect":
+            pass
+
+    vigia = asyncio.ensure_future(_esperar_desconexion())
+    await send({"type": "http.response.start", "status": 200, "headers": _CABECERAS_SSE})
+    try:
+        async with aclosing(eventos.stream_async(negocio_id, fecha_str, version)) as trozos:
+            async for trozo in trozos:
+                # El ping periódico hace que un panel cerrado se detecte aquí
+                if vigia.done():
+                    return
+                await send({"type": "http.response.body", "body": trozo.encode("utf-8"), "more_body": True})
+        await send({"type": "http.response.body", "body": b""})
+    finally:
+        vigia.cancel()
+
+# -------------------------
+# Aplicación ASGI
+# -------------------------
+
+async def _lifespan(receive, send):
+    while True:
+        mensaje = await receive()
+        if mensaje["type"] == "lifespan.startup":
+            log.info("Modo ASGI: %d hilos para la app Flask", ASGI_HILOS)
+            await send({"type": "lifespan.startup.complete"})
+        elif mensaje["type"] == "lifespan.shutdown":
+            _ejecutor.shutdown(wait=True)
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+async def app(scope, receive, send):
+    if scope["type"] == "lifespan":
+        await _lifespan(receive, send)
+        return
+    if scope["type"] != "http":
+        return  # sin websockets
+    ruta = _RUTA_STREAM.match(scope["path"])
+    if ruta and scope["method"] == "GET":
+        await _stream_panel(int(ruta.group(1)), scope, receive, send)
+    else:
+        await _http_wsgi(scope, receive, send)
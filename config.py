@@ -1,13 +1,19 @@
 # config.py
 import os
-import dj_database_url
-from dotenv import load_dotenv
 
-load_dotenv()
+# Solo en local hay .env; en producción las variables ya vienen del entorno y
+# no merece la pena importar dotenv ni recorrer directorios buscándolo.
+_ENV_LOCAL = next((p for p in (os.path.join(os.getcwd(), ".env"),
+                               os.path.join(os.path.dirname(os.path.abspath(__file__)), ".env"))
+                   if os.path.isfile(p)), None)
+if _ENV_LOCAL:
+    from dotenv import load_dotenv
+    load_dotenv(_ENV_LOCAL)
 
 DATABASE_URL = os.getenv("DATABASE_URL")
 
 if DATABASE_URL:
+    import dj_database_url
     db_config = dj_database_url.config(default=DATABASE_URL)
     DB_USER = db_config.get('USER')
     DB_PASSWORD = db_config.get('PASSWORD')
@@ -1,314 +1,1921 @@
 # database.py
+import os
+import re
+import json
+import time
+import secrets
+import threading
+from contextlib import contextmanager
+from datetime import date, timedelta
 import psycopg2
-import psycopg2.extras
+import psycopg2.extensions
 import config
+import metrics
+import utils
+import log_manager
 
-def get_db_connection():
+log = log_manager.get_logger("database")
+
+# Minutos que una hora elegida en el chat queda retenida para ese usuario
+RESERVA_TEMPORAL_MINUTOS = int(getattr(config, "RESERVA_TEMPORAL_MINUTOS", 10))
+HUECO_MINUTOS = 5  # lo mínimo que ocupa una cita o un bloqueo en la agenda (ocupacion.MINUTOS_HUECO)
+
+# Pool por proceso: como mucho DB_POOL_MAX conexiones en uso a la vez. Quien no
+# consigue una en DB_POOL_TIMEOUT segundos recibe PoolAgotado (la app responde
+# 503) en lugar de quedarse esperando indefinidamente.
+DB_POOL_MAX = int(getattr(config, "DB_POOL_MAX", os.getenv("DB_POOL_MAX", 10)))
+DB_POOL_TIMEOUT = float(getattr(config, "DB_POOL_TIMEOUT", os.getenv("DB_POOL_TIMEOUT", 2)))
+DB_POOL_PING_SEGUNDOS = 30  # conexiones ociosas más tiempo se comprueban antes de reutilizarse
+
+class PoolAgotado(Exception):
+    """No quedó ninguna conexión libre en DB_POOL_TIMEOUT segundos."""
+
+class _ConexionPool(psycopg2.extensions.connection):
+    """Conexión cuyo close() la devuelve al pool (el código existente sigue igual)."""
+
+    def close(self):
+        _pool.devolver(self)
+
+    def cerrar(self):
+        super().close()
+
+class _Pool:
+    def __init__(self, maximo):
+        self._lock = threading.Lock()
+        self._plazas = threading.BoundedSemaphore(maximo)
+        self._libres = []  # pila (conexión, momento en que se devolvió): se reutiliza la más reciente
+
+    def obtener(self, timeout):
+        if not self._plazas.acquire(timeout=timeout):
+            metrics.DB_POOL_AGOTADO.inc()
+            raise PoolAgotado(f"Sin conexiones libres tras {timeout}s")
+        try:
+            conn = self._sacar_libre()
+            if conn is None:
+                conn = _conectar(_ConexionPool)
+            conn.prestada = True
+            metrics.DB_POOL_EN_USO.inc()
+            return conn
+        except Exception:
+            self._plazas.release()
+            raise
+
+    def _sacar_libre(self):
+        while True:
+            with self._lock:
+                if not self._libres:
+                    return None
+                conn, devuelta = self._libres.pop()
+            if conn.closed:
+                continue
+            if time.monotonic() - devuelta > DB_POOL_PING_SEGUNDOS:
+                try:
+                    with conn.cursor() as cur:
+                        cur.execute("SELECT 1;")
+                    conn.rollback()
+                except psycopg2.Error:
+                    conn.cerrar()
+                    continue
+            return conn
+
+    def devolver(self, conn):
+        if not getattr(conn, "prestada", False):
+            return  # close() repetido
+        conn.prestada = False
+        try:
+            if not conn.closed:
+                if conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+                with self._lock:
+                    self._libres.append((conn, time.monotonic()))
+        except psycopg2.Error:
+            conn.cerrar()
+        finally:
+            metrics.DB_POOL_EN_USO.dec()
+            self._plazas.release()
+
+def _conectar(factoria=None):
+    t0 = time.perf_counter()
     try:
         conn = psycopg2.connect(
             host=config.DB_HOST,
             database=config.DB_NAME,
             user=config.DB_USER,
             password=config.DB_PASSWORD,
-            port=config.DB_PORT
+            port=config.DB_PORT,
+            connection_factory=factoria
         )
+        metrics.DB_CONEXIONES.inc()
+        metrics.DB_CONEXION_LATENCIA.observar(time.perf_counter() - t0)
         return conn
     except psycopg2.OperationalError as e:
-        print(f"Error de conexión a la base de datos: {e}")
+        metrics.DB_CONEXION_ERRORES.inc()
+        log.error("Error de conexión a la base de datos: %s", e)
         raise
 
+_pool = _Pool(DB_POOL_MAX)
+_heredadas = []  # conexiones del proceso padre (ver _pool_tras_fork)
+
+def _pool_tras_fork():
+    """
+    Con gunicorn --preload los workers nacen de un fork del master: las
+    conexiones libres son sockets compartidos con él. Cerrarlas (o dejar que el
+    GC lo haga) mandaría el Terminate por el socket del padre, así que se
+    guardan sin tocar y el worker empieza con un pool vacío.
+    """
+    global _pool
+    _heredadas.extend(conn for conn, _ in _pool._libres)
+    _pool = _Pool(DB_POOL_MAX)
+
+os.register_at_fork(after_in_child=_pool_tras_fork)
+
+def _extras():
+    # psycopg2.extras solo hace falta al abrir el primer cursor, no al importar
+    import psycopg2.extras
+    return psycopg2.extras
+
+def get_db_connection():
+    """Conexión del pool; conn.close() la devuelve. Lanza PoolAgotado si no hay ninguna libre."""
+    return _pool.obtener(DB_POOL_TIMEOUT)
+
+def conexion_dedicada():
+    """Conexión fuera del pool, para usos de larga duración (p.ej. LISTEN)."""
+    return _conectar()
+
+# -------------------------
+# NEGOCIOS / SERVICIOS / EMPLEADOS
+# -------------------------
+
+def obtener_negocio_por_slug(slug):
+    conn = get_db_connection()
+    try:
+        with conn.cursor(cursor_factory=_extras().DictCursor) as cur:
+            cur.execute("SELECT * FROM negocios WHERE LOWER(slug) = %s;", (slug,))
+            negocio = cur.fetchone()
+            if negocio:
+                negocio_id = negocio['id']
+                cur.execute("SELECT nombre, precio FROM servicios WHERE negocio_id = %s;", (negocio_id,))
+                servicios = cur.fetchall()
+                cur.execute("SELECT id, nombre FROM empleados WHERE negocio_id = %s;", (negocio_id,))
+                empleados = cur.fetchall()
+                negocio = dict(negocio)
+                negocio['servicios'] = [dict(s) for s in servicios]
+                negocio['empleados'] = [dict(e) for e in empleados]
+            return negocio
+    finally:
+        conn.close()
+
+def obtener_negocio_por_id(negocio_id):
+    conn = get_db_connection()
+    try:
+        with conn.cursor(cursor_factory=_extras().DictCursor) as cur:
+            cur.execute("SELECT * FROM negocios WHERE id = %s;", (negocio_id,))
+            negocio = cur.fetchone()
+            if negocio:
+                cur.execute("SELECT nombre, precio, duracion FROM servicios WHERE negocio_id = %s;", (negocio_id,))
+                servicios = cur.fetchall()
+                cur.execute("SELECT id, nombre FROM empleados WHERE negocio_id = %s;", (negocio_id,))
+                empleados = cur.fetchall()
+                negocio = dict(negocio)
+                negocio['servicios'] = [dict(s) for s in servicios]
+                negocio['empleados'] = [dict(e) for e in empleados]
+            return negocio
+    finally:
+        conn.close()
+
+# Listados de administración: páginas por clave (sin OFFSET) de este tamaño como mucho
+LISTADO_PAGINA_MAX = 500
+
+def _limite_listado(limite):
+    return max(1, min(int(limite), LISTADO_PAGINA_MAX))
+
+def _patron_contiene(texto):
+    """Patrón ILIKE que busca 'texto' literal (sin comodines del usuario)."""
+    return "%" + re.sub(r"([\\%_])", r"\\\1", texto) + "%"
+
+def listar_negocios(filtro_nombre='', despues=None, limite=LISTADO_PAGINA_MAX):
+    """
+    Negocios por nombre (e id), como mucho 'limite', a continuación de
+    'despues' ((nombre, id) del último de la página anterior). filtro_nombre
+    busca un trozo del nombre sin distinguir mayúsculas (índice trigram, ver
+    ensure_indices_listados).
+    """
+    condiciones, params = [], []
+    if filtro_nombre:
+        condiciones.append("nombre ILIKE %s")
+        params.append(_patron_contiene(filtro_nombre))
+    if despues:
+        condiciones.append("(nombre, id) > (%s, %s)")
+        params.extend(despues)
+    where = f"WHERE {' AND '.join(condiciones)}" if condiciones else ""
+    conn = get_db_connection()
+    try:
+        with conn.cursor(cursor_factory=_extras().DictCursor) as cur:
+            cur.execute(
+                f"SELECT id, nombre, slug FROM negocios {where} ORDER BY nombre, id LIMIT %s;",
+                params + [_limite_listado(limite)]
+            )
+            return cur.fetchall()
+    finally:
+        conn.close()
+
+def crear_negocio_completo(datos):
+    conn = get_db_connection()
+    try:
+        with conn.cursor() as cur:
+            cur.execute(
+                "INSERT INTO negocios (nombre, slug, direccion, telefono, email) VALUES (%s, %s, %s, %s, %s) RETURNING id;",
+                (datos['nombre'], datos['slug'], datos.get('direccion'), datos.get('telefono'), datos.get('email'))
+            )
+            negocio_id = cur.fetchone()[0]
+            for servicio in datos['servicios']:
+                cur.execute(
+                    "INSERT INTO servicios (negocio_id, nombre, precio, duracion) VALUES (%s, %s, %s, %s);",
+                    (negocio_id, servicio['nombre'], servicio['precio'], servicio['duracion'])
+                )
+            for empleado in datos['empleados']:
+                cur.execute(
+                    "INSERT INTO empleados (negocio_id, nombre) VALUES (%s, %s);",
+                    (negocio_id, empleado['nombre'])
+                )
+            conn.commit()
+    finally:
+        conn.close()
+
+def borrar_negocio(negocio_id):
+    conn = get_db_connection()
+    try:
+        with conn.cursor() as cur:
+            cur.execute(_SQL_BORRAR_CITAS.format("negocio_id = %s"), (negocio_id,))
+            cur.execute("DELETE FROM servicios WHERE negocio_id = %s;", (negocio_id,))
+            cur.execute("DELETE FROM empleados WHERE negocio_id = %s;", (negocio_id,))
+            cur.execute("DELETE FROM negocios WHERE id = %s;", (negocio_id,))
+            _incrementar_version_config(cur, negocio_id)
+            conn.commit()
+    finally:
+        conn.close()
+
+def modificar_negocio_completo(negocio_id, datos):
+    conn = get_db_connection()
+    try:
+        with conn.cursor() as cur:
+            # El horario pasa a horario_reglas: las columnas antiguas se vacían
+            cur.execute(
+                """UPDATE negocios SET 
+                   nombre = %s, slug = %s, direccion = %s, telefono = %s, email = %s,
+                   horizonte_reserva_dias = %s,
+                   horario_lunes = NULL, horario_martes = NULL, horario_miercoles = NULL,
+                   horario_jueves = NULL, horario_viernes = NULL, horario_sabado = NULL, horario_domingo = NULL
+                   WHERE id = %s;""",
+                (datos['nombre'], datos['slug'], datos.get('direccion'), datos.get('telefono'), datos.get('email'),
+                 datos.get('horizonte_reserva_dias'), negocio_id)
+            )
+            # Reset de datos dependientes
+            cur.execute(_SQL_BORRAR_CITAS.format("negocio_id = %s"), (negocio_id,))
+            cur.execute("DELETE FROM servicios WHERE negocio_id = %s;", (negocio_id,))
+            cur.execute("DELETE FROM recursos WHERE negocio_id = %s;", (negocio_id,))
+            ids_recursos = {}
+            for nombre, capacidad in datos.get('recursos', []):
+                cur.execute(
+                    "INSERT INTO recursos (negocio_id, nombre, capacidad) VALUES (%s, %s, %s) RETURNING id;",
+                    (negocio_id, nombre, capacidad)
+                )
+                ids_recursos[nombre] = cur.fetchone()[0]
+            for servicio in datos['servicios']:
+                cur.execute(
+                    "INSERT INTO servicios (negocio_id, nombre, precio, duracion) VALUES (%s, %s, %s, %s) RETURNING id;",
+                    (negocio_id, servicio['nombre'], servicio['precio'], servicio['duracion'])
+                )
+                servicio_id = cur.fetchone()[0]
+                for nombre, cantidad in servicio.get('recursos', []):
+                    cur.execute(
+                        "INSERT INTO servicio_recursos (servicio_id, recurso_id, cantidad) VALUES (%s, %s, %s);",
+                        (servicio_id, ids_recursos[nombre], cantidad)
+                    )
+            cur.execute("DELETE FROM horario_reglas WHERE negocio_id = %s;", (negocio_id,))
+            cur.execute("DELETE FROM horario_excepciones WHERE negocio_id = %s;", (negocio_id,))
+            cur.execute("DELETE FROM empleados WHERE negocio_id = %s;", (negocio_id,))
+            ids_empleados = {}
+            for empleado in datos['empleados']:
+                cur.execute(
+                    "INSERT INTO empleados (negocio_id, nombre) VALUES (%s, %s) RETURNING id;",
+                    (negocio_id, empleado['nombre'])
+                )
+                ids_empleados[empleado['nombre']] = cur.fetchone()[0]
+                _insertar_reglas_horario(cur, negocio_id, empleado.get('horario', {}), ids_empleados[empleado['nombre']])
+            _insertar_reglas_horario(cur, negocio_id, datos.get('horario', {}))
+            for fecha, nombre_empleado, tramos in datos.get('excepciones', []):
+                empleado_id = ids_empleados[nombre_empleado] if nombre_empleado else None
+                for inicio, fin, paso in tramos or [(None, None, 60)]:
+                    cur.execute(
+                        """INSERT INTO horario_excepciones (negocio_id, empleado_id, fecha, inicio_min, fin_min, paso_min)
+                           VALUES (%s, %s, %s, %s, %s, %s);""",
+                        (negocio_id, empleado_id, fecha, inicio, fin, paso)
+                    )
+            _incrementar_version_config(cur, negocio_id)
+            conn.commit()
+    finally:
+        conn.close()
+
+# -------------------------
+# CLIENTES (NUEVO)
+# -------------------------
+
+# Teléfono ya en E.164 (así se guardan; ver utils.telefono_e164)
+_SQL_E164 = r"^\+[1-9][0-9]{7,14}$"
+# Prefijo del país repetido ("+3434600112233"): lo guardaban versiones anteriores de utils.telefono_e164
+_SQL_PREFIJO_DOBLE = (r"^\+" + re.sub(r"\D+", "", utils.DEFAULT_COUNTRY_CODE) * 2
+                      + "[0-9]{%d}$" % utils.TELEFONO_NACIONAL_DIGITOS)
+
+def _telefono(telefono):
+    """Teléfono tal como se guarda y se busca: en E.164 si se puede, si no tal cual."""
+    return utils.telefono_e164(telefono) or (telefono or "").strip()
+
+def ensure_telefonos_e164():
+    """
+    Índice (negocio, teléfono, fecha) de citas para reconocer al cliente sin
+    leer la tabla, y migración de los teléfonos guardados tal como se
+    tecleaban ("600 11 22 33") o con el prefijo repetido ("+3434600112233")
+    a E.164 en citas, clientes y lista_espera.
+    Solo se normalizan los valores distintos que aún no lo están; en clientes,
+    si dos filas pasan a ser el mismo teléfono, se queda la que ya estaba en
+    E.164 (o la más reciente).
+    """
+    conn = get_db_connection()
+    try:
+        with conn.cursor() as cur:
+            cur.execute("CREATE INDEX IF NOT EXISTS idx_citas_negocio_telefono ON citas (negocio_id, telefono, fecha);")
+            conn.commit()
+            cur.execute(
+                """SELECT telefono FROM citas WHERE telefono !~ %s OR telefono ~ %s
+                   UNION SELECT telefono FROM clientes WHERE telefono !~ %s OR telefono ~ %s
+                   UNION SELECT telefono FROM lista_espera WHERE telefono !~ %s OR telefono ~ %s;""",
+                (_SQL_E164, _SQL_PREFIJO_DOBLE) * 3
+            )
+            cambios = [(viejo, nuevo) for (viejo,) in cur.fetchall()
+                       if (nuevo := utils.telefono_e164(viejo)) and nuevo != viejo]
+            if not cambios:
+                conn.rollback()
+                return 0
+            cur.execute("CREATE TEMP TABLE telefonos_e164 (viejo TEXT PRIMARY KEY, nuevo TEXT NOT NULL) ON COMMIT DROP;")
+            _extras().execute_values(cur, "INSERT INTO telefonos_e164 (viejo, nuevo) VALUES %s", cambios)
+            # El teléfono no cambia la agenda: sin avisos de baja/alta por cada cita migrada
+            cur.execute("ALTER TABLE citas DISABLE TRIGGER trg_citas_notificar;")
+            cur.execute("UPDATE citas c SET telefono = t.nuevo FROM telefonos_e164 t WHERE c.telefono = t.viejo;")
+            cur.execute("ALTER TABLE citas ENABLE TRIGGER trg_citas_notificar;")
+            cur.execute("UPDATE lista_espera l SET telefono = t.nuevo FROM telefonos_e164 t WHERE l.telefono = t.viejo;")
+            cur.execute(
+                """DELETE FROM clientes WHERE id IN (
+                       SELECT id FROM (
+                           SELECT c.id, ROW_NUMBER() OVER (
+                                      PARTITION BY c.negocio_id, COALESCE(t.nuevo, c.telefono)
+                                      ORDER BY t.viejo IS NULL DESC, c.id DESC) AS n
+                           FROM clientes c LEFT JOIN telefonos_e164 t ON t.viejo = c.telefono
+                       ) duplicados WHERE n > 1
+                   );"""
+            )
+            cur.execute("UPDATE clientes c SET telefono = t.nuevo FROM telefonos_e164 t WHERE c.telefono = t.viejo;")
+            conn.commit()
+            log.info("Teléfonos migrados a E.164: %d", len(cambios))
+            return len(cambios)
+    finally:
+        conn.close()
+
+def upsert_cliente(negocio_id, telefono, email, nombre=None):
+    """
+    Crea o actualiza un cliente (por negocio + teléfono).
+    Requiere email (la columna es NOT NULL).
+    """
+    if not (negocio_id and telefono and email):
+        return
+    conn = get_db_connection()
+    try:
+        with conn.cursor() as cur:
+            _upsert_cliente(cur, negocio_id, telefono, email, nombre)
+            conn.commit()
+    finally:
+        conn.close()
+
+def _upsert_cliente(cur, negocio_id, telefono, email, nombre=None):
+    """upsert_cliente dentro de la transacción de 'cur' (p.ej. la de guardar_reserva)."""
+    cur.execute(
+        """
+        INSERT INTO clientes (negocio_id, telefono, email, nombre)
+        VALUES (%s, %s, %s, %s)
+        ON CONFLICT (negocio_id, telefono)
+        DO UPDATE SET
+            email = EXCLUDED.email,
+            nombre = COALESCE(EXCLUDED.nombre, clientes.nombre),
+            updated_at = NOW();
+        """,
+        (negocio_id, _telefono(telefono), email, nombre)
+    )
+
+def obtener_email_cliente(telefono, negocio_id):
+    """
+    Devuelve el email guardado para un teléfono en un negocio, o None.
+    """
+    conn = get_db_connection()
+    try:
+        with conn.cursor() as cur:
+            cur.execute(
+                "SELECT email FROM clientes WHERE negocio_id = %s AND telefono = %s LIMIT 1;",
+                (negocio_id, _telefono(telefono))
+            )
+            row = cur.fetchone()
+            return row[0] if row else None
+    finally:
+        conn.close()
+
+# -------------------------
+# CITAS / DISPONIBILIDAD
+# -------------------------
+
+def tiene_cita_futura(telefono, negocio_id):
+    conn = get_db_connection()
+    try:
+        with conn.cursor() as cur:
+            cur.execute(
+                "SELECT 1 FROM citas WHERE telefono = %s AND negocio_id = %s AND fecha >= NOW()::date;",
+                (_telefono(telefono), negocio_id)
+            )
+            return cur.fetchone() is not None
+    finally:
+        conn.close()
+
+def obtener_citas_pasadas(telefono, negocio_id):
+    conn = get_db_connection()
+    try:
+        with conn.cursor(cursor_factory=_extras().DictCursor) as cur:
+            cur.execute(
+                f"""SELECT c.*, {_SQL_SERVICIOS_CITA} AS servicio_nombre 
+                   FROM citas c JOIN servicios s ON c.servicio_id = s.id
+                   WHERE c.telefono = %s AND c.negocio_id = %s AND c.fecha < NOW()::date 
+                   ORDER BY c.fecha DESC LIMIT 1;""",
+                (_telefono(telefono), negocio_id)
+            )
+            return cur.fetchall()
+    finally:
+        conn.close()
+
+def listar_servicios(negocio_id):
+    conn = get_db_connection()
+    try:
+        with conn.cursor(cursor_factory=_extras().DictCursor) as cur:
+            cur.execute("SELECT id, nombre, precio, duracion FROM servicios WHERE negocio_id = %s;", (negocio_id,))
+            return cur.fetchall()
+    finally:
+        conn.close()
+
+def listar_empleados(negocio_id):
+    conn = get_db_connection()
+    try:
+        with conn.cursor(cursor_factory=_extras().DictCursor) as cur:
+            cur.execute("SELECT id, nombre FROM empleados WHERE negocio_id = %s;", (negocio_id,))
+            return cur.fetchall()
+    finally:
+        conn.close()
+
+def obtener_horario_negocio(negocio_id):
+    conn = get_db_connection()
+    try:
+        with conn.cursor(cursor_factory=_extras().DictCursor) as cur:
+            cur.execute(
+                """SELECT horario_lunes, horario_martes, horario_miercoles, horario_jueves, horario_viernes,
+                          horario_sabado, horario_domingo, horizonte_reserva_dias
+                   FROM negocios WHERE id = %s;""",
+                (negocio_id,)
+            )
+            return cur.fetchone()
+    finally:
+        conn.close()
+
+def _insertar_reglas_horario(cur, negocio_id, semana, empleado_id=None):
+    """semana: {dia_semana: [(inicio_min, fin_min, paso_min)]} (ver horarios.parsear_semana)."""
+    for dia, tramos in semana.items():
+        for inicio, fin, paso in tramos:
+            cur.execute(
+                """INSERT INTO horario_reglas (negocio_id, empleado_id, dia_semana, inicio_min, fin_min, paso_min)
+                   VALUES (%s, %s, %s, %s, %s, %s);""",
+                (negocio_id, empleado_id, dia, inicio, fin, paso)
+            )
+
+def obtener_reglas_horario(negocio_id):
+    """(reglas, excepciones) del horario estructurado del negocio (lo que compila horarios.py)."""
+    conn = get_db_connection()
+    try:
+        with conn.cursor(cursor_factory=_extras().DictCursor) as cur:
+            cur.execute(
+                """SELECT dia_semana, empleado_id, inicio_min, fin_min, paso_min
+                   FROM horario_reglas WHERE negocio_id = %s;""",
+                (negocio_id,)
+            )
+            reglas = cur.fetchall()
+            cur.execute(
+                """SELECT fecha, empleado_id, inicio_min, fin_min, paso_min
+                   FROM horario_excepciones WHERE negocio_id = %s;""",
+                (negocio_id,)
+            )
+            return reglas, cur.fetchall()
+    finally:
+        conn.close()
+
+def obtener_ocupacion_fija_rango(negocio_id, fecha_desde, fecha_hasta):
+    """
+    Citas y bloqueos de [fecha_desde, fecha_hasta] en una sola consulta (lo que
+    indexa ocupacion.py). Filas: fecha, hora ('HH:MM'), empleado_id, origen
+    ('cita' | 'bloqueo' | 'version'), duracion_min (NULL: un solo hueco),
+    recursos ({recurso_id: cantidad} o NULL), version. Las filas 'version'
+    traen la de agenda_versiones de cada día con cambios, leída en la misma
+    instantánea que las citas: los avisos con versión menor o igual ya están
+    incluidos.
+    """
+    conn = get_db_connection()
+    try:
+        with conn.cursor(cursor_factory=_extras().DictCursor) as cur:
+            cur.execute(
+                """
+                SELECT fecha, TO_CHAR(hora, 'HH24:MI') AS hora, empleado_id, 'cita' AS origen, duracion_min, recursos,
+                       NULL::bigint AS version
+                FROM citas WHERE negocio_id = %s AND fecha BETWEEN %s AND %s
+                UNION ALL
+                SELECT fecha, TO_CHAR(hora, 'HH24:MI'), empleado_id, 'bloqueo', NULL, NULL, NULL
+                FROM bloqueos WHERE negocio_id = %s AND fecha BETWEEN %s AND %s
+                UNION ALL
+                SELECT fecha, NULL, NULL, 'version', NULL, NULL, version
+                FROM agenda_versiones WHERE negocio_id = %s AND fecha BETWEEN %s AND %s;
+                """,
+                (negocio_id, fecha_desde, fecha_hasta,
+                 negocio_id, fecha_desde, fecha_hasta,
+                 negocio_id, fecha_desde, fecha_hasta)
+            )
+            return cur.fetchall()
+    finally:
+        conn.close()
+
+def obtener_retenciones_rango(negocio_id, fecha_desde, fecha_hasta, titular=None):
+    """
+    Retenciones vigentes de otros titulares en [fecha_desde, fecha_hasta] (las
+    del propio 'titular' no cuentan). Filas: fecha, hora ('HH:MM'), empleado_id,
+    duracion_min, recursos.
+    """
+    conn = get_db_connection()
+    try:
+        with conn.cursor(cursor_factory=_extras().DictCursor) as cur:
+            cur.execute(
+                """
+                SELECT fecha, TO_CHAR(hora, 'HH24:MI') AS hora, empleado_id, duracion_min, recursos
+                FROM reservas_temporales
+                WHERE negocio_id = %s AND fecha BETWEEN %s AND %s
+                  AND expira_at > NOW() AND titular IS DISTINCT FROM %s;
+                """,
+                (negocio_id, fecha_desde, fecha_hasta, titular)
+            )
+            return cur.fetchall()
+    finally:
+        conn.close()
+
+def guardar_reserva(datos, negocio_id):
+    """
+    Inserta la cita con sus líneas de servicio y, si viene 'email' en datos,
+    realiza upsert en clientes.
+    datos = {
+        'nombre', 'telefono', 'servicio', 'fecha', 'hora', 'empleado_id',  # (oblig/opt)
+        'servicios' (opcional, nombres en orden; si no, solo 'servicio'),
+        'email' (opcional, para persistir cliente),
+        'titular' (opcional, retención creada con retener_hueco)
+    }
+    La cita dura la suma de sus servicios y ocupa los recursos que piden. Si
+    el titular conserva la retención (de esa misma duración y recursos), la
+    cita se crea consumiéndola sin más comprobaciones. Si no (caducó o no
+    hubo), se comprueba que nada se solape con ese tramo y que los recursos
+    caben.
+    Devuelve el id de la cita, o None si el tramo ya no está libre.
+    """
+    conn = get_db_connection()
+    try:
+        with conn.cursor() as cur:
+            lineas = _lineas_servicio(cur, negocio_id, datos.get('servicios') or [datos['servicio']])
+            duracion = _duracion_lineas(lineas)
+            recursos = _recursos_lineas(cur, lineas)
+            empleado_id = datos.get('empleado_id')
+            retenida = False
+            if datos.get('titular'):
+                cur.execute(
+                    """DELETE FROM reservas_temporales
+                       WHERE titular = %s AND negocio_id = %s AND fecha = %s AND hora = %s
+                       RETURNING expira_at > NOW() AND duracion_min IS NOT DISTINCT FROM %s
+                                 AND recursos IS NOT DISTINCT FROM %s::jsonb;""",
+                    (datos['titular'], negocio_id, datos['fecha'], datos['hora'], duracion, _json_recursos(recursos))
+                )
+                retenida = any(fila[0] for fila in cur.fetchall())
+            # Las líneas van antes que la cita para que el aviso
+            # de agenda que dispara el INSERT ya lleve todos los servicios
+            cur.execute("SELECT nextval(pg_get_serial_sequence('citas', 'id'));")
+            cita_id = cur.fetchone()[0]
+            _insertar_lineas_cita(cur, cita_id, lineas)
+            if retenida:
+                cur.execute(
+                    """INSERT INTO citas (id, negocio_id, nombre_cliente, telefono, servicio_id, fecha, hora, empleado_id,
+                                          duracion_min, recursos)
+                       VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s) RETURNING id;""",
+                    (cita_id, negocio_id, datos['nombre'], _telefono(datos['telefono']), lineas[0][0],
+                     datos['fecha'], datos['hora'], empleado_id, duracion, _json_recursos(recursos))
+                )
+            else:
+                _bloquear_dia(cur, negocio_id, datos['fecha'])
+                cur.execute(
+                    """INSERT INTO citas (id, negocio_id, nombre_cliente, telefono, servicio_id, fecha, hora, empleado_id,
+                                          duracion_min, recursos)
+                       SELECT %s, %s, %s, %s, %s, %s, %s, %s, %s, %s
+                       WHERE """ + _SQL_HUECO_LIBRE + " RETURNING id;",
+                    (cita_id, negocio_id, datos['nombre'], _telefono(datos['telefono']), lineas[0][0],
+                     datos['fecha'], datos['hora'], empleado_id, duracion, _json_recursos(recursos),
+                     *_params_hueco_libre(negocio_id, datos['fecha'], datos['hora'], empleado_id,
+                                          datos.get('titular'), duracion, recursos))
+                )
+            row = cur.fetchone()
+            if not row:
+                conn.rollback()
+                return None
+            # --- NUEVO: persistir cliente si se pasó email (misma transacción que la cita) ---
+            email = datos.get('email')
+            if email and datos['telefono']:
+                _upsert_cliente(cur, negocio_id, datos['telefono'], email, datos.get('nombre'))
+            conn.commit()
+            return row[0]
+    finally:
+        conn.close()
+
+# -------------------------
+# LÍNEAS DE SERVICIO DE UNA CITA
+# -------------------------
+
+# Servicios de la cita "A + B" (citas antiguas sin líneas: su servicio_id); requiere alias c y s
+_SQL_SERVICIOS_CITA = """COALESCE((SELECT string_agg(cs.nombre, ' + ' ORDER BY cs.orden)
+                                   FROM cita_servicios cs WHERE cs.cita_id = c.id), s.nombre)"""
+# Precio total de la cita, con el mismo criterio
+_SQL_PRECIO_CITA = """COALESCE((SELECT SUM(cs.precio) FROM cita_servicios cs WHERE cs.cita_id = c.id), s.precio)"""
+# Líneas de la cita como lista JSON de {nombre, precio, duracion} (NULL en citas antiguas)
+_SQL_LINEAS_JSON = """(SELECT json_agg(json_build_object('nombre', cs.nombre, 'precio', cs.precio,
+                                                        'duracion', cs.duracion) ORDER BY cs.orden)
+                       FROM cita_servicios cs WHERE cs.cita_id = c.id)"""
+
+def _lineas_servicio(cur, negocio_id, nombres):
+    """[(servicio_id, nombre, precio, duracion)] de esos servicios del negocio, en el orden dado."""
+    cur.execute(
+        "SELECT id, nombre, precio, duracion FROM servicios WHERE negocio_id = %s AND nombre = ANY(%s);",
+        (negocio_id, list(nombres))
+    )
+    por_nombre = {fila[1]: tuple(fila) for fila in cur.fetchall()}
+    return [por_nombre[nombre] for nombre in nombres]
+
+def _duracion_lineas(lineas):
+    """Minutos de la cita (suma de sus servicios); None si ninguno tiene duración."""
+    return sum(duracion or 0 for _, _, _, duracion in lineas) or None
+
+def _insertar_lineas_cita(cur, cita_id, lineas):
+    for orden, (servicio_id, nombre, precio, duracion) in enumerate(lineas):
+        cur.execute(
+            """INSERT INTO cita_servicios (cita_id, orden, servicio_id, nombre, precio, duracion)
+               VALUES (%s, %s, %s, %s, %s, %s);""",
+            (cita_id, orden, servicio_id, nombre, precio, duracion)
+        )
+
+def obtener_lineas_cita(cita_id):
+    """Servicios de la cita en orden: dicts nombre, precio, duracion."""
+    conn = get_db_connection()
+    try:
+        with conn.cursor(cursor_factory=_extras().DictCursor) as cur:
+            cur.execute(
+                "SELECT nombre, precio, duracion FROM cita_servicios WHERE cita_id = %s ORDER BY orden;",
+                (cita_id,)
+            )
+            return [dict(fila) for fila in cur.fetchall()]
+    finally:
+        conn.close()
+
+# Borra citas y lo que cuelga de ellas (sin clave foránea: citas está particionada)
+_SQL_BORRAR_CITAS = """
+    WITH borradas AS (DELETE FROM citas WHERE {} RETURNING id),
+         lineas AS (DELETE FROM cita_servicios WHERE cita_id IN (SELECT id FROM borradas))
+    DELETE FROM recordatorios_enviados WHERE cita_id IN (SELECT id FROM borradas);
+"""
+
+# También lo ejecuta ensure_notificaciones_agenda: el trigger de agenda lee cita_servicios
+_SQL_LINEAS_CITA = """
+    ALTER TABLE citas ADD COLUMN IF NOT EXISTS duracion_min SMALLINT
+        CHECK (duracion_min > 0);   -- NULL: citas antiguas, un solo hueco
+    ALTER TABLE IF EXISTS reservas_temporales ADD COLUMN IF NOT EXISTS duracion_min SMALLINT
+        CHECK (duracion_min > 0);
+
+    CREATE TABLE IF NOT EXISTS cita_servicios (
+        cita_id INTEGER NOT NULL,   -- citas(id); citas está particionada (ver _SQL_BORRAR_CITAS)
+        orden SMALLINT NOT NULL,
+        servicio_id INTEGER REFERENCES servicios(id) ON DELETE SET NULL,
+        nombre TEXT NOT NULL,
+        precio NUMERIC(10,2),
+        duracion INTEGER,
+        PRIMARY KEY (cita_id, orden)
+    );
+"""
+
+def ensure_tablas_lineas_cita():
+    """
+    Citas con varios servicios: duración de la cita (y de las retenciones) y
+    una línea por servicio con nombre y precio del momento de la reserva.
+    """
+    conn = get_db_connection()
+    try:
+        with conn.cursor() as cur:
+            cur.execute(_SQL_LINEAS_CITA)
+            conn.commit()
+    finally:
+        conn.close()
+
+# -------------------------
+# RECURSOS (sillas, cabinas, máquinas) Y SU CAPACIDAD
+# -------------------------
+
+def ensure_tablas_recursos():
+    """
+    Recursos con capacidad por negocio, unidades que pide cada servicio y las
+    que ocupa cada cita o retención ({recurso_id: cantidad}, ver recursos.py).
+    """
+    conn = get_db_connection()
+    try:
+        with conn.cursor() as cur:
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS recursos (
+                    id SERIAL PRIMARY KEY,
+                    negocio_id INTEGER NOT NULL REFERENCES negocios(id) ON DELETE CASCADE,
+                    nombre TEXT NOT NULL,
+                    capacidad INTEGER NOT NULL DEFAULT 1 CHECK (capacidad > 0),
+                    UNIQUE (negocio_id, nombre)
+                );
+                CREATE TABLE IF NOT EXISTS servicio_recursos (
+                    servicio_id INTEGER NOT NULL REFERENCES servicios(id) ON DELETE CASCADE,
+                    recurso_id INTEGER NOT NULL REFERENCES recursos(id) ON DELETE CASCADE,
+                    cantidad INTEGER NOT NULL DEFAULT 1 CHECK (cantidad > 0),
+                    PRIMARY KEY (servicio_id, recurso_id)
+                );
+                ALTER TABLE citas ADD COLUMN IF NOT EXISTS recursos JSONB;
+                ALTER TABLE IF EXISTS reservas_temporales ADD COLUMN IF NOT EXISTS recursos JSONB;
+            """)
+            conn.commit()
+    finally:
+        conn.close()
+
+def obtener_recursos(negocio_id):
+    """
+    (recursos, servicio_recursos) del negocio: filas id, nombre, capacidad y
+    filas servicio (nombre), recurso_id, cantidad.
+    """
+    conn = get_db_connection()
+    try:
+        with conn.cursor(cursor_factory=_extras().DictCursor) as cur:
+            cur.execute(
+                "SELECT id, nombre, capacidad FROM recursos WHERE negocio_id = %s ORDER BY nombre;",
+                (negocio_id,)
+            )
+            recursos = cur.fetchall()
+            cur.execute(
+                """SELECT s.nombre AS servicio, sr.recurso_id, sr.cantidad
+                   FROM servicio_recursos sr JOIN servicios s ON s.id = sr.servicio_id
+                   WHERE s.negocio_id = %s;""",
+                (negocio_id,)
+            )
+            return recursos, cur.fetchall()
+    finally:
+        conn.close()
+
+def _recursos_lineas(cur, lineas):
+    """{recurso_id: cantidad} que ocupa una cita con esas líneas (por recurso, el máximo); None si ninguno."""
+    cur.execute(
+        """SELECT jsonb_object_agg(recurso_id, cantidad)
+           FROM (SELECT recurso_id, MAX(cantidad) AS cantidad FROM servicio_recursos
+                 WHERE servicio_id = ANY(%s) GROUP BY recurso_id) n;""",
+        ([servicio_id for servicio_id, _, _, _ in lineas],)
+    )
+    return cur.fetchone()[0]
+
+def _json_recursos(recursos):
+    return json.dumps({str(k): v for k, v in recursos.items()}) if recursos else None
+
+# -------------------------
+# RETENCIONES TEMPORALES DE HUECOS
+# -------------------------
+
+# Minuto del día de una columna TIME
+_SQL_MINUTO = "(EXTRACT(EPOCH FROM {})::int / 60)"
+
+# Condición "el tramo [inicio, fin) en minutos está libre" (mismo criterio que
+# ocupacion.Vista.libre): nada se solapa con él. Bloqueos y citas sin duración
+# ocupan un hueco de HUECO_MINUTOS. Sin profesional, si se piden recursos las
+# citas y retenciones no bloquean por sí mismas: cuentan en sus recursos; sin
+# recursos pedidos, cualquier cita o retención bloquea (mismo criterio que
+# ocupacion.Vista.ocupados). Con profesional, una retención sin profesional
+# también bloquea: no se sabe a quién acabará ocupando (no es el "empleado 0").
+# La cita que se está modificando (si la hay) no cuenta contra sí misma.
+#
+# Recursos: por cada uno que pide la cita, en cada instante del tramo en que
+# cambia su uso (el inicio y cada uso que empieza dentro), las unidades ya
+# ocupadas por citas y retenciones ajenas más las pedidas no superan la
+# capacidad. Es un recuento (SUM), no un "hay algo a esa hora".
+_SQL_HUECO_LIBRE = """
+    NOT EXISTS (SELECT 1 FROM citas c
+                WHERE c.negocio_id = %s AND c.fecha = %s
+                  AND {c} < %s AND {c} + GREATEST(COALESCE(c.duracion_min, 0), {h}) > %s
+                  AND CASE WHEN %s::int IS NULL THEN %s::jsonb IS NULL ELSE c.empleado_id = %s END
+                  AND c.id IS DISTINCT FROM %s)
+    AND NOT EXISTS (SELECT 1 FROM bloqueos b
+                    WHERE b.negocio_id = %s AND b.fecha = %s
+                      AND {b} < %s AND {b} + {h} > %s
+                      AND (%s::int IS NULL OR b.empleado_id IS NULL OR b.empleado_id = %s))
+    AND NOT EXISTS (SELECT 1 FROM reservas_temporales r
+                    WHERE r.negocio_id = %s AND r.fecha = %s
+                      AND {r} < %s AND {r} + GREATEST(COALESCE(r.duracion_min, 0), {h}) > %s
+                      AND r.expira_at > NOW() AND r.titular IS DISTINCT FROM %s
+                      AND CASE WHEN %s::int IS NULL THEN %s::jsonb IS NULL
+                               ELSE r.empleado_id IS NULL OR r.empleado_id = %s END)
+    AND NOT EXISTS (
+        WITH usos AS (
+            SELECT u.key::int AS recurso_id, u.value::int AS cantidad,
+                   {c} AS ini, {c} + GREATEST(COALESCE(c.duracion_min, 0), {h}) AS fin
+            FROM citas c, jsonb_each_text(c.recursos) u
+            WHERE c.negocio_id = %s AND c.fecha = %s AND c.id IS DISTINCT FROM %s
+            UNION ALL
+            SELECT u.key::int, u.value::int,
+                   {r}, {r} + GREATEST(COALESCE(r.duracion_min, 0), {h})
+            FROM reservas_temporales r, jsonb_each_text(r.recursos) u
+            WHERE r.negocio_id = %s AND r.fecha = %s
+              AND r.expira_at > NOW() AND r.titular IS DISTINCT FROM %s
+        )
+        SELECT 1
+        FROM jsonb_each_text(%s::jsonb) pide
+        JOIN recursos x ON x.id = pide.key::int
+        CROSS JOIN LATERAL (
+            SELECT %s::int AS t
+            UNION SELECT ini FROM usos WHERE recurso_id = x.id AND ini > %s AND ini < %s
+        ) p
+        WHERE pide.value::int + (SELECT COALESCE(SUM(cantidad), 0) FROM usos
+                                 WHERE recurso_id = x.id AND ini <= p.t AND fin > p.t) > x.capacidad)
+""".format(c=_SQL_MINUTO.format("c.hora"), b=_SQL_MINUTO.format("b.hora"),
+           r=_SQL_MINUTO.format("r.hora"), h=HUECO_MINUTOS)
+
+def _params_hueco_libre(negocio_id, fecha, hora, empleado_id, titular, duracion=None, recursos=None,
+                        cita_id=None):
+    h, m = str(hora).split(':')[:2]
+    inicio = int(h) * 60 + int(m)
+    fin = inicio + max(duracion or 0, HUECO_MINUTOS)
+    pide = _json_recursos(recursos)
+    return (
+        negocio_id, fecha, fin, inicio, empleado_id, pide, empleado_id, cita_id,
+        negocio_id, fecha, fin, inicio, empleado_id, empleado_id,
+        negocio_id, fecha, fin, inicio, titular, empleado_id, pide, empleado_id,
+        negocio_id, fecha, cita_id, negocio_id, fecha, titular, pide, inicio, inicio, fin,
+    )
+
+def _bloquear_dia(cur, negocio_id, fecha):
+    """
+    Cerrojo de transacción por (negocio, día): dos reservas que se solapan (o
+    que comparten un recurso con plazas) no las separa ningún índice único, así
+    que las comprobaciones de tramo libre de un mismo día se hacen de una en una.
+    """
+    cur.execute(
+        "SELECT pg_advisory_xact_lock(%s, (%s::date - DATE '2000-01-01'));",
+        (negocio_id, fecha)
+    )
+
+def ensure_tabla_reservas_temporales():
+    """Crea la tabla de retenciones temporales de huecos si no existe."""
+    conn = get_db_connection()
+    try:
+        with conn.cursor() as cur:
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS reservas_temporales (
+                    id SERIAL PRIMARY KEY,
+                    negocio_id INTEGER NOT NULL REFERENCES negocios(id) ON DELETE CASCADE,
+                    empleado_id INTEGER,
+                    fecha DATE NOT NULL,
+                    hora TIME NOT NULL,
+                    titular TEXT NOT NULL,
+                    expira_at TIMESTAMP NOT NULL,
+                    duracion_min SMALLINT CHECK (duracion_min > 0),
+                    recursos JSONB
+                );
+                -- Varias retenciones pueden compartir hora (sillas, profesionales):
+                -- lo que se solapa lo ordena el cerrojo del día, no un índice
+                DROP INDEX IF EXISTS uq_reservas_temporales_hueco;
+                DELETE FROM reservas_temporales a USING reservas_temporales b
+                    WHERE a.titular = b.titular AND a.negocio_id = b.negocio_id
+                      AND a.fecha = b.fecha AND a.hora = b.hora AND a.id < b.id;
+                CREATE UNIQUE INDEX IF NOT EXISTS uq_reservas_temporales_titular
+                    ON reservas_temporales (titular, negocio_id, fecha, hora);
+                CREATE INDEX IF NOT EXISTS idx_reservas_temporales_expira
+                    ON reservas_temporales (expira_at);
+                CREATE INDEX IF NOT EXISTS idx_reservas_temporales_titular
+                    ON reservas_temporales (titular);
+            """)
+            conn.commit()
+    finally:
+        conn.close()
+
+def retener_hueco(negocio_id, fecha, hora, empleado_id, titular, minutos=None, duracion=None, recursos=None):
+    """
+    Retiene atómicamente (fecha, hora, empleado) para 'titular' durante N minutos,
+    ocupando 'duracion' minutos desde esa hora (None: un hueco) y 'recursos'
+    ({recurso_id: cantidad}, ver recursos.necesidades).
+    Libera cualquier otra retención del mismo titular (una por conversación).
+    Devuelve True si la retención es suya, False si el tramo ya está cogido.
+    """
+    minutos = minutos or RESERVA_TEMPORAL_MINUTOS
+    conn = get_db_connection()
+    try:
+        with conn.cursor() as cur:
+            cur.execute(
+                """DELETE FROM reservas_temporales
+                   WHERE titular = %s AND NOT (negocio_id = %s AND fecha = %s AND hora = %s);""",
+                (titular, negocio_id, fecha, hora)
+            )
+            ok = _insertar_retencion(cur, negocio_id, fecha, hora, empleado_id, titular, minutos, duracion, recursos)
+            conn.commit()
+            return ok
+    finally:
+        conn.close()
+
+def _insertar_retencion(cur, negocio_id, fecha, hora, empleado_id, titular, minutos, duracion=None, recursos=None):
+    """Inserta (o renueva) la retención si el tramo está libre. True si queda retenido."""
+    # El cerrojo del día ordena a quienes piden tramos que se solapan: el
+    # segundo ya ve la retención del primero al comprobar el tramo.
+    _bloquear_dia(cur, negocio_id, fecha)
+    cur.execute(
+        """INSERT INTO reservas_temporales (negocio_id, empleado_id, fecha, hora, titular, expira_at,
+                                           duracion_min, recursos)
+           SELECT %s, %s, %s, %s, %s, NOW() + make_interval(mins => %s), %s, %s::jsonb
+           WHERE """ + _SQL_HUECO_LIBRE + """
+           ON CONFLICT (titular, negocio_id, fecha, hora)
+           DO UPDATE SET empleado_id = EXCLUDED.empleado_id, expira_at = EXCLUDED.expira_at,
+                         duracion_min = EXCLUDED.duracion_min, recursos = EXCLUDED.recursos
+           RETURNING id;""",
+        (negocio_id, empleado_id, fecha, hora, titular, minutos, duracion, _json_recursos(recursos),
+         *_params_hueco_libre(negocio_id, fecha, hora, empleado_id, titular, duracion, recursos))
+    )
+    return cur.fetchone() is not None
+
+def liberar_retenciones(titular):
+    """Suelta todas las retenciones de un titular (p.ej. al reiniciar la conversación)."""
+    if not titular:
+        return
+    conn = get_db_connection()
+    try:
+        with conn.cursor() as cur:
+            cur.execute("DELETE FROM reservas_temporales WHERE titular = %s;", (titular,))
+            conn.commit()
+    finally:
+        conn.close()
+
+def purgar_reservas_temporales():
+    """Borra en bloque las retenciones caducadas. Devuelve cuántas se eliminaron."""
+    conn = get_db_connection()
+    try:
+        with conn.cursor() as cur:
+            cur.execute("DELETE FROM reservas_temporales WHERE expira_at <= NOW();")
+            borradas = cur.rowcount
+            conn.commit()
+            return borradas
+    finally:
+        conn.close()
+
+# -------------------------
+# LISTA DE ESPERA
+# -------------------------
+
+# Ventana máxima de una entrada: acota la búsqueda por fecha_desde al casar un hueco
+LISTA_ESPERA_MAX_DIAS = 62
+
+def ensure_tabla_lista_espera():
+    """
+    Lista de espera por negocio (ver lista_espera.py). token NULL: esperando;
+    con token: se le ha ofrecido oferta_fecha/oferta_hora, retenida hasta
+    oferta_expira con el titular 'espera:<token>'.
+    """
+    conn = get_db_connection()
+    try:
+        with conn.cursor() as cur:
+            cur.execute(f"""
+                CREATE TABLE IF NOT EXISTS lista_espera (
+                    id SERIAL PRIMARY KEY,
+                    negocio_id INTEGER NOT NULL REFERENCES negocios(id) ON DELETE CASCADE,
+                    empleado_id INTEGER REFERENCES empleados(id) ON DELETE SET NULL,  -- NULL: cualquiera
+                    servicios TEXT[] NOT NULL,
+                    duracion_min SMALLINT CHECK (duracion_min > 0),
+                    recursos JSONB,
+                    fecha_desde DATE NOT NULL,
+                    fecha_hasta DATE NOT NULL,
+                    nombre TEXT NOT NULL,
+                    telefono TEXT NOT NULL,
+                    email TEXT,
+                    creada_at TIMESTAMP NOT NULL DEFAULT NOW(),
+                    token TEXT UNIQUE,
+                    oferta_fecha DATE,
+                    oferta_hora TIME,
+                    oferta_empleado_id INTEGER,
+                    oferta_expira TIMESTAMP,
+                    CHECK (fecha_hasta >= fecha_desde AND fecha_hasta - fecha_desde < {LISTA_ESPERA_MAX_DIAS})
+                );
+                CREATE INDEX IF NOT EXISTS idx_lista_espera_esperando
+                    ON lista_espera (negocio_id, fecha_desde) WHERE token IS NULL;
+                CREATE INDEX IF NOT EXISTS idx_lista_espera_ofertas
+                    ON lista_espera (oferta_expira) WHERE token IS NOT NULL;
+            """)
+            conn.commit()
+    finally:
+        conn.close()
+
+def apuntar_lista_espera(negocio_id, datos):
+    """
+    Apunta (o sustituye) la entrada de ese teléfono en la lista del negocio.
+    datos: nombre, telefono, email, servicios, duracion, recursos,
+    empleado_id (None: cualquiera), fecha_desde, fecha_hasta.
+    """
+    conn = get_db_connection()
+    try:
+        with conn.cursor() as cur:
+            cur.execute(
+                "DELETE FROM lista_espera WHERE negocio_id = %s AND telefono = %s AND token IS NULL;",
+                (negocio_id, _telefono(datos['telefono']))
+            )
+            cur.execute(
+                """INSERT INTO lista_espera (negocio_id, empleado_id, servicios, duracion_min, recursos,
+                                            fecha_desde, fecha_hasta, nombre, telefono, email)
+                   VALUES (%s, %s, %s, %s, %s::jsonb, %s, %s, %s, %s, %s) RETURNING id;""",
+                (negocio_id, datos.get('empleado_id'), list(datos['servicios']), datos.get('duracion'),
+                 _json_recursos(datos.get('recursos')), datos['fecha_desde'], datos['fecha_hasta'],
+                 datos['nombre'], _telefono(datos['telefono']), datos.get('email'))
+            )
+            entrada_id = cur.fetchone()[0]
+            conn.commit()
+            return entrada_id
+    finally:
+        conn.close()
+
+def candidatos_lista_espera(negocio_id, fecha, empleado_id=None, limite=20):
+    """
+    Entradas en espera cuya ventana incluye 'fecha', por orden de llegada. Con
+    empleado_id, solo las de ese profesional o de cualquiera (lo que libera un
+    profesional no sirve a quien espera a otro). Lee por índice solo las
+    entradas que empiezan como mucho LISTA_ESPERA_MAX_DIAS antes: el coste
+    depende del hueco liberado, no del tamaño de la lista.
+    """
+    conn = get_db_connection()
+    try:
+        with conn.cursor(cursor_factory=_extras().DictCursor) as cur:
+            cur.execute(
+                f"""SELECT id, empleado_id, servicios, duracion_min, recursos, nombre, telefono, email
+                   FROM lista_espera
+                   WHERE negocio_id = %s AND token IS NULL
+                     AND fecha_desde BETWEEN %s::date - {LISTA_ESPERA_MAX_DIAS - 1} AND %s
+                     AND fecha_hasta >= %s
+                     AND (%s::int IS NULL OR empleado_id IS NULL OR empleado_id = %s)
+                   ORDER BY creada_at, id
+                   LIMIT %s;""",
+                (negocio_id, fecha, fecha, fecha, empleado_id, empleado_id, limite)
+            )
+            return cur.fetchall()
+    finally:
+        conn.close()
+
+def ofrecer_lista_espera(entrada_id, fecha, hora, empleado_id, minutos):
+    """
+    Reclama la entrada y le retiene (fecha, hora, empleado) 'minutos' minutos,
+    todo en una transacción. Devuelve el token de la oferta, o None si la
+    entrada ya tiene oferta (otro proceso recibió el mismo aviso) o el tramo
+    ya no está libre.
+    """
+    token = secrets.token_urlsafe(18)
+    conn = get_db_connection()
+    try:
+        with conn.cursor() as cur:
+            cur.execute(
+                """UPDATE lista_espera
+                   SET token = %s, oferta_fecha = %s, oferta_hora = %s, oferta_empleado_id = %s,
+                       oferta_expira = NOW() + make_interval(mins => %s)
+                   WHERE id = %s AND token IS NULL
+                   RETURNING negocio_id, duracion_min, recursos;""",
+                (token, fecha, hora, empleado_id, minutos, entrada_id)
+            )
+            fila = cur.fetchone()
+            if fila is None or not _insertar_retencion(cur, fila[0], fecha, hora, empleado_id,
+                                                       f"espera:{token}", minutos, fila[1], fila[2]):
+                conn.rollback()
+                return None
+            conn.commit()
+            return token
+    finally:
+        conn.close()
+
+def obtener_oferta_lista_espera(token):
+    """Oferta vigente de ese token con los datos para reservarla y mostrarla, o None."""
+    conn = get_db_connection()
+    try:
+        with conn.cursor(cursor_factory=_extras().DictCursor) as cur:
+            cur.execute(
+                """SELECT l.*, TO_CHAR(l.oferta_hora, 'HH24:MI') AS hora, n.nombre AS negocio_nombre,
+                          n.email AS negocio_email, e.nombre AS empleado_nombre
+                   FROM lista_espera l
+                   JOIN negocios n ON n.id = l.negocio_id
+                   LEFT JOIN empleados e ON e.id = l.oferta_empleado_id
+                   WHERE l.token = %s AND l.oferta_expira > NOW();""",
+                (token,)
+            )
+            return cur.fetchone()
+    finally:
+        conn.close()
+
+def borrar_entrada_lista_espera(entrada_id):
+    conn = get_db_connection()
+    try:
+        with conn.cursor() as cur:
+            cur.execute("DELETE FROM lista_espera WHERE id = %s;", (entrada_id,))
+            conn.commit()
+    finally:
+        conn.close()
+
+def caducar_ofertas_lista_espera():
+    """
+    Ofertas caducadas sin respuesta: la entrada sale de la lista (no se le
+    vuelve a ofrecer lo mismo en cada ciclo). Devuelve los huecos que quedan
+    libres (negocio_id, fecha, empleado_id) para ofrecerlos al siguiente.
+    Solo lee las ofertas vencidas (por índice).
+    """
+    conn = get_db_connection()
+    try:
+        with conn.cursor(cursor_factory=_extras().DictCursor) as cur:
+            cur.execute(
+                """WITH caducadas AS (
+                       SELECT id, negocio_id, oferta_fecha, oferta_empleado_id FROM lista_espera
+                       WHERE token IS NOT NULL AND oferta_expira <= NOW()
+                       FOR UPDATE SKIP LOCKED
+                   )
+                   DELETE FROM lista_espera l
+                   USING caducadas c WHERE l.id = c.id
+                   RETURNING c.negocio_id, c.oferta_fecha AS fecha, c.oferta_empleado_id AS empleado_id;"""
+            )
+            filas = cur.fetchall()
+            conn.commit()
+            return filas
+    finally:
+        conn.close()
+
+def purgar_lista_espera():
+    """Borra las entradas cuya ventana ya pasó. Devuelve cuántas se eliminaron."""
+    conn = get_db_connection()
+    try:
+        with conn.cursor() as cur:
+            cur.execute("DELETE FROM lista_espera WHERE fecha_hasta < CURRENT_DATE AND token IS NULL;")
+            borradas = cur.rowcount
+            conn.commit()
+            return borradas
+    finally:
+        conn.close()
+
+# -------------------------
+# LIMITACIÓN DE TASA (backend compartido entre workers)
+# -------------------------
+
+def ensure_tabla_limites_tasa():
+    conn = get_db_connection()
+    try:
+        with conn.cursor() as cur:
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS limites_tasa (
+                    clave TEXT PRIMARY KEY,
+                    fichas DOUBLE PRECISION NOT NULL,
+                    actualizado TIMESTAMPTZ NOT NULL
+                );
+            """)
+            conn.commit()
+    finally:
+        conn.close()
+
+def consumir_ficha(clave, tasa_por_segundo, capacidad):
+    """
+    Token bucket atómico: rellena según el tiempo transcurrido y gasta una ficha.
+    True si había ficha. Si no la había, la fila no se toca.
+    """
+    conn = get_db_connection()
+    try:
+        with conn.cursor() as cur:
+            cur.execute(
+                """INSERT INTO limites_tasa (clave, fichas, actualizado)
+                   VALUES (%(clave)s, %(capacidad)s - 1, clock_timestamp())
+                   ON CONFLICT (clave) DO UPDATE SET
+                       fichas = LEAST(%(capacidad)s, limites_tasa.fichas
+                                + EXTRACT(EPOCH FROM clock_timestamp() - limites_tasa.actualizado) * %(tasa)s) - 1,
+                       actualizado = clock_timestamp()
+                   WHERE LEAST(%(capacidad)s, limites_tasa.fichas
+                         + EXTRACT(EPOCH FROM clock_timestamp() - limites_tasa.actualizado) * %(tasa)s) >= 1
+                   RETURNING fichas;""",
+                {"clave": clave, "capacidad": capacidad, "tasa": tasa_por_segundo}
+            )
+            ok = cur.fetchone() is not None
+            conn.commit()
+            return ok
+    finally:
+        conn.close()
+
+def purgar_limites_tasa():
+    """Borra cubos sin uso en la última hora (ya estarían llenos)."""
+    conn = get_db_connection()
+    try:
+        with conn.cursor() as cur:
+            cur.execute("DELETE FROM limites_tasa WHERE actualizado < NOW() - INTERVAL '1 hour';")
+            borradas = cur.rowcount
+            conn.commit()
+            return borradas
+    finally:
+        conn.close()
+
+# -------------------------
+# IDEMPOTENCIA DE /mensaje
+# -------------------------
+
+def ensure_tabla_respuestas_idempotentes():
+    """Crea la tabla de respuestas guardadas por clave de idempotencia si no existe."""
+    conn = get_db_connection()
+    try:
+        with conn.cursor() as cur:
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS respuestas_idempotentes (
+                    clave TEXT PRIMARY KEY,   -- "<conversación>:<Idempotency-Key>"
+                    respuesta JSONB,
+                    expira_at TIMESTAMP NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS idx_respuestas_idempotentes_expira
+                    ON respuestas_idempotentes (expira_at);
+                -- Ya no se guarda la sesión (datos del cliente) junto a la respuesta
+                ALTER TABLE respuestas_idempotentes DROP COLUMN IF EXISTS sesion;
+            """)
+            conn.commit()
+    finally:
+        conn.close()
+
+def reclamar_clave_idempotente(clave, ttl_segundos):
+    """
+    Reserva 'clave' para procesarla. True si es nueva (o la anterior caducó);
+    False si otra petición con la misma clave ya la reclamó.
+    """
+    conn = get_db_connection()
+    try:
+        with conn.cursor() as cur:
+            cur.execute(
+                """INSERT INTO respuestas_idempotentes (clave, expira_at)
+                   VALUES (%s, NOW() + make_interval(secs => %s))
+                   ON CONFLICT (clave) DO UPDATE
+                       SET respuesta = NULL, expira_at = EXCLUDED.expira_at
+                       WHERE respuestas_idempotentes.expira_at <= NOW()
+                   RETURNING clave;""",
+                (clave, ttl_segundos)
+            )
+            ok = cur.fetchone() is not None
+            conn.commit()
+            return ok
+    finally:
+        conn.close()
+
+def guardar_respuesta_idempotente(clave, respuesta):
+    conn = get_db_connection()
+    try:
+        with conn.cursor() as cur:
+            cur.execute(
+                "UPDATE respuestas_idempotentes SET respuesta = %s WHERE clave = %s;",
+                (_extras().Json(respuesta), clave)
+            )
+            conn.commit()
+    finally:
+        conn.close()
+
+def obtener_respuesta_idempotente(clave):
+    """Fila {respuesta} de una clave vigente (respuesta None = aún en curso), o None."""
+    conn = get_db_connection()
+    try:
+        with conn.cursor(cursor_factory=_extras().DictCursor) as cur:
+            cur.execute(
+                "SELECT respuesta FROM respuestas_idempotentes WHERE clave = %s AND expira_at > NOW();",
+                (clave,)
+            )
+            return cur.fetchone()
+    finally:
+        conn.close()
+
+def liberar_clave_idempotente(clave):
+    """Suelta una clave cuyo procesamiento falló, para que el reintento se ejecute."""
+    conn = get_db_connection()
+    try:
+        with conn.cursor() as cur:
+            cur.execute("DELETE FROM respuestas_idempotentes WHERE clave = %s AND respuesta IS NULL;", (clave,))
+            conn.commit()
+    finally:
+        conn.close()
+
+def purgar_respuestas_idempotentes():
+    """Borra en bloque las respuestas caducadas. Devuelve cuántas se eliminaron."""
+    conn = get_db_connection()
+    try:
+        with conn.cursor() as cur:
+            cur.execute("DELETE FROM respuestas_idempotentes WHERE expira_at <= NOW();")
+            borradas = cur.rowcount
+            conn.commit()
+            return borradas
+    finally:
+        conn.close()
+
 # -------------------------
-# NEGOCIOS / SERVICIOS / EMPLEADOS
+# CONVERSACIONES DE INTEGRACIONES (/mensajes/batch)
 # -------------------------
 
-def obtener_negocio_por_slug(slug):
+def ensure_tabla_conversaciones():
+    """Sesiones de chat guardadas en servidor para canales sin cookie (webhooks, importadores)."""
     conn = get_db_connection()
     try:
-        with conn.cursor(cursor_factory=psycopg2.extras.DictCursor) as cur:
-            cur.execute("SELECT * FROM negocios WHERE LOWER(slug) = %s;", (slug,))
-            negocio = cur.fetchone()
-            if negocio:
-                negocio_id = negocio['id']
-                cur.execute("SELECT nombre, precio FROM servicios WHERE negocio_id = %s;", (negocio_id,))
-                servicios = cur.fetchall()
-                cur.execute("SELECT id, nombre FROM empleados WHERE negocio_id = %s;", (negocio_id,))
-                empleados = cur.fetchall()
-                negocio = dict(negocio)
-                negocio['servicios'] = [dict(s) for s in servicios]
-                negocio['empleados'] = [dict(e) for e in empleados]
-            return negocio
+        with conn.cursor() as cur:
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS conversaciones (
+                    id TEXT PRIMARY KEY,
+                    sesion TEXT NOT NULL,
+                    actualizado TIMESTAMP NOT NULL DEFAULT NOW()
+                );
+                CREATE INDEX IF NOT EXISTS idx_conversaciones_actualizado
+                    ON conversaciones (actualizado);
+            """)
+            conn.commit()
     finally:
         conn.close()
 
-def obtener_negocio_por_id(negocio_id):
+def ensure_indices_listados():
+    """
+    Índices de los listados de administración: (nombre, id) para paginar
+    negocios y trigramas (pg_trgm) para buscar un trozo del nombre. Sin
+    permiso para crear la extensión, la búsqueda sigue funcionando sin índice.
+    """
     conn = get_db_connection()
     try:
-        with conn.cursor(cursor_factory=psycopg2.extras.DictCursor) as cur:
-            cur.execute("SELECT * FROM negocios WHERE id = %s;", (negocio_id,))
-            negocio = cur.fetchone()
-            if negocio:
-                cur.execute("SELECT nombre, precio, duracion FROM servicios WHERE negocio_id = %s;", (negocio_id,))
-                servicios = cur.fetchall()
-                cur.execute("SELECT id, nombre FROM empleados WHERE negocio_id = %s;", (negocio_id,))
-                empleados = cur.fetchall()
-                negocio = dict(negocio)
-                negocio['servicios'] = [dict(s) for s in servicios]
-                negocio['empleados'] = [dict(e) for e in empleados]
-            return negocio
+        with conn.cursor() as cur:
+            cur.execute("CREATE INDEX IF NOT EXISTS idx_negocios_nombre_id ON negocios (nombre, id);")
+            conn.commit()
+            try:
+                cur.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm;")
+                cur.execute(
+                    "CREATE INDEX IF NOT EXISTS idx_negocios_nombre_trgm ON negocios USING gin (nombre gin_trgm_ops);"
+                )
+                conn.commit()
+            except psycopg2.Error as e:
+                conn.rollback()
+                log.warning("Sin índice trigram para buscar negocios por nombre: %s", e)
     finally:
         conn.close()
 
-def listar_negocios(filtro_nombre=''):
+def ensure_tablas_horario():
+    """
+    Horario estructurado: reglas semanales (negocio o profesional), excepciones
+    por fecha y horizonte de reserva del negocio.
+    """
     conn = get_db_connection()
     try:
-        with conn.cursor(cursor_factory=psycopg2.extras.DictCursor) as cur:
-            query = "SELECT id, nombre, slug FROM negocios ORDER BY nombre ASC"
-            params = []
-            if filtro_nombre:
-                query = "SELECT id, nombre, slug FROM negocios WHERE nombre ILIKE %s ORDER BY nombre ASC;"
-                params.append(f"%{filtro_nombre}%")
-            cur.execute(query, params)
-            return cur.fetchall()
+        with conn.cursor() as cur:
+            cur.execute("""
+                ALTER TABLE negocios ADD COLUMN IF NOT EXISTS horizonte_reserva_dias INTEGER
+                    CHECK (horizonte_reserva_dias > 0);
+
+                CREATE TABLE IF NOT EXISTS horario_reglas (
+                    id SERIAL PRIMARY KEY,
+                    negocio_id INTEGER NOT NULL REFERENCES negocios(id) ON DELETE CASCADE,
+                    empleado_id INTEGER REFERENCES empleados(id) ON DELETE CASCADE,
+                    dia_semana SMALLINT NOT NULL CHECK (dia_semana BETWEEN 0 AND 6),
+                    inicio_min SMALLINT NOT NULL CHECK (inicio_min >= 0),
+                    fin_min SMALLINT NOT NULL CHECK (fin_min > inicio_min AND fin_min <= 1440),
+                    paso_min SMALLINT NOT NULL DEFAULT 60 CHECK (paso_min > 0)
+                );
+                CREATE INDEX IF NOT EXISTS idx_horario_reglas_negocio ON horario_reglas (negocio_id);
+
+                CREATE TABLE IF NOT EXISTS horario_excepciones (
+                    id SERIAL PRIMARY KEY,
+                    negocio_id INTEGER NOT NULL REFERENCES negocios(id) ON DELETE CASCADE,
+                    empleado_id INTEGER REFERENCES empleados(id) ON DELETE CASCADE,
+                    fecha DATE NOT NULL,
+                    inicio_min SMALLINT,   -- NULL: cerrado ese día
+                    fin_min SMALLINT,
+                    paso_min SMALLINT NOT NULL DEFAULT 60 CHECK (paso_min > 0),
+                    CHECK ((inicio_min IS NULL AND fin_min IS NULL)
+                           OR (inicio_min >= 0 AND fin_min > inicio_min AND fin_min <= 1440))
+                );
+                CREATE INDEX IF NOT EXISTS idx_horario_excepciones_negocio ON horario_excepciones (negocio_id, fecha);
+            """)
+            conn.commit()
     finally:
         conn.close()
 
-def crear_negocio_completo(datos):
+def obtener_sesiones_conversacion(ids):
+    """{id: sesion serializada} de las conversaciones que existan, en una sola consulta."""
+    if not ids:
+        return {}
     conn = get_db_connection()
     try:
         with conn.cursor() as cur:
-            cur.execute(
-                "INSERT INTO negocios (nombre, slug, direccion, telefono, email) VALUES (%s, %s, %s, %s, %s) RETURNING id;",
-                (datos['nombre'], datos['slug'], datos.get('direccion'), datos.get('telefono'), datos.get('email'))
-            )
-            negocio_id = cur.fetchone()[0]
-            for servicio in datos['servicios']:
-                cur.execute(
-                    "INSERT INTO servicios (negocio_id, nombre, precio, duracion) VALUES (%s, %s, %s, %s);",
-                    (negocio_id, servicio['nombre'], servicio['precio'], servicio['duracion'])
-                )
-            for empleado in datos['empleados']:
-                cur.execute(
-                    "INSERT INTO empleados (negocio_id, nombre) VALUES (%s, %s);",
-                    (negocio_id, empleado['nombre'])
-                )
-            conn.commit()
+            cur.execute("SELECT id, sesion FROM conversaciones WHERE id = ANY(%s);", (list(ids),))
+            return dict(cur.fetchall())
     finally:
         conn.close()
 
-def borrar_negocio(negocio_id):
+def guardar_sesiones_conversacion(sesiones):
+    """Guarda {id: sesion serializada} con un único UPSERT."""
+    if not sesiones:
+        return
     conn = get_db_connection()
     try:
         with conn.cursor() as cur:
-            cur.execute("DELETE FROM citas WHERE negocio_id = %s;", (negocio_id,))
-            cur.execute("DELETE FROM servicios WHERE negocio_id = %s;", (negocio_id,))
-            cur.execute("DELETE FROM empleados WHERE negocio_id = %s;", (negocio_id,))
-            cur.execute("DELETE FROM negocios WHERE id = %s;", (negocio_id,))
+            _extras().execute_values(
+                cur,
+                """INSERT INTO conversaciones (id, sesion) VALUES %s
+                   ON CONFLICT (id) DO UPDATE SET sesion = EXCLUDED.sesion, actualizado = NOW();""",
+                list(sesiones.items())
+            )
             conn.commit()
     finally:
         conn.close()
 
-def modificar_negocio_completo(negocio_id, datos):
+def purgar_conversaciones(dias):
+    """Borra las conversaciones sin actividad en 'dias' días. Devuelve cuántas se eliminaron."""
     conn = get_db_connection()
     try:
         with conn.cursor() as cur:
-            cur.execute(
-                """UPDATE negocios SET 
-                   nombre = %s, slug = %s, direccion = %s, telefono = %s, email = %s,
-                   horario_lunes = %s, horario_martes = %s, horario_miercoles = %s,
-                   horario_jueves = %s, horario_viernes = %s, horario_sabado = %s, horario_domingo = %s
-                   WHERE id = %s;""",
-                (datos['nombre'], datos['slug'], datos.get('direccion'), datos.get('telefono'), datos.get('email'),
-                 datos.get('horario_lunes'), datos.get('horario_martes'), datos.get('horario_miercoles'),
-                 datos.get('horario_jueves'), datos.get('horario_viernes'), datos.get('horario_sabado'),
-                 datos.get('horario_domingo'), negocio_id)
-            )
-            # Reset de datos dependientes
-            cur.execute("DELETE FROM citas WHERE negocio_id = %s;", (negocio_id,))
-            cur.execute("DELETE FROM servicios WHERE negocio_id = %s;", (negocio_id,))
-            for servicio in datos['servicios']:
-                cur.execute(
-                    "INSERT INTO servicios (negocio_id, nombre, precio, duracion) VALUES (%s, %s, %s, %s);",
-                    (negocio_id, servicio['nombre'], servicio['precio'], servicio['duracion'])
-                )
-            cur.execute("DELETE FROM empleados WHERE negocio_id = %s;", (negocio_id,))
-            for empleado in datos['empleados']:
-                cur.execute(
-                    "INSERT INTO empleados (negocio_id, nombre) VALUES (%s, %s);",
-                    (negocio_id, empleado['nombre'])
-                )
+            cur.execute("DELETE FROM conversaciones WHERE actualizado < NOW() - make_interval(days => %s);", (dias,))
+            borradas = cur.rowcount
             conn.commit()
+            return borradas
     finally:
         conn.close()
 
 # -------------------------
-# CLIENTES (NUEVO)
+# WHATSAPP ENTRANTE (bandeja persistente)
 # -------------------------
 
-def upsert_cliente(negocio_id, telefono, email, nombre=None):
+# Segundos que una conversación queda tomada por el hilo que la procesa
+WHATSAPP_PLAZO_SEGUNDOS = int(getattr(config, "WHATSAPP_PLAZO_SEGUNDOS", os.getenv("WHATSAPP_PLAZO_SEGUNDOS", 120)))
+# Intentos de procesar un mensaje antes de abandonarlo (queda en la tabla con abandonado_at)
+WHATSAPP_INTENTOS = int(getattr(config, "WHATSAPP_INTENTOS", os.getenv("WHATSAPP_INTENTOS", 5)))
+WHATSAPP_ESPERA_MAX_SEGUNDOS = 300
+
+def ensure_tabla_whatsapp_entrantes():
     """
-    Crea o actualiza un cliente (por negocio + teléfono).
-    Requiere email (la columna es NOT NULL).
+    Mensajes de WhatsApp recibidos y aún sin procesar: el webhook los guarda
+    antes de contestar a Twilio, así un reinicio del worker no los pierde.
     """
-    if not (negocio_id and telefono and email):
-        return
     conn = get_db_connection()
     try:
         with conn.cursor() as cur:
-            cur.execute(
-                """
-                INSERT INTO clientes (negocio_id, telefono, email, nombre)
-                VALUES (%s, %s, %s, %s)
-                ON CONFLICT (negocio_id, telefono)
-                DO UPDATE SET
-                    email = EXCLUDED.email,
-                    nombre = COALESCE(EXCLUDED.nombre, clientes.nombre),
-                    updated_at = NOW();
-                """,
-                (negocio_id, telefono, email, nombre)
-            )
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS whatsapp_entrantes (
+                    id BIGSERIAL PRIMARY KEY,
+                    conversacion TEXT NOT NULL,
+                    texto TEXT NOT NULL,
+                    slug TEXT NOT NULL DEFAULT '',
+                    sid TEXT UNIQUE,             -- MessageSid de Twilio: sus reintentos no se duplican
+                    recibido_at TIMESTAMP NOT NULL DEFAULT NOW()
+                );
+                ALTER TABLE whatsapp_entrantes ADD COLUMN IF NOT EXISTS procesando_hasta TIMESTAMP;
+                ALTER TABLE whatsapp_entrantes ADD COLUMN IF NOT EXISTS intentos SMALLINT NOT NULL DEFAULT 0;
+                ALTER TABLE whatsapp_entrantes ADD COLUMN IF NOT EXISTS abandonado_at TIMESTAMP;
+                CREATE INDEX IF NOT EXISTS idx_whatsapp_entrantes_conversacion
+                    ON whatsapp_entrantes (conversacion, id);
+            """)
             conn.commit()
     finally:
         conn.close()
 
-def obtener_email_cliente(telefono, negocio_id):
-    """
-    Devuelve el email guardado para un teléfono en un negocio, o None.
-    """
+def guardar_whatsapp_entrante(conversacion, texto, slug, sid=None):
+    """Guarda un mensaje recibido (un reintento con el mismo 'sid' no se duplica)."""
     conn = get_db_connection()
     try:
         with conn.cursor() as cur:
             cur.execute(
-                "SELECT email FROM clientes WHERE negocio_id = %s AND telefono = %s LIMIT 1;",
-                (negocio_id, telefono)
+                """INSERT INTO whatsapp_entrantes (conversacion, texto, slug, sid) VALUES (%s, %s, %s, %s)
+                   ON CONFLICT (sid) DO NOTHING;""",
+                (conversacion, texto, slug or '', sid or None)
             )
-            row = cur.fetchone()
-            return row[0] if row else None
+            conn.commit()
     finally:
         conn.close()
 
-# -------------------------
-# CITAS / DISPONIBILIDAD
-# -------------------------
+def _tomar_conversacion_whatsapp(cur, candidatas):
+    # Conversaciones sin plazo vigente, de la más antigua a la más nueva; el
+    # cerrojo consultivo solo dura esta transacción corta y evita que dos hilos
+    # se den a la vez el mismo plazo
+    cur.execute(
+        """SELECT conversacion FROM whatsapp_entrantes
+           WHERE abandonado_at IS NULL
+           GROUP BY conversacion
+           HAVING COALESCE(MAX(procesando_hasta), '-infinity') < NOW()
+           ORDER BY MIN(id) LIMIT %s;""",
+        (candidatas,)
+    )
+    for (conversacion,) in cur.fetchall():
+        cur.execute("SELECT pg_try_advisory_xact_lock(hashtext(%s));", (f"whatsapp:{conversacion}",))
+        if not cur.fetchone()[0]:
+            continue
+        # Otro hilo pudo darse el plazo entre la consulta y el cerrojo
+        cur.execute(
+            """SELECT COALESCE(MAX(procesando_hasta), '-infinity') < NOW() FROM whatsapp_entrantes
+               WHERE conversacion = %s AND abandonado_at IS NULL;""",
+            (conversacion,)
+        )
+        if cur.fetchone()[0]:
+            return conversacion
+    return None
 
-def tiene_cita_futura(telefono, negocio_id):
+@contextmanager
+def conversacion_whatsapp_pendiente(candidatas=20):
+    """
+    Toma, de las 'candidatas' conversaciones con mensajes pendientes más
+    antiguas, la primera que no esté procesando otro hilo o worker y da
+    (conversacion, [(texto, slug)]) en orden de llegada; None si no hay
+    ninguna libre.
+
+    Tomarla es una transacción corta que da a sus mensajes un plazo
+    (procesando_hasta) de WHATSAPP_PLAZO_SEGUNDOS: la conexión vuelve al pool
+    antes de procesar y nadie más toca esa conversación mientras el plazo
+    siga vigente (si el worker muere, otro la retoma al vencer). Al salir sin
+    error se borran esos mensajes; si el bloque falla, la conversación espera
+    un tiempo que se dobla con cada intento. Los mensajes que ya llevan
+    WHATSAPP_INTENTOS intentos se marcan abandonado_at y no se reintentan.
+    """
     conn = get_db_connection()
     try:
         with conn.cursor() as cur:
-            cur.execute(
-                "SELECT 1 FROM citas WHERE telefono = %s AND negocio_id = %s AND fecha >= NOW()::date;",
-                (telefono, negocio_id)
-            )
-            return cur.fetchone() is not None
+            tomada = _tomar_conversacion_whatsapp(cur, candidatas)
+            if tomada is None:
+                conn.rollback()
+                filas = None
+            else:
+                cur.execute(
+                    """UPDATE whatsapp_entrantes SET abandonado_at = NOW()
+                       WHERE conversacion = %s AND abandonado_at IS NULL AND intentos >= %s
+                       RETURNING id;""",
+                    (tomada, WHATSAPP_INTENTOS)
+                )
+                abandonados = cur.rowcount
+                cur.execute(
+                    """UPDATE whatsapp_entrantes
+                       SET procesando_hasta = NOW() + make_interval(secs => %s), intentos = intentos + 1
+                       WHERE conversacion = %s AND abandonado_at IS NULL
+                       RETURNING id, texto, slug;""",
+                    (WHATSAPP_PLAZO_SEGUNDOS, tomada)
+                )
+                filas = sorted(cur.fetchall())
+                conn.commit()
+                if abandonados:
+                    metrics.WHATSAPP_ENTRANTES.inc("abandonado", valor=abandonados)
+                    log.error("WhatsApp: %d mensaje(s) de %s abandonados tras %d intentos.",
+                              abandonados, tomada, WHATSAPP_INTENTOS)
     finally:
         conn.close()
 
-def obtener_citas_pasadas(telefono, negocio_id):
+    if not filas:
+        # Sin conversación libre, o solo le quedaban mensajes abandonados
+        yield None
+        return
+    ids = [fila[0] for fila in filas]
+    try:
+        yield tomada, [(texto, slug) for _, texto, slug in filas]
+    except BaseException:
+        _reintentar_whatsapp_entrantes(ids)
+        raise
+    _borrar_whatsapp_entrantes(ids)
+
+def _borrar_whatsapp_entrantes(ids):
     conn = get_db_connection()
     try:
-        with conn.cursor(cursor_factory=psycopg2.extras.DictCursor) as cur:
-            cur.execute(
-                """SELECT c.*, s.nombre as servicio_nombre 
-                   FROM citas c JOIN servicios s ON c.servicio_id = s.id
-                   WHERE c.telefono = %s AND c.negocio_id = %s AND c.fecha < NOW()::date 
-                   ORDER BY c.fecha DESC LIMIT 1;""",
-                (telefono, negocio_id)
-            )
-            return cur.fetchall()
+        with conn.cursor() as cur:
+            cur.execute("DELETE FROM whatsapp_entrantes WHERE id = ANY(%s);", (ids,))
+            conn.commit()
     finally:
         conn.close()
 
-def listar_servicios(negocio_id):
+def _reintentar_whatsapp_entrantes(ids):
+    # El plazo pasa a ser la espera hasta el siguiente intento: 2, 4, 8... segundos
     conn = get_db_connection()
     try:
-        with conn.cursor(cursor_factory=psycopg2.extras.DictCursor) as cur:
-            cur.execute("SELECT id, nombre, precio FROM servicios WHERE negocio_id = %s;", (negocio_id,))
-            return cur.fetchall()
+        with conn.cursor() as cur:
+            cur.execute(
+                """UPDATE whatsapp_entrantes
+                   SET procesando_hasta = NOW() + make_interval(secs => LEAST(%s, 2 ^ intentos))
+                   WHERE id = ANY(%s);""",
+                (WHATSAPP_ESPERA_MAX_SEGUNDOS, ids)
+            )
+            conn.commit()
     finally:
         conn.close()
 
-def listar_empleados(negocio_id):
+# -------------------------
+# NOTIFICACIONES DE AGENDA (LISTEN/NOTIFY)
+# -------------------------
+
+CANAL_AGENDA = "agenda_cambios"
+
+# Fecha de la fila de agenda_versiones que versiona la configuración del negocio
+# (horario, servicios, empleados) en lugar de un día concreto.
+FECHA_VERSION_CONFIG = '-infinity'
+
+# Un UPDATE se publica como 'baja' de la fila vieja + 'alta' de la nueva, así el
+# panel solo maneja dos tipos de delta. pg_notify se entrega al hacer COMMIT.
+# Cada fila afectada sube además el contador (negocio_id, fecha) que alimenta
+# los ETag del panel.
+_SQL_NOTIFICACIONES_AGENDA = """
+    CREATE TABLE IF NOT EXISTS agenda_versiones (
+        negocio_id INTEGER NOT NULL,
+        fecha DATE NOT NULL,
+        version BIGINT NOT NULL DEFAULT 1,
+        PRIMARY KEY (negocio_id, fecha)
+    );
+
+    CREATE OR REPLACE FUNCTION notificar_cambio_agenda() RETURNS trigger AS $$
+    DECLARE
+        -- Tabla lógica (argumento del trigger): en citas particionada TG_TABLE_NAME es la partición
+        tabla TEXT := COALESCE(TG_ARGV[0], TG_TABLE_NAME);
+        filas JSON[] := ARRAY[]::JSON[];
+        ops TEXT[] := ARRAY[]::TEXT[];
+        f JSON;
+        v BIGINT;
+    BEGIN
+        IF TG_OP IN ('UPDATE', 'DELETE') THEN
+            filas := filas || row_to_json(OLD); ops := ops || 'baja'::TEXT;
+        END IF;
+        IF TG_OP IN ('INSERT', 'UPDATE') THEN
+            filas := filas || row_to_json(NEW); ops := ops || 'alta'::TEXT;
+        END IF;
+        FOR i IN 1 .. array_length(filas, 1) LOOP
+            f := filas[i];
+            INSERT INTO agenda_versiones (negocio_id, fecha)
+            VALUES ((f->>'negocio_id')::INTEGER, (f->>'fecha')::DATE)
+            ON CONFLICT (negocio_id, fecha) DO UPDATE SET version = agenda_versiones.version + 1
+            RETURNING version INTO v;
+            PERFORM pg_notify('""" + CANAL_AGENDA + """', json_build_object(
+                'tabla', tabla,
+                'op', ops[i],
+                'version', v,
+                'id', f->'id',
+                'negocio_id', f->'negocio_id',
+                'fecha', f->>'fecha',
+                'hora', TO_CHAR((f->>'hora')::TIME, 'HH24:MI'),
+                'empleado_id', f->'empleado_id',
+                'nombre_cliente', f->>'nombre_cliente',
+                'servicio_nombre', COALESCE(
+                    CASE WHEN tabla = 'citas' THEN
+                        (SELECT string_agg(nombre, ' + ' ORDER BY orden) FROM cita_servicios
+                         WHERE cita_id = (f->>'id')::INTEGER)
+                    END,
+                    (SELECT nombre FROM servicios WHERE id = (f->>'servicio_id')::INTEGER)),
+                'empleado_nombre', (SELECT nombre FROM empleados WHERE id = (f->>'empleado_id')::INTEGER),
+                'duracion_min', f->'duracion_min',
+                'recursos', f->'recursos'
+            )::TEXT);
+        END LOOP;
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql;
+
+    -- Triggers sin argumento (versiones anteriores) se rehacen con la tabla lógica
+    DO $$
+    BEGIN
+        IF NOT EXISTS (SELECT 1 FROM pg_trigger
+                       WHERE tgname = 'trg_citas_notificar' AND tgrelid = 'citas'::regclass AND tgnargs = 1) THEN
+            DROP TRIGGER IF EXISTS trg_citas_notificar ON citas;
+            CREATE TRIGGER trg_citas_notificar AFTER INSERT OR UPDATE OR DELETE ON citas
+                FOR EACH ROW EXECUTE FUNCTION notificar_cambio_agenda('citas');
+        END IF;
+        IF NOT EXISTS (SELECT 1 FROM pg_trigger
+                       WHERE tgname = 'trg_bloqueos_notificar' AND tgrelid = 'bloqueos'::regclass AND tgnargs = 1) THEN
+            DROP TRIGGER IF EXISTS trg_bloqueos_notificar ON bloqueos;
+            CREATE TRIGGER trg_bloqueos_notificar AFTER INSERT OR UPDATE OR DELETE ON bloqueos
+                FOR EACH ROW EXECUTE FUNCTION notificar_cambio_agenda('bloqueos');
+        END IF;
+    END;
+    $$;
+"""
+
+def ensure_notificaciones_agenda():
+    """
+    Instala los triggers que publican en CANAL_AGENDA los cambios de citas y
+    bloqueos y mantienen agenda_versiones.
+    """
     conn = get_db_connection()
     try:
-        with conn.cursor(cursor_factory=psycopg2.extras.DictCursor) as cur:
-            cur.execute("SELECT id, nombre FROM empleados WHERE negocio_id = %s;", (negocio_id,))
-            return cur.fetchall()
+        with conn.cursor() as cur:
+            cur.execute(_SQL_LINEAS_CITA)
+            cur.execute(_SQL_NOTIFICACIONES_AGENDA)
+            conn.commit()
     finally:
         conn.close()
 
-def obtener_horario_negocio(negocio_id):
-    conn = get_db_connection()
-    try:
-        with conn.cursor(cursor_factory=psycopg2.extras.DictCursor) as cur:
+# -------------------------
+# CITAS PARTICIONADAS POR MES Y ARCHIVO
+# -------------------------
+
+# Las claves únicas de una tabla particionada incluyen la fecha: cita_servicios
+# y recordatorios_enviados apuntan a citas(id) sin clave foránea y sus filas se
+# borran junto con la cita (ver _SQL_BORRAR_CITAS) o al archivar la partición.
+ESQUEMA_ARCHIVO = "archivo"
+# Un solo proceso a la vez particiona, crea o archiva (cada worker tiene su scheduler)
+_SQL_CERROJO_PARTICIONES = "SELECT pg_advisory_xact_lock(hashtext('citas_particiones'));"
+_PARTICION = re.compile(r"citas_(\d{4})_(\d{2})")
+
+def _mes_siguiente(mes):
+    return (mes + timedelta(days=32)).replace(day=1)
+
+def _particiones_citas(cur):
+    """{primer día del mes: nombre} de las particiones enganchadas a citas."""
+    cur.execute(
+        """SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+           WHERE i.inhparent = 'citas'::regclass;"""
+    )
+    particiones = {}
+    for (nombre,) in cur.fetchall():
+        m = _PARTICION.fullmatch(nombre)
+        if m:
+            particiones[date(int(m.group(1)), int(m.group(2)), 1)] = nombre
+    return particiones
+
+def _crear_particiones_citas(cur, desde, hasta):
+    """Crea las particiones mensuales que falten entre los meses de 'desde' y 'hasta'."""
+    existentes = _particiones_citas(cur)
+    mes = desde.replace(day=1)
+    while mes <= hasta:
+        siguiente = _mes_siguiente(mes)
+        if mes not in existentes:
             cur.execute(
-                "SELECT horario_lunes, horario_martes, horario_miercoles, horario_jueves, horario_viernes, horario_sabado, horario_domingo FROM negocios WHERE id = %s;",
-                (negocio_id,)
+                f"CREATE TABLE IF NOT EXISTS citas_{mes:%Y_%m} PARTITION OF citas "
+                f"FOR VALUES FROM ('{mes.isoformat()}') TO ('{siguiente.isoformat()}');"
             )
-            return cur.fetchone()
+        mes = siguiente
+
+def _particionar_citas(cur):
+    """
+    Convierte la tabla citas en particionada por mes (una sola vez): misma
+    estructura, valores por defecto, secuencia y claves foráneas; clave
+    primaria (id, fecha); copia las filas y vuelve a instalar índices y trigger.
+    """
+    cur.execute("LOCK TABLE citas IN ACCESS EXCLUSIVE MODE;")
+    cur.execute(
+        "SELECT conrelid::regclass::text, conname FROM pg_constraint "
+        "WHERE confrelid = 'citas'::regclass AND contype = 'f';"
+    )
+    for tabla, nombre in cur.fetchall():
+        cur.execute(f'ALTER TABLE {tabla} DROP CONSTRAINT "{nombre}";')
+    cur.execute("SELECT pg_get_serial_sequence('citas', 'id');")
+    secuencia = cur.fetchone()[0]
+    cur.execute("ALTER TABLE citas RENAME TO citas_sin_particionar;")
+    cur.execute(
+        "CREATE TABLE citas (LIKE citas_sin_particionar INCLUDING DEFAULTS INCLUDING CONSTRAINTS) "
+        "PARTITION BY RANGE (fecha);"
+    )
+    cur.execute(
+        "SELECT conname, pg_get_constraintdef(oid) FROM pg_constraint "
+        "WHERE conrelid = 'citas_sin_particionar'::regclass AND contype = 'f';"
+    )
+    for nombre, definicion in cur.fetchall():
+        cur.execute(f'ALTER TABLE citas ADD CONSTRAINT "{nombre}" {definicion};')
+    # Si no, DROP TABLE se llevaría la secuencia (y guardar_reserva la busca por la columna)
+    cur.execute(f"ALTER SEQUENCE {secuencia} OWNED BY citas.id;")
+    cur.execute("SELECT MIN(fecha), MAX(fecha) FROM citas_sin_particionar;")
+    minima, maxima = cur.fetchone()
+    if minima:
+        _crear_particiones_citas(cur, minima, maxima)
+    cur.execute("INSERT INTO citas SELECT * FROM citas_sin_particionar;")
+    copiadas = cur.rowcount
+    cur.execute("DROP TABLE citas_sin_particionar;")
+    cur.execute("ALTER TABLE citas ADD PRIMARY KEY (id, fecha);")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_citas_negocio_fecha ON citas (negocio_id, fecha, hora);")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_citas_negocio_telefono ON citas (negocio_id, telefono, fecha);")
+    cur.execute(_SQL_NOTIFICACIONES_AGENDA)
+    log.info("Tabla citas particionada por mes (%d filas copiadas)", copiadas)
+
+def ensure_particiones_citas(dias_adelante=0):
+    """
+    Particiona citas por mes la primera vez y deja creadas las particiones
+    desde este mes hasta cubrir el horizonte de reserva más largo (el de los
+    negocios o 'dias_adelante') más un mes. Idempotente; el scheduler la
+    repite a diario.
+    """
+    conn = get_db_connection()
+    try:
+        with conn.cursor() as cur:
+            cur.execute(_SQL_CERROJO_PARTICIONES)
+            cur.execute("SELECT relkind FROM pg_class WHERE oid = 'citas'::regclass;")
+            if cur.fetchone()[0] != 'p':
+                _particionar_citas(cur)
+            cur.execute("SELECT CURRENT_DATE, COALESCE(MAX(horizonte_reserva_dias), 0) FROM negocios;")
+            hoy, horizonte = cur.fetchone()
+            hasta = hoy + timedelta(days=max(horizonte, dias_adelante))
+            _crear_particiones_citas(cur, hoy, _mes_siguiente(hasta))
+            conn.commit()
     finally:
         conn.close()
 
-def obtener_horas_ocupadas(fecha_str, negocio_id, empleado_id):
+def archivar_citas_antiguas(meses):
+    """
+    Desengancha las particiones de citas anteriores a hace 'meses' meses y las
+    mueve al esquema ESQUEMA_ARCHIVO, con sus líneas de servicio
+    (archivo.cita_servicios); sus recordatorios enviados se borran. Las
+    consultas sobre citas dejan de verlas. meses <= 0: no se archiva nada.
+    Devuelve los nombres de las particiones archivadas.
+    """
+    if meses <= 0:
+        return []
     conn = get_db_connection()
     try:
         with conn.cursor() as cur:
-            sql_citas = "SELECT TO_CHAR(hora, 'HH24:MI') FROM citas WHERE fecha = %s AND negocio_id = %s"
-            params_citas = [fecha_str, negocio_id]
-            if empleado_id:
-                sql_citas += " AND empleado_id = %s"
-                params_citas.append(empleado_id)
-            sql_bloqueos = "SELECT TO_CHAR(hora, 'HH24:MI') FROM bloqueos WHERE fecha = %s AND negocio_id = %s"
-            params_bloqueos = [fecha_str, negocio_id]
-            if empleado_id:
-                sql_bloqueos += " AND (empleado_id IS NULL OR empleado_id = %s)"
-                params_bloqueos.append(empleado_id)
-            else:
-                sql_bloqueos += " AND (empleado_id IS NULL OR empleado_id IS NOT NULL)"
-            final_sql = f"({sql_citas}) UNION ({sql_bloqueos});"
-            cur.execute(final_sql, tuple(params_citas + params_bloqueos))
-            return [row[0] for row in cur.fetchall()]
+            cur.execute("SELECT date_trunc('month', CURRENT_DATE)::date;")
+            limite = cur.fetchone()[0]
+            for _ in range(meses):
+                limite = (limite - timedelta(days=1)).replace(day=1)
+            antiguas = [nombre for mes, nombre in sorted(_particiones_citas(cur).items())
+                        if _mes_siguiente(mes) <= limite]
+            if not antiguas:
+                conn.rollback()
+                return []
+            cur.execute(f"CREATE SCHEMA IF NOT EXISTS {ESQUEMA_ARCHIVO};")
+            cur.execute(f"CREATE TABLE IF NOT EXISTS {ESQUEMA_ARCHIVO}.cita_servicios (LIKE cita_servicios INCLUDING ALL);")
+            conn.commit()
+            archivadas = []
+            for nombre in antiguas:
+                cur.execute(_SQL_CERROJO_PARTICIONES)
+                if nombre not in _particiones_citas(cur).values():
+                    conn.rollback()
+                    continue  # ya la ha archivado otro proceso
+                cur.execute(f"DELETE FROM recordatorios_enviados WHERE cita_id IN (SELECT id FROM {nombre});")
+                cur.execute(
+                    f"""WITH movidas AS (
+                            DELETE FROM cita_servicios WHERE cita_id IN (SELECT id FROM {nombre}) RETURNING *
+                        )
+                        INSERT INTO {ESQUEMA_ARCHIVO}.cita_servicios SELECT * FROM movidas ON CONFLICT DO NOTHING;"""
+                )
+                cur.execute(f"ALTER TABLE citas DETACH PARTITION {nombre};")
+                cur.execute(f"ALTER TABLE {nombre} SET SCHEMA {ESQUEMA_ARCHIVO};")
+                conn.commit()
+                archivadas.append(nombre)
+                log.info("Partición %s archivada en %s", nombre, ESQUEMA_ARCHIVO)
+            return archivadas
     finally:
         conn.close()
 
-def guardar_reserva(datos, negocio_id):
+def _incrementar_version_config(cur, negocio_id):
+    cur.execute(
+        """INSERT INTO agenda_versiones (negocio_id, fecha) VALUES (%s, %s)
+           ON CONFLICT (negocio_id, fecha) DO UPDATE SET version = agenda_versiones.version + 1;""",
+        (negocio_id, FECHA_VERSION_CONFIG)
+    )
+    # Aviso a los procesos (horarios compilados, paneles abiertos); sale con el COMMIT
+    cur.execute(
+        "SELECT pg_notify(%s, %s);",
+        (CANAL_AGENDA, json.dumps({"tabla": "negocios", "op": "config", "negocio_id": negocio_id}))
+    )
+
+def obtener_version_agenda(negocio_id, fecha_desde, fecha_hasta=None):
     """
-    Inserta la cita y, si viene 'email' en datos, realiza upsert en clientes.
-    datos = {
-        'nombre', 'telefono', 'servicio', 'fecha', 'hora', 'empleado_id',  # (oblig/opt)
-        'email' (opcional, para persistir cliente)
-    }
+    Versión de la agenda de [fecha_desde, fecha_hasta] como texto "<días>.<config>".
+    Cambia con cualquier cita/bloqueo de esos días o edición del negocio.
+    Una sola lectura por clave primaria: sirve para responder 304 sin consultar la agenda.
     """
     conn = get_db_connection()
     try:
         with conn.cursor() as cur:
             cur.execute(
-                "SELECT id FROM servicios WHERE nombre = %s AND negocio_id = %s;",
-                (datos['servicio'], negocio_id)
-            )
-            servicio_id = cur.fetchone()[0]
-            cur.execute(
-                """INSERT INTO citas (negocio_id, nombre_cliente, telefono, servicio_id, fecha, hora, empleado_id) 
-                   VALUES (%s, %s, %s, %s, %s, %s, %s);""",
-                (negocio_id, datos['nombre'], datos['telefono'], servicio_id, datos['fecha'], datos['hora'], datos.get('empleado_id'))
+                """SELECT COALESCE(SUM(version) FILTER (WHERE fecha BETWEEN %s AND %s), 0),
+                          COALESCE(SUM(version) FILTER (WHERE fecha = %s), 0)
+                   FROM agenda_versiones
+                   WHERE negocio_id = %s AND (fecha BETWEEN %s AND %s OR fecha = %s);""",
+                (fecha_desde, fecha_hasta or fecha_desde, FECHA_VERSION_CONFIG,
+                 negocio_id, fecha_desde, fecha_hasta or fecha_desde, FECHA_VERSION_CONFIG)
             )
-            # --- NUEVO: persistir cliente si se pasó email ---
-            email = datos.get('email')
-            if email:
-                upsert_cliente(negocio_id, datos['telefono'], email, datos.get('nombre'))
-            conn.commit()
+            dias, conf = cur.fetchone()
+            return f"{dias}.{conf}"
     finally:
         conn.close()
 
 def obtener_citas_futuras_por_telefono(telefono, negocio_id):
     conn = get_db_connection()
     try:
-        with conn.cursor(cursor_factory=psycopg2.extras.DictCursor) as cur:
+        with conn.cursor(cursor_factory=_extras().DictCursor) as cur:
             cur.execute(
-                """SELECT c.id, c.fecha, c.hora, s.nombre as servicio_nombre, e.nombre as empleado_nombre
+                f"""SELECT c.id, c.fecha, c.hora, c.duracion_min, {_SQL_SERVICIOS_CITA} AS servicio_nombre, e.nombre as empleado_nombre,
+                          COALESCE((SELECT array_agg(cs.nombre ORDER BY cs.orden) FROM cita_servicios cs
+                                    WHERE cs.cita_id = c.id), ARRAY[s.nombre]) AS servicios
                    FROM citas c 
                    JOIN servicios s ON c.servicio_id = s.id
                    LEFT JOIN empleados e ON c.empleado_id = e.id
                    WHERE c.telefono = %s AND c.negocio_id = %s AND c.fecha >= NOW()::date;""",
-                (telefono, negocio_id)
+                (_telefono(telefono), negocio_id)
             )
             return cur.fetchall()
     finally:
@@ -322,14 +1929,15 @@ def obtener_cita_detalle(cita_id):
     """Devuelve un dict con detalles completos de la cita (incluye email del negocio)."""
     conn = get_db_connection()
     try:
-        with conn.cursor(cursor_factory=psycopg2.extras.DictCursor) as cur:
+        with conn.cursor(cursor_factory=_extras().DictCursor) as cur:
             cur.execute(
-                """
+                f"""
                 SELECT 
                     c.id, c.negocio_id, c.nombre_cliente, c.telefono, c.fecha, c.hora,
-                    c.servicio_id, s.nombre AS servicio_nombre,
+                    c.servicio_id, {_SQL_SERVICIOS_CITA} AS servicio_nombre, c.duracion_min,
                     c.empleado_id, e.nombre AS empleado_nombre,
-                    n.email AS negocio_email, n.nombre AS negocio_nombre
+                    n.email AS negocio_email, n.nombre AS negocio_nombre,
+                    {_SQL_LINEAS_JSON} AS lineas
                 FROM citas c
                 JOIN servicios s ON c.servicio_id = s.id
                 LEFT JOIN empleados e ON c.empleado_id = e.id
@@ -365,7 +1973,7 @@ def cancelar_cita(cita_id, negocio_id):
     conn = get_db_connection()
     try:
         with conn.cursor() as cur:
-            cur.execute("DELETE FROM citas WHERE id = %s AND negocio_id = %s;", (cita_id, negocio_id))
+            cur.execute(_SQL_BORRAR_CITAS.format("id = %s AND negocio_id = %s"), (cita_id, negocio_id))
             conn.commit()
     finally:
         conn.close()
@@ -373,7 +1981,12 @@ def cancelar_cita(cita_id, negocio_id):
 
 def modificar_cita(cita_id, negocio_id, nuevos_datos):
     """
-    Modifica una cita. Devuelve (antes, despues) como dicts para email.
+    Modifica una cita. Devuelve (antes, despues) como dicts para email;
+    (antes, None) si con los cambios ya no cabe (se solapa con otra cita,
+    bloqueo o retención, o no hay plazas en algún recurso) y no se ha tocado.
+    nuevos_datos: 'servicios' (nombres; sustituyen las líneas, la duración y los recursos)
+    o 'servicio' (uno solo), y/o 'fecha' + 'hora'; 'titular' (opcional): sus
+    retenciones no cuentan como ocupadas.
     """
     antes = obtener_cita_detalle(cita_id)
     if not antes or antes.get('negocio_id') != negocio_id:
@@ -382,14 +1995,44 @@ def modificar_cita(cita_id, negocio_id, nuevos_datos):
     conn = get_db_connection()
     try:
         with conn.cursor() as cur:
-            if 'servicio' in nuevos_datos:
-                cur.execute("SELECT id FROM servicios WHERE nombre = %s AND negocio_id = %s;", (nuevos_datos['servicio'], negocio_id))
-                servicio_row = cur.fetchone()
-                if servicio_row:
-                    servicio_id = servicio_row[0]
-                    cur.execute("UPDATE citas SET servicio_id = %s WHERE id = %s;", (servicio_id, cita_id))
-            if 'fecha' in nuevos_datos and 'hora' in nuevos_datos:
-                cur.execute("UPDATE citas SET fecha = %s, hora = %s WHERE id = %s;", (nuevos_datos['fecha'], nuevos_datos['hora'], cita_id))
+            nombres = nuevos_datos.get('servicios') or ([nuevos_datos['servicio']] if 'servicio' in nuevos_datos else [])
+            lineas = []
+            if nombres:
+                try:
+                    lineas = _lineas_servicio(cur, negocio_id, nombres)
+                except KeyError:
+                    pass  # algún servicio ya no existe: se deja como estaba
+            mover = 'fecha' in nuevos_datos and 'hora' in nuevos_datos
+            if not (lineas or mover):
+                return antes, antes
+            cur.execute(
+                "SELECT fecha, TO_CHAR(hora, 'HH24:MI'), empleado_id, duracion_min, recursos FROM citas WHERE id = %s;",
+                (cita_id,)
+            )
+            fecha, hora, empleado_id, duracion, recursos = cur.fetchone()
+            if mover:
+                fecha, hora = nuevos_datos['fecha'], nuevos_datos['hora']
+            if lineas:
+                duracion, recursos = _duracion_lineas(lineas), _recursos_lineas(cur, lineas)
+            # El tramo nuevo (o más largo) tiene que seguir libre, sin contar la propia cita
+            _bloquear_dia(cur, negocio_id, fecha)
+            cur.execute(
+                "SELECT " + _SQL_HUECO_LIBRE + ";",
+                _params_hueco_libre(negocio_id, fecha, hora, empleado_id, nuevos_datos.get('titular'),
+                                    duracion, recursos, cita_id=cita_id)
+            )
+            if not cur.fetchone()[0]:
+                conn.rollback()
+                return antes, None
+            if lineas:
+                cur.execute("DELETE FROM cita_servicios WHERE cita_id = %s;", (cita_id,))
+                _insertar_lineas_cita(cur, cita_id, lineas)
+                cur.execute(
+                    "UPDATE citas SET servicio_id = %s, duracion_min = %s, recursos = %s::jsonb WHERE id = %s;",
+                    (lineas[0][0], duracion, _json_recursos(recursos), cita_id)
+                )
+            if mover:
+                cur.execute("UPDATE citas SET fecha = %s, hora = %s WHERE id = %s;", (fecha, hora, cita_id))
         conn.commit()
     finally:
         conn.close()
@@ -404,9 +2047,10 @@ def modificar_cita(cita_id, negocio_id, nuevos_datos):
 def obtener_citas_para_exportar(negocio_id, fecha_inicio, fecha_fin):
     conn = get_db_connection()
     try:
-        with conn.cursor(cursor_factory=psycopg2.extras.DictCursor) as cur:
-            sql = """
-                SELECT c.fecha, c.hora, c.nombre_cliente, c.telefono, s.nombre AS servicio_nombre, e.nombre AS empleado_nombre, s.precio
+        with conn.cursor(cursor_factory=_extras().DictCursor) as cur:
+            sql = f"""
+                SELECT c.fecha, c.hora, c.nombre_cliente, c.telefono, {_SQL_SERVICIOS_CITA} AS servicio_nombre, e.nombre AS empleado_nombre,
+                       {_SQL_PRECIO_CITA} AS precio, c.duracion_min
                 FROM citas c JOIN servicios s ON c.servicio_id = s.id LEFT JOIN empleados e ON c.empleado_id = e.id
                 WHERE c.negocio_id = %s AND c.fecha BETWEEN %s AND %s
                 ORDER BY c.fecha, c.hora;
@@ -419,10 +2063,10 @@ def obtener_citas_para_exportar(negocio_id, fecha_inicio, fecha_fin):
 def obtener_citas_del_dia(negocio_id, fecha):
     conn = get_db_connection()
     try:
-        with conn.cursor(cursor_factory=psycopg2.extras.DictCursor) as cur:
-            sql = """
+        with conn.cursor(cursor_factory=_extras().DictCursor) as cur:
+            sql = f"""
                 SELECT 
-                    c.id, c.hora, c.nombre_cliente, c.telefono, s.nombre AS servicio_nombre, e.nombre AS empleado_nombre
+                    c.id, c.hora, c.nombre_cliente, c.telefono, {_SQL_SERVICIOS_CITA} AS servicio_nombre, e.nombre AS empleado_nombre
                 FROM citas c JOIN servicios s ON c.servicio_id = s.id LEFT JOIN empleados e ON c.empleado_id = e.id
                 WHERE c.negocio_id = %s AND c.fecha = %s
                 ORDER BY c.hora;
@@ -432,19 +2076,63 @@ def obtener_citas_del_dia(negocio_id, fecha):
     finally:
         conn.close()
 
+def obtener_agenda_rango(negocio_id, fecha_desde, fecha_hasta, empleado_id=None):
+    """
+    Citas y bloqueos de [fecha_desde, fecha_hasta] en una sola consulta (para
+    las vistas semana/mes). Filas: tipo ('cita' | 'bloqueo'), id, fecha, hora
+    ('HH:MM'), empleado_id, nombre_cliente, servicio_nombre, empleado_nombre.
+    """
+    conn = get_db_connection()
+    try:
+        with conn.cursor(cursor_factory=_extras().DictCursor) as cur:
+            filtro_citas = ""
+            filtro_bloqueos = ""
+            params_citas = [negocio_id, fecha_desde, fecha_hasta]
+            params_bloqueos = [negocio_id, fecha_desde, fecha_hasta]
+            if empleado_id:
+                filtro_citas = " AND c.empleado_id = %s"
+                params_citas.append(empleado_id)
+                filtro_bloqueos = " AND (b.empleado_id IS NULL OR b.empleado_id = %s)"
+                params_bloqueos.append(empleado_id)
+            sql = f"""
+                SELECT 'cita' AS tipo, c.id, c.fecha, TO_CHAR(c.hora, 'HH24:MI') AS hora, c.empleado_id,
+                       c.nombre_cliente, {_SQL_SERVICIOS_CITA} AS servicio_nombre, e.nombre AS empleado_nombre
+                FROM citas c
+                LEFT JOIN servicios s ON c.servicio_id = s.id
+                LEFT JOIN empleados e ON c.empleado_id = e.id
+                WHERE c.negocio_id = %s AND c.fecha BETWEEN %s AND %s{filtro_citas}
+                UNION ALL
+                SELECT 'bloqueo', b.id, b.fecha, TO_CHAR(b.hora, 'HH24:MI'), b.empleado_id,
+                       NULL, NULL, NULL
+                FROM bloqueos b
+                WHERE b.negocio_id = %s AND b.fecha BETWEEN %s AND %s{filtro_bloqueos}
+                ORDER BY 3, 4;
+            """
+            cur.execute(sql, tuple(params_citas + params_bloqueos))
+            return cur.fetchall()
+    finally:
+        conn.close()
+
 def cancelar_cita_cliente(cita_id, negocio_id):
     # Mantener función existente, pero devolviendo el detalle previo para consistencia
     return cancelar_cita(cita_id, negocio_id)
 
-def obtener_todas_las_citas(negocio_id):
+def listar_citas(negocio_id, despues=None, limite=LISTADO_PAGINA_MAX):
+    """
+    Citas del negocio por fecha y hora, como mucho 'limite', a continuación de
+    'despues' ((fecha, hora, id) de la última de la página anterior). Recorre
+    idx_citas_negocio_fecha; solo las particiones activas (sin archivar).
+    """
+    despues_sql = "AND (fecha, hora, id) > (%s, %s, %s)" if despues else ""
     conn = get_db_connection()
     try:
-        with conn.cursor(cursor_factory=psycopg2.extras.DictCursor) as cur:
-            sql = """
-                SELECT fecha, hora, nombre_cliente, telefono
-                FROM citas WHERE negocio_id = %s ORDER BY fecha, hora;
-            """
-            cur.execute(sql, (negocio_id,))
+        with conn.cursor(cursor_factory=_extras().DictCursor) as cur:
+            cur.execute(
+                f"""SELECT id, fecha, hora, nombre_cliente, telefono
+                    FROM citas WHERE negocio_id = %s {despues_sql}
+                    ORDER BY fecha, hora, id LIMIT %s;""",
+                (negocio_id, *(despues or ()), _limite_listado(limite))
+            )
             return cur.fetchall()
     finally:
         conn.close()
@@ -452,7 +2140,7 @@ def obtener_todas_las_citas(negocio_id):
 def obtener_horas_bloqueadas(negocio_id, fecha):
     conn = get_db_connection()
     try:
-        with conn.cursor(cursor_factory=psycopg2.extras.DictCursor) as cur:
+        with conn.cursor(cursor_factory=_extras().DictCursor) as cur:
             sql = "SELECT hora, empleado_id FROM bloqueos WHERE negocio_id = %s AND fecha = %s"
             cur.execute(sql, (negocio_id, fecha))
             return cur.fetchall()
@@ -469,6 +2157,37 @@ def crear_bloqueo(negocio_id, fecha, hora, empleado_id=None):
     finally:
         conn.close()
 
+def guardar_bloqueos_dia(negocio_id, fecha, horas_jornada, horas_bloqueadas):
+    """
+    Deja bloqueadas (sin profesional) exactamente 'horas_bloqueadas' de entre
+    'horas_jornada', en una transacción. Solo se tocan las horas que cambian:
+    borrar y volver a crear un bloqueo que sigue igual publicaría una 'baja'
+    falsa en la agenda (y la lista de espera ofrecería ese hueco).
+    """
+    horas_jornada = [str(h) for h in horas_jornada]
+    horas_bloqueadas = [h for h in (str(h) for h in horas_bloqueadas) if h in horas_jornada]
+    conn = get_db_connection()
+    try:
+        with conn.cursor() as cur:
+            _bloquear_dia(cur, negocio_id, fecha)
+            cur.execute(
+                """DELETE FROM bloqueos
+                   WHERE negocio_id = %s AND fecha = %s AND empleado_id IS NULL
+                     AND hora = ANY(%s::time[]) AND hora <> ALL(%s::time[]);""",
+                (negocio_id, fecha, horas_jornada, horas_bloqueadas)
+            )
+            cur.execute(
+                """INSERT INTO bloqueos (negocio_id, fecha, hora, empleado_id)
+                   SELECT %s, %s, h, NULL FROM unnest(%s::time[]) h
+                   WHERE NOT EXISTS (SELECT 1 FROM bloqueos b
+                                     WHERE b.negocio_id = %s AND b.fecha = %s
+                                       AND b.hora = h AND b.empleado_id IS NULL);""",
+                (negocio_id, fecha, horas_bloqueadas, negocio_id, fecha)
+            )
+            conn.commit()
+    finally:
+        conn.close()
+
 def eliminar_bloqueo(negocio_id, fecha, hora, empleado_id=None):
     conn = get_db_connection()
     try:
@@ -495,12 +2214,12 @@ def obtener_ultima_cita_pasada(telefono, negocio_id):
     """
     conn = get_db_connection()
     try:
-        with conn.cursor(cursor_factory=psycopg2.extras.DictCursor) as cur:
+        with conn.cursor(cursor_factory=_extras().DictCursor) as cur:
             cur.execute(
-                """
+                f"""
                 SELECT 
                     c.id, c.negocio_id, c.nombre_cliente, c.telefono, c.fecha, c.hora,
-                    c.servicio_id, s.nombre AS servicio_nombre,
+                    c.servicio_id, {_SQL_SERVICIOS_CITA} AS servicio_nombre,
                     c.empleado_id, e.nombre AS empleado_nombre,
                     n.email AS negocio_email, n.nombre AS negocio_nombre
                 FROM citas c
@@ -511,7 +2230,7 @@ def obtener_ultima_cita_pasada(telefono, negocio_id):
                 ORDER BY c.fecha DESC
                 LIMIT 1;
                 """,
-                (telefono, negocio_id)
+                (_telefono(telefono), negocio_id)
             )
             row = cur.fetchone()
             return dict(row) if row else None
@@ -551,10 +2270,10 @@ def obtener_citas_para_recordatorio_2h(desde_dt, hasta_dt):
     """
     conn = get_db_connection()
     try:
-        with conn.cursor(cursor_factory=psycopg2.extras.DictCursor) as cur:
-            cur.execute("""
-                SELECT c.id, c.negocio_id, c.fecha, c.hora, c.nombre_cliente, c.telefono,
-                       s.nombre AS servicio_nombre,
+        with conn.cursor(cursor_factory=_extras().DictCursor) as cur:
+            cur.execute(f"""
+                SELECT c.id, c.negocio_id, c.fecha, c.hora, c.nombre_cliente, c.telefono, c.duracion_min,
+                       {_SQL_SERVICIOS_CITA} AS servicio_nombre, {_SQL_LINEAS_JSON} AS lineas,
                        e.nombre AS empleado_nombre,
                        n.nombre AS negocio_nombre, n.slug AS negocio_slug, n.email AS negocio_email, n.direccion,
                        cli.email AS cliente_email
@@ -0,0 +1,264 @@
+# disponibilidad.py
+"""
+Búsquedas de disponibilidad que abarcan varios días y profesionales.
+
+El horario sale compilado de horarios.py y la ocupación (citas, bloqueos y
+retenciones de otros usuarios) del índice en memoria de ocupacion.py por
+rangos de fechas; se recorre en orden cronológico cortando en cuanto hay
+suficientes resultados.
+
+'duracion' (minutos, la suma de los servicios elegidos) convierte cada
+pregunta en "¿caben tantos huecos seguidos desde esta hora, dentro del
+horario?": se resuelve con los mapas de bits del día de una vez, no hora a
+hora. Sin duración, un hueco, como antes.
+
+'necesidades' ({recurso_id: cantidad}, ver recursos.necesidades) añade que
+los recursos con plazas del negocio (sillas, cabinas...) tengan sitio en todo
+el tramo, contando las unidades en uso de cada hueco.
+"""
+from datetime import timedelta
+import calendar
+import config
+import database
+import horarios
+import ocupacion
+import utils
+
+# Días por delante que se pueden reservar, salvo que el negocio fije los suyos
+HORIZONTE_BUSQUEDA_DIAS = int(getattr(config, "HORIZONTE_BUSQUEDA_DIAS", 30))
+BLOQUE_DIAS = 7  # días leídos por consulta mientras se busca hacia delante
+CALENDARIO_DIAS_PAGINA = int(getattr(config, "CALENDARIO_DIAS_PAGINA", 14))
+
+# Valor de empleado_id para "cualquier profesional"
+CUALQUIERA = "any"
+
+def horizonte_dias(negocio_id):
+    """Días por delante (desde hoy) que se pueden reservar en ese negocio."""
+    return horarios.horario(negocio_id).horizonte_dias or HORIZONTE_BUSQUEDA_DIAS
+
+def _inicios(horario, vista, fecha, empleado_id, huecos, necesidades=None):
+    """Mapa de huecos desde los que ese profesional puede atender algo de 'huecos' huecos esa fecha."""
+    return vista.inicios_libres(empleado_id, huecos, horario.jornada(fecha, empleado_id), necesidades)
+
+def horas_libres(negocio_id, fecha, horas_jornada, empleado_id=None, titular=None, duracion=None,
+                 necesidades=None):
+    """
+    Horas de 'horas_jornada' desde las que caben 'duracion' minutos libres
+    para ese profesional (empleado_id None: libres de cualquier ocupación),
+    en orden.
+    """
+    inicios = _inicios(horarios.horario(negocio_id), ocupacion.vista_dia(negocio_id, fecha, titular),
+                       fecha, empleado_id or None, ocupacion.huecos_de(duracion), necesidades)
+    return [h for h in horas_jornada if (inicios >> ocupacion.hueco(h)) & 1]
+
+def horas_libres_cualquiera(negocio_id, fecha, titular=None, duracion=None, necesidades=None):
+    """
+    Horas de esa fecha desde las que al menos un profesional trabaja y tiene
+    'duracion' minutos libres (unión de la disponibilidad de todos).
+    """
+    ids = [e['id'] for e in database.listar_empleados(negocio_id)]
+    horario = horarios.horario(negocio_id)
+    return ocupacion.vista_dia(negocio_id, fecha, titular).libres_alguno(
+        ids, horario.horas_alguno(fecha, ids), horario.jornadas(fecha, ids), ocupacion.huecos_de(duracion),
+        necesidades
+    )
+
+def empleados_libres_por_carga(negocio_id, fecha, hora, titular=None, duracion=None, necesidades=None):
+    """
+    Profesionales con 'duracion' minutos libres desde esa hora, del menos al
+    más cargado ese día (empate: orden de alta). Lista de (empleado_id, nombre).
+    """
+    empleados = database.listar_empleados(negocio_id)
+    horario = horarios.horario(negocio_id)
+    dia = ocupacion.vista_dia(negocio_id, fecha, titular)
+    huecos = ocupacion.huecos_de(duracion)
+    h = ocupacion.hueco(hora)
+    libres = [
+        (e['id'], e['nombre'].strip())
+        for e in empleados
+        if (_inicios(horario, dia, fecha, e['id'], huecos, necesidades) >> h) & 1
+    ]
+    libres.sort(key=lambda emp: dia.carga.get(emp[0], 0))
+    return libres
+
+# -------------------------
+# Agenda por rangos (vistas semana / mes del panel)
+# -------------------------
+
+def rango_vista(vista, fecha):
+    """(desde, hasta, anterior, siguiente) para la vista 'semana' o 'mes' que contiene 'fecha'."""
+    if vista == 'mes':
+        desde = fecha.replace(day=1)
+        hasta = fecha.replace(day=calendar.monthrange(fecha.year, fecha.month)[1])
+        anterior = (desde - timedelta(days=1)).replace(day=1)
+        siguiente = hasta + timedelta(days=1)
+    else:
+        desde = fecha - timedelta(days=fecha.weekday())
+        hasta = desde + timedelta(days=6)
+        anterior = desde - timedelta(days=7)
+        siguiente = desde + timedelta(days=7)
+    return desde, hasta, anterior, siguiente
+
+def agenda_rango(negocio_id, desde, hasta, empleado_id=None):
+    """
+    Agenda compilada de [desde, hasta]: el horario se resuelve una vez y las
+    citas/bloqueos llegan en una sola consulta. Devuelve un dict serializable
+    a JSON con las horas del rango y, por día, las citas y bloqueos de cada
+    hora y el porcentaje de ocupación.
+    """
+    horario = horarios.horario(negocio_id)
+    empleados = database.listar_empleados(negocio_id)
+    # Plazas por hora: un profesional si se filtra por uno, si no todos (mínimo 1)
+    plazas = 1 if empleado_id else max(1, len(empleados))
+
+    por_dia = {}
+    for fila in database.obtener_agenda_rango(negocio_id, desde, hasta, empleado_id=empleado_id):
+        celda = por_dia.setdefault(fila['fecha'], {}).setdefault(
+            fila['hora'], {"citas": [], "bloqueos_empleado": 0, "bloqueado": False}
+        )
+        if fila['tipo'] == 'cita':
+            celda["citas"].append({
+                "id": fila['id'],
+                "nombre_cliente": fila['nombre_cliente'],
+                "servicio_nombre": fila['servicio_nombre'],
+                "empleado_nombre": fila['empleado_nombre'] or 'No asignado',
+            })
+        elif fila['empleado_id'] is None:
+            celda["bloqueado"] = True
+        else:
+            celda["bloqueos_empleado"] += 1
+
+    dias = []
+    todas_las_horas = set()
+    dia = desde
+    while dia <= hasta:
+        horas = horario.horas(dia, empleado_id)
+        celdas = por_dia.get(dia, {})
+        usadas = 0
+        n_citas = 0
+        horas_dia = {}
+        for hora in horas:
+            celda = celdas.get(hora)
+            if not celda:
+                continue
+            n_citas += len(celda["citas"])
+            if empleado_id and celda["bloqueos_empleado"]:
+                celda["bloqueado"] = True
+            if celda["bloqueado"]:
+                usadas += plazas
+            else:
+                usadas += min(plazas, len(celda["citas"]) + celda["bloqueos_empleado"])
+            horas_dia[hora] = {"citas": celda["citas"], "bloqueado": celda["bloqueado"]}
+        capacidad = len(horas) * plazas
+        todas_las_horas.update(horas)
+        dias.append({
+            "fecha": dia.isoformat(),
+            "nombre": utils.formato_nombre_dia_es(dia),
+            "abierto": bool(horas),
+            "horas_jornada": horas,
+            "horas": horas_dia,
+            "citas": n_citas,
+            "ocupacion": round(100 * usadas / capacidad) if capacidad else 0,
+        })
+        dia += timedelta(days=1)
+
+    return {
+        "negocio_id": negocio_id,
+        "desde": desde.isoformat(),
+        "hasta": hasta.isoformat(),
+        "empleado_id": empleado_id,
+        "empleados": [{"id": e['id'], "nombre": e['nombre'].strip()} for e in empleados],
+        "horas": sorted(todas_las_horas, key=lambda h: tuple(int(p) for p in h.split(':'))),
+        "dias": dias,
+    }
+
+def _hora_ya_pasada(fecha, hora, ahora):
+    return fecha < ahora.date() or (fecha == ahora.date() and int(hora.split(':')[0]) <= ahora.hour)
+
+def _candidatos(negocio_id, empleado_id):
+    """[(empleado_id, nombre)] a probar en cada hora, según empleado_id (ver primer_hueco_disponible)."""
+    if empleado_id == CUALQUIERA:
+        empleados = database.listar_empleados(negocio_id)
+        return [(e['id'], e['nombre'].strip()) for e in empleados] or [(None, None)]
+    if empleado_id is None:
+        return [(None, None)]
+    nombres = {e['id']: e['nombre'].strip() for e in database.listar_empleados(negocio_id)}
+    return [(empleado_id, nombres.get(empleado_id))]
+
+def dias_con_hueco(negocio_id, empleado_id, desde, hasta, titular=None, duracion=None, necesidades=None):
+    """
+    Fechas de [desde, hasta] con al menos una hora desde la que caben
+    'duracion' minutos (empleado_id como en primer_hueco_disponible), en
+    orden, con una sola lectura del rango.
+    """
+    horario = horarios.horario(negocio_id)
+    if not horario.tiene_horas or hasta < desde:
+        return []
+    candidatos = _candidatos(negocio_id, empleado_id)
+    ids_candidatos = [cand_id for cand_id, _ in candidatos if cand_id is not None]
+    huecos = ocupacion.huecos_de(duracion)
+    ahora = utils.now_spain()
+    libres = []
+    for dia, ocupacion_dia in sorted(ocupacion.dias(negocio_id, desde, hasta, titular).items()):
+        inicios = 0
+        for cand_id, _ in candidatos:
+            inicios |= _inicios(horario, ocupacion_dia, dia, cand_id, huecos, necesidades)
+        if any((inicios >> ocupacion.hueco(hora)) & 1
+               for hora in horario.horas_alguno(dia, ids_candidatos)
+               if not _hora_ya_pasada(dia, hora, ahora)):
+            libres.append(dia)
+    return libres
+
+def primer_hueco_disponible(negocio_id, duracion, empleado_id, desde, limite=3, titular=None,
+                            necesidades=None, hasta=None):
+    """
+    Devuelve los 'limite' huecos libres más cercanos a partir de 'desde' (y
+    hasta 'hasta', si se da; si no, el horizonte del negocio) en los que caben
+    'duracion' minutos (None: un hueco), como lista de dicts
+    {fecha, hora, empleado_id, empleado_nombre}, sin repetir (fecha, hora).
+
+    empleado_id:
+      - id concreto: solo ese profesional.
+      - CUALQUIERA: el primer profesional libre a esa hora.
+      - None: criterio sin profesional (cualquier ocupación bloquea la hora).
+    """
+    horario = horarios.horario(negocio_id)
+    if not horario.tiene_horas:
+        return []
+
+    candidatos = _candidatos(negocio_id, empleado_id)
+    ids_candidatos = [cand_id for cand_id, _ in candidatos if cand_id is not None]
+    huecos = ocupacion.huecos_de(duracion)
+    ahora = utils.now_spain()
+    fin_horizonte = ahora.date() + timedelta(days=horario.horizonte_dias or HORIZONTE_BUSQUEDA_DIAS)
+    if hasta is not None:
+        fin_horizonte = min(fin_horizonte, hasta)
+    bloque_ini = max(desde, ahora.date())
+    resultados = []
+
+    while bloque_ini <= fin_horizonte:
+        bloque_fin = min(bloque_ini + timedelta(days=BLOQUE_DIAS - 1), fin_horizonte)
+        ocupacion_bloque = ocupacion.dias(negocio_id, bloque_ini, bloque_fin, titular)
+        dia = bloque_ini
+        while dia <= bloque_fin:
+            ocupacion_dia = ocupacion_bloque[dia]
+            inicios = [_inicios(horario, ocupacion_dia, dia, cand_id, huecos, necesidades)
+                       for cand_id, _ in candidatos]
+            for hora in horario.horas_alguno(dia, ids_candidatos):
+                if _hora_ya_pasada(dia, hora, ahora):
+                    continue
+                h = ocupacion.hueco(hora)
+                for (cand_id, cand_nombre), inicios_cand in zip(candidatos, inicios):
+                    if (inicios_cand >> h) & 1:
+                        resultados.append({
+                            "fecha": dia.isoformat(),
+                            "hora": hora,
+                            "empleado_id": cand_id,
+                            "empleado_nombre": cand_nombre,
+                        })
+                        break
+                if len(resultados) >= limite:
+                    return resultados
+            dia += timedelta(days=1)
+        bloque_ini = bloque_fin + timedelta(days=1)
+    return resultados
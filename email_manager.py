@@ -9,8 +9,12 @@ from email import encoders
 from datetime import datetime, timedelta
 import uuid
 import re
-from jinja2 import Environment, FileSystemLoader, select_autoescape
+import time
 import config
+import metrics
+import log_manager
+
+log = log_manager.get_logger("email_manager")
 
 SMTP_SERVER = getattr(config, "MAIL_SMTP", "smtp.gmail.com")
 SMTP_PORT = int(getattr(config, "MAIL_PORT", 587))
@@ -31,10 +35,17 @@ BRAND_LOGOS = {
 }
 
 TEMPLATES_DIR = os.path.join(os.getcwd(), "templates", "email")
-_env = Environment(
-    loader=FileSystemLoader(TEMPLATES_DIR),
-    autoescape=select_autoescape(["html", "xml"])
-)
+_env = None  # entorno Jinja de los emails: se crea con el primer envío, no al importar
+
+def _entorno():
+    global _env
+    if _env is None:
+        from jinja2 import Environment, FileSystemLoader, select_autoescape
+        _env = Environment(
+            loader=FileSystemLoader(TEMPLATES_DIR),
+            autoescape=select_autoescape(["html", "xml"])
+        )
+    return _env
 
 def _slugify(texto: str) -> str:
     t = (texto or "").strip().lower()
@@ -78,14 +89,14 @@ def _cargar_logo_bytes(logo_path: str | None):
     except Exception:
         return None, None
 
-def _formatear_fecha_hora_es(fecha_iso: str | datetime, hora_hhmm: str):
+def _formatear_fecha_hora_es(fecha_iso: str | datetime, hora_hhmm: str, duracion: int | None = None):
     if isinstance(fecha_iso, datetime):
         fecha = fecha_iso.date()
     else:
         fecha = datetime.fromisoformat(fecha_iso).date()
     h, m = map(int, hora_hhmm.split(":"))
     dt_inicio = datetime(fecha.year, fecha.month, fecha.day, h, m, 0)
-    dt_fin = dt_inicio + timedelta(minutes=DURACION_DEF_MIN)
+    dt_fin = dt_inicio + timedelta(minutes=duracion or DURACION_DEF_MIN)
     dias = ["lunes","martes","miércoles","jueves","viernes","sábado","domingo"]
     meses = ["enero","febrero","marzo","abril","mayo","junio","julio","agosto","septiembre","octubre","noviembre","diciembre"]
     fecha_legible = f"{dias[dt_inicio.weekday()]}, {dt_inicio.day} de {meses[dt_inicio.month-1]} de {dt_inicio.year}"
@@ -118,7 +129,7 @@ def _build_ics(datos: dict, tipo: str, sequence: int | None = None) -> bytes:
     email_negocio = datos.get("email_negocio")
     email_cliente = datos.get("email_cliente")
 
-    _, _, dt_inicio, dt_fin = _formatear_fecha_hora_es(fecha, hora)
+    _, _, dt_inicio, dt_fin = _formatear_fecha_hora_es(fecha, hora, datos.get("duracion"))
     uid = datos.get("ics_uid") or f"cita-{datos.get('negocio_id','x')}-{datos.get('cita_id',uuid.uuid4().hex)}@{(MAIL_SENDER.split('@')[-1])}"
     descripcion = f"{servicio} con {negocio_nombre}\\nCliente: {cliente_nombre}\\nTeléfono: {datos.get('telefono','')}"
     summary = f"{servicio} — {negocio_nombre}"
@@ -149,7 +160,7 @@ def _build_ics(datos: dict, tipo: str, sequence: int | None = None) -> bytes:
     return "\r\n".join(lines).encode("utf-8")
 
 def _render_template(nombre_tpl: str, contexto: dict) -> str:
-    template = _env.get_template(nombre_tpl)
+    template = _entorno().get_template(nombre_tpl)
     return template.render(**contexto)
 
 def _send_mail(subject: str, to_list: list[str], html: str, text: str,
@@ -186,18 +197,41 @@ def _send_mail(subject: str, to_list: list[str], html: str, text: str,
         ics.add_header("Content-Class", "urn:content-classes:calendarmessage")
         msg_root.attach(ics)
 
-    with smtplib.SMTP(SMTP_SERVER, SMTP_PORT) as smtp:
-        if SMTP_USE_TLS:
-            smtp.starttls()
-        if MAIL_PASSWORD:
-            smtp.login(MAIL_SENDER, MAIL_PASSWORD)
-        smtp.sendmail(MAIL_SENDER, [t for t in to_list if t], msg_root.as_string())
+    t0 = time.perf_counter()
+    try:
+        with smtplib.SMTP(SMTP_SERVER, SMTP_PORT) as smtp:
+            if SMTP_USE_TLS:
+                smtp.starttls()
+            if MAIL_PASSWORD:
+                smtp.login(MAIL_SENDER, MAIL_PASSWORD)
+            smtp.sendmail(MAIL_SENDER, [t for t in to_list if t], msg_root.as_string())
+    except Exception as e:
+        metrics.NOTIFICACION_FALLOS.inc("email")
+        log.error("Error enviando email '%s': %s", subject, e)
+        raise
+    finally:
+        metrics.NOTIFICACION_LATENCIA.observar(time.perf_counter() - t0, "email")
+    log.info("Email enviado: '%s' (%d destinatario(s))", subject, len([t for t in to_list if t]))
+
+def _texto_lineas(lineas: list | None) -> list[str]:
+    """Una línea por servicio ("Corte — 30 min · 12.00€") si la cita tiene varios; si no, nada."""
+    if not lineas or len(lineas) < 2:
+        return []
+    textos = []
+    for linea in lineas:
+        texto = linea.get("nombre") or ""
+        if linea.get("duracion"):
+            texto += f" — {linea['duracion']} min"
+        if linea.get("precio") is not None:
+            texto += f" · {float(linea['precio']):.2f}€"
+        textos.append(texto)
+    return textos
 
 def _build_contexto_comun(datos: dict, tipo: str):
     negocio_nombre = datos.get("negocio_nombre") or "Tu negocio"
     negocio_slug = datos.get("negocio_slug")
     cliente_nombre = datos.get("nombre") or datos.get("nombre_cliente") or "Cliente"
-    fecha_legible, hora, dt_inicio, dt_fin = _formatear_fecha_hora_es(datos.get("fecha"), datos.get("hora"))
+    fecha_legible, hora, dt_inicio, dt_fin = _formatear_fecha_hora_es(datos.get("fecha"), datos.get("hora"), datos.get("duracion"))
     servicio_actual = datos.get("servicio") or datos.get("servicio_despues") or datos.get("servicio_antes")
     empleado = datos.get("empleado_nombre") or "No asignado"
     direccion = datos.get("direccion") or ""
@@ -223,6 +257,8 @@ def _build_contexto_comun(datos: dict, tipo: str):
         "google_calendar_url": gcal_url,
         "servicio_antes": datos.get("servicio_antes"),
         "servicio_despues": datos.get("servicio_despues"),
+        "lineas": _texto_lineas(datos.get("lineas")),
+        "duracion": datos.get("duracion"),
         "logo_cid": logo_cid,
     }
     return ctx, logo_bytes, logo_ext
@@ -234,6 +270,7 @@ def enviar_notificacion_cita(datos: dict):
     text = (f"Confirmación de cita — {ctx['negocio_nombre']}\n"
             f"Cliente: {ctx['cliente_nombre']}\n"
             f"Servicio: {ctx['servicio']}\n"
+            + "".join(f"  · {l}\n" for l in ctx['lineas']) +
             f"Profesional: {ctx['empleado_nombre']}\n"
             f"Fecha: {ctx['fecha_legible']} a las {ctx['hora']}\n")
     ics = _build_ics(datos, "confirmacion", sequence=0)
@@ -246,6 +283,7 @@ def enviar_notificacion_modificacion(datos: dict):
     html = _render_template("modificacion.html", ctx)
     text = (f"Tu cita ha sido modificada — {ctx['negocio_nombre']}\n"
             f"Nuevo servicio: {ctx['servicio']}\n"
+            + "".join(f"  · {l}\n" for l in ctx['lineas']) +
             f"Profesional: {ctx['empleado_nombre']}\n"
             f"Nueva fecha: {ctx['fecha_legible']} a las {ctx['hora']}\n")
     ics = _build_ics(datos, "modificacion", sequence=1)
@@ -258,6 +296,7 @@ def enviar_notificacion_cancelacion(datos: dict):
     html = _render_template("cancelacion.html", ctx)
     text = (f"Tu cita ha sido cancelada — {ctx['negocio_nombre']}\n"
             f"Servicio: {ctx['servicio']}\n"
+            + "".join(f"  · {l}\n" for l in ctx['lineas']) +
             f"Fecha cancelada: {ctx['fecha_legible']} {ctx['hora']}\n")
     ics = _build_ics(datos, "cancelacion", sequence=2)
     subject = f"❌ Cita cancelada — {ctx['servicio']} ({ctx['fecha_legible']} {ctx['hora']})"
@@ -274,9 +313,28 @@ def enviar_recordatorio_cita(datos: dict):
     text = (f"Recordatorio de cita — {ctx['negocio_nombre']}\n"
             f"Cliente: {ctx['cliente_nombre']}\n"
             f"Servicio: {ctx['servicio']}\n"
+            + "".join(f"  · {l}\n" for l in ctx['lineas']) +
             f"Profesional: {ctx['empleado_nombre']}\n"
             f"Hoy a las {ctx['hora']}\n")
     ics = _build_ics(datos, "recordatorio", sequence=0)
     subject = f"⏰ Recordatorio: {ctx['servicio']} hoy a las {ctx['hora']}"
     to_list = [datos.get("email_cliente")]  # foco en el cliente; añade negocio si quieres copia
     _send_mail(subject, to_list, html, text, ics_bytes=ics, logo_bytes=logo_bytes, logo_ext=logo_ext)
+
+# ---------- Lista de espera: hueco liberado ----------
+def enviar_oferta_lista_espera(datos: dict):
+    """
+    Avisa a quien esperaba de que se ha liberado un hueco, retenido a su nombre
+    hasta datos['expira'] (HH:MM); datos['enlace'] lleva a la página para aceptarlo.
+    """
+    ctx, logo_bytes, logo_ext = _build_contexto_comun(datos, "oferta_espera")
+    ctx["enlace"] = datos.get("enlace")
+    ctx["expira"] = datos.get("expira")
+    html = _render_template("oferta_espera.html", ctx)
+    text = (f"Se ha liberado un hueco — {ctx['negocio_nombre']}\n"
+            f"Servicio: {ctx['servicio']}\n"
+            f"Profesional: {ctx['empleado_nombre']}\n"
+            f"Fecha: {ctx['fecha_legible']} a las {ctx['hora']}\n"
+            f"Te lo guardamos hasta las {ctx['expira']}. Para reservarlo: {ctx['enlace']}\n")
+    subject = f"🔔 Hueco libre — {ctx['servicio']} ({ctx['fecha_legible']} {ctx['hora']})"
+    _send_mail(subject, [datos.get("email_cliente")], html, text, logo_bytes=logo_bytes, logo_ext=logo_ext)
@@ -0,0 +1,135 @@
+# estaticos.py
+"""
+Ficheros estáticos con caché HTTP.
+
+- url_estatica("x.css") -> /static/x.css?v=<hash del contenido>. Con la versión
+  en la URL el navegador puede guardarlo un año (immutable); sin ella, revalida.
+- ETag fuerte por contenido y codificación: If-None-Match responde 304.
+- Variantes brotli/gzip: se usan las .br/.gz que haya en disco (generadas con
+  `python estaticos.py`) y, si faltan, se comprimen una sola vez por proceso.
+"""
+import os
+import sys
+import gzip
+import hashlib
+import mimetypes
+from flask import request, current_app, url_for, send_file, abort, Response
+from werkzeug.security import safe_join
+
+try:
+    import brotli
+except ImportError:  # opcional: sin el paquete solo se sirve gzip
+    brotli = None
+
+CACHE_INMUTABLE = "public, max-age=31536000, immutable"
+CACHE_REVALIDAR = "no-cache"
+COMPRIMIBLES = {".html", ".css", ".js", ".json", ".svg", ".txt", ".xml", ".map"}
+MIN_BYTES_COMPRIMIR = 1024
+EXTENSIONES = {"br": ".br", "gzip": ".gz"}
+
+_huellas = {}       # ruta -> ((mtime_ns, tamaño), hash)
+_comprimidos = {}   # (ruta, hash, codificación) -> bytes
+
+def _huella(ruta):
+    st = os.stat(ruta)
+    clave = (st.st_mtime_ns, st.st_size)
+    info = _huellas.get(ruta)
+    if info is None or info[0] != clave:
+        with open(ruta, "rb") as f:
+            info = _huellas[ruta] = (clave, hashlib.sha256(f.read()).hexdigest()[:16])
+    return info[1]
+
+def _comprimir(datos, codificacion):
+    if codificacion == "br":
+        return brotli.compress(datos, quality=11)
+    return gzip.compress(datos, compresslevel=9, mtime=0)
+
+def _variante(ruta, codificacion, huella):
+    """Bytes comprimidos de 'ruta' o None si esa codificación no está disponible."""
+    en_disco = ruta + EXTENSIONES[codificacion]
+    try:
+        if os.stat(en_disco).st_mtime_ns >= os.stat(ruta).st_mtime_ns:
+            with open(en_disco, "rb") as f:
+                return f.read()
+    except OSError:
+        pass
+    if codificacion == "br" and brotli is None:
+        return None
+    clave = (ruta, huella, codificacion)
+    datos = _comprimidos.get(clave)
+    if datos is None:
+        with open(ruta, "rb") as f:
+            datos = _comprimidos[clave] = _comprimir(f.read(), codificacion)
+    return datos
+
+def url_estatica(filename):
+    """url_for('static') con la huella del contenido como ?v= (para plantillas)."""
+    try:
+        huella = _huella(os.path.join(current_app.static_folder, filename))
+    except OSError:
+        return url_for("static", filename=filename)
+    return url_for("static", filename=filename, v=huella)
+
+def enviar(directorio, filename):
+    """Sirve directorio/filename con ETag, Cache-Control y compresión negociada."""
+    ruta = safe_join(directorio, filename)
+    if ruta is None or not os.path.isfile(ruta):
+        abort(404)
+    huella = _huella(ruta)
+    mimetype = mimetypes.guess_type(ruta)[0] or "application/octet-stream"
+    comprimible = os.path.splitext(ruta)[1].lower() in COMPRIMIBLES and os.path.getsize(ruta) >= MIN_BYTES_COMPRIMIR
+
+    cuerpo = codificacion = None
+    if comprimible:
+        for candidata in ("br", "gzip"):
+            if request.accept_encodings[candidata]:
+                cuerpo = _variante(ruta, candidata, huella)
+                if cuerpo is not None:
+                    codificacion = candidata
+                    break
+
+    if cuerpo is None:
+        resp = send_file(ruta, mimetype=mimetype, etag=huella)
+    else:
+        resp = Response(cuerpo, mimetype=mimetype)
+        resp.headers["Content-Encoding"] = codificacion
+        resp.set_etag(f"{huella}-{codificacion}")
+        resp.make_conditional(request)
+
+    resp.headers["Cache-Control"] = CACHE_INMUTABLE if request.args.get("v") == huella else CACHE_REVALIDAR
+    if comprimible:
+        resp.vary.add("Accept-Encoding")
+    return resp
+
+# -------------------------
+# Precompresión en despliegue: python estaticos.py [ficheros o carpetas...]
+# -------------------------
+
+def _ficheros(rutas):
+    for ruta in rutas:
+        if os.path.isdir(ruta):
+            for base, _, nombres in os.walk(ruta):
+                for nombre in nombres:
+                    yield os.path.join(base, nombre)
+        elif os.path.isfile(ruta):
+            yield ruta
+
+def precomprimir(rutas):
+    """Escribe las variantes .gz (y .br si está brotli) junto a cada fichero comprimible."""
+    escritos = 0
+    for ruta in _ficheros(rutas):
+        if os.path.splitext(ruta)[1].lower() not in COMPRIMIBLES or os.path.getsize(ruta) < MIN_BYTES_COMPRIMIR:
+            continue
+        with open(ruta, "rb") as f:
+            datos = f.read()
+        for codificacion, ext in EXTENSIONES.items():
+            if codificacion == "br" and brotli is None:
+                continue
+            with open(ruta + ext, "wb") as f:
+                f.write(_comprimir(datos, codificacion))
+            escritos += 1
+    return escritos
+
+if __name__ == "__main__":
+    objetivos = sys.argv[1:] or ["static", "index.html"]
+    print(f"Variantes comprimidas escritas: {precomprimir(objetivos)}")
@@ -0,0 +1,311 @@
+# eventos.py
+"""
+Cambios de agenda en vivo para el panel (Server-Sent Events).
+
+Los triggers de citas y bloqueos publican cada cambio con pg_notify en
+database.CANAL_AGENDA (y la edición de un negocio, un aviso 'negocios'). Cada proceso mantiene UNA conexión en LISTEN (un hilo
+en segundo plano que arranca con el primer suscriptor) y reparte los avisos
+entre los paneles abiertos de ese negocio y fecha, sin consultar la base de
+datos por cada panel.
+
+stream() es el generador del modo WSGI (un hilo por panel); stream_async() el
+del modo ASGI (asgi.py), donde cada panel es una corrutina en el bucle.
+
+Cada evento lleva como id la versión "<día>.<config>" de agenda_versiones. Al
+reconectar, el navegador la devuelve en Last-Event-ID (la primera vez va en
+?version=, la del panel pintado); si la agenda ya no está en esa versión se
+han perdido cambios mientras tanto y el panel recarga.
+"""
+import os
+import json
+import time
+import queue
+import select
+import asyncio
+import threading
+from datetime import date
+import psycopg2
+import psycopg2.extensions
+import config
+import database
+import metrics
+import log_manager
+
+log = log_manager.get_logger("eventos")
+
+SSE_HEARTBEAT_SEGUNDOS = float(getattr(config, "SSE_HEARTBEAT_SEGUNDOS", os.getenv("SSE_HEARTBEAT_SEGUNDOS", 15)))
+# Tras este tiempo se cierra el stream y el navegador reconecta solo (EventSource),
+# así un panel olvidado no ocupa un hilo del worker indefinidamente.
+SSE_MAX_SEGUNDOS = float(getattr(config, "SSE_MAX_SEGUNDOS", os.getenv("SSE_MAX_SEGUNDOS", 300)))
+# Streams abiertos a la vez por worker en modo WSGI: cada uno ocupa un hilo de
+# gthread (--threads 16 en el Procfile), y el resto tiene que quedar libre para
+# /mensaje y los paneles. Por encima se le pide al navegador que vuelva luego.
+SSE_MAX_STREAMS = int(getattr(config, "SSE_MAX_STREAMS", os.getenv("SSE_MAX_STREAMS", 8)))
+SSE_REINTENTO_LLENO_MS = 30000
+SSE_COLA_MAX = 200      # eventos pendientes por panel antes de pedirle que recargue
+REINTENTO_MAX_SEGUNDOS = 30
+
+# Evento que pide al panel recargar: se han podido perder cambios
+RECARGAR = {"tipo": "recargar"}
+
+_lock = threading.Lock()
+_suscriptores = {}      # negocio_id -> set de _Suscripcion
+_oyentes = []           # funciones internas que reciben todos los avisos (p.ej. ocupacion.py)
+_hilo = None
+_escuchando = False     # LISTEN activo: ningún aviso se está perdiendo
+_plazas = threading.BoundedSemaphore(SSE_MAX_STREAMS)  # streams WSGI del proceso
+
+class _Suscripcion:
+    __slots__ = ("negocio_id", "fecha", "cola")
+
+    def __init__(self, negocio_id, fecha):
+        self.negocio_id = negocio_id
+        self.fecha = fecha  # "YYYY-MM-DD" o None para todas
+        self.cola = queue.Queue(maxsize=SSE_COLA_MAX)
+
+    def entregar(self, evento):
+        try:
+            self.cola.put_nowait(evento)
+        except queue.Full:
+            # Panel que no consume: vaciamos y le pedimos recargar
+            while True:
+                try:
+                    self.cola.get_nowait()
+                except queue.Empty:
+                    break
+            self.cola.put_nowait(RECARGAR)
+
+class _SuscripcionAsync(_Suscripcion):
+    """Suscripción del modo ASGI: el hilo del listener entrega en la cola del bucle de eventos."""
+    __slots__ = ("bucle",)
+
+    def __init__(self, negocio_id, fecha, bucle):
+        self.negocio_id = negocio_id
+        self.fecha = fecha
+        self.bucle = bucle
+        self.cola = asyncio.Queue(maxsize=SSE_COLA_MAX)
+
+    def entregar(self, evento):
+        try:
+            self.bucle.call_soon_threadsafe(self._poner, evento)
+        except RuntimeError:
+            pass  # bucle cerrado: el stream ya terminó
+
+    def _poner(self, evento):
+        try:
+            self.cola.put_nowait(evento)
+        except asyncio.QueueFull:
+            while not self.cola.empty():
+                self.cola.get_nowait()
+            self.cola.put_nowait(RECARGAR)
+
+def suscribir(negocio_id, fecha=None):
+    """Registra un panel y devuelve su suscripción (arranca el listener si hace falta)."""
+    return _registrar(_Suscripcion(negocio_id, fecha))
+
+def _registrar(sus):
+    _arrancar_listener()
+    with _lock:
+        _suscriptores.setdefault(sus.negocio_id, set()).add(sus)
+    metrics.SSE_SUSCRIPTORES.inc()
+    return sus
+
+def cancelar(sus):
+    with _lock:
+        grupo = _suscriptores.get(sus.negocio_id)
+        if grupo is not None:
+            grupo.discard(sus)
+            if not grupo:
+                del _suscriptores[sus.negocio_id]
+    metrics.SSE_SUSCRIPTORES.dec()
+
+def al_cambiar(funcion):
+    """
+    Registra funcion(evento) para todos los avisos de este proceso (arranca el
+    listener). Recibe RECARGAR cuando se han podido perder avisos. Se llama
+    desde el hilo del listener: debe ser rápida y no lanzar excepciones.
+    """
+    if funcion not in _oyentes:
+        _oyentes.append(funcion)
+    _arrancar_listener()
+
+def escuchando():
+    """True si el listener está conectado, o sea, si los avisos llegan completos."""
+    return _escuchando
+
+def _avisar_oyentes(evento):
+    for funcion in _oyentes:
+        try:
+            funcion(evento)
+        except Exception as e:
+            log.error("Error en oyente de agenda %s: %s", funcion.__name__, e)
+
+def _repartir(evento):
+    _avisar_oyentes(evento)
+    with _lock:
+        destinos = list(_suscriptores.get(evento.get("negocio_id"), ()))
+    if evento.get("tabla") == "negocios":
+        # Cambió horario/servicios/empleados: los paneles de ese negocio se redibujan enteros
+        for sus in destinos:
+            sus.entregar(RECARGAR)
+        return
+    for sus in destinos:
+        if sus.fecha is None or sus.fecha == evento.get("fecha"):
+            sus.entregar(evento)
+
+def _repartir_a_todos(evento):
+    _avisar_oyentes(evento)
+    with _lock:
+        destinos = [sus for grupo in _suscriptores.values() for sus in grupo]
+    for sus in destinos:
+        sus.entregar(evento)
+
+# -------------------------
+# Listener (uno por proceso)
+# -------------------------
+
+def _arrancar_listener():
+    global _hilo
+    with _lock:
+        if _hilo is not None and _hilo.is_alive():
+            return
+        _hilo = threading.Thread(target=_escuchar, name="agenda-listen", daemon=True)
+        _hilo.start()
+
+def _tras_fork():
+    # El hilo de LISTEN y sus suscriptores son del proceso padre
+    global _lock, _suscriptores, _hilo, _escuchando, _plazas
+    _lock = threading.Lock()
+    _plazas = threading.BoundedSemaphore(SSE_MAX_STREAMS)
+    _suscriptores = {}
+    _hilo = None
+    _escuchando = False
+
+os.register_at_fork(after_in_child=_tras_fork)
+
+def _escuchar():
+    # Los triggers los instala el arranque (ensure_notificaciones_agenda), no el listener
+    global _escuchando
+    espera = 1
+    primera = True
+    while True:
+        conn = None
+        try:
+            conn = database.conexion_dedicada()
+            conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+            with conn.cursor() as cur:
+                cur.execute(f"LISTEN {database.CANAL_AGENDA};")
+            log.info("Escuchando cambios de agenda (pid %s)", os.getpid())
+            _escuchando = True
+            if not primera:
+                # Durante la caída se han podido perder avisos
+                _repartir_a_todos(RECARGAR)
+            primera = False
+            espera = 1
+            while True:
+                if select.select([conn], [], [], SSE_HEARTBEAT_SEGUNDOS) == ([], [], []):
+                    # Sin tráfico: comprueba que la conexión sigue viva
+                    with conn.cursor() as cur:
+                        cur.execute("SELECT 1;")
+                    continue
+                conn.poll()
+                while conn.notifies:
+                    aviso = conn.notifies.pop(0)
+                    try:
+                        evento = json.loads(aviso.payload)
+                    except ValueError:
+                        log.warning("Aviso de agenda no válido: %r", aviso.payload)
+                        continue
+                    evento["tipo"] = "cambio"
+                    metrics.SSE_EVENTOS.inc(evento.get("tabla", ""))
+                    _repartir(evento)
+        except Exception as e:
+            log.error("Listener de agenda caído, reintento en %ss: %s", espera, e)
+            if _escuchando:
+                _escuchando = False
+                # Lo que se sabía ya no se mantiene al día
+                _avisar_oyentes(RECARGAR)
+            primera = False
+            time.sleep(espera)
+            espera = min(espera * 2, REINTENTO_MAX_SEGUNDOS)
+        finally:
+            if conn is not None:
+                try:
+                    conn.close()
+                except psycopg2.Error:
+                    pass
+
+# -------------------------
+# Formato SSE
+# -------------------------
+
+def _sse(evento, config_version=None):
+    trozo = f"event: {evento['tipo']}\ndata: {json.dumps(evento, ensure_ascii=False)}\n\n"
+    if config_version is not None and evento.get("version") is not None:
+        trozo = f"id: {evento['version']}.{config_version}\n" + trozo
+    return trozo
+
+def _resincronizar(negocio_id, fecha, version):
+    """
+    (parte de config de la versión actual o None, si el panel debe recargar).
+    Se llama ya suscrito: lo que cambie después llega por la cola.
+    """
+    if fecha is None:
+        return None, False
+    try:
+        actual = database.obtener_version_agenda(negocio_id, date.fromisoformat(fecha))
+    except Exception as e:
+        log.warning("No se pudo comprobar la versión del panel %s: %s", negocio_id, e)
+        return None, bool(version)
+    return actual.split(".")[1], bool(version) and version != actual
+
+def stream(negocio_id, fecha=None, version=None):
+    """
+    Generador de text/event-stream con los cambios de ese negocio (y fecha).
+    'version' es la que ya tiene el panel (Last-Event-ID o ?version=).
+    """
+    if not _plazas.acquire(blocking=False):
+        log.info("Streams SSE al máximo (%d): el panel %s reintentará", SSE_MAX_STREAMS, negocio_id)
+        yield f"retry: {SSE_REINTENTO_LLENO_MS}\n\n"
+        return
+    try:
+        sus = suscribir(negocio_id, fecha)
+        try:
+            yield "retry: 5000\n\n"
+            config_version, recargar = _resincronizar(negocio_id, fecha, version)
+            if recargar:
+                yield _sse(RECARGAR)
+                return
+            limite = time.monotonic() + SSE_MAX_SEGUNDOS
+            while time.monotonic() < limite:
+                try:
+                    evento = sus.cola.get(timeout=SSE_HEARTBEAT_SEGUNDOS)
+                except queue.Empty:
+                    # Comentario SSE: mantiene vivos proxies y detecta clientes desconectados
+                    yield ": ping\n\n"
+                    continue
+                yield _sse(evento, config_version)
+        finally:
+            cancelar(sus)
+    finally:
+        _plazas.release()
+
+async def stream_async(negocio_id, fecha=None, version=None):
+    """Como stream(), para el modo ASGI: cada panel espera en el bucle de eventos, no en un hilo."""
+    sus = _registrar(_SuscripcionAsync(negocio_id, fecha, asyncio.get_running_loop()))
+    try:
+        yield "retry: 5000\n\n"
+        config_version, recargar = await asyncio.to_thread(_resincronizar, negocio_id, fecha, version)
+        if recargar:
+            yield _sse(RECARGAR)
+            return
+        limite = time.monotonic() + SSE_MAX_SEGUNDOS
+        while time.monotonic() < limite:
+            try:
+                evento = await asyncio.wait_for(sus.cola.get(), SSE_HEARTBEAT_SEGUNDOS)
+            except asyncio.TimeoutError:
+                yield ": ping\n\n"
+                continue
+            yield _sse(evento, config_version)
+    finally:
+        cancelar(sus)
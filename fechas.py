@@ -0,0 +1,241 @@
+# fechas.py
+"""
+Fechas y horas escritas en español: "el viernes por la tarde", "mañana a
+las 5 y media", "15 de marzo", "12/04 a las 10:30".
+
+interpretar() devuelve la fecha, la hora exacta o la franja (mañana, tarde...)
+entendidas, listas para la búsqueda de disponibilidad. Lo habitual (hoy,
+mañana, días de la semana, "la semana que viene", fechas numéricas, horas)
+se resuelve con expresiones regulares; el resto ("dentro de 3 días", "el
+primer lunes de mayo") pasa a dateparser, con un parser en español por hilo
+(nada se serializa entre peticiones). Cada frase normalizada se memoriza
+junto a la fecha de referencia: repetirla no vuelve a analizar nada.
+"""
+import os
+import re
+import threading
+from datetime import date, timedelta
+from functools import lru_cache
+import config
+import utils
+import log_manager
+
+log = log_manager.get_logger("fechas")
+
+FECHAS_CACHE_TAM = int(getattr(config, "FECHAS_CACHE_TAM", os.getenv("FECHAS_CACHE_TAM", 4096)))
+
+# Franjas del día en minutos [desde, hasta)
+FRANJAS = {
+    "manana": (7 * 60, 14 * 60),
+    "mediodia": (12 * 60, 16 * 60),
+    "tarde": (14 * 60, 21 * 60),
+    "noche": (20 * 60, 24 * 60),
+}
+
+_DIAS_SEMANA = {"lunes": 0, "martes": 1, "miercoles": 2, "jueves": 3, "viernes": 4, "sabado": 5, "domingo": 6}
+_MESES = {
+    "enero": 1, "febrero": 2, "marzo": 3, "abril": 4, "mayo": 5, "junio": 6, "julio": 7, "agosto": 8,
+    "septiembre": 9, "setiembre": 9, "octubre": 10, "noviembre": 11, "diciembre": 12,
+}
+
+# Una hora sin minutos ("a las 5") solo cuenta con prefijo o sufijo: un número suelto es un día
+_HORA = re.compile(
+    r"\b(?P<pre>(?:a|sobre|hacia|para|desde) (?:la|las|eso de las?) )?"
+    r"(?P<h>\d{1,2})(?:[:\.h](?P<m>\d{2})| y (?P<frac>media|cuarto)| menos (?P<menos>cuarto))?"
+    r"(?P<suf> ?(?:h|hrs?|horas))?(?: ?(?P<ampm>am|pm))?"
+    r"(?: de la (?P<parte>manana|tarde|noche))?\b"
+)
+_FRANJA = re.compile(
+    r"\b(?:por|de|en|a|durante) (?:la|las) (?P<f>manana|tarde|noche)s?\b"
+    r"|\b(?:a|al|sobre el|hacia el) (?P<md>mediodia)\b"
+    r"|\b(?P<hoy>esta) (?P<fh>manana|tarde|noche)\b"
+)
+_RELATIVO = re.compile(r"\b(?P<d>pasado manana|manana|hoy)\b")
+_SEMANA_QUE_VIENE = re.compile(r"\b(?:semana que viene|proxima semana|semana proxima|semana siguiente)\b")
+_DIA_SEMANA = re.compile(
+    r"\b(?P<este>este )?(?P<dia>" + "|".join(_DIAS_SEMANA) + r")\b"
+)
+_NUMERICA = re.compile(r"\b(?P<d>\d{1,2})[/\-](?P<m>\d{1,2})(?:[/\-](?P<a>\d{2}|\d{4}))?\b")
+_DE_MES = re.compile(r"\b(?P<d>\d{1,2}) de (?P<mes>" + "|".join(_MESES) + r")(?: de (?P<a>\d{4}))?\b")
+_DIA_DEL_MES = re.compile(r"\bel (?:dia )?(?P<d>\d{1,2})\b")
+_RELLENO = re.compile(r"\b(?:quiero|quisiera|mejor|porfa|por favor|me viene bien|puede ser|cita|pues|vale|si)\b")
+
+class Interpretacion:
+    """Lo entendido de una frase. Se comparte desde la caché: no modificar."""
+    __slots__ = ("fecha", "hora", "franja")
+
+    def __init__(self, fecha=None, hora=None, franja=None):
+        self.fecha = fecha      # date, o None si la frase no da día
+        self.hora = hora        # "HH:MM" exacta, o None
+        self.franja = franja    # (desde, hasta) en minutos, o None
+
+    def __repr__(self):
+        return f"Interpretacion(fecha={self.fecha!r}, hora={self.hora!r}, franja={self.franja!r})"
+
+def normalizar(texto):
+    """Minúsculas sin tildes ni signos, espacios simples: la clave de la caché."""
+    texto = utils.normalizar_texto(texto or "")
+    texto = re.sub(r"[^\w:/\-\. ]+", " ", texto)
+    return " ".join(texto.replace(". ", " ").rstrip(".").split())
+
+def interpretar(texto, referencia=None):
+    """
+    Interpreta 'texto' respecto a 'referencia' (date, hoy por defecto). None
+    si no se entiende ni fecha, ni hora ni franja. Las fechas pasadas se
+    descartan (fecha None).
+    """
+    return _interpretar(normalizar(texto), referencia or utils.now_spain().date())
+
+@lru_cache(maxsize=FECHAS_CACHE_TAM)
+def _interpretar(texto, referencia):
+    if not texto:
+        return None
+    hora, texto = _extraer_hora(texto)
+    franja = None
+    fecha = None
+    if hora is None:
+        m = _FRANJA.search(texto)
+        if m:
+            franja = FRANJAS[m.group("f") or m.group("md") or m.group("fh")]
+            if m.group("hoy"):
+                fecha = referencia
+            texto = _quitar(texto, m)
+    if fecha is None:
+        fecha = _extraer_fecha(texto, referencia)
+    if fecha is not None and fecha < referencia:
+        fecha = None
+    if fecha is None and hora is None and franja is None:
+        return None
+    return Interpretacion(fecha, hora, franja)
+
+def _quitar(texto, m):
+    return " ".join((texto[:m.start()] + " " + texto[m.end():]).split())
+
+def _extraer_hora(texto):
+    """("HH:MM", texto sin la hora) de la primera hora válida, o (None, texto)."""
+    for m in _HORA.finditer(texto):
+        if not (m.group("m") or m.group("frac") or m.group("menos") or m.group("pre")
+                or m.group("suf") or m.group("ampm") or m.group("parte")):
+            continue
+        h, minutos = int(m.group("h")), int(m.group("m") or 0)
+        if m.group("frac"):
+            minutos = 30 if m.group("frac") == "media" else 15
+        parte = m.group("parte")
+        if parte == "noche" and h == 12:
+            h = 0  # "a las 12 de la noche": medianoche
+        elif parte in ("tarde", "noche") or m.group("ampm") == "pm":
+            h = h + 12 if h < 12 else h
+        elif m.group("ampm") == "am" and h == 12:
+            h = 0
+        elif parte is None and m.group("ampm") is None and 1 <= h <= 7:
+            h += 12  # "a las 5": en horario comercial, de la tarde
+        if m.group("menos"):
+            h, minutos = h - 1, 45
+        if 0 <= h < 24 and 0 <= minutos < 60:
+            return f"{h:02d}:{minutos:02d}", _quitar(texto, m)
+    return None, texto
+
+def _con_anio(referencia, anio, mes, dia):
+    """Fecha de ese día/mes; sin año, el próximo en que cae (este año o el siguiente)."""
+    try:
+        if anio:
+            anio = int(anio)
+            return date(anio + 2000 if anio < 100 else anio, mes, dia)
+        fecha = date(referencia.year, mes, dia)
+        return fecha if fecha >= referencia else date(referencia.year + 1, mes, dia)
+    except ValueError:
+        return None
+
+def _extraer_fecha(texto, referencia):
+    m = _RELATIVO.search(texto)
+    if m:
+        return referencia + timedelta(days={"hoy": 0, "manana": 1, "pasado manana": 2}[m.group("d")])
+    lunes_siguiente = referencia + timedelta(days=7 - referencia.weekday())
+    semana_que_viene = _SEMANA_QUE_VIENE.search(texto)
+    m = _DIA_SEMANA.search(texto)
+    if m and semana_que_viene:
+        # "el martes de la semana que viene": ese día de la semana próxima, no el más cercano
+        return lunes_siguiente + timedelta(days=_DIAS_SEMANA[m.group("dia")])
+    if semana_que_viene:
+        return lunes_siguiente
+    if m:
+        dias = (_DIAS_SEMANA[m.group("dia")] - referencia.weekday()) % 7
+        if dias == 0 and not m.group("este"):
+            dias = 7  # "el viernes" dicho un viernes: el de la semana que viene
+        return referencia + timedelta(days=dias)
+    m = _NUMERICA.search(texto)
+    if m:
+        return _con_anio(referencia, m.group("a"), int(m.group("m")), int(m.group("d")))
+    m = _DE_MES.search(texto)
+    if m:
+        return _con_anio(referencia, m.group("a"), _MESES[m.group("mes")], int(m.group("d")))
+    m = _DIA_DEL_MES.search(texto)
+    if m:
+        dia = int(m.group("d"))
+        mes, anio = referencia.month, referencia.year
+        if dia < referencia.day:
+            mes, anio = (1, anio + 1) if mes == 12 else (mes + 1, anio)
+        try:
+            return date(anio, mes, dia)
+        except ValueError:
+            return None
+    resto = " ".join(_RELLENO.sub(" ", texto).split())
+    return _con_dateparser(resto, referencia) if resto else None
+
+# -------------------------
+# dateparser (dependencia opcional)
+# -------------------------
+
+_lock = threading.Lock()
+_clase = None  # DateDataParser; False si dateparser no está instalado
+_por_hilo = threading.local()  # .parser = (referencia, DateDataParser) de cada hilo
+
+def _clase_parser():
+    global _clase
+    with _lock:
+        if _clase is None:
+            try:
+                from dateparser.date import DateDataParser
+            except ImportError:
+                log.warning("dateparser no disponible: solo se entienden las fechas habituales")
+                _clase = False
+            else:
+                _clase = DateDataParser
+        return _clase
+
+def _obtener_parser(referencia):
+    """
+    Parser en español del hilo con 'referencia' como base de lo relativo; se
+    rehace solo al cambiar de día. DateDataParser no es seguro entre hilos:
+    uno por hilo evita un lock alrededor de cada análisis.
+    """
+    propio = getattr(_por_hilo, "parser", None)
+    if propio is not None and propio[0] == referencia:
+        return propio[1]
+    clase = _clase_parser()
+    if not clase:
+        return None
+    base = utils.now_spain().replace(year=referencia.year, month=referencia.month, day=referencia.day,
+                                     hour=0, minute=0, second=0, microsecond=0)
+    _por_hilo.parser = (referencia, clase(
+        languages=["es"], settings={"PREFER_DATES_FROM": "future", "RELATIVE_BASE": base}
+    ))
+    return _por_hilo.parser[1]
+
+def _con_dateparser(texto, referencia):
+    parser = _obtener_parser(referencia)
+    if parser is None:
+        return None
+    try:
+        resultado = parser.get_date_data(texto)
+    except Exception as e:
+        log.debug("dateparser no entendió '%s': %s", texto, e)
+        return None
+    fecha = resultado and resultado["date_obj"]
+    return fecha.date() if fecha else None
+
+def _tras_fork():
+    global _lock
+    _lock = threading.Lock()
+
+os.register_at_fork(after_in_child=_tras_fork)
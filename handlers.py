@@ -1,9 +1,19 @@
 # handlers.py
 from flask import session
 from datetime import timedelta, datetime
+import uuid
 import utils
 import database
 import email_manager
+import notificaciones
+import log_manager
+import disponibilidad
+import horarios
+import recursos
+import lista_espera
+import fechas
+
+log = log_manager.get_logger("handlers")
 
 def _get_negocio_id():
     return session.get('negocio_id')
@@ -11,17 +21,81 @@ def _get_negocio_id():
 def _get_negocio_nombre():
     return session.get('negocio_nombre', 'nuestro negocio')
 
+def _get_titular_reserva():
+    # Identifica a esta conversación como dueña de las horas que retiene
+    if not session.get('titular_reserva'):
+        session['titular_reserva'] = uuid.uuid4().hex
+    return session['titular_reserva']
+
 def _limpiar_sesion_conversacion():
     """Elimina solo los datos de la conversación actual, preservando el negocio."""
+    if session.pop('hora_retenida', None):
+        database.liberar_retenciones(session.get('titular_reserva'))
     claves_a_borrar = [
         'estado', 'nombre', 'telefono', 'servicio', 'empleado_id',
         'empleado_nombre', 'empleados_disponibles', 'fecha', 'hora',
         'nombres_servicios_disponibles', 'cita_a_gestionar', 'modificando_cita',
-        'email_cliente', 'es_recurrente'
+        'email_cliente', 'es_recurrente', 'huecos_sugeridos', 'empleado_cualquiera', 'calendario',
+        'servicios', 'duracion'
     ]
     for clave in claves_a_borrar:
         session.pop(clave, None)
 
+OPCION_CUALQUIER_EMPLEADO = "Indiferente"
+OPCION_MAS_DIAS = "Más días »"
+OPCION_DIAS_ANTERIORES = "« Días anteriores"
+OPCION_CONTINUAR = "Continuar"
+OPCION_LISTA_ESPERA = "Avisarme si se libera un hueco"
+SEPARADOR_SERVICIOS = "+"  # "Corte + Barba": varios servicios en una misma cita
+
+def _selector_servicios(servicios_db):
+    """Selector de uno o varios servicios (el chat web envía los elegidos unidos con SEPARADOR_SERVICIOS)."""
+    return {
+        "type": "multi_choice",
+        "choices": [f"{s['nombre']} — {s['precio']}€" for s in servicios_db],
+        "submit": OPCION_CONTINUAR,
+    }
+
+def _elegir_servicios(texto_usuario, servicios_db):
+    """
+    Servicios del texto ("Corte — 12€", o varios separados por '+'), en el
+    orden dado y sin repetir. Lista de filas de servicios_db; vacía si alguno
+    no se reconoce.
+    """
+    nombres = [s['nombre'] for s in servicios_db]
+    por_nombre = {s['nombre']: s for s in servicios_db}
+    entero = utils.normalizar_texto(texto_usuario.split('—')[0].strip())
+    for nombre in nombres:
+        if utils.normalizar_texto(nombre) == entero:
+            return [por_nombre[nombre]]  # un servicio que lleva '+' en el nombre
+    elegidos = []
+    for trozo in texto_usuario.split(SEPARADOR_SERVICIOS):
+        nombre = utils.encontrar_servicio_mas_cercano(trozo.split('—')[0].strip(), nombres)
+        if not nombre:
+            return []
+        if por_nombre[nombre] not in elegidos:
+            elegidos.append(por_nombre[nombre])
+    return elegidos
+
+def _duracion_servicios(servicios):
+    """Minutos de la cita (suma de los servicios); None si ninguno tiene duración."""
+    return sum(s['duracion'] or 0 for s in servicios) or None
+
+def _necesidades():
+    """Recursos (sillas, cabinas...) que ocupan los servicios elegidos: {recurso_id: cantidad}."""
+    return recursos.necesidades(_get_negocio_id(), session.get('servicios'))
+
+def _botones_empleados(empleados):
+    nombres_empleados = [e['nombre'].strip() for e in empleados]
+    if len(nombres_empleados) > 1:
+        nombres_empleados.append(OPCION_CUALQUIER_EMPLEADO)
+    return nombres_empleados
+
+def _empleado_para_busqueda():
+    if session.get('empleado_cualquiera'):
+        return disponibilidad.CUALQUIERA
+    return session.get('empleado_id')
+
 def handle_bienvenida(_texto_usuario):
     _limpiar_sesion_conversacion()
     return {
@@ -64,21 +138,25 @@ def _mostrar_servicios_con_saludo(mensaje_inicial="¡Perfecto!"):
     servicios_db = database.listar_servicios(negocio_id=_get_negocio_id())
     nombres_servicios = [s['nombre'] for s in servicios_db]
     session['nombres_servicios_disponibles'] = nombres_servicios
-    botones_servicios = [f"{s['nombre']} — {s['precio']}€" for s in servicios_db]
-    respuesta_completa = f"{mensaje_inicial}\n\n¿Qué te vas a hacer hoy? Estos son nuestros servicios:"
+    respuesta_completa = (f"{mensaje_inicial}\n\n¿Qué te vas a hacer hoy? Estos son nuestros servicios "
+                          "(puedes elegir varios):")
     return {
         "respuesta": respuesta_completa,
-        "ui_component": { "type": "choice_buttons", "choices": botones_servicios },
+        "ui_component": _selector_servicios(servicios_db),
         "nuevo_estado": "pidiendo_servicio"
     }
 
 def handle_peticion_telefono(texto_usuario):
-    telefono = texto_usuario.strip()
+    # En E.164: mismo cliente lo escriba como lo escriba, y búsqueda por igualdad en el índice
+    telefono = utils.telefono_e164(texto_usuario)
+    if not telefono:
+        return {"respuesta": "Ese teléfono no parece válido. ¿Me lo escribes de nuevo?", "nuevo_estado": "pidiendo_telefono"}
     session['telefono'] = telefono
 
     # Si ya tiene una cita futura, avisamos y reiniciamos el flujo para que gestione
     if database.tiene_cita_futura(telefono, negocio_id=_get_negocio_id()):
-        session.clear()
+        # Suelta la hora retenida antes de olvidar la conversación (y conserva el negocio)
+        _limpiar_sesion_conversacion()
         respuesta_reinicio = handle_bienvenida("")
         return {
             "respuesta": "¡Ojo! Ya tienes una cita pendiente. Si quieres gestionarla, empieza de nuevo y elige 'Gestionar Cita'.",
@@ -135,108 +213,218 @@ def handle_peticion_email(texto_usuario):
     return _mostrar_servicios_con_saludo(mensaje_inicial=mensaje_inicial)
 
 def handle_peticion_servicio(texto_usuario):
-    texto_servicio_puro = texto_usuario.split('—')[0].strip()
     if session.get('modificando_cita'):
-        return handle_modificar_servicio(texto_servicio_puro)
-    nombres_servicios = session.get('nombres_servicios_disponibles', [])
-    servicio_elegido = utils.encontrar_servicio_mas_cercano(texto_servicio_puro, nombres_servicios)
-    if not servicio_elegido:
-        servicios_db = database.listar_servicios(negocio_id=_get_negocio_id())
-        botones_servicios = [f"{s['nombre']} — {s['precio']}€" for s in servicios_db]
+        return handle_modificar_servicio(texto_usuario)
+    servicios_db = database.listar_servicios(negocio_id=_get_negocio_id())
+    elegidos = _elegir_servicios(texto_usuario, servicios_db)
+    if not elegidos:
         return {
-            "respuesta": "No he entendido tu elección. Por favor, pulsa uno de los siguientes servicios:",
-            "ui_component": { "type": "choice_buttons", "choices": botones_servicios },
+            "respuesta": "No he entendido tu elección. Por favor, elige uno o varios de los siguientes servicios:",
+            "ui_component": _selector_servicios(servicios_db),
             "nuevo_estado": "pidiendo_servicio"
         }
-    session['servicio'] = servicio_elegido
+    session['servicios'] = [s['nombre'] for s in elegidos]
+    session['servicio'] = f" {SEPARADOR_SERVICIOS} ".join(session['servicios'])
+    session['duracion'] = _duracion_servicios(elegidos)
+    servicio_elegido = session['servicio']
     empleados = database.listar_empleados(negocio_id=_get_negocio_id())
     if not empleados:
         session['empleado_id'] = None
         session['empleado_nombre'] = None
         return _mostrar_calendario()
     session['empleados_disponibles'] = {e['nombre'].strip(): e['id'] for e in empleados}
-    nombres_empleados = [e['nombre'].strip() for e in empleados]
     return {
         "respuesta": f"¡Perfecto, un '{servicio_elegido}'! ¿Con qué profesional te gustaría?",
-        "ui_component": { "type": "choice_buttons", "choices": nombres_empleados },
+        "ui_component": { "type": "choice_buttons", "choices": _botones_empleados(empleados) },
         "nuevo_estado": "pidiendo_empleado"
     }
 
 def handle_peticion_empleado(texto_usuario):
     empleado_elegido = texto_usuario.strip()
     empleados_map = session.get('empleados_disponibles', {})
+    if utils.normalizar_texto(empleado_elegido) == utils.normalizar_texto(OPCION_CUALQUIER_EMPLEADO) and len(empleados_map) > 1:
+        # Disponibilidad conjunta; el profesional se asigna al elegir la hora
+        session['empleado_cualquiera'] = True
+        session['empleado_id'] = None
+        session['empleado_nombre'] = 'cualquier profesional'
+        return _mostrar_calendario()
     if empleado_elegido not in empleados_map:
         return {"respuesta": "No he reconocido a ese profesional.", "nuevo_estado": "pidiendo_empleado"}
+    session.pop('empleado_cualquiera', None)
     session['empleado_id'] = empleados_map[empleado_elegido]
     session['empleado_nombre'] = empleado_elegido
     return _mostrar_calendario()
 
-def _mostrar_calendario():
-    dias_disponibles = []
+def _dias_calendario(pagina):
+    """
+    Días con hueco de la página 'pagina' del calendario (CALENDARIO_DIAS_PAGINA
+    días cada una, desde hoy hasta el horizonte del negocio), y si hay páginas
+    antes y después. Lo ya calculado se guarda en la sesión como máscara de
+    días desde hoy, siempre con la página siguiente incluida: pasar de página
+    se sirve de la sesión y solo consulta la que queda por delante.
+    """
     hoy = utils.now_spain().date()
-    dia_actual = hoy
-    horario_semanal = database.obtener_horario_negocio(_get_negocio_id())
-    dias_semana_map = ['lunes', 'martes', 'miercoles', 'jueves', 'viernes', 'sabado', 'domingo']
-    while dia_actual.month == hoy.month:
-        nombre_columna_dia = f"horario_{dias_semana_map[dia_actual.weekday()]}"
-        if horario_semanal and horario_semanal.get(nombre_columna_dia):
-            dias_disponibles.append({
-                "display": f"{utils.formato_nombre_dia_es(dia_actual)} {dia_actual.strftime('%d/%m')}",
-                "value": dia_actual.strftime('%Y-%m-%d')
-            })
-        dia_actual += timedelta(days=1)
+    negocio_id = _get_negocio_id()
+    empleado = _empleado_para_busqueda()
+    por_pagina = disponibilidad.CALENDARIO_DIAS_PAGINA
+    total = disponibilidad.horizonte_dias(negocio_id) + 1  # hoy incluido
+    duracion = session.get('duracion')
+    cal = session.get('calendario')
+    servicios = session.get('servicios')
+    if (not cal or cal.get('hoy') != hoy.isoformat() or cal.get('empleado') != empleado
+            or cal.get('duracion') != duracion or cal.get('servicios') != servicios):
+        cal = {'hoy': hoy.isoformat(), 'empleado': empleado, 'duracion': duracion, 'servicios': servicios,
+               'calculados': 0, 'dias': '0'}
+    mascara = int(cal['dias'], 16)  # en hexadecimal: la sesión solo guarda enteros de 64 bits
+    necesarios = min((pagina + 2) * por_pagina, total)
+    if cal['calculados'] < necesarios:
+        for dia in disponibilidad.dias_con_hueco(
+            negocio_id, empleado, hoy + timedelta(days=cal['calculados']),
+            hoy + timedelta(days=necesarios - 1), titular=session.get('titular_reserva'), duracion=duracion,
+            necesidades=_necesidades()
+        ):
+            mascara |= 1 << (dia - hoy).days
+        cal = dict(cal, calculados=necesarios, dias=format(mascara, 'x'))
+    session['calendario'] = dict(cal, pagina=pagina)
+    inicio = pagina * por_pagina
+    fin = min(inicio + por_pagina, total)
+    dias = [hoy + timedelta(days=i) for i in range(inicio, fin) if (mascara >> i) & 1]
+    return dias, inicio > 0, fin < total
+
+def _mostrar_calendario(pagina=0):
+    dias, hay_anteriores, hay_siguientes = _dias_calendario(pagina)
+    dias_disponibles = [
+        {
+            "display": f"{utils.formato_nombre_dia_es(dia)} {dia.strftime('%d/%m')}",
+            "value": dia.strftime('%Y-%m-%d')
+        }
+        for dia in dias
+    ]
+    if hay_anteriores:
+        dias_disponibles.insert(0, {"display": OPCION_DIAS_ANTERIORES, "value": OPCION_DIAS_ANTERIORES})
+    if hay_siguientes:
+        dias_disponibles.append({"display": OPCION_MAS_DIAS, "value": OPCION_MAS_DIAS})
+    if dias:
+        respuesta = "De acuerdo, elige un nuevo día del calendario:"
+    elif hay_siguientes:
+        respuesta = "No quedan huecos en estos días. Prueba con los siguientes:"
+    else:
+        respuesta = "Lo siento, no quedan huecos libres en las fechas que se pueden reservar."
+        if _ofrecer_lista_espera():
+            return {
+                "respuesta": respuesta + " Si quieres, te avisamos cuando se libere uno.",
+                "ui_component": { "type": "choice_buttons", "choices": [OPCION_LISTA_ESPERA] },
+                "nuevo_estado": "pidiendo_hora"
+            }
     return {
-        "respuesta": "De acuerdo, elige un nuevo día del calendario:",
+        "respuesta": respuesta,
         "ui_component": { "type": "day_selector", "days": dias_disponibles },
         "nuevo_estado": "pidiendo_hora"
     }
 
-def _get_horas_jornada_para_dia(dia_semana_num, negocio_id=None):
+def _ofrecer_lista_espera():
+    # Al cambiar una cita ya existente no se apunta: conserva la suya
+    return lista_espera.activa() and not session.get('modificando_cita')
+
+def _es_lista_espera(texto_usuario):
+    return utils.normalizar_texto(texto_usuario.strip()) == utils.normalizar_texto(OPCION_LISTA_ESPERA)
+
+def _apuntar_lista_espera():
+    """Apunta la conversación a la lista de espera desde la fecha elegida (o hoy) y vuelve al inicio."""
+    servicios = session.get('servicios') or [session.get('servicio')]
+    hasta = lista_espera.apuntar(_get_negocio_id(), {
+        "nombre": session.get('nombre'),
+        "telefono": session.get('telefono'),
+        "email": session.get('email_cliente'),
+        "servicios": servicios,
+        "duracion": session.get('duracion'),
+        "recursos": _necesidades(),
+        "empleado_id": None if session.get('empleado_cualquiera') else session.get('empleado_id'),
+        "fecha": session.get('fecha'),
+    })
+    _limpiar_sesion_conversacion()
+    return {
+        "respuesta": (f"¡Hecho! Te avisaremos si se libera un hueco hasta el {hasta.strftime('%d/%m')}. "
+                     "Te lo guardaremos un rato para que puedas reservarlo."),
+        "post_respuesta": handle_bienvenida(""),
+        "nuevo_estado": "esperando_eleccion_inicial"
+    }
+
+def _pagina_calendario_pedida(texto_usuario):
+    """Página pedida con los botones de paso del calendario, o None si es otra cosa."""
+    opcion = utils.normalizar_texto(texto_usuario.strip())
+    actual = (session.get('calendario') or {}).get('pagina', 0)
+    if opcion == utils.normalizar_texto(OPCION_MAS_DIAS):
+        return actual + 1
+    if opcion == utils.normalizar_texto(OPCION_DIAS_ANTERIORES):
+        return max(0, actual - 1)
+    return None
+
+def _get_horas_jornada(fecha, negocio_id=None, empleado_id=None):
+    """Horas ("HH:MM") que se ofrecen esa fecha; las del profesional si se indica."""
     id_del_negocio = negocio_id if negocio_id is not None else _get_negocio_id()
     if not id_del_negocio:
-        return []
-
-    horario_db = database.obtener_horario_negocio(id_del_negocio)
-    if not horario_db:
-        return []
-
-    nombre_columna = f"horario_{dia_semana_num if isinstance(dia_semana_num, str) else ['lunes','martes','miercoles','jueves','viernes','sabado','domingo'][dia_semana_num]}"
-
-    # Ajuste para mantener compatibilidad con tu estructura (dict-like)
-    if isinstance(horario_db, dict):
-        horas_str = horario_db.get(nombre_columna, "")
-    else:
-        horas_str = None
-        try:
-            horas_str = horario_db[nombre_columna]
-        except Exception:
-            horas_str = ""
-
-    if not horas_str:
-        return []
-
-    return [h.strip() for h in horas_str.split(',')]
-
-def _mostrar_horas_para_fecha(fecha_str):
+        return ()
+    return horarios.horario(id_del_negocio).horas(fecha, empleado_id)
+
+def _horas_para_texto(texto_usuario, fecha_actual=None):
+    """
+    Horas libres del día pulsado en el calendario ("YYYY-MM-DD") o escrito
+    ("el viernes por la tarde", "mañana a las 5", ver fechas.py). Si el texto
+    no da día se usa 'fecha_actual' (el ya elegido), si lo hay.
+    """
+    texto = texto_usuario.strip()
+    try:
+        datetime.strptime(texto, '%Y-%m-%d')
+        return _mostrar_horas_para_fecha(texto)
+    except ValueError:
+        pass
+    hoy = utils.now_spain().date()
+    interpretacion = fechas.interpretar(texto, hoy)
+    fecha = interpretacion and (interpretacion.fecha.isoformat() if interpretacion.fecha else fecha_actual)
+    if not fecha:
+        return {
+            "respuesta": "No he entendido la fecha. Elige un día del calendario o escríbelo (por ejemplo, «el viernes por la tarde»).",
+            "nuevo_estado": "pidiendo_hora"
+        }
+    limite = hoy + timedelta(days=disponibilidad.horizonte_dias(_get_negocio_id()))
+    if interpretacion.fecha and interpretacion.fecha > limite:
+        calendario = _mostrar_calendario()
+        calendario["respuesta"] = f"Solo se puede reservar hasta el {limite.strftime('%d/%m')}. " + calendario["respuesta"]
+        return calendario
+    return _mostrar_horas_para_fecha(fecha, interpretacion.franja, interpretacion.hora)
+
+def _mostrar_horas_para_fecha(fecha_str, franja=None, hora_pedida=None):
+    """
+    Horas libres de esa fecha. 'franja' ((desde, hasta) en minutos) deja solo
+    las de esa parte del día si hay alguna; 'hora_pedida' libre pasa directa a
+    confirmar, como si se hubiera pulsado.
+    """
     try:
         fecha_obj = datetime.strptime(fecha_str, '%Y-%m-%d').date()
         session['fecha'] = fecha_str
-        horas_jornada = _get_horas_jornada_para_dia(fecha_obj.weekday())
+        cualquiera = session.get('empleado_cualquiera') and not session.get('modificando_cita')
+        horas_jornada = _get_horas_jornada(fecha_obj, empleado_id=None if cualquiera else session.get('empleado_id') or None)
         if not horas_jornada:
-            return {"respuesta": f"Lo siento, el día {fecha_obj.strftime('%d/%m')} está cerrado.", "nuevo_estado": "pidiendo_hora"}
+            return _sugerir_huecos(fecha_obj, f"Lo siento, el día {fecha_obj.strftime('%d/%m')} está cerrado.")
 
-        # CORRECCIÓN del walrus: definir fuera y usar directamente
-        horas_ocupadas = database.obtener_horas_ocupadas(
-            fecha_str,
-            negocio_id=_get_negocio_id(),
-            empleado_id=session.get('empleado_id')
-        )
+        if cualquiera:
+            # Unión de todos los profesionales: libre si al menos uno trabaja y lo está
+            horas_candidatas = disponibilidad.horas_libres_cualquiera(
+                _get_negocio_id(), fecha_obj, titular=session.get('titular_reserva'),
+                duracion=session.get('duracion'), necesidades=_necesidades()
+            )
+        else:
+            horas_candidatas = disponibilidad.horas_libres(
+                _get_negocio_id(), fecha_obj, horas_jornada,
+                empleado_id=session.get('empleado_id'), titular=session.get('titular_reserva'),
+                duracion=session.get('duracion'), necesidades=_necesidades()
+            )
         ahora = utils.now_spain()
 
         horas_libres = [
-            h for h in horas_jornada
-            if h not in horas_ocupadas
-            and (
+            h for h in horas_candidatas
+            if (
                 fecha_obj > ahora.date()
                 or (fecha_obj == ahora.date() and int(h.split(':')[0]) > ahora.hour)
             )
@@ -245,32 +433,143 @@ def _mostrar_horas_para_fecha(fecha_str):
         nuevo_estado = 'modificar_confirmar_hora' if session.get('modificando_cita') else 'esperando_pre_confirmacion'
         empleado = session.get('empleado_nombre', 'el profesional seleccionado')
         if not horas_libres:
-            return {"respuesta": f"Vaya, para el día {fecha_obj.strftime('%d/%m')} no quedan huecos con {empleado}.", "nuevo_estado": "pidiendo_hora"}
-
+            return _sugerir_huecos(fecha_obj, f"Vaya, para el día {fecha_obj.strftime('%d/%m')} no quedan huecos con {empleado}.")
+
+        respuesta = f"Estupendo. Para el día {fecha_obj.strftime('%d/%m')} con {empleado}, tengo hueco en estas horas:"
+        if hora_pedida in horas_libres:
+            if session.get('modificando_cita'):
+                return handle_modificar_confirmar_hora(hora_pedida)
+            return handle_esperando_pre_confirmacion(hora_pedida)
+        if hora_pedida:
+            respuesta = (f"A las {hora_pedida} no me queda hueco el día {fecha_obj.strftime('%d/%m')} con {empleado}, "
+                         "pero sí en estas horas:")
+        elif franja:
+            en_franja = [h for h in horas_libres if franja[0] <= int(h[:2]) * 60 + int(h[3:5]) < franja[1]]
+            if en_franja:
+                horas_libres = en_franja
+            else:
+                respuesta = (f"Ese día no me queda hueco en esa franja con {empleado}, "
+                             "pero sí en estas otras horas:")
         return {
-            "respuesta": f"Estupendo. Para el día {fecha_obj.strftime('%d/%m')} con {empleado}, tengo hueco en estas horas:",
+            "respuesta": respuesta,
             "ui_component": { "type": "hour_selector", "hours": horas_libres },
             "nuevo_estado": nuevo_estado
         }
     except (ValueError, IndexError):
         return {"respuesta": "No he entendido la fecha. Por favor, elige de nuevo.", "nuevo_estado": "pidiendo_hora"}
 
+def _sugerir_huecos(fecha_obj, mensaje):
+    """Cuando un día no tiene huecos, ofrece los más cercanos en una sola búsqueda."""
+    huecos = disponibilidad.primer_hueco_disponible(
+        _get_negocio_id(), session.get('duracion'), _empleado_para_busqueda(),
+        desde=fecha_obj, limite=4, titular=session.get('titular_reserva'), necesidades=_necesidades()
+    )
+    if not huecos:
+        if _ofrecer_lista_espera():
+            session['huecos_sugeridos'] = {}
+            return {
+                "respuesta": f"{mensaje} No quedan huecos libres más adelante; si quieres, te avisamos cuando se libere uno.",
+                "ui_component": { "type": "choice_buttons", "choices": [OPCION_LISTA_ESPERA, "Ver calendario"] },
+                "nuevo_estado": "eligiendo_hueco_sugerido"
+            }
+        return {"respuesta": f"{mensaje} Elige otro día del calendario.", "nuevo_estado": "pidiendo_hora"}
+    sugeridos = {}
+    for h in huecos:
+        fecha_h = datetime.strptime(h['fecha'], '%Y-%m-%d').date()
+        etiqueta = f"{utils.formato_nombre_dia_es(fecha_h)} {fecha_h.strftime('%d/%m')} · {h['hora']}"
+        if h.get('empleado_nombre') and session.get('empleado_cualquiera'):
+            etiqueta += f" · {h['empleado_nombre']}"
+        sugeridos[etiqueta] = h
+    session['huecos_sugeridos'] = sugeridos
+    return {
+        "respuesta": f"{mensaje} Los huecos libres más cercanos son:",
+        "ui_component": { "type": "choice_buttons", "choices": list(sugeridos.keys()) + ["Ver calendario"] },
+        "nuevo_estado": "eligiendo_hueco_sugerido"
+    }
+
+def handle_eleccion_hueco_sugerido(texto_usuario):
+    sugeridos = session.get('huecos_sugeridos') or {}
+    hueco = sugeridos.get(texto_usuario.strip())
+    if not hueco:
+        if 'calendario' in utils.normalizar_texto(texto_usuario):
+            session.pop('huecos_sugeridos', None)
+            return _mostrar_calendario()
+        if not sugeridos and _ofrecer_lista_espera():
+            if _es_lista_espera(texto_usuario):
+                session.pop('huecos_sugeridos', None)
+                return _apuntar_lista_espera()
+            opciones = [OPCION_LISTA_ESPERA]
+        else:
+            opciones = list(sugeridos.keys())
+        return {
+            "respuesta": "Por favor, pulsa una de las opciones.",
+            "ui_component": { "type": "choice_buttons", "choices": opciones + ["Ver calendario"] },
+            "nuevo_estado": "eligiendo_hueco_sugerido"
+        }
+    session.pop('huecos_sugeridos', None)
+    session['fecha'] = hueco['fecha']
+    if session.get('modificando_cita'):
+        return handle_modificar_confirmar_hora(hueco['hora'])
+    if hueco.get('empleado_id') is not None and not session.get('empleado_cualquiera'):
+        session['empleado_id'] = hueco['empleado_id']
+        session['empleado_nombre'] = hueco['empleado_nombre']
+    return handle_esperando_pre_confirmacion(hueco['hora'])
+
 def handle_peticion_hora(texto_usuario):
+    pagina = _pagina_calendario_pedida(texto_usuario)
+    if pagina is not None:
+        return _mostrar_calendario(pagina)
+    if _es_lista_espera(texto_usuario) and _ofrecer_lista_espera():
+        return _apuntar_lista_espera()
     if session.get('modificando_cita'):
         return handle_modificar_fecha_hora(texto_usuario)
-    return _mostrar_horas_para_fecha(texto_usuario)
+    return _horas_para_texto(texto_usuario)
+
+def _retener_con_empleado_menos_cargado(hora_elegida):
+    """Asigna la hora al profesional libre con menos citas ese día y la retiene a su nombre."""
+    fecha_obj = datetime.strptime(session.get('fecha'), '%Y-%m-%d').date()
+    necesidades = _necesidades()
+    candidatos = disponibilidad.empleados_libres_por_carga(
+        _get_negocio_id(), fecha_obj, hora_elegida, titular=session.get('titular_reserva'),
+        duracion=session.get('duracion'), necesidades=necesidades
+    )
+    for empleado_id, empleado_nombre in candidatos:
+        if database.retener_hueco(_get_negocio_id(), session.get('fecha'), hora_elegida, empleado_id,
+                                  _get_titular_reserva(), duracion=session.get('duracion'),
+                                  recursos=necesidades):
+            session['empleado_id'] = empleado_id
+            session['empleado_nombre'] = empleado_nombre
+            return True
+    return False
 
 def handle_esperando_pre_confirmacion(texto_usuario):
     hora_elegida = texto_usuario.strip()
     if not (':' in hora_elegida and len(hora_elegida) == 5):
+        if fechas.interpretar(hora_elegida):
+            return _horas_para_texto(hora_elegida, session.get('fecha'))
         return {"respuesta": "Por favor, pulsa uno de los botones de hora.", "nuevo_estado": "esperando_pre_confirmacion"}
+    # Retener la hora mientras el usuario revisa y confirma
+    if session.get('empleado_cualquiera'):
+        retenida = _retener_con_empleado_menos_cargado(hora_elegida)
+    else:
+        retenida = database.retener_hueco(
+            _get_negocio_id(), session.get('fecha'), hora_elegida,
+            session.get('empleado_id'), _get_titular_reserva(), duracion=session.get('duracion'),
+            recursos=_necesidades()
+        )
+    if not retenida:
+        horas = _mostrar_horas_para_fecha(session.get('fecha'))
+        horas["respuesta"] = f"¡Vaya! Alguien acaba de reservar las {hora_elegida}. " + horas["respuesta"]
+        return horas
+    session['hora_retenida'] = True
     session['hora'] = hora_elegida
     nombre_usuario = session.get('nombre', 'Cliente')
     fecha_legible = datetime.strptime(session.get('fecha'), '%Y-%m-%d').strftime('%A, %d de %B de %Y')
     empleado_nombre = session.get('empleado_nombre', 'el personal')
+    duracion = f" ({session['duracion']} min)" if session.get('duracion') else ""
     resumen = (
         f"¡Perfecto, {nombre_usuario}! Vamos a revisar los datos:\n\n"
-        f"› **Servicio:** {session.get('servicio')}\n"
+        f"› **Servicio:** {session.get('servicio')}{duracion}\n"
         f"› **Profesional:** {empleado_nombre}\n"
         f"› **Día:** {fecha_legible}\n"
         f"› **Hora:** {session.get('hora')}\n\n"
@@ -291,22 +590,33 @@ def handle_procesando_confirmacion(texto_usuario):
                 "nombre": session.get('nombre'),
                 "telefono": session.get('telefono'),
                 "servicio": session.get('servicio'),
+                "servicios": session.get('servicios'),
                 "fecha": session.get('fecha'),
                 "hora": session.get('hora'),
                 "empleado_id": session.get('empleado_id'),
-                "email": session.get('email_cliente')  # <-- importante para upsert_cliente
+                "email": session.get('email_cliente'),  # <-- importante para upsert_cliente
+                "titular": session.get('titular_reserva')
             }
-            database.guardar_reserva(datos_para_guardar, _get_negocio_id())
+            cita_id = database.guardar_reserva(datos_para_guardar, _get_negocio_id())
+            session.pop('hora_retenida', None)
+            if not cita_id:
+                calendario = _mostrar_calendario()
+                calendario["respuesta"] = "¡Vaya! Esa hora se ha ocupado mientras confirmabas. " + calendario["respuesta"]
+                return calendario
+            log_manager.vincular(cita_id=cita_id)
 
             negocio_info = database.obtener_negocio_por_id(_get_negocio_id())
             datos_notificacion = {
                 **datos_para_guardar,
+                "cita_id": cita_id,
+                "duracion": session.get('duracion'),
+                "lineas": database.obtener_lineas_cita(cita_id),
                 "empleado_nombre": session.get('empleado_nombre'),
                 "negocio_nombre": _get_negocio_nombre(),
                 "email_negocio": negocio_info.get('email') if negocio_info else None,
                 "email_cliente": session.get('email_cliente')
             }
-            email_manager.enviar_notificacion_cita(datos_notificacion)
+            notificaciones.enviar(email_manager.enviar_notificacion_cita, datos_notificacion)
 
             respuesta_final = "¡Tachán! Cita confirmada. Te hemos enviado un email con todos los detalles. ¡Gracias!"
             _limpiar_sesion_conversacion()
@@ -317,14 +627,14 @@ def handle_procesando_confirmacion(texto_usuario):
                 "nuevo_estado": "esperando_eleccion_inicial"
             }
         except Exception as e:
-            print(f"!!! ERROR al guardar o notificar cita: {e}")
+            log.exception("Error al guardar o notificar cita: %s", e)
             return {"respuesta": "¡Uy! Ha ocurrido un error al confirmar tu cita.", "nuevo_estado": None}
     elif "profesional" in texto_norm:
         empleados = database.listar_empleados(negocio_id=_get_negocio_id())
-        nombres_empleados = [e['nombre'].strip() for e in empleados]
+        session['empleados_disponibles'] = {e['nombre'].strip(): e['id'] for e in empleados}
         return {
             "respuesta": "¡Entendido! Elige de nuevo con qué profesional te gustaría:",
-            "ui_component": { "type": "choice_buttons", "choices": nombres_empleados },
+            "ui_component": { "type": "choice_buttons", "choices": _botones_empleados(empleados) },
             "nuevo_estado": "pidiendo_empleado"
         }
     elif "dia" in texto_norm or "hora" in texto_norm:
@@ -333,7 +643,9 @@ def handle_procesando_confirmacion(texto_usuario):
         return {"respuesta": "No te he entendido. Por favor, elige una de las opciones.", "nuevo_estado": "procesando_confirmacion"}
 
 def handle_gestion_pide_telefono(texto_usuario):
-    telefono = texto_usuario.strip()
+    telefono = utils.telefono_e164(texto_usuario)
+    if not telefono:
+        return {"respuesta": "Ese teléfono no parece válido. ¿Me lo escribes de nuevo?", "nuevo_estado": "gestion_pide_telefono"}
     session['telefono'] = telefono  # guardar para notificaciones posteriores
     # Recuperar email previo si existe soporte (tabla clientes)
     try:
@@ -353,6 +665,8 @@ def handle_gestion_pide_telefono(texto_usuario):
         "fecha": cita['fecha'].strftime('%Y-%m-%d'),
         "hora": cita['hora'].strftime('%H:%M'),
         "servicio_nombre": cita['servicio_nombre'],
+        "duracion": cita['duracion_min'],
+        "servicios": list(cita['servicios']),
         "empleado_nombre": cita.get('empleado_nombre', 'No asignado')
     }
     session['cita_a_gestionar'] = cita_serializable
@@ -386,6 +700,7 @@ def handle_gestion_confirmar_cancelacion(texto_usuario):
     if 'si' in respuesta_norm:
         cita_a_cancelar = session.get('cita_a_gestionar')
         if cita_a_cancelar:
+            log_manager.vincular(cita_id=cita_a_cancelar['id'])
             # database.cancelar_cita devuelve el detalle previo de la cita
             detalle_prev = database.cancelar_cita(cita_a_cancelar['id'], negocio_id=_get_negocio_id())
             try:
@@ -398,13 +713,15 @@ def handle_gestion_confirmar_cancelacion(texto_usuario):
                         "nombre": detalle_prev.get('nombre_cliente'),
                         "telefono": detalle_prev.get('telefono'),
                         "servicio": detalle_prev.get('servicio_nombre'),
+                        "lineas": detalle_prev.get('lineas'),
+                        "duracion": detalle_prev.get('duracion_min'),
                         "empleado_nombre": detalle_prev.get('empleado_nombre'),
                         "fecha": detalle_prev.get('fecha').strftime('%Y-%m-%d') if detalle_prev.get('fecha') else None,
                         "hora": detalle_prev.get('hora').strftime('%H:%M') if detalle_prev.get('hora') else None
                     }
-                    email_manager.enviar_notificacion_cancelacion(datos_email)
+                    notificaciones.enviar(email_manager.enviar_notificacion_cancelacion, datos_email)
             except Exception as e:
-                print(f"!!! ERROR al enviar email de cancelación: {e}")
+                log.exception("Error al enviar email de cancelación: %s", e)
         _limpiar_sesion_conversacion()
         return {"respuesta": "¡Hecho! Tu cita ha sido cancelada.", "nuevo_estado": "esperando_eleccion_inicial"}
     elif 'no' in respuesta_norm:
@@ -424,25 +741,37 @@ def handle_gestion_pide_campo_a_modificar(texto_usuario):
         servicios_db = database.listar_servicios(negocio_id=_get_negocio_id())
         nombres_servicios = [s['nombre'] for s in servicios_db]
         session['nombres_servicios_disponibles'] = nombres_servicios
-        botones_servicios = [f"{s['nombre']} — {s['precio']}€" for s in servicios_db]
         return {
-            "respuesta": "Entendido. ¿Por cuál de estos servicios quieres cambiarla?",
-            "ui_component": { "type": "choice_buttons", "choices": botones_servicios },
+            "respuesta": "Entendido. ¿Por cuál (o cuáles) de estos servicios quieres cambiarla?",
+            "ui_component": _selector_servicios(servicios_db),
             "nuevo_estado": "pidiendo_servicio"
         }
     elif 'dia' in texto_norm or 'hora' in texto_norm:
+        # La nueva hora tiene que tener sitio para la cita entera (y sus recursos)
+        session['duracion'] = (session.get('cita_a_gestionar') or {}).get('duracion')
+        session['servicios'] = (session.get('cita_a_gestionar') or {}).get('servicios')
         return _mostrar_calendario()
     else:
         return {"respuesta": "No te he entendido. Elige una de las opciones.", "nuevo_estado": "gestion_pide_campo_a_modificar"}
 
-def handle_modificar_servicio(texto_usuario_puro):
-    nombres_servicios = session.get('nombres_servicios_disponibles', [])
-    nuevo_servicio = utils.encontrar_servicio_mas_cercano(texto_usuario_puro, nombres_servicios)
-    if not nuevo_servicio:
+def handle_modificar_servicio(texto_usuario):
+    servicios_db = database.listar_servicios(negocio_id=_get_negocio_id())
+    elegidos = _elegir_servicios(texto_usuario, servicios_db)
+    if not elegidos:
         return {"respuesta": "No he reconocido ese servicio.", "nuevo_estado": "pidiendo_servicio"}
+    nuevos = [s['nombre'] for s in elegidos]
+    nuevo_servicio = f" {SEPARADOR_SERVICIOS} ".join(nuevos)
     cita_id = session['cita_a_gestionar']['id']
     # Obtener antes/después para notificación
-    antes, despues = database.modificar_cita(cita_id, _get_negocio_id(), {'servicio': nuevo_servicio})
+    antes, despues = database.modificar_cita(cita_id, _get_negocio_id(),
+                                             {'servicios': nuevos, 'titular': session.get('titular_reserva')})
+    if antes and not despues:
+        return {
+            "respuesta": (f"Con **'{nuevo_servicio}'** la cita ya no cabe a esa hora: se solaparía con otra "
+                          "o no queda sitio. Tu cita sigue como estaba. ¿Quieres elegir otros servicios?"),
+            "ui_component": _selector_servicios(servicios_db),
+            "nuevo_estado": "pidiendo_servicio"
+        }
     try:
         if antes and despues:
             datos_email = {
@@ -454,27 +783,35 @@ def handle_modificar_servicio(texto_usuario_puro):
                 "telefono": antes.get('telefono'),
                 "servicio_antes": antes.get('servicio_nombre'),
                 "servicio_despues": despues.get('servicio_nombre'),
+                "lineas": despues.get('lineas'),
+                "duracion": despues.get('duracion_min'),
                 "empleado_nombre": despues.get('empleado_nombre'),
                 "fecha": (despues.get('fecha').strftime('%Y-%m-%d') if despues.get('fecha') else None),
                 "hora": (despues.get('hora').strftime('%H:%M') if despues.get('hora') else None)
             }
-            email_manager.enviar_notificacion_modificacion(datos_email)
+            notificaciones.enviar(email_manager.enviar_notificacion_modificacion, datos_email)
     except Exception as e:
-        print(f"!!! ERROR al enviar email de modificación (servicio): {e}")
+        log.exception("Error al enviar email de modificación (servicio): %s", e)
 
     _limpiar_sesion_conversacion()
     return {"respuesta": f"¡Listo! He cambiado el servicio de tu cita a **'{nuevo_servicio}'**. El día y la hora se mantienen.", "nuevo_estado": "esperando_eleccion_inicial"}
 
 def handle_modificar_fecha_hora(texto_usuario):
-    return _mostrar_horas_para_fecha(texto_usuario)
+    return _horas_para_texto(texto_usuario)
 
 def handle_modificar_confirmar_hora(texto_usuario):
     hora_elegida = texto_usuario.strip()
     if not (':' in hora_elegida and len(hora_elegida) == 5):
+        if fechas.interpretar(hora_elegida):
+            return _horas_para_texto(hora_elegida, session.get('fecha'))
         return {"respuesta": "Por favor, pulsa uno de los botones de hora.", "nuevo_estado": "modificar_confirmar_hora"}
     cita_id = session['cita_a_gestionar']['id']
-    nuevos_datos = { 'fecha': session.get('fecha'), 'hora': hora_elegida }
+    nuevos_datos = { 'fecha': session.get('fecha'), 'hora': hora_elegida, 'titular': session.get('titular_reserva') }
     antes, despues = database.modificar_cita(cita_id, _get_negocio_id(), nuevos_datos)
+    if antes and not despues:
+        respuesta = _mostrar_horas_para_fecha(session.get('fecha'))
+        respuesta["respuesta"] = f"Lo siento, a las {hora_elegida} tu cita ya no cabe. " + respuesta["respuesta"]
+        return respuesta
 
     try:
         if antes and despues:
@@ -487,13 +824,15 @@ def handle_modificar_confirmar_hora(texto_usuario):
                 "telefono": antes.get('telefono'),
                 "servicio_antes": antes.get('servicio_nombre'),
                 "servicio_despues": despues.get('servicio_nombre'),
+                "lineas": despues.get('lineas'),
+                "duracion": despues.get('duracion_min'),
                 "empleado_nombre": despues.get('empleado_nombre'),
                 "fecha": (despues.get('fecha').strftime('%Y-%m-%d') if despues.get('fecha') else None),
                 "hora": (despues.get('hora').strftime('%H:%M') if despues.get('hora') else None)
             }
-            email_manager.enviar_notificacion_modificacion(datos_email)
+            notificaciones.enviar(email_manager.enviar_notificacion_modificacion, datos_email)
     except Exception as e:
-        print(f"!!! ERROR al enviar email de modificación (fecha/hora): {e}")
+        log.exception("Error al enviar email de modificación (fecha/hora): %s", e)
 
     _limpiar_sesion_conversacion()
     fecha_legible = datetime.strptime(nuevos_datos['fecha'], '%Y-%m-%d').strftime('%d/%m/%Y')
@@ -0,0 +1,364 @@
+# horarios.py
+"""
+Horarios semanales estructurados, compilados en memoria por negocio.
+
+- Reglas (horario_reglas): día de la semana, tramo [inicio, fin) en minutos
+  desde medianoche y paso entre citas; con profesional o sin él (horario del
+  negocio). Varios tramos el mismo día = pausas (p.ej. la comida).
+- Excepciones (horario_excepciones): sustituyen las reglas de una fecha, para
+  el negocio o un profesional. Una fila sin tramo es "cerrado".
+- Un profesional sin reglas propias sigue el horario del negocio; con reglas
+  propias trabaja en ellas, pero nunca fuera del horario del negocio ese día.
+
+horario(negocio_id) devuelve el Horario compilado: las horas de cada día ya
+calculadas, como tuplas "HH:MM" y como mapas de bits sobre los huecos de
+ocupacion.py. Se guarda por negocio mientras el listener de agenda escucha y
+se descarta cuando el negocio cambia su configuración (aviso 'negocios').
+
+Los negocios sin reglas del negocio siguen usando las columnas horario_*
+antiguas (horas sueltas separadas por comas), convertidas a tramos al cargar;
+al guardar el horario desde el admin pasan a reglas y las columnas se vacían.
+"""
+import os
+import threading
+from datetime import date
+import database
+import eventos
+import metrics
+import ocupacion
+import utils
+import log_manager
+
+log = log_manager.get_logger("horarios")
+
+DIAS_SEMANA = ['lunes', 'martes', 'miercoles', 'jueves', 'viernes', 'sabado', 'domingo']
+PASO_DEFECTO = 60
+MINUTOS_DIA = 24 * 60
+
+# -------------------------
+# Texto <-> tramos (solo al editar y al migrar el formato antiguo)
+# -------------------------
+
+def _minutos(hhmm):
+    h, m = hhmm.strip().split(':')
+    minutos = int(h) * 60 + int(m)
+    if not 0 <= int(m) < 60 or not 0 <= minutos <= MINUTOS_DIA:
+        raise ValueError(hhmm)
+    return minutos
+
+def _hhmm(minutos):
+    return f"{minutos // 60:02d}:{minutos % 60:02d}"
+
+def tramos_desde_horas(minutos):
+    """Agrupa horas sueltas (en minutos) en tramos (inicio, fin, paso) de paso constante."""
+    minutos = sorted(set(minutos))
+    tramos = []
+    i = 0
+    while i < len(minutos):
+        paso, j = PASO_DEFECTO, i
+        if i + 1 < len(minutos) and minutos[i + 1] - minutos[i] <= PASO_DEFECTO:
+            paso = minutos[i + 1] - minutos[i]
+            while j + 1 < len(minutos) and minutos[j + 1] - minutos[j] == paso:
+                j += 1
+        tramos.append((minutos[i], min(minutos[j] + paso, MINUTOS_DIA), paso))
+        i = j + 1
+    return tramos
+
+def parsear_tramos(texto):
+    """
+    "09:00-14:00, 16:00-20:00/30" -> [(540, 840, 60), (960, 1200, 30)]: de
+    inicio a cierre, con citas cada 60 minutos salvo que se indique "/paso".
+    Acepta también horas sueltas ("09:00,10:00,11:00", el formato antiguo).
+    Vacío o "cerrado": sin tramos. ValueError si no se entiende.
+    """
+    texto = (texto or "").strip()
+    if not texto or utils.normalizar_texto(texto) == 'cerrado':
+        return []
+    tramos, sueltas = [], []
+    for parte in texto.split(','):
+        parte = parte.strip()
+        if not parte:
+            continue
+        try:
+            if '-' in parte:
+                rango, _, paso = parte.partition('/')
+                inicio, fin = rango.split('-')
+                tramo = (_minutos(inicio), _minutos(fin), int(paso) if paso.strip() else PASO_DEFECTO)
+                if tramo[1] <= tramo[0] or tramo[2] <= 0:
+                    raise ValueError(parte)
+                tramos.append(tramo)
+            else:
+                sueltas.append(_minutos(parte))
+        except ValueError:
+            raise ValueError(f"Horario no válido: '{parte}' (ejemplo: 09:00-14:00, 16:00-20:00/30)") from None
+    return sorted(tramos + tramos_desde_horas(sueltas))
+
+def formatear_tramos(tramos):
+    if not tramos:
+        return ""
+    return ", ".join(
+        f"{_hhmm(ini)}-{_hhmm(fin)}" + ("" if paso == PASO_DEFECTO else f"/{paso}")
+        for ini, fin, paso in tramos
+    )
+
+def _dias(texto):
+    inicio, _, fin = utils.normalizar_texto(texto).partition('-')
+    try:
+        a = DIAS_SEMANA.index(inicio)
+        b = DIAS_SEMANA.index(fin) if fin else a
+    except ValueError:
+        raise ValueError(f"Día no válido: '{texto}' (ejemplo: lunes-viernes)") from None
+    return list(range(a, b + 1)) if a <= b else [*range(a, 7), *range(0, b + 1)]
+
+def parsear_semana(texto):
+    """
+    Horario propio de un profesional: "lunes-viernes 10:00-14:00; sabado 10:00-13:00"
+    -> {dia_semana: tramos}. Los días no nombrados no trabaja. Vacío: {} (sigue
+    el horario del negocio).
+    """
+    semana = {}
+    for parte in (texto or "").split(';'):
+        parte = parte.strip()
+        if not parte:
+            continue
+        dias, _, tramos = parte.partition(' ')
+        tramos = parsear_tramos(tramos)
+        for dia in _dias(dias):
+            semana[dia] = tramos
+    return semana
+
+def formatear_semana(semana):
+    return "; ".join(
+        f"{DIAS_SEMANA[dia]} {formatear_tramos(tramos) or 'cerrado'}"
+        for dia, tramos in sorted(semana.items())
+    )
+
+def parsear_excepciones(texto, nombres_empleados=()):
+    """
+    Una excepción por línea: "2026-12-24: 09:00-14:00", "2026-12-25: cerrado",
+    "2026-08-10 Ana: cerrado". Devuelve [(fecha, nombre_empleado o None, tramos)].
+    """
+    excepciones = []
+    for linea in (texto or "").splitlines():
+        linea = linea.strip()
+        if not linea:
+            continue
+        cabecera, _, tramos = linea.partition(':')
+        fecha, _, nombre = cabecera.strip().partition(' ')
+        try:
+            fecha = date.fromisoformat(fecha)
+        except ValueError:
+            raise ValueError(f"Fecha no válida en excepción: '{linea}' (ejemplo: 2026-12-24: cerrado)") from None
+        nombre = nombre.strip() or None
+        if nombre is not None and nombre not in nombres_empleados:
+            raise ValueError(f"Profesional desconocido en excepción: '{nombre}'")
+        excepciones.append((fecha, nombre, parsear_tramos(tramos)))
+    return excepciones
+
+# -------------------------
+# Horario compilado
+# -------------------------
+
+_H = ocupacion.MINUTOS_HUECO
+
+class _Jornada:
+    """Horas de un día (negocio o profesional): tramos, horas "HH:MM" y mapas de bits."""
+    __slots__ = ("tramos", "horas", "mascara", "abierto")
+
+    def __init__(self, tramos, dentro=None):
+        self.tramos = tuple(sorted(tramos))
+        minutos = sorted({m for ini, fin, paso in self.tramos for m in range(ini, fin, paso)})
+        if dentro is not None:
+            minutos = [m for m in minutos if (dentro >> (m // _H)) & 1]
+        self.horas = tuple(_hhmm(m) for m in minutos)
+        self.mascara = 0   # hueco de inicio de cada hora ofrecida
+        for m in minutos:
+            self.mascara |= 1 << (m // _H)
+        self.abierto = 0   # todos los huecos dentro de algún tramo
+        for ini, fin, _ in self.tramos:
+            self.abierto |= ((1 << (-(-fin // _H) - ini // _H)) - 1) << (ini // _H)
+        if dentro is not None:
+            self.abierto &= dentro
+
+    def dentro(self, abierto):
+        return _Jornada(self.tramos, dentro=abierto)
+
+_CERRADO = _Jornada(())
+
+class Horario:
+    """Horario compilado de un negocio: qué horas se ofrecen cada fecha y con quién."""
+    __slots__ = ("semana", "excepciones", "con_horario_propio", "tiene_horas", "horizonte_dias", "_efectivas")
+
+    def __init__(self, reglas, excepciones=(), horizonte_dias=None):
+        """
+        reglas: (dia_semana, empleado_id, (inicio, fin, paso)).
+        excepciones: (fecha, empleado_id, (inicio, fin, paso) o None = cerrado).
+        horizonte_dias: días por delante que se pueden reservar (None: el general).
+        """
+        self.horizonte_dias = horizonte_dias
+        por_dia = [{} for _ in DIAS_SEMANA]
+        for dia, empleado_id, tramo in reglas:
+            por_dia[dia].setdefault(empleado_id, []).append(tramo)
+        self.semana = [{e: _Jornada(t) for e, t in dia.items()} for dia in por_dia]
+        self.con_horario_propio = {e for dia in por_dia for e in dia if e is not None}
+        por_fecha = {}
+        for fecha, empleado_id, tramo in excepciones:
+            tramos = por_fecha.setdefault(fecha, {}).setdefault(empleado_id, [])
+            if tramo:
+                tramos.append(tramo)
+        self.excepciones = {f: {e: _Jornada(t) for e, t in dia.items()} for f, dia in por_fecha.items()}
+        self.tiene_horas = any(
+            j.horas for dias in (self.semana, self.excepciones.values()) for dia in dias for j in dia.values()
+        )
+        self._efectivas = {}  # (dia_semana, empleado_id) -> _Jornada, para días sin excepción
+
+    def _del_negocio(self, fecha, excepcion):
+        if excepcion and None in excepcion:
+            return excepcion[None]
+        return self.semana[fecha.weekday()].get(None, _CERRADO)
+
+    def jornada(self, fecha, empleado_id=None):
+        excepcion = self.excepciones.get(fecha)
+        negocio = self._del_negocio(fecha, excepcion)
+        if empleado_id is None:
+            return negocio
+        propia = excepcion.get(empleado_id) if excepcion else None
+        if propia is None:
+            if empleado_id not in self.con_horario_propio:
+                return negocio
+            if excepcion is None:
+                clave = (fecha.weekday(), empleado_id)
+                efectiva = self._efectivas.get(clave)
+                if efectiva is None:
+                    efectiva = self._efectivas[clave] = self.semana[fecha.weekday()].get(
+                        empleado_id, _CERRADO).dentro(negocio.abierto)
+                return efectiva
+            propia = self.semana[fecha.weekday()].get(empleado_id, _CERRADO)
+        return propia.dentro(negocio.abierto)
+
+    def horas(self, fecha, empleado_id=None):
+        """Horas "HH:MM" que se ofrecen esa fecha (las del profesional si se indica)."""
+        return self.jornada(fecha, empleado_id).horas
+
+    def trabaja(self, fecha, hora, empleado_id=None):
+        return bool((self.jornada(fecha, empleado_id).mascara >> ocupacion.hueco(hora)) & 1)
+
+    def jornadas(self, fecha, empleado_ids):
+        """{empleado_id: _Jornada} de esa fecha (ver ocupacion.Vista.libres_alguno)."""
+        return {e: self.jornada(fecha, e) for e in empleado_ids}
+
+    def horas_alguno(self, fecha, empleado_ids):
+        """Horas en que trabaja al menos uno de esos profesionales (sin profesionales: las del negocio)."""
+        if not empleado_ids:
+            return self.horas(fecha)
+        if not self.con_horario_propio and fecha not in self.excepciones:
+            return self.horas(fecha)
+        return tuple(sorted(set().union(*(self.horas(fecha, e) for e in empleado_ids))))
+
+    def textos(self, empleados):
+        """Horario en el formato del formulario de edición ('empleados': filas con id y nombre)."""
+        nombres = {e['id']: e['nombre'] for e in empleados}
+        lineas = []
+        for fecha in sorted(self.excepciones):
+            for empleado_id, jornada in self.excepciones[fecha].items():
+                if empleado_id is not None and empleado_id not in nombres:
+                    continue
+                quien = f" {nombres[empleado_id]}" if empleado_id is not None else ""
+                lineas.append(f"{fecha.isoformat()}{quien}: {formatear_tramos(jornada.tramos) or 'cerrado'}")
+        return {
+            "dias": {
+                nombre: formatear_tramos(self.semana[i][None].tramos) if None in self.semana[i] else ""
+                for i, nombre in enumerate(DIAS_SEMANA)
+            },
+            "empleados": {
+                e: formatear_semana({i: dia[e].tramos for i, dia in enumerate(self.semana) if e in dia})
+                for e in self.con_horario_propio
+            },
+            "excepciones": "\n".join(lineas),
+            "horizonte_dias": self.horizonte_dias or "",
+        }
+
+def _reglas_antiguas(fila):
+    """Reglas del negocio a partir de las columnas horario_* (horas sueltas separadas por comas)."""
+    reglas = []
+    for dia, nombre in enumerate(DIAS_SEMANA):
+        minutos = []
+        for hora in (fila.get(f"horario_{nombre}") or "").split(','):
+            if not hora.strip():
+                continue
+            try:
+                minutos.append(_minutos(hora))
+            except ValueError:
+                log.warning("Hora no válida en horario_%s: %r", nombre, hora)
+        reglas.extend((dia, None, tramo) for tramo in tramos_desde_horas(minutos))
+    return reglas
+
+def _cargar(negocio_id):
+    reglas, excepciones = database.obtener_reglas_horario(negocio_id)
+    reglas = [(r['dia_semana'], r['empleado_id'], (r['inicio_min'], r['fin_min'], r['paso_min'])) for r in reglas]
+    fila = database.obtener_horario_negocio(negocio_id) or {}
+    if not any(empleado_id is None for _, empleado_id, _ in reglas):
+        reglas.extend(_reglas_antiguas(fila))
+    excepciones = [
+        (x['fecha'], x['empleado_id'],
+         (x['inicio_min'], x['fin_min'], x['paso_min']) if x['inicio_min'] is not None else None)
+        for x in excepciones
+    ]
+    return Horario(reglas, excepciones, fila.get('horizonte_reserva_dias'))
+
+# -------------------------
+# Caché por negocio
+# -------------------------
+
+_lock = threading.Lock()
+_horarios = {}      # negocio_id -> Horario
+_generacion = 0     # sube con cada invalidación: una carga en curso no guarda un horario viejo
+_registrado = False
+
+def _registrar_oyente():
+    global _registrado
+    if not _registrado:
+        _registrado = True
+        eventos.al_cambiar(_al_cambiar)
+
+def _al_cambiar(evento):
+    """Descarta el horario del negocio que cambió su configuración (hilo del listener)."""
+    global _generacion
+    if evento.get("tipo") == eventos.RECARGAR["tipo"]:
+        with _lock:
+            _horarios.clear()
+            _generacion += 1
+    elif evento.get("tabla") == "negocios":
+        with _lock:
+            _horarios.pop(evento.get("negocio_id"), None)
+            _generacion += 1
+
+def horario(negocio_id):
+    """Horario compilado del negocio (de memoria si no ha cambiado)."""
+    _registrar_oyente()
+    with _lock:
+        compilado = _horarios.get(negocio_id)
+        generacion = _generacion
+    if compilado is not None:
+        metrics.HORARIOS_CACHE.inc("acierto")
+        return compilado
+    metrics.HORARIOS_CACHE.inc("fallo")
+    guardar = eventos.escuchando()
+    compilado = _cargar(negocio_id)
+    if guardar:
+        with _lock:
+            if _generacion == generacion:
+                _horarios[negocio_id] = compilado
+    return compilado
+
+def textos_formulario(negocio_id, empleados):
+    return horario(negocio_id).textos(empleados)
+
+def _tras_fork():
+    # El listener del padre no existe aquí: el primer uso vuelve a registrarse y lo arranca
+    global _lock, _horarios, _registrado
+    _lock = threading.Lock()
+    _horarios = {}
+    _registrado = False
+
+os.register_at_fork(after_in_child=_tras_fork)
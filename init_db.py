@@ -2,6 +2,7 @@
 import psycopg2
 from psycopg2.extras import RealDictCursor
 import os
+from database import _SQL_NOTIFICACIONES_AGENDA
 
 DB_NAME = os.getenv("DB_NAME", "chatbot_sialweb_local")
 DB_USER = os.getenv("DB_USER", "postgres")
@@ -31,8 +32,10 @@ def crear_tablas_basicas():
             horario_jueves TEXT,
             horario_viernes TEXT,
             horario_sabado TEXT,
-            horario_domingo TEXT
+            horario_domingo TEXT,
+            horizonte_reserva_dias INTEGER CHECK (horizonte_reserva_dias > 0)
         );""")
+        cur.execute("ALTER TABLE negocios ADD COLUMN IF NOT EXISTS horizonte_reserva_dias INTEGER CHECK (horizonte_reserva_dias > 0);")
 
         cur.execute("""
         CREATE TABLE IF NOT EXISTS servicios (
@@ -50,16 +53,65 @@ def crear_tablas_basicas():
             nombre TEXT NOT NULL
         );""")
 
+        # Particionada por mes (fecha): las particiones las mantiene database.ensure_particiones_citas
         cur.execute("""
         CREATE TABLE IF NOT EXISTS citas (
-            id SERIAL PRIMARY KEY,
+            id SERIAL,
             negocio_id INTEGER REFERENCES negocios(id) ON DELETE CASCADE,
             nombre_cliente TEXT NOT NULL,
             telefono TEXT NOT NULL,
             servicio_id INTEGER REFERENCES servicios(id),
             empleado_id INTEGER REFERENCES empleados(id),
             fecha DATE NOT NULL,
-            hora TIME NOT NULL
+            hora TIME NOT NULL,
+            duracion_min SMALLINT CHECK (duracion_min > 0),  -- NULL: citas antiguas, un solo hueco
+            PRIMARY KEY (id, fecha)
+        ) PARTITION BY RANGE (fecha);""")
+        cur.execute("""
+        DO $$
+        DECLARE mes DATE;
+        BEGIN
+            IF (SELECT relkind FROM pg_class WHERE oid = 'citas'::regclass) = 'p' THEN
+                FOR mes IN SELECT generate_series(date_trunc('month', CURRENT_DATE) - INTERVAL '1 month',
+                                                  date_trunc('month', CURRENT_DATE) + INTERVAL '13 months',
+                                                  INTERVAL '1 month')::date
+                LOOP
+                    EXECUTE format('CREATE TABLE IF NOT EXISTS %I PARTITION OF citas FOR VALUES FROM (%L) TO (%L)',
+                                   'citas_' || to_char(mes, 'YYYY_MM'), mes, (mes + INTERVAL '1 month')::date);
+                END LOOP;
+            END IF;
+        END $$;""")
+        cur.execute("ALTER TABLE citas ADD COLUMN IF NOT EXISTS duracion_min SMALLINT CHECK (duracion_min > 0);")
+        cur.execute("ALTER TABLE citas ADD COLUMN IF NOT EXISTS recursos JSONB;")  # {recurso_id: cantidad}
+
+        # --- Líneas de servicio de cada cita (varios servicios en una misma cita) ---
+        # Sin clave foránea a citas (particionada): se borran con la cita (database._SQL_BORRAR_CITAS)
+        cur.execute("""
+        CREATE TABLE IF NOT EXISTS cita_servicios (
+            cita_id INTEGER NOT NULL,
+            orden SMALLINT NOT NULL,
+            servicio_id INTEGER REFERENCES servicios(id) ON DELETE SET NULL,
+            nombre TEXT NOT NULL,
+            precio NUMERIC(10,2),
+            duracion INTEGER,
+            PRIMARY KEY (cita_id, orden)
+        );""")
+
+        # --- Recursos con capacidad (sillas, cabinas, máquinas) y lo que pide cada servicio ---
+        cur.execute("""
+        CREATE TABLE IF NOT EXISTS recursos (
+            id SERIAL PRIMARY KEY,
+            negocio_id INTEGER NOT NULL REFERENCES negocios(id) ON DELETE CASCADE,
+            nombre TEXT NOT NULL,
+            capacidad INTEGER NOT NULL DEFAULT 1 CHECK (capacidad > 0),
+            UNIQUE (negocio_id, nombre)
+        );""")
+        cur.execute("""
+        CREATE TABLE IF NOT EXISTS servicio_recursos (
+            servicio_id INTEGER NOT NULL REFERENCES servicios(id) ON DELETE CASCADE,
+            recurso_id INTEGER NOT NULL REFERENCES recursos(id) ON DELETE CASCADE,
+            cantidad INTEGER NOT NULL DEFAULT 1 CHECK (cantidad > 0),
+            PRIMARY KEY (servicio_id, recurso_id)
         );""")
 
         cur.execute("""
@@ -86,12 +138,140 @@ def crear_tablas_basicas():
         cur.execute("""
         CREATE TABLE IF NOT EXISTS recordatorios_enviados (
             id SERIAL PRIMARY KEY,
-            cita_id INTEGER NOT NULL REFERENCES citas(id) ON DELETE CASCADE,
+            cita_id INTEGER NOT NULL,         -- citas(id), sin clave foránea (citas particionada)
             tipo TEXT NOT NULL,               -- '2h'
             enviado_en TIMESTAMP NOT NULL DEFAULT NOW(),
             UNIQUE (cita_id, tipo)
         );""")
 
+        # --- Índices para las consultas de disponibilidad por rango de fechas ---
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_citas_negocio_fecha ON citas (negocio_id, fecha, hora);")
+        # Cliente por teléfono (en E.164; los antiguos los migra database.ensure_telefonos_e164)
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_citas_negocio_telefono ON citas (negocio_id, telefono, fecha);")
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_bloqueos_negocio_fecha ON bloqueos (negocio_id, fecha, hora);")
+        # Listados de administración: páginas por (nombre, id) y búsqueda de un trozo del nombre
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_negocios_nombre_id ON negocios (nombre, id);")
+        # Sin permiso para crear la extensión se sigue sin índice (como database.ensure_indices_listados)
+        cur.execute("SAVEPOINT trgm;")
+        try:
+            cur.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm;")
+            cur.execute("CREATE INDEX IF NOT EXISTS idx_negocios_nombre_trgm ON negocios USING gin (nombre gin_trgm_ops);")
+            cur.execute("RELEASE SAVEPOINT trgm;")
+        except psycopg2.Error as e:
+            cur.execute("ROLLBACK TO SAVEPOINT trgm;")
+            print(f"Sin índice trigram para buscar negocios por nombre: {e}")
+
+        # --- Retenciones temporales de huecos durante la conversación ---
+        cur.execute("""
+        CREATE TABLE IF NOT EXISTS reservas_temporales (
+            id SERIAL PRIMARY KEY,
+            negocio_id INTEGER NOT NULL REFERENCES negocios(id) ON DELETE CASCADE,
+            empleado_id INTEGER,
+            fecha DATE NOT NULL,
+            hora TIME NOT NULL,
+            titular TEXT NOT NULL,             -- token de la conversación
+            expira_at TIMESTAMP NOT NULL,
+            duracion_min SMALLINT CHECK (duracion_min > 0),
+            recursos JSONB
+        );""")
+        cur.execute("ALTER TABLE reservas_temporales ADD COLUMN IF NOT EXISTS duracion_min SMALLINT CHECK (duracion_min > 0);")
+        cur.execute("ALTER TABLE reservas_temporales ADD COLUMN IF NOT EXISTS recursos JSONB;")
+        # Varias retenciones pueden compartir hora: los solapes los ordena el cerrojo del día
+        cur.execute("DROP INDEX IF EXISTS uq_reservas_temporales_hueco;")
+        cur.execute("""
+        CREATE UNIQUE INDEX IF NOT EXISTS uq_reservas_temporales_titular
+            ON reservas_temporales (titular, negocio_id, fecha, hora);""")
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_reservas_temporales_expira ON reservas_temporales (expira_at);")
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_reservas_temporales_titular ON reservas_temporales (titular);")
+
+        # --- Respuestas de /mensaje por clave de idempotencia (reintentos del widget) ---
+        cur.execute("""
+        CREATE TABLE IF NOT EXISTS respuestas_idempotentes (
+            clave TEXT PRIMARY KEY,            -- "<conversación>:<Idempotency-Key>"
+            respuesta JSONB,                   -- NULL mientras se procesa
+            expira_at TIMESTAMP NOT NULL
+        );""")
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_respuestas_idempotentes_expira ON respuestas_idempotentes (expira_at);")
+
+        # --- Sesiones de chat en servidor para integraciones (/mensajes/batch) ---
+        cur.execute("""
+        CREATE TABLE IF NOT EXISTS conversaciones (
+            id TEXT PRIMARY KEY,
+            sesion TEXT NOT NULL,
+            actualizado TIMESTAMP NOT NULL DEFAULT NOW()
+        );""")
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_conversaciones_actualizado ON conversaciones (actualizado);")
+
+        # --- WhatsApp entrante aún sin procesar (el webhook guarda antes de contestar a Twilio) ---
+        cur.execute("""
+        CREATE TABLE IF NOT EXISTS whatsapp_entrantes (
+            id BIGSERIAL PRIMARY KEY,
+            conversacion TEXT NOT NULL,
+            texto TEXT NOT NULL,
+            slug TEXT NOT NULL DEFAULT '',
+            sid TEXT UNIQUE,                   -- MessageSid de Twilio
+            recibido_at TIMESTAMP NOT NULL DEFAULT NOW()
+        );""")
+        cur.execute("ALTER TABLE whatsapp_entrantes ADD COLUMN IF NOT EXISTS procesando_hasta TIMESTAMP;")  # plazo del hilo que la procesa
+        cur.execute("ALTER TABLE whatsapp_entrantes ADD COLUMN IF NOT EXISTS intentos SMALLINT NOT NULL DEFAULT 0;")
+        cur.execute("ALTER TABLE whatsapp_entrantes ADD COLUMN IF NOT EXISTS abandonado_at TIMESTAMP;")  # tras WHATSAPP_INTENTOS fallos
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_whatsapp_entrantes_conversacion ON whatsapp_entrantes (conversacion, id);")
+
+        # --- Horario estructurado: reglas semanales y excepciones por fecha (minutos desde medianoche) ---
+        cur.execute("""
+        CREATE TABLE IF NOT EXISTS horario_reglas (
+            id SERIAL PRIMARY KEY,
+            negocio_id INTEGER NOT NULL REFERENCES negocios(id) ON DELETE CASCADE,
+            empleado_id INTEGER REFERENCES empleados(id) ON DELETE CASCADE,
+            dia_semana SMALLINT NOT NULL CHECK (dia_semana BETWEEN 0 AND 6),
+            inicio_min SMALLINT NOT NULL CHECK (inicio_min >= 0),
+            fin_min SMALLINT NOT NULL CHECK (fin_min > inicio_min AND fin_min <= 1440),
+            paso_min SMALLINT NOT NULL DEFAULT 60 CHECK (paso_min > 0)
+        );""")
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_horario_reglas_negocio ON horario_reglas (negocio_id);")
+        cur.execute("""
+        CREATE TABLE IF NOT EXISTS horario_excepciones (
+            id SERIAL PRIMARY KEY,
+            negocio_id INTEGER NOT NULL REFERENCES negocios(id) ON DELETE CASCADE,
+            empleado_id INTEGER REFERENCES empleados(id) ON DELETE CASCADE,
+            fecha DATE NOT NULL,
+            inicio_min SMALLINT,
+            fin_min SMALLINT,
+            paso_min SMALLINT NOT NULL DEFAULT 60 CHECK (paso_min > 0),
+            CHECK ((inicio_min IS NULL AND fin_min IS NULL)
+                   OR (inicio_min >= 0 AND fin_min > inicio_min AND fin_min <= 1440))
+        );""")
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_horario_excepciones_negocio ON horario_excepciones (negocio_id, fecha);")
+
+        # --- Lista de espera: token NULL = esperando; con token = hueco ofrecido y retenido ---
+        cur.execute("""
+        CREATE TABLE IF NOT EXISTS lista_espera (
+            id SERIAL PRIMARY KEY,
+            negocio_id INTEGER NOT NULL REFERENCES negocios(id) ON DELETE CASCADE,
+            empleado_id INTEGER REFERENCES empleados(id) ON DELETE SET NULL,
+            servicios TEXT[] NOT NULL,
+            duracion_min SMALLINT CHECK (duracion_min > 0),
+            recursos JSONB,
+            fecha_desde DATE NOT NULL,
+            fecha_hasta DATE NOT NULL,
+            nombre TEXT NOT NULL,
+            telefono TEXT NOT NULL,
+            email TEXT,
+            creada_at TIMESTAMP NOT NULL DEFAULT NOW(),
+            token TEXT UNIQUE,
+            oferta_fecha DATE,
+            oferta_hora TIME,
+            oferta_empleado_id INTEGER,
+            oferta_expira TIMESTAMP,
+            CHECK (fecha_hasta >= fecha_desde AND fecha_hasta - fecha_desde < 62)
+        );""")
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_lista_espera_esperando ON lista_espera (negocio_id, fecha_desde) WHERE token IS NULL;")
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_lista_espera_ofertas ON lista_espera (oferta_expira) WHERE token IS NOT NULL;")
+
+        # --- Versiones por (negocio, día) y avisos en vivo al panel (LISTEN/NOTIFY) ---
+        # Mismo SQL que database.ensure_notificaciones_agenda para no mantener dos copias
+        cur.execute(_SQL_NOTIFICACIONES_AGENDA)
+
         conn.commit()
         print("Tablas verificadas/creadas correctamente.")
 
@@ -0,0 +1,110 @@
+# limitador.py
+"""
+Limitación de tasa por token bucket (por IP y por negocio) para /mensaje.
+
+Cada clave tiene un cubo de 'rafaga' fichas que se rellena a 'por_minuto'
+fichas/minuto; cada petición gasta una. Sin ficha -> 429 con Retry-After.
+
+Backends (RATE_LIMIT_BACKEND):
+  local     (por defecto) cubos en memoria del proceso. Para aproximar un límite
+            global se reparte la tasa entre los WEB_CONCURRENCY workers. No
+            toca la base de datos.
+  postgres  cubos compartidos en la tabla limites_tasa: un único UPSERT
+            atómico por comprobación.
+"""
+import os
+import math
+import time
+import threading
+import config
+import database
+import log_manager
+
+log = log_manager.get_logger("limitador")
+
+RATE_LIMIT_BACKEND = getattr(config, "RATE_LIMIT_BACKEND", os.getenv("RATE_LIMIT_BACKEND", "local")).lower()
+RATE_LIMIT_IP_POR_MINUTO = float(getattr(config, "RATE_LIMIT_IP_POR_MINUTO", os.getenv("RATE_LIMIT_IP_POR_MINUTO", 30)))
+RATE_LIMIT_IP_RAFAGA = float(getattr(config, "RATE_LIMIT_IP_RAFAGA", os.getenv("RATE_LIMIT_IP_RAFAGA", 10)))
+RATE_LIMIT_NEGOCIO_POR_MINUTO = float(getattr(config, "RATE_LIMIT_NEGOCIO_POR_MINUTO", os.getenv("RATE_LIMIT_NEGOCIO_POR_MINUTO", 300)))
+RATE_LIMIT_NEGOCIO_RAFAGA = float(getattr(config, "RATE_LIMIT_NEGOCIO_RAFAGA", os.getenv("RATE_LIMIT_NEGOCIO_RAFAGA", 60)))
+WEB_CONCURRENCY = max(1, int(os.getenv("WEB_CONCURRENCY", 1)))
+
+MAX_CLAVES_LOCALES = 50000  # tope de memoria del backend local
+
+class _CubosLocales:
+    def __init__(self, reparto):
+        self._lock = threading.Lock()
+        self._cubos = {}  # clave -> [fichas, instante]
+        self._reparto = reparto
+
+    def consumir(self, clave, por_minuto, rafaga):
+        """0 si se permite; si no, segundos hasta la próxima ficha."""
+        tasa = por_minuto / 60.0 / self._reparto
+        capacidad = max(1.0, rafaga / self._reparto)
+        ahora = time.monotonic()
+        with self._lock:
+            cubo = self._cubos.get(clave)
+            if cubo is None:
+                if len(self._cubos) >= MAX_CLAVES_LOCALES:
+                    self._purgar(ahora)
+                cubo = self._cubos[clave] = [capacidad, ahora]
+            fichas = min(capacidad, cubo[0] + (ahora - cubo[1]) * tasa)
+            cubo[1] = ahora
+            if fichas >= 1:
+                cubo[0] = fichas - 1
+                return 0
+            cubo[0] = fichas
+            return (1 - fichas) / tasa if tasa else 60
+
+    def _purgar(self, ahora):
+        # Cubos sin uso en 10 min ya estarían llenos: olvidarlos no cambia nada
+        for clave in [c for c, (_, t) in self._cubos.items() if ahora - t > 600]:
+            del self._cubos[clave]
+
+class _CubosPostgres:
+    def consumir(self, clave, por_minuto, rafaga):
+        tasa = por_minuto / 60.0
+        if database.consumir_ficha(clave, tasa, rafaga):
+            return 0
+        return 1 / tasa if tasa else 60
+
+def _crear_backend():
+    if RATE_LIMIT_BACKEND == "postgres":
+        return _CubosPostgres()
+    return _CubosLocales(WEB_CONCURRENCY)
+
+_backend = _crear_backend()
+
+def _tras_fork():
+    # Cada worker (también los de gunicorn --preload) lleva sus propios cubos
+    global _backend
+    _backend = _crear_backend()
+
+os.register_at_fork(after_in_child=_tras_fork)
+
+# slug de ?business= -> id del negocio al que lo resolvió la app en este proceso.
+# Así el cubo del negocio va siempre por id, venga de la sesión o de la URL,
+# sin consultar la base de datos antes de limitar.
+_ids_por_slug = {}
+
+def recordar_slug(slug, negocio_id):
+    """Anota a qué negocio llevó un slug de la URL (lo llama la app al resolverlo)."""
+    if len(_ids_por_slug) >= MAX_CLAVES_LOCALES:
+        _ids_por_slug.clear()
+    _ids_por_slug[slug] = negocio_id
+
+def id_de_slug(slug):
+    """Id del negocio de un slug ya resuelto en este proceso, o None."""
+    return _ids_por_slug.get(slug)
+
+def comprobar(ip, negocio_id):
+    """
+    Gasta una ficha del cubo de la IP y otra del negocio (por id; None si aún
+    no se sabe cuál es). Devuelve None si se permite o los segundos de
+    Retry-After (entero) si hay que responder 429.
+    """
+    esperas = [_backend.consumir(f"ip:{ip}", RATE_LIMIT_IP_POR_MINUTO, RATE_LIMIT_IP_RAFAGA)]
+    if negocio_id is not None and not esperas[0]:
+        esperas.append(_backend.consumir(f"negocio:{negocio_id}", RATE_LIMIT_NEGOCIO_POR_MINUTO, RATE_LIMIT_NEGOCIO_RAFAGA))
+    espera = max(esperas)
+    return math.ceil(espera) if espera else None
@@ -0,0 +1,200 @@
+# lista_espera.py
+"""
+Lista de espera: quien se queda sin huecos en el chat deja su contacto y,
+cuando se libera algo, se le ofrece.
+
+- El aviso de agenda de eventos.py (una cita cancelada o movida, un bloqueo
+  borrado: op 'baja') dispara el casado; no hay barrido periódico de la lista.
+- Por cada hueco liberado se leen por índice solo las entradas de ese negocio
+  cuya ventana incluye la fecha (database.candidatos_lista_espera) y se
+  comprueba, por orden de llegada, si el tramo que necesitan cabe ese día. El
+  coste crece con los huecos liberados, no con el tamaño de la lista.
+- Al primero que encaja se le retiene el tramo LISTA_ESPERA_OFERTA_MINUTOS
+  minutos (titular 'espera:<token>') y se le avisa por email y WhatsApp con un
+  enlace para aceptarlo. Si caduca sin respuesta, la entrada sale de la lista
+  y el hueco se ofrece al siguiente (ver caducar_ofertas).
+
+Con varios workers cada uno recibe el aviso: reclamar la entrada y retener el
+tramo van en una misma transacción, así que solo uno llega a ofrecerlo.
+Necesita URL_PUBLICA para construir el enlace; sin ella no se ofrece apuntarse.
+"""
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, timedelta
+import config
+import database
+import disponibilidad
+import email_manager
+import whatsapp_manager
+import notificaciones
+import eventos
+import ocupacion
+import utils
+import log_manager
+
+log = log_manager.get_logger("lista_espera")
+
+URL_PUBLICA = (getattr(config, "URL_PUBLICA", os.getenv("URL_PUBLICA", "")) or "").rstrip("/")
+LISTA_ESPERA_OFERTA_MINUTOS = int(getattr(config, "LISTA_ESPERA_OFERTA_MINUTOS", os.getenv("LISTA_ESPERA_OFERTA_MINUTOS", 30)))
+# Días (desde la fecha pedida) durante los que sirve cualquier hueco
+LISTA_ESPERA_DIAS = min(int(getattr(config, "LISTA_ESPERA_DIAS", os.getenv("LISTA_ESPERA_DIAS", 14))),
+                        database.LISTA_ESPERA_MAX_DIAS)
+LISTA_ESPERA_CANDIDATOS = 20  # entradas probadas por hueco liberado
+
+_lock = threading.Lock()
+_ejecutor = None
+_registrado = False
+
+def activa():
+    return bool(URL_PUBLICA)
+
+def apuntar(negocio_id, datos):
+    """Apunta a la lista (datos como en database.apuntar_lista_espera, sin la ventana)."""
+    desde = date.fromisoformat(datos['fecha']) if datos.get('fecha') else utils.now_spain().date()
+    entrada_id = database.apuntar_lista_espera(negocio_id, dict(
+        datos, fecha_desde=desde, fecha_hasta=desde + timedelta(days=LISTA_ESPERA_DIAS - 1)
+    ))
+    log.info("Apuntado a la lista de espera: entrada %s", entrada_id)
+    return desde + timedelta(days=LISTA_ESPERA_DIAS - 1)
+
+# -------------------------
+# Casado por eventos
+# -------------------------
+
+def iniciar():
+    """Empieza a atender los avisos de agenda de este proceso."""
+    global _registrado
+    if _registrado or not activa():
+        return
+    _registrado = True
+    # Primero el índice de ocupación: cuando llega nuestro turno ya ha aplicado la baja
+    ocupacion._registrar_oyente()
+    eventos.al_cambiar(_al_cambiar)
+
+def _obtener_ejecutor():
+    global _ejecutor
+    with _lock:
+        if _ejecutor is None:
+            # Un hilo: los huecos se ofrecen en el orden en que se liberan
+            _ejecutor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="lista_espera")
+        return _ejecutor
+
+def _al_cambiar(evento):
+    """Encola el casado de cada hueco liberado (hilo del listener: no consulta nada aquí)."""
+    if evento.get("op") != 'baja' or evento.get("tabla") not in ('citas', 'bloqueos'):
+        return
+    try:
+        fecha = date.fromisoformat(evento["fecha"])
+    except (KeyError, TypeError, ValueError):
+        return
+    if fecha < utils.now_spain().date():
+        return
+    _obtener_ejecutor().submit(_casar, evento["negocio_id"], fecha, evento.get("empleado_id"))
+
+def _casar(negocio_id, fecha, empleado_id):
+    try:
+        with log_manager.contexto(negocio_id=negocio_id):
+            hueco_liberado(negocio_id, fecha, empleado_id)
+    except Exception as e:
+        log.exception("Error casando la lista de espera: %s", e)
+
+def hueco_liberado(negocio_id, fecha, empleado_id=None):
+    """
+    Ofrece lo liberado ese día (de ese profesional, si se indica) a la primera
+    entrada en espera que quepa. True si se ha hecho una oferta.
+    """
+    for entrada in database.candidatos_lista_espera(negocio_id, fecha, empleado_id, LISTA_ESPERA_CANDIDATOS):
+        necesidades = {int(k): v for k, v in (entrada['recursos'] or {}).items()}
+        huecos = disponibilidad.primer_hueco_disponible(
+            negocio_id, entrada['duracion_min'], entrada['empleado_id'] or disponibilidad.CUALQUIERA,
+            desde=fecha, hasta=fecha, limite=1, necesidades=necesidades
+        )
+        if not huecos:
+            continue
+        hueco = huecos[0]
+        token = database.ofrecer_lista_espera(entrada['id'], hueco['fecha'], hueco['hora'],
+                                              hueco['empleado_id'], LISTA_ESPERA_OFERTA_MINUTOS)
+        if token:
+            _avisar(negocio_id, entrada, hueco, token)
+            return True
+    return False
+
+def caducar_ofertas():
+    """Retira las ofertas sin respuesta y ofrece esos huecos al siguiente (scheduler)."""
+    for fila in database.caducar_ofertas_lista_espera():
+        if fila['fecha'] >= utils.now_spain().date():
+            _casar(fila['negocio_id'], fila['fecha'], fila['empleado_id'])
+
+def _avisar(negocio_id, entrada, hueco, token):
+    negocio = database.obtener_negocio_por_id(negocio_id) or {}
+    expira = utils.now_spain() + timedelta(minutes=LISTA_ESPERA_OFERTA_MINUTOS)
+    datos = {
+        "negocio_id": negocio_id,
+        "negocio_nombre": negocio.get('nombre'),
+        "negocio_slug": negocio.get('slug'),
+        "direccion": negocio.get('direccion'),
+        "nombre": entrada['nombre'],
+        "telefono": entrada['telefono'],
+        "email_cliente": entrada['email'],
+        "servicio": " + ".join(entrada['servicios']),
+        "duracion": entrada['duracion_min'],
+        "empleado_nombre": hueco['empleado_nombre'],
+        "fecha": hueco['fecha'],
+        "hora": hueco['hora'],
+        "expira": expira.strftime('%H:%M'),
+        "enlace": f"{URL_PUBLICA}/espera/{token}",
+    }
+    if entrada['email']:
+        notificaciones.enviar(email_manager.enviar_oferta_lista_espera, datos)
+    notificaciones.enviar(whatsapp_manager.enviar_oferta_lista_espera, datos)
+    log.info("Hueco %s %s ofrecido a la entrada %s", hueco['fecha'], hueco['hora'], entrada['id'])
+
+# -------------------------
+# Aceptar una oferta
+# -------------------------
+
+def oferta(token):
+    return database.obtener_oferta_lista_espera(token)
+
+def aceptar(token):
+    """Convierte la oferta vigente en cita. Devuelve la oferta si se ha reservado, o None."""
+    ofrecida = database.obtener_oferta_lista_espera(token)
+    if not ofrecida:
+        return None
+    datos = {
+        "nombre": ofrecida['nombre'],
+        "telefono": ofrecida['telefono'],
+        "servicio": ofrecida['servicios'][0],
+        "servicios": list(ofrecida['servicios']),
+        "fecha": ofrecida['oferta_fecha'].isoformat(),
+        "hora": ofrecida['hora'],
+        "empleado_id": ofrecida['oferta_empleado_id'],
+        "email": ofrecida['email'],
+        "titular": f"espera:{token}",
+    }
+    cita_id = database.guardar_reserva(datos, ofrecida['negocio_id'])
+    if not cita_id:
+        return None
+    database.borrar_entrada_lista_espera(ofrecida['id'])
+    log_manager.vincular(cita_id=cita_id)
+    notificaciones.enviar(email_manager.enviar_notificacion_cita, {
+        **datos,
+        "cita_id": cita_id,
+        "duracion": ofrecida['duracion_min'],
+        "lineas": database.obtener_lineas_cita(cita_id),
+        "empleado_nombre": ofrecida['empleado_nombre'],
+        "negocio_nombre": ofrecida['negocio_nombre'],
+        "email_negocio": ofrecida['negocio_email'],
+        "email_cliente": ofrecida['email'],
+    })
+    return ofrecida
+
+def _tras_fork():
+    # El hilo del ejecutor y el listener son del proceso padre
+    global _lock, _ejecutor, _registrado
+    _lock = threading.Lock()
+    _ejecutor = None
+    _registrado = False
+
+os.register_at_fork(after_in_child=_tras_fork)
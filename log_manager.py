@@ -0,0 +1,188 @@
+# log_manager.py
+"""
+Logging estructurado (JSON) y no bloqueante.
+
+Los módulos piden su logger con get_logger("nombre"). Los registros se
+encolan en el hilo que los emite (solo se les añade el contexto: request_id,
+negocio_id, estado, cita_id) y un QueueListener en segundo plano se encarga
+de formatearlos y escribirlos en stdout, así una escritura lenta no bloquea
+las peticiones.
+
+Variables de entorno:
+  LOG_LEVEL            nivel por defecto (INFO)
+  LOG_LEVELS           niveles por módulo: "database=WARNING,scheduler=DEBUG"
+  LOG_DEBUG_MUESTREO   emitir 1 de cada N líneas DEBUG por punto de llamada (1 = todas)
+  LOG_FORMAT           "json" (por defecto) o "texto"
+"""
+import os
+import sys
+import json
+import queue
+import atexit
+import logging
+import threading
+import contextvars
+from contextlib import contextmanager
+from datetime import datetime, timezone
+import logging.handlers
+import config
+
+LOG_LEVEL = getattr(config, "LOG_LEVEL", os.getenv("LOG_LEVEL", "INFO")).upper()
+LOG_LEVELS = getattr(config, "LOG_LEVELS", os.getenv("LOG_LEVELS", ""))
+LOG_DEBUG_MUESTREO = int(getattr(config, "LOG_DEBUG_MUESTREO", os.getenv("LOG_DEBUG_MUESTREO", 1)))
+LOG_FORMAT = getattr(config, "LOG_FORMAT", os.getenv("LOG_FORMAT", "json")).lower()
+
+CAMPOS_CONTEXTO = ("request_id", "negocio_id", "estado", "cita_id")
+
+_contexto = contextvars.ContextVar("log_contexto", default={})
+_lock = threading.Lock()
+_listener = None
+
+# -------------------------
+# Contexto por petición
+# -------------------------
+
+def nuevo_contexto(**campos):
+    """Sustituye el contexto actual (se llama al empezar cada petición)."""
+    _contexto.set({k: v for k, v in campos.items() if v is not None})
+
+def vincular(**campos):
+    """Añade campos al contexto actual."""
+    actual = dict(_contexto.get())
+    actual.update({k: v for k, v in campos.items() if v is not None})
+    _contexto.set(actual)
+
+@contextmanager
+def contexto(**campos):
+    """Añade campos al contexto solo dentro del bloque."""
+    token = _contexto.set({**_contexto.get(), **{k: v for k, v in campos.items() if v is not None}})
+    try:
+        yield
+    finally:
+        _contexto.reset(token)
+
+# -------------------------
+# Filtros y formateo
+# -------------------------
+
+class _FiltroContexto(logging.Filter):
+    """Copia el contexto al registro en el hilo que emite (antes de encolar)."""
+    def filter(self, record):
+        for k, v in _contexto.get().items():
+            if not hasattr(record, k):
+                setattr(record, k, v)
+        return True
+
+class _FiltroMuestreo(logging.Filter):
+    """
+    Deja pasar 1 de cada N registros DEBUG por punto de llamada.
+    N = LOG_DEBUG_MUESTREO, o extra={"muestreo": N} en la llamada concreta.
+    """
+    def __init__(self, cada_n):
+        super().__init__()
+        self.cada_n = max(1, cada_n)
+        self._contadores = {}
+
+    def filter(self, record):
+        cada_n = getattr(record, "muestreo", None) or (self.cada_n if record.levelno <= logging.DEBUG else 1)
+        if cada_n <= 1:
+            return True
+        clave = (record.pathname, record.lineno)
+        n = self._contadores.get(clave, 0)
+        self._contadores[clave] = n + 1
+        return n % cada_n == 0
+
+class _QueueHandlerDiferido(logging.handlers.QueueHandler):
+    """
+    QueueHandler que no formatea en el hilo emisor: el registro viaja intacto
+    (mismo proceso, no hace falta serializarlo) y se formatea en el listener.
+    """
+    def prepare(self, record):
+        return record
+
+class FormateadorJSON(logging.Formatter):
+    def format(self, record):
+        datos = {
+            "ts": datetime.fromtimestamp(record.created, tz=timezone.utc).isoformat(timespec="milliseconds"),
+            "nivel": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        for campo in CAMPOS_CONTEXTO:
+            valor = getattr(record, campo, None)
+            if valor is not None:
+                datos[campo] = valor
+        if record.exc_info:
+            datos["exc"] = self.formatException(record.exc_info)
+        return json.dumps(datos, ensure_ascii=False, default=str)
+
+class FormateadorTexto(logging.Formatter):
+    def format(self, record):
+        base = f"[{record.name}] {record.getMessage()}"
+        ctx = " ".join(f"{c}={getattr(record, c)}" for c in CAMPOS_CONTEXTO if getattr(record, c, None) is not None)
+        if ctx:
+            base += f" ({ctx})"
+        if record.exc_info:
+            base += "\n" + self.formatException(record.exc_info)
+        return base
+
+# -------------------------
+# Configuración
+# -------------------------
+
+def _niveles_por_modulo(texto):
+    niveles = {}
+    for parte in (texto or "").split(","):
+        if "=" in parte:
+            modulo, nivel = parte.split("=", 1)
+            niveles[modulo.strip()] = nivel.strip().upper()
+    return niveles
+
+def configurar():
+    """Instala el pipeline (idempotente)."""
+    global _listener
+    with _lock:
+        if _listener is not None:
+            return
+        cola = queue.SimpleQueue()
+
+        salida = logging.StreamHandler(sys.stdout)
+        salida.setFormatter(FormateadorJSON() if LOG_FORMAT == "json" else FormateadorTexto())
+
+        entrada = _QueueHandlerDiferido(cola)
+        entrada.addFilter(_FiltroMuestreo(LOG_DEBUG_MUESTREO))
+        entrada.addFilter(_FiltroContexto())
+
+        raiz = logging.getLogger("agente")
+        raiz.handlers[:] = [entrada]
+        raiz.setLevel(LOG_LEVEL)
+        raiz.propagate = False
+        for modulo, nivel in _niveles_por_modulo(LOG_LEVELS).items():
+            logging.getLogger(f"agente.{modulo}").setLevel(nivel)
+
+        _listener = logging.handlers.QueueListener(cola, salida, respect_handler_level=True)
+        _listener.start()
+        atexit.register(detener)
+
+def detener():
+    """Vacía la cola y para el hilo del listener."""
+    global _listener
+    with _lock:
+        if _listener is not None:
+            _listener.stop()
+            _listener = None
+
+def _tras_fork():
+    # El hilo del listener no sobrevive al fork (gunicorn --preload): el hijo
+    # monta su propia cola y su propio listener.
+    global _lock, _listener
+    _lock = threading.Lock()
+    if _listener is not None:
+        _listener = None
+        configurar()
+
+os.register_at_fork(after_in_child=_tras_fork)
+
+def get_logger(nombre):
+    configurar()
+    return logging.getLogger(f"agente.{nombre}")
@@ -0,0 +1,392 @@
+# metrics.py
+"""
+Métricas estilo Prometheus sin dependencias externas.
+
+Cada proceso (worker de gunicorn) acumula contadores, histogramas y gauges en
+memoria y vuelca periódicamente una instantánea a METRICS_DIR/proc_<pid>.json.
+El endpoint /metrics agrega todos los ficheros, así las cifras cubren a todos
+los workers aunque la petición la atienda solo uno de ellos.
+
+Los contadores e histogramas de un worker muerto se suman a
+METRICS_DIR/agregado.json y su fichero se borra: el directorio no crece con
+cada reinicio y las cifras no retroceden aunque otro proceso herede su pid.
+"""
+import os
+import json
+import time
+import fcntl
+import atexit
+import secrets
+import tempfile
+import threading
+from contextlib import contextmanager
+from bisect import bisect_left
+import config
+import log_manager
+
+log = log_manager.get_logger("metrics")
+
+METRICS_DIR = getattr(config, "METRICS_DIR", os.getenv("METRICS_DIR", "")) or os.path.join(tempfile.gettempdir(), "agente_reservas_metrics")
+METRICS_FLUSH_SECONDS = float(getattr(config, "METRICS_FLUSH_SECONDS", os.getenv("METRICS_FLUSH_SECONDS", 5)))
+
+# Buckets por defecto (segundos), pensados para latencias web/DB/SMTP
+BUCKETS_DEF = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_lock = threading.Lock()
+_registro = {}           # nombre -> métrica
+_ultimo_volcado = 0.0
+# Distingue este proceso de uno anterior, ya muerto, que tuviera el mismo pid
+_id_proceso = secrets.token_hex(8)
+_fichero_propio = False  # ya se comprobó que proc_<pid>.json no es de ese proceso anterior
+
+_AGREGADO = "agregado.json"
+_PLEGADOS_MAX = 256      # ids de procesos ya sumados que recuerda agregado.json
+
+class _Metrica:
+    tipo = "untyped"
+
+    def __init__(self, nombre, ayuda, etiquetas=()):
+        self.nombre = nombre
+        self.ayuda = ayuda
+        self.etiquetas = tuple(etiquetas)
+        self.valores = {}  # tupla de valores de etiquetas -> dato
+
+class _Contador(_Metrica):
+    tipo = "counter"
+
+    def inc(self, *etiquetas, valor=1):
+        with _lock:
+            self.valores[etiquetas] = self.valores.get(etiquetas, 0) + valor
+
+class _Gauge(_Metrica):
+    tipo = "gauge"
+
+    def __init__(self, nombre, ayuda, etiquetas=(), agregacion="sum"):
+        super().__init__(nombre, ayuda, etiquetas)
+        # 'sum' (p.ej. conexiones en uso) o 'max' (p.ej. backlog visto por cualquier worker)
+        self.agregacion = agregacion
+
+    def set(self, valor, *etiquetas):
+        self.valores[etiquetas] = valor
+
+    def inc(self, *etiquetas, valor=1):
+        with _lock:
+            self.valores[etiquetas] = self.valores.get(etiquetas, 0) + valor
+
+    def dec(self, *etiquetas, valor=1):
+        self.inc(*etiquetas, valor=-valor)
+
+class _Histograma(_Metrica):
+    tipo = "histogram"
+
+    def __init__(self, nombre, ayuda, etiquetas=(), buckets=BUCKETS_DEF):
+        super().__init__(nombre, ayuda, etiquetas)
+        self.buckets = tuple(sorted(buckets))
+
+    def observar(self, valor, *etiquetas):
+        # Camino caliente: una búsqueda binaria y tres sumas bajo un lock sin contención
+        with _lock:
+            dato = self.valores.get(etiquetas)
+            if dato is None:
+                dato = self.valores[etiquetas] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            dato[0][bisect_left(self.buckets, valor)] += 1
+            dato[1] += valor
+            dato[2] += 1
+
+    def cronometro(self, *etiquetas):
+        return _Cronometro(self, etiquetas)
+
+class _Cronometro:
+    __slots__ = ("hist", "etiquetas", "t0")
+
+    def __init__(self, hist, etiquetas):
+        self.hist = hist
+        self.etiquetas = etiquetas
+
+    def __enter__(self):
+        self.t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.hist.observar(time.perf_counter() - self.t0, *self.etiquetas)
+        return False
+
+def _registrar(metrica):
+    # Idempotente: reimportar un módulo no duplica la métrica
+    existente = _registro.get(metrica.nombre)
+    if existente is not None:
+        return existente
+    _registro[metrica.nombre] = metrica
+    return metrica
+
+def contador(nombre, ayuda, etiquetas=()):
+    return _registrar(_Contador(nombre, ayuda, etiquetas))
+
+def gauge(nombre, ayuda, etiquetas=(), agregacion="sum"):
+    return _registrar(_Gauge(nombre, ayuda, etiquetas, agregacion))
+
+def histograma(nombre, ayuda, etiquetas=(), buckets=BUCKETS_DEF):
+    return _registrar(_Histograma(nombre, ayuda, etiquetas, buckets))
+
+# -------------------------
+# Volcado multiproceso
+# -------------------------
+
+def _ruta_proceso(pid=None):
+    return os.path.join(METRICS_DIR, f"proc_{pid or os.getpid()}.json")
+
+def _escribir(ruta, datos):
+    # Escritura atómica vía os.replace: quien lee nunca ve un fichero a medias
+    tmp = f"{ruta}.{os.getpid()}.tmp"
+    with open(tmp, "w") as f:
+        json.dump(datos, f, separators=(",", ":"))
+    os.replace(tmp, ruta)
+
+def _leer(ruta):
+    try:
+        with open(ruta) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+@contextmanager
+def _cerrojo_directorio():
+    """Cerrojo entre procesos para sumar y borrar ficheros de METRICS_DIR."""
+    os.makedirs(METRICS_DIR, exist_ok=True)
+    with open(os.path.join(METRICS_DIR, "agregado.lock"), "a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        yield
+
+def volcar():
+    """Escribe la instantánea de este proceso."""
+    global _ultimo_volcado, _fichero_propio
+    _ultimo_volcado = time.monotonic()
+    with _lock:
+        datos = {
+            "pid": os.getpid(),
+            "id": _id_proceso,
+            "metricas": {
+                m.nombre: [[list(k), v] for k, v in m.valores.items()]
+                for m in _registro.values() if m.valores
+            },
+        }
+    try:
+        if not _fichero_propio:
+            # Si el fichero de este pid es de un proceso anterior, sus cifras se
+            # suman al agregado antes de pisarlo
+            with _cerrojo_directorio():
+                anterior = _leer(_ruta_proceso())
+                if anterior is not None and anterior.get("id") != _id_proceso:
+                    _plegar([_ruta_proceso()])
+            _fichero_propio = True
+        _escribir(_ruta_proceso(), datos)
+    except OSError as e:
+        log.warning("No se pudo volcar métricas: %s", e)
+
+def volcar_si_toca():
+    if time.monotonic() - _ultimo_volcado >= METRICS_FLUSH_SECONDS:
+        volcar()
+
+atexit.register(volcar)
+
+def _tras_fork():
+    # Worker recién nacido de un fork (gunicorn --preload): lo acumulado por el
+    # master ya está en su propio fichero; contadores e histogramas empiezan de
+    # cero. Los gauges se conservan (describen estado heredado, p.ej. el arranque).
+    global _lock, _ultimo_volcado, _id_proceso, _fichero_propio
+    _lock = threading.Lock()
+    _ultimo_volcado = 0.0
+    _id_proceso = secrets.token_hex(8)
+    _fichero_propio = False
+    for m in _registro.values():
+        if m.tipo != "gauge":
+            m.valores = {}
+
+os.register_at_fork(after_in_child=_tras_fork)
+
+def _proceso_vivo(pid):
+    try:
+        os.kill(pid, 0)
+        return True
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+
+def _pids_volcados():
+    """{pid: ruta} de los ficheros proc_<pid>.json de METRICS_DIR."""
+    try:
+        nombres = os.listdir(METRICS_DIR)
+    except FileNotFoundError:
+        return {}
+    return {int(n[5:-5]): os.path.join(METRICS_DIR, n)
+            for n in nombres if n.startswith("proc_") and n.endswith(".json") and n[5:-5].isdigit()}
+
+def _leer_snapshots():
+    rutas = list(_pids_volcados().values()) + [os.path.join(METRICS_DIR, _AGREGADO)]
+    return [snap for snap in map(_leer, rutas) if snap is not None]
+
+def _plegar(rutas):
+    """
+    Suma a agregado.json los contadores e histogramas de las instantáneas
+    'rutas' (de procesos que ya no existen) y las borra. Con el cerrojo del
+    directorio tomado. agregado.json recuerda los últimos ids sumados, así
+    que un fichero que sobreviva a una caída entre escribir y borrar no se
+    suma dos veces.
+    """
+    ruta_agregado = os.path.join(METRICS_DIR, _AGREGADO)
+    previo = _leer(ruta_agregado) or {}
+    plegados = previo.get("plegados", [])
+    muertos = []
+    for ruta in rutas:
+        snap = _leer(ruta)
+        if snap is not None and snap.get("id") not in plegados:
+            # Sin pid: _agregar lo trata como muerto y descarta sus gauges
+            muertos.append({"metricas": snap.get("metricas", {})})
+            if snap.get("id"):
+                plegados.append(snap["id"])
+    if muertos:
+        agregado = _agregar([previo] + muertos)
+        _escribir(ruta_agregado, {
+            "metricas": {nombre: [[list(k), v] for k, v in filas.items()] for nombre, filas in agregado.items()},
+            "plegados": plegados[-_PLEGADOS_MAX:],
+        })
+    for ruta in rutas:
+        try:
+            os.remove(ruta)
+        except FileNotFoundError:
+            pass
+
+def _plegar_muertos():
+    muertos = [ruta for pid, ruta in _pids_volcados().items() if not _proceso_vivo(pid)]
+    if muertos:
+        _plegar(muertos)
+
+def _agregar(snapshots):
+    agregado = {}  # nombre -> {etiquetas: dato}
+    for snap in snapshots:
+        vivo = "pid" in snap and _proceso_vivo(snap["pid"])
+        for nombre, filas in snap.get("metricas", {}).items():
+            metrica = _registro.get(nombre)
+            if metrica is None:
+                continue
+            # Los gauges de workers muertos ya no describen nada real
+            if metrica.tipo == "gauge" and not vivo:
+                continue
+            destino = agregado.setdefault(nombre, {})
+            for etiquetas, dato in filas:
+                k = tuple(etiquetas)
+                if metrica.tipo == "histogram":
+                    acc = destino.get(k)
+                    if acc is None:
+                        destino[k] = [list(dato[0]), dato[1], dato[2]]
+                    else:
+                        acc[0] = [a + b for a, b in zip(acc[0], dato[0])]
+                        acc[1] += dato[1]
+                        acc[2] += dato[2]
+                elif metrica.tipo == "gauge" and metrica.agregacion == "max":
+                    destino[k] = max(destino.get(k, dato), dato)
+                else:
+                    destino[k] = destino.get(k, 0) + dato
+    return agregado
+
+def _fmt_etiquetas(nombres, valores, extra=None):
+    pares = [f'{n}="{_escapar(v)}"' for n, v in zip(nombres, valores)]
+    if extra:
+        pares.append(extra)
+    return "{" + ",".join(pares) + "}" if pares else ""
+
+def _escapar(valor):
+    return str(valor).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _fmt_num(v):
+    if v == float("inf"):
+        return "+Inf"
+    return repr(float(v)) if isinstance(v, float) else str(v)
+
+def exportar():
+    """Devuelve todas las métricas agregadas en formato de texto Prometheus 0.0.4."""
+    volcar()
+    try:
+        with _cerrojo_directorio():
+            _plegar_muertos()
+            snapshots = _leer_snapshots()
+    except OSError as e:
+        log.warning("No se pudieron sumar las métricas de workers terminados: %s", e)
+        snapshots = _leer_snapshots()
+    agregado = _agregar(snapshots)
+    lineas = []
+    for nombre in sorted(_registro):
+        metrica = _registro[nombre]
+        lineas.append(f"# HELP {nombre} {metrica.ayuda}")
+        lineas.append(f"# TYPE {nombre} {metrica.tipo}")
+        for etiquetas, dato in sorted(agregado.get(nombre, {}).items()):
+            if metrica.tipo == "histogram":
+                acumulado = 0
+                limites = list(metrica.buckets) + [float("inf")]
+                for limite, n in zip(limites, dato[0]):
+                    acumulado += n
+                    le = f'le="{_fmt_num(limite)}"'
+                    lineas.append(f"{nombre}_bucket{_fmt_etiquetas(metrica.etiquetas, etiquetas, le)} {acumulado}")
+                lineas.append(f"{nombre}_sum{_fmt_etiquetas(metrica.etiquetas, etiquetas)} {_fmt_num(dato[1])}")
+                lineas.append(f"{nombre}_count{_fmt_etiquetas(metrica.etiquetas, etiquetas)} {dato[2]}")
+            else:
+                lineas.append(f"{nombre}{_fmt_etiquetas(metrica.etiquetas, etiquetas)} {_fmt_num(dato)}")
+    return "\n".join(lineas) + "\n"
+
+# -------------------------
+# Métricas de la aplicación
+# -------------------------
+
+HTTP_LATENCIA = histograma(
+    "agente_http_request_duration_seconds", "Latencia de las peticiones HTTP por ruta.",
+    ("ruta", "metodo", "codigo"))
+ESTADO_LATENCIA = histograma(
+    "agente_estado_duration_seconds", "Tiempo de proceso de un mensaje del chat por estado de la conversación.",
+    ("estado",))
+DB_CONEXIONES = contador(
+    "agente_db_connections_opened_total", "Conexiones a PostgreSQL abiertas.")
+DB_CONEXION_ERRORES = contador(
+    "agente_db_connection_errors_total", "Errores al abrir conexión con PostgreSQL.")
+DB_CONEXION_LATENCIA = histograma(
+    "agente_db_connect_duration_seconds", "Tiempo en obtener una conexión a PostgreSQL.")
+NOTIFICACION_LATENCIA = histograma(
+    "agente_notification_send_duration_seconds", "Latencia de envío de notificaciones por canal.",
+    ("canal",))
+NOTIFICACION_FALLOS = contador(
+    "agente_notification_failures_total", "Envíos de notificación fallidos por canal.",
+    ("canal",))
+RECORDATORIOS_PENDIENTES = gauge(
+    "agente_reminder_backlog", "Citas en la ventana de recordatorio pendientes de envío.",
+    agregacion="max")
+SSE_SUSCRIPTORES = gauge(
+    "agente_sse_subscribers", "Paneles suscritos al stream de cambios de agenda.")
+SSE_EVENTOS = contador(
+    "agente_sse_events_total", "Cambios de agenda recibidos por LISTEN/NOTIFY.",
+    ("tabla",))
+IDEMPOTENCIA_REPETICIONES = contador(
+    "agente_idempotent_replays_total", "Reenvíos de /mensaje respondidos con la respuesta guardada.")
+DB_POOL_EN_USO = gauge(
+    "agente_db_pool_in_use", "Conexiones del pool prestadas en este momento.")
+DB_POOL_AGOTADO = contador(
+    "agente_db_pool_exhausted_total", "Peticiones rechazadas por no haber conexión libre en el pool.")
+PETICIONES_RECHAZADAS = contador(
+    "agente_requests_shed_total", "Peticiones rechazadas por límite de tasa (429) o saturación (503).",
+    ("codigo",))
+ARRANQUE_IMPORTACION = gauge(
+    "agente_import_seconds", "Tiempo en importar la app (arranque en frío del proceso).",
+    agregacion="max")
+NOTIFICACIONES_PENDIENTES = gauge(
+    "agente_notifications_pending", "Emails/WhatsApp encolados para envío en segundo plano.")
+WHATSAPP_ENTRANTES = contador(
+    "agente_whatsapp_inbound_total", "Mensajes entrantes del webhook de WhatsApp por resultado.",
+    ("resultado",))
+OCUPACION_CACHE = contador(
+    "agente_occupancy_index_days_total", "Días pedidos al índice de ocupación, servidos de memoria o leídos de la base de datos.",
+    ("resultado",))
+HORARIOS_CACHE = contador(
+    "agente_schedule_cache_total", "Horarios de negocio pedidos, servidos compilados de memoria o leídos de la base de datos.",
+    ("resultado",))
+RECURSOS_CACHE = contador(
+    "agente_resources_cache_total", "Recursos de negocio pedidos, servidos de memoria o leídos de la base de datos.",
+    ("resultado",))
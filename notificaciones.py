@@ -0,0 +1,58 @@
+# notificaciones.py
+"""
+Envío de emails y WhatsApp fuera de la petición.
+
+SMTP y Twilio pueden tardar segundos y el chat no debe esperarlos: enviar()
+deja la llamada en un pool pequeño de hilos del proceso y vuelve en el acto.
+El contexto de log (request_id, negocio_id...) viaja con la tarea. Los fallos
+se registran aquí; las métricas de latencia/errores ya las llevan
+email_manager y whatsapp_manager.
+
+Con NOTIFICACIONES_HILOS=0 se envía en línea, como antes. Al salir el proceso
+se esperan los envíos pendientes.
+"""
+import os
+import threading
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+import config
+import metrics
+import log_manager
+
+log = log_manager.get_logger("notificaciones")
+
+NOTIFICACIONES_HILOS = int(getattr(config, "NOTIFICACIONES_HILOS", os.getenv("NOTIFICACIONES_HILOS", 4)))
+
+_lock = threading.Lock()
+_ejecutor = None
+
+def _obtener_ejecutor():
+    global _ejecutor
+    with _lock:
+        if _ejecutor is None:
+            _ejecutor = ThreadPoolExecutor(max_workers=NOTIFICACIONES_HILOS, thread_name_prefix="notificaciones")
+        return _ejecutor
+
+def _ejecutar(funcion, datos):
+    try:
+        funcion(datos)
+    except Exception as e:
+        log.exception("Error en %s: %s", funcion.__name__, e)
+    finally:
+        metrics.NOTIFICACIONES_PENDIENTES.dec()
+
+def enviar(funcion, datos):
+    """Ejecuta funcion(datos) (p.ej. email_manager.enviar_notificacion_cita) en segundo plano."""
+    metrics.NOTIFICACIONES_PENDIENTES.inc()
+    if NOTIFICACIONES_HILOS <= 0:
+        _ejecutar(funcion, datos)
+        return
+    _obtener_ejecutor().submit(contextvars.copy_context().run, _ejecutar, funcion, datos)
+
+def _tras_fork():
+    # Los hilos del pool son del proceso padre
+    global _lock, _ejecutor
+    _lock = threading.Lock()
+    _ejecutor = None
+
+os.register_at_fork(after_in_child=_tras_fork)
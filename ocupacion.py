@@ -0,0 +1,361 @@
+# ocupacion.py
+"""
+Índice de ocupación en memoria, por (negocio, fecha).
+
+Cada día es un mapa de bits de huecos de MINUTOS_HUECO minutos (288 bits en un
+int): bloqueos generales, cada profesional, citas sin profesional y el total.
+Saber si una hora está libre es un AND; combinar profesionales, OR/AND de
+enteros; y tramos_libres() encuentra k huecos seguidos con desplazamientos.
+
+- Se carga por rangos de días con una sola consulta (citas + bloqueos).
+- Se mantiene al día con los avisos LISTEN/NOTIFY que ya recibe eventos.py:
+  cada alta/baja de cita o bloqueo suma o resta en el día indexado, sin volver
+  a consultar. Si el listener se cae (se han podido perder avisos) el índice
+  se vacía, y mientras no escucha no se guarda nada.
+- Cada día guarda la versión de agenda_versiones con la que se leyó: un aviso
+  que llega después pero cuyo cambio ya estaba en la lectura (versión menor o
+  igual) no se aplica dos veces.
+- Las retenciones temporales no se indexan: dependen de quién pregunta y
+  caducan solas. Se leen en cada consulta (tabla pequeña) y se superponen.
+- Una cita (o retención) con duración ocupa todos sus huecos; sin duración
+  (citas antiguas, bloqueos), uno.
+- Los recursos con plazas (recursos.py) se llevan por recuento: cada hueco
+  suma las unidades en uso, y llenos() marca donde lo pedido ya no cabe.
+- Como mucho OCUPACION_MAX_DIAS días en memoria; se descartan los menos usados.
+"""
+import os
+import threading
+from collections import OrderedDict
+from datetime import date, timedelta
+import config
+import database
+import eventos
+import metrics
+import recursos
+import log_manager
+
+log = log_manager.get_logger("ocupacion")
+
+OCUPACION_MAX_DIAS = int(getattr(config, "OCUPACION_MAX_DIAS", os.getenv("OCUPACION_MAX_DIAS", 5000)))
+
+MINUTOS_HUECO = database.HUECO_MINUTOS
+HUECOS_DIA = 24 * 60 // MINUTOS_HUECO
+MASCARA_DIA = (1 << HUECOS_DIA) - 1
+
+def hueco(hora):
+    """Índice del hueco de "HH:MM" (0 = 00:00)."""
+    h, m = hora.split(':')[:2]
+    return (int(h) * 60 + int(m)) // MINUTOS_HUECO
+
+def huecos_de(duracion):
+    """Huecos que ocupa algo de 'duracion' minutos (None: uno)."""
+    if not duracion:
+        return 1
+    return max(1, -(-int(duracion) // MINUTOS_HUECO))
+
+def _bits_tramo(hora, duracion):
+    h = hueco(hora)
+    return (((1 << huecos_de(duracion)) - 1) << h) & MASCARA_DIA
+
+def tramos_libres(ocupados, k):
+    """
+    Bits de los huecos donde empiezan k huecos libres seguidos, dado el mapa de
+    ocupados. Duplica la longitud del tramo en cada paso: O(log k) operaciones
+    sobre el día entero en lugar de recorrer hueco a hueco.
+    """
+    libres = ~ocupados & MASCARA_DIA
+    n = 1
+    while n < k:
+        paso = min(n, k - n)
+        libres &= libres >> paso
+        n += paso
+    return libres
+
+class _Capa:
+    """
+    Mapa de bits con recuento por hueco (dos ocupaciones en el mismo hueco no se
+    pisan al borrar una). En los recursos el recuento son unidades en uso.
+    """
+    __slots__ = ("bits", "conteo")
+
+    def __init__(self):
+        self.bits = 0
+        self.conteo = {}
+
+    def sumar(self, h, signo):
+        n = self.conteo.get(h, 0) + signo
+        if n > 0:
+            self.conteo[h] = n
+            self.bits |= 1 << h
+        else:
+            self.conteo.pop(h, None)
+            self.bits &= ~(1 << h)
+
+class _Dia:
+    """Citas y bloqueos de un día, separados por a quién afectan."""
+    __slots__ = ("todas", "global_", "bloqueos", "sin_empleado", "por_empleado", "por_recurso", "carga", "version")
+
+    def __init__(self):
+        self.todas = _Capa()         # cualquier ocupación (criterio sin profesional)
+        self.global_ = _Capa()       # bloqueos sin profesional: afectan a todos
+        self.bloqueos = _Capa()      # todos los bloqueos (criterio sin profesional con recursos)
+        self.sin_empleado = _Capa()  # citas sin profesional: ocupan a uno cualquiera
+        self.por_empleado = {}       # empleado_id -> _Capa
+        self.por_recurso = {}        # recurso_id -> _Capa con las unidades en uso
+        self.carga = {}              # empleado_id -> nº de citas del día
+        self.version = 0             # última versión del día (agenda_versiones) ya incluida
+
+    def aplicar(self, origen, hora, empleado_id, signo=1, duracion=None, recursos=None):
+        inicio = hueco(hora)
+        huecos = range(inicio, min(inicio + huecos_de(duracion), HUECOS_DIA))
+        if empleado_id is None:
+            capa = self.sin_empleado if origen == 'cita' else self.global_
+        else:
+            capa = self.por_empleado.get(empleado_id)
+            if capa is None:
+                capa = self.por_empleado[empleado_id] = _Capa()
+        for h in huecos:
+            self.todas.sumar(h, signo)
+            capa.sumar(h, signo)
+            if origen != 'cita':
+                self.bloqueos.sumar(h, signo)
+        for recurso_id, cantidad in (recursos or {}).items():
+            recurso_id = int(recurso_id)  # las claves llegan como texto desde JSON
+            capa = self.por_recurso.get(recurso_id)
+            if capa is None:
+                capa = self.por_recurso[recurso_id] = _Capa()
+            for h in huecos:
+                capa.sumar(h, signo * int(cantidad))
+        if empleado_id is not None and origen == 'cita':
+            self.carga[empleado_id] = max(0, self.carga.get(empleado_id, 0) + signo)
+
+class Vista:
+    """
+    Ocupación de un día para quien pregunta: el día indexado más las
+    retenciones vigentes de otros titulares. 'capacidades' ({recurso_id:
+    capacidad}) son las del negocio; vacío si no usa recursos.
+    """
+    __slots__ = ("dia", "capacidades", "ret_todas", "ret_global", "ret_empleado", "ret_recurso")
+
+    def __init__(self, dia, capacidades=None):
+        self.dia = dia
+        self.capacidades = capacidades or {}
+        self.ret_todas = 0
+        self.ret_global = 0
+        self.ret_empleado = {}
+        self.ret_recurso = {}  # recurso_id -> {hueco: unidades retenidas}
+
+    def retener(self, hora, empleado_id, duracion=None, recursos=None):
+        b = _bits_tramo(hora, duracion)
+        self.ret_todas |= b
+        if empleado_id is None:
+            self.ret_global |= b
+        else:
+            self.ret_empleado[empleado_id] = self.ret_empleado.get(empleado_id, 0) | b
+        inicio = hueco(hora)
+        for recurso_id, cantidad in (recursos or {}).items():
+            usos = self.ret_recurso.setdefault(int(recurso_id), {})
+            for h in range(inicio, min(inicio + huecos_de(duracion), HUECOS_DIA)):
+                usos[h] = usos.get(h, 0) + int(cantidad)
+
+    @property
+    def carga(self):
+        return self.dia.carga
+
+    def ocupados(self, empleado_id, necesidades=None):
+        """
+        Mapa de huecos no reservables para ese profesional (None = cualquier
+        ocupación cuenta; si además se piden recursos, solo los bloqueos: las
+        citas cuentan en llenos()).
+        """
+        if empleado_id is None:
+            if self.capacidades and necesidades:
+                return self.dia.bloqueos.bits
+            return self.dia.todas.bits | self.ret_todas
+        capa = self.dia.por_empleado.get(empleado_id)
+        return (self.dia.global_.bits | self.ret_global
+                | (capa.bits if capa else 0) | self.ret_empleado.get(empleado_id, 0))
+
+    def llenos(self, necesidades):
+        """
+        Mapa de huecos donde no caben 'necesidades' ({recurso_id: cantidad}):
+        las unidades en uso (citas y retenciones) más las pedidas superan la
+        capacidad del recurso. Solo recorre los huecos con algo en uso.
+        """
+        bits = 0
+        for recurso_id, cantidad in (necesidades or {}).items():
+            capacidad = self.capacidades.get(int(recurso_id))
+            if capacidad is None:
+                continue
+            sobran = capacidad - int(cantidad)
+            if sobran < 0:
+                return MASCARA_DIA
+            capa = self.dia.por_recurso.get(int(recurso_id))
+            en_uso = dict(capa.conteo) if capa else {}  # copia: el hilo del listener la modifica
+            for h, n in self.ret_recurso.get(int(recurso_id), {}).items():
+                en_uso[h] = en_uso.get(h, 0) + n
+            for h, n in en_uso.items():
+                if n > sobran:
+                    bits |= 1 << h
+        return bits
+
+    def inicios_libres(self, empleado_id, huecos=1, jornada=None, necesidades=None):
+        """
+        Mapa de huecos desde los que hay 'huecos' seguidos libres para ese
+        profesional. Con 'jornada' (horarios._Jornada) solo cuentan sus horas
+        de inicio y lo que queda fuera de su horario está ocupado: el tramo
+        entero tiene que caber dentro. Con 'necesidades', además tienen que
+        caber los recursos en todo el tramo.
+        """
+        ocupados = self.ocupados(empleado_id, necesidades) | self.llenos(necesidades)
+        if jornada is None:
+            return tramos_libres(ocupados, huecos)
+        return tramos_libres(ocupados | (~jornada.abierto & MASCARA_DIA), huecos) & jornada.mascara
+
+    def libre(self, hora, empleado_id, huecos=1, necesidades=None):
+        """Si 'huecos' huecos seguidos desde 'hora' están libres para ese profesional."""
+        ocupados = self.ocupados(empleado_id, necesidades) | self.llenos(necesidades)
+        if huecos <= 1:
+            return not (ocupados >> hueco(hora)) & 1
+        return bool(tramos_libres(ocupados, huecos) >> hueco(hora) & 1)
+
+    def libres_alguno(self, empleado_ids, horas, jornadas=None, huecos=1, necesidades=None):
+        """
+        Horas de 'horas' desde las que al menos un profesional tiene 'huecos'
+        huecos seguidos libres: OR de los inicios libres de cada uno. Las citas
+        sin profesional se descuentan aparte (ocupan a uno cualquiera, no a uno
+        concreto). 'jornadas' ({empleado_id: _Jornada}, ver
+        horarios.Horario.jornadas) limita cada uno a su horario.
+        """
+        if not empleado_ids:
+            return [hora for hora in horas if self.libre(hora, None, huecos, necesidades)]
+        inicios = [
+            self.inicios_libres(e, huecos, jornadas.get(e) if jornadas is not None else None, necesidades)
+            for e in empleado_ids
+        ]
+        libre_alguno = 0
+        for bits in inicios:
+            libre_alguno |= bits
+        sin_empleado = self.dia.sin_empleado.conteo
+        resultado = []
+        for hora in horas:
+            h = hueco(hora)
+            if not (libre_alguno >> h) & 1:
+                continue
+            # Cada cita sin profesional que pisa el tramo se lleva a uno de los libres
+            pendientes = max((sin_empleado.get(s, 0) for s in range(h, h + huecos)), default=0) if sin_empleado else 0
+            if pendientes and sum((bits >> h) & 1 for bits in inicios) <= pendientes:
+                continue
+            resultado.append(hora)
+        return resultado
+
+# -------------------------
+# Caché LRU de días
+# -------------------------
+
+_lock = threading.Lock()
+_dias = OrderedDict()   # (negocio_id, fecha) -> _Dia
+_cargando = {}          # (negocio_id, fecha) -> True si cambió durante la carga
+_registrado = False
+
+def _registrar_oyente():
+    global _registrado
+    if not _registrado:
+        _registrado = True
+        eventos.al_cambiar(_al_cambiar)
+
+def _al_cambiar(evento):
+    """Aplica un aviso de eventos.py al día indexado (hilo del listener)."""
+    if evento.get("tipo") == eventos.RECARGAR["tipo"]:
+        with _lock:
+            _dias.clear()
+            for clave in _cargando:
+                _cargando[clave] = True
+        return
+    try:
+        clave = (evento["negocio_id"], date.fromisoformat(evento["fecha"]))
+    except (KeyError, TypeError, ValueError):
+        return
+    origen = 'cita' if evento.get("tabla") == 'citas' else 'bloqueo'
+    with _lock:
+        if clave in _cargando:
+            _cargando[clave] = True
+        dia = _dias.get(clave)
+        if dia is not None and evento.get("hora"):
+            version = evento.get("version")
+            if version is not None:
+                if version <= dia.version:
+                    return  # ya estaba en la lectura del día
+                dia.version = version
+            dia.aplicar(origen, evento["hora"], evento.get("empleado_id"),
+                        1 if evento.get("op") == 'alta' else -1, evento.get("duracion_min"), evento.get("recursos"))
+
+def _dias_indexados(negocio_id, desde, hasta):
+    """{fecha: _Dia} de [desde, hasta]; los que faltan se leen con una consulta."""
+    _registrar_oyente()
+    fechas = [desde + timedelta(days=i) for i in range((hasta - desde).days + 1)]
+    guardar = eventos.escuchando()
+    resultado, faltan = {}, []
+    with _lock:
+        for fecha in fechas:
+            dia = _dias.get((negocio_id, fecha))
+            if dia is None:
+                faltan.append(fecha)
+                if guardar:
+                    _cargando[(negocio_id, fecha)] = False
+            else:
+                _dias.move_to_end((negocio_id, fecha))
+                resultado[fecha] = dia
+    metrics.OCUPACION_CACHE.inc("acierto", valor=len(fechas) - len(faltan))
+    if not faltan:
+        return resultado
+
+    metrics.OCUPACION_CACHE.inc("fallo", valor=len(faltan))
+    nuevos = {fecha: _Dia() for fecha in faltan}
+    try:
+        for fila in database.obtener_ocupacion_fija_rango(negocio_id, faltan[0], faltan[-1]):
+            dia = nuevos.get(fila['fecha'])
+            if dia is None:
+                continue
+            if fila['origen'] == 'version':
+                dia.version = fila['version']
+            else:
+                dia.aplicar(fila['origen'], fila['hora'], fila['empleado_id'],
+                            duracion=fila['duracion_min'], recursos=fila['recursos'])
+    except Exception:
+        with _lock:
+            for fecha in faltan:
+                _cargando.pop((negocio_id, fecha), None)
+        raise
+    with _lock:
+        for fecha, dia in nuevos.items():
+            # Un aviso llegado durante la lectura puede no estar en 'dia': no se guarda
+            if not _cargando.pop((negocio_id, fecha), True):
+                _dias[(negocio_id, fecha)] = dia
+        while len(_dias) > OCUPACION_MAX_DIAS:
+            _dias.popitem(last=False)
+    resultado.update(nuevos)
+    return resultado
+
+def dias(negocio_id, desde, hasta, titular=None):
+    """{fecha: Vista} de cada día de [desde, hasta], con las retenciones ajenas a 'titular'."""
+    capacidades = recursos.capacidades(negocio_id)
+    vistas = {fecha: Vista(dia, capacidades) for fecha, dia in _dias_indexados(negocio_id, desde, hasta).items()}
+    for fila in database.obtener_retenciones_rango(negocio_id, desde, hasta, titular):
+        vista = vistas.get(fila['fecha'])
+        if vista is not None:
+            vista.retener(fila['hora'], fila['empleado_id'], fila['duracion_min'], fila['recursos'])
+    return vistas
+
+def vista_dia(negocio_id, fecha, titular=None):
+    return dias(negocio_id, fecha, fecha, titular)[fecha]
+
+def _tras_fork():
+    # El listener del padre no existe aquí: el primer uso vuelve a registrarse y lo arranca
+    global _lock, _dias, _cargando, _registrado
+    _lock = threading.Lock()
+    _dias = OrderedDict()
+    _cargando = {}
+    _registrado = False
+
+os.register_at_fork(after_in_child=_tras_fork)
@@ -0,0 +1,167 @@
+# recursos.py
+"""
+Recursos compartidos del negocio: sillas, cabinas, una máquina de láser...
+
+- recursos: nombre y capacidad (cuántas citas pueden usarlo a la vez).
+- servicio_recursos: unidades de cada recurso que ocupa un servicio.
+
+Una cita ocupa durante toda su duración las unidades que piden sus servicios
+(por recurso, el máximo entre ellos: se atienden uno detrás de otro). Un
+tramo cabe si, en cada hueco, lo ya ocupado más lo pedido no supera la
+capacidad: se cuenta, no basta con "hay algo a esa hora". En un negocio con
+recursos el criterio sin profesional deja de tratar cualquier cita como
+ocupación total; limitan los recursos y los bloqueos.
+
+Capacidades y necesidades por servicio se guardan por negocio, como los
+horarios de horarios.py, y se descartan con el aviso 'negocios'.
+"""
+import os
+import re
+import threading
+import database
+import eventos
+import metrics
+
+# -------------------------
+# Texto del formulario
+# -------------------------
+
+_NECESIDAD = re.compile(r"(.+?)(?:\s*[x×]\s*(\d+))?", re.IGNORECASE)
+
+def parsear_recursos(texto):
+    """Un recurso por línea: "Silla: 3", "Láser: 1" (sin número, 1). Devuelve [(nombre, capacidad)]."""
+    resultado = []
+    for linea in (texto or "").splitlines():
+        linea = linea.strip()
+        if not linea:
+            continue
+        nombre, _, capacidad = linea.partition(':')
+        nombre = nombre.strip()
+        try:
+            capacidad = int(capacidad) if capacidad.strip() else 1
+        except ValueError:
+            capacidad = 0
+        if not nombre or capacidad < 1:
+            raise ValueError(f"Recurso no válido: '{linea}' (ejemplo: Silla: 3)")
+        if any(nombre == otro for otro, _ in resultado):
+            raise ValueError(f"Recurso repetido: '{nombre}'")
+        resultado.append((nombre, capacidad))
+    return resultado
+
+def parsear_necesidades(texto, nombres_recursos=()):
+    """Recursos de un servicio separados por comas: "Silla", "Silla x2, Láser". Devuelve [(nombre, cantidad)]."""
+    resultado = []
+    for parte in (texto or "").split(','):
+        parte = parte.strip()
+        if not parte:
+            continue
+        nombre, cantidad = _NECESIDAD.fullmatch(parte).groups()
+        nombre = nombre.strip()
+        if nombre not in nombres_recursos:
+            raise ValueError(f"Recurso desconocido en servicio: '{nombre}'")
+        cantidad = int(cantidad or 1)
+        if cantidad < 1:
+            raise ValueError(f"Cantidad no válida en servicio: '{parte}' (ejemplo: Silla x2)")
+        resultado.append((nombre, cantidad))
+    return resultado
+
+# -------------------------
+# Recursos de un negocio
+# -------------------------
+
+class Recursos:
+    """Capacidades y necesidades por servicio de un negocio, ya resueltas."""
+    __slots__ = ("nombres", "capacidades", "por_servicio")
+
+    def __init__(self, recursos, servicio_recursos):
+        self.nombres = {r['id']: r['nombre'] for r in recursos}
+        self.capacidades = {r['id']: r['capacidad'] for r in recursos}
+        self.por_servicio = {}  # nombre de servicio -> {recurso_id: cantidad}
+        for fila in servicio_recursos:
+            self.por_servicio.setdefault(fila['servicio'], {})[fila['recurso_id']] = fila['cantidad']
+
+    def necesidades(self, servicios):
+        """{recurso_id: cantidad} que ocupa una cita con esos servicios (vacío si ninguno pide nada)."""
+        resultado = {}
+        for servicio in servicios or ():
+            for recurso_id, cantidad in self.por_servicio.get(servicio, {}).items():
+                resultado[recurso_id] = max(cantidad, resultado.get(recurso_id, 0))
+        return resultado
+
+    def textos(self):
+        """Textos del formulario de edición: {"recursos": ..., "servicios": {nombre: ...}}."""
+        servicios = {
+            servicio: ", ".join(
+                self.nombres[recurso_id] + (f" x{cantidad}" if cantidad > 1 else "")
+                for recurso_id, cantidad in necesidades.items()
+            )
+            for servicio, necesidades in self.por_servicio.items()
+        }
+        return {
+            "recursos": "\n".join(f"{self.nombres[i]}: {c}" for i, c in self.capacidades.items()),
+            "servicios": servicios,
+        }
+
+# -------------------------
+# Caché por negocio
+# -------------------------
+
+_lock = threading.Lock()
+_recursos = {}      # negocio_id -> Recursos
+_generacion = 0     # sube con cada invalidación: una carga en curso no guarda datos viejos
+_registrado = False
+
+def _registrar_oyente():
+    global _registrado
+    if not _registrado:
+        _registrado = True
+        eventos.al_cambiar(_al_cambiar)
+
+def _al_cambiar(evento):
+    """Descarta los recursos del negocio que cambió su configuración (hilo del listener)."""
+    global _generacion
+    if evento.get("tipo") == eventos.RECARGAR["tipo"]:
+        with _lock:
+            _recursos.clear()
+            _generacion += 1
+    elif evento.get("tabla") == "negocios":
+        with _lock:
+            _recursos.pop(evento.get("negocio_id"), None)
+            _generacion += 1
+
+def recursos(negocio_id):
+    """Recursos del negocio (de memoria si no han cambiado)."""
+    _registrar_oyente()
+    with _lock:
+        cargados = _recursos.get(negocio_id)
+        generacion = _generacion
+    if cargados is not None:
+        metrics.RECURSOS_CACHE.inc("acierto")
+        return cargados
+    metrics.RECURSOS_CACHE.inc("fallo")
+    guardar = eventos.escuchando()
+    cargados = Recursos(*database.obtener_recursos(negocio_id))
+    if guardar:
+        with _lock:
+            if _generacion == generacion:
+                _recursos[negocio_id] = cargados
+    return cargados
+
+def capacidades(negocio_id):
+    """{recurso_id: capacidad} del negocio (vacío: el negocio no usa recursos)."""
+    return recursos(negocio_id).capacidades
+
+def necesidades(negocio_id, servicios):
+    return recursos(negocio_id).necesidades(servicios)
+
+def textos_formulario(negocio_id):
+    return recursos(negocio_id).textos()
+
+def _tras_fork():
+    # El listener del padre no existe aquí: el primer uso vuelve a registrarse y lo arranca
+    global _lock, _recursos, _registrado
+    _lock = threading.Lock()
+    _recursos = {}
+    _registrado = False
+
+os.register_at_fork(after_in_child=_tras_fork)
@@ -0,0 +1,67 @@
+# sesion.py
+"""
+Cookie de sesión compacta: mismo esquema firmado de Flask, pero el contenido
+se serializa con msgpack (binario) en lugar de JSON etiquetado, que además
+itsdangerous comprime con zlib antes de pasarlo a base64.
+
+Las cookies antiguas (JSON) se siguen leyendo, así un despliegue no corta las
+conversaciones en curso. Sin msgpack instalado se usa el serializador por
+defecto de Flask.
+"""
+from datetime import date, datetime
+from flask.json.tag import TaggedJSONSerializer
+from flask.sessions import SecureCookieSessionInterface
+import log_manager
+
+try:
+    import msgpack
+except ImportError:  # opcional
+    msgpack = None
+
+log = log_manager.get_logger("sesion")
+
+_EXT_FECHA = 1
+_EXT_FECHA_HORA = 2
+
+def _por_defecto(obj):
+    # Los handlers guardan texto/números, pero fechas sueltas no deben romper la sesión
+    if isinstance(obj, datetime):
+        return msgpack.ExtType(_EXT_FECHA_HORA, obj.isoformat().encode())
+    if isinstance(obj, date):
+        return msgpack.ExtType(_EXT_FECHA, obj.isoformat().encode())
+    raise TypeError(f"No serializable en sesión: {type(obj).__name__}")
+
+def _ext(codigo, datos):
+    if codigo == _EXT_FECHA:
+        return date.fromisoformat(datos.decode())
+    if codigo == _EXT_FECHA_HORA:
+        return datetime.fromisoformat(datos.decode())
+    return msgpack.ExtType(codigo, datos)
+
+class SerializadorMsgpack:
+    """Interfaz dumps/loads que espera itsdangerous (dumps devuelve bytes)."""
+
+    def __init__(self):
+        self._json = TaggedJSONSerializer()
+
+    def dumps(self, valor):
+        return msgpack.packb(valor, default=_por_defecto, use_bin_type=True)
+
+    def loads(self, datos):
+        if isinstance(datos, str):
+            datos = datos.encode()
+        try:
+            valor = msgpack.unpackb(datos, ext_hook=_ext, raw=False, strict_map_key=False)
+            if isinstance(valor, dict):
+                return valor
+        except ValueError:  # incluye ExtraData/FormatError de msgpack
+            pass
+        # Cookie emitida antes del cambio de formato
+        return self._json.loads(datos.decode())
+
+class SesionCompacta(SecureCookieSessionInterface):
+    if msgpack is not None:
+        serializer = SerializadorMsgpack()
+
+if msgpack is None:
+    log.info("msgpack no instalado: la sesión usa el serializador JSON de Flask.")
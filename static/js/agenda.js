@@ -0,0 +1,114 @@
+(function(){
+  var dataNode = document.getElementById('js-data');
+  var jsonUrl = dataNode.getAttribute('data-json-url') || '';
+  var panelUrl = dataNode.getAttribute('data-panel-url') || '';
+  var datos = JSON.parse(document.getElementById('agenda-inicial').textContent);
+
+  var grid = document.getElementById('grid');
+  var rango = document.getElementById('rango');
+  var filtro = document.getElementById('filtroEmpleado');
+
+  datos.empleados.forEach(function(e){
+    var o = document.createElement('option'); o.value = e.id; o.textContent = e.nombre;
+    filtro.appendChild(o);
+  });
+
+  function el(tag, clase, texto){
+    var n = document.createElement(tag);
+    if (clase) n.className = clase;
+    if (texto !== undefined) n.textContent = texto;
+    return n;
+  }
+
+  function barra(pct){
+    var b = el('div', 'barra'); var s = el('span'); s.style.width = pct + '%'; b.appendChild(s);
+    return b;
+  }
+
+  function pintarSemana(){
+    grid.style.gridTemplateColumns = '70px repeat(' + datos.dias.length + ', minmax(120px, 1fr))';
+    grid.appendChild(el('div', 'cab', ''));
+    datos.dias.forEach(function(d){
+      var cab = el('div', 'cab');
+      var a = el('a', '', d.nombre + ' ' + d.fecha.slice(8, 10) + '/' + d.fecha.slice(5, 7));
+      a.href = panelUrl + '?fecha=' + d.fecha;
+      cab.appendChild(a);
+      cab.appendChild(el('div', 'pct', d.abierto ? d.ocupacion + '%' : 'Cerrado'));
+      if (d.abierto) cab.appendChild(barra(d.ocupacion));
+      grid.appendChild(cab);
+    });
+    datos.horas.forEach(function(h){
+      grid.appendChild(el('div', 'hora', h));
+      datos.dias.forEach(function(d){
+        var celda = el('div', 'celda');
+        if (d.horas_jornada.indexOf(h) === -1) {
+          celda.classList.add('cerrada');
+        } else {
+          var info = d.horas[h];
+          if (info && info.bloqueado) {
+            celda.classList.add('bloqueada'); celda.textContent = 'Bloqueada';
+          } else if (info && info.citas.length) {
+            celda.classList.add('ocupada');
+            info.citas.forEach(function(c){
+              celda.appendChild(el('div', '', c.nombre_cliente + ' · ' + (c.servicio_nombre || '') + ' · ' + c.empleado_nombre));
+            });
+          }
+        }
+        grid.appendChild(celda);
+      });
+    });
+  }
+
+  function pintarMes(){
+    grid.style.gridTemplateColumns = 'repeat(7, minmax(110px, 1fr))';
+    ['Lun', 'Mar', 'Mié', 'Jue', 'Vie', 'Sáb', 'Dom'].forEach(function(n){ grid.appendChild(el('div', 'cab', n)); });
+    var primero = new Date(datos.desde + 'T00:00:00');
+    var hueco = (primero.getDay() + 6) % 7;
+    for (var i = 0; i < hueco; i++) grid.appendChild(el('div'));
+    datos.dias.forEach(function(d){
+      var a = el('a', 'mes-dia' + (d.abierto ? '' : ' cerrada'));
+      a.href = panelUrl + '?fecha=' + d.fecha;
+      a.appendChild(el('div', 'num', String(parseInt(d.fecha.slice(8, 10), 10))));
+      if (d.abierto) {
+        a.appendChild(el('div', 'pct', d.ocupacion + '% ocupado'));
+        a.appendChild(barra(d.ocupacion));
+        a.appendChild(el('div', 'muted', d.citas + ' cita(s)'));
+      } else {
+        a.appendChild(el('div', 'muted', 'Cerrado'));
+      }
+      grid.appendChild(a);
+    });
+  }
+
+  function pintar(){
+    grid.innerHTML = '';
+    rango.textContent = datos.desde + ' → ' + datos.hasta;
+    filtro.value = datos.empleado_id || '';
+    document.getElementById('btnSemana').classList.toggle('activo', datos.vista === 'semana');
+    document.getElementById('btnMes').classList.toggle('activo', datos.vista === 'mes');
+    if (datos.vista === 'mes') pintarMes(); else pintarSemana();
+  }
+
+  function cargar(vista, fecha, empleadoId){
+    var params = new URLSearchParams({ vista: vista, fecha: fecha });
+    if (empleadoId) params.set('empleado_id', empleadoId);
+    history.replaceState(null, '', '?' + params.toString());
+    fetch(jsonUrl + '?' + params.toString(), { credentials: 'same-origin' })
+      .then(function(r){ return r.json(); })
+      .then(function(nuevos){ datos = nuevos; pintar(); });
+  }
+
+  function hoyISO(){
+    var tz = (new Date()).getTimezoneOffset() * 60000;
+    return (new Date(Date.now() - tz)).toISOString().slice(0, 10);
+  }
+
+  document.getElementById('btnAnterior').addEventListener('click', function(){ cargar(datos.vista, datos.anterior, datos.empleado_id); });
+  document.getElementById('btnSiguiente').addEventListener('click', function(){ cargar(datos.vista, datos.siguiente, datos.empleado_id); });
+  document.getElementById('btnHoy').addEventListener('click', function(){ cargar(datos.vista, hoyISO(), datos.empleado_id); });
+  document.getElementById('btnSemana').addEventListener('click', function(){ cargar('semana', datos.fecha, datos.empleado_id); });
+  document.getElementById('btnMes').addEventListener('click', function(){ cargar('mes', datos.fecha, datos.empleado_id); });
+  filtro.addEventListener('change', function(){ cargar(datos.vista, datos.fecha, this.value); });
+
+  pintar();
+})();
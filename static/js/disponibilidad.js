@@ -0,0 +1,36 @@
+(function(){
+  var dataNode = document.getElementById('js-data');
+  var gestionBaseUrl = dataNode.getAttribute('data-gestion-url') || '';
+
+  var fechaInput = document.getElementById('fecha');
+  var btnHoy = document.getElementById('btnHoy');
+
+  // Cambiar fecha → navegar (sin mezclar template literals con Jinja)
+  fechaInput.addEventListener('change', function(){
+    var val = this.value;
+    if (val) window.location.href = gestionBaseUrl + '?fecha=' + encodeURIComponent(val);
+  });
+
+  // Botón "Hoy"
+  btnHoy.addEventListener('click', function(){
+    var tzOffset = (new Date()).getTimezoneOffset() * 60000;
+    var hoyISO = (new Date(Date.now() - tzOffset)).toISOString().slice(0,10);
+    window.location.href = gestionBaseUrl + '?fecha=' + hoyISO;
+  });
+
+  // Auto-refresh cada 15 s si la pestaña está visible
+  setInterval(function(){
+    if (document.visibilityState === 'visible') {
+      window.location.reload();
+    }
+  }, 15000);
+
+  // Si viene con hash (#slot-HH:MM) resalta el slot
+  if (location.hash) {
+    var el = document.querySelector(location.hash);
+    if (el) {
+      el.classList.add('selected');
+      el.scrollIntoView({ behavior: 'smooth', block: 'center' });
+    }
+  }
+})();
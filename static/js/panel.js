@@ -0,0 +1,171 @@
+(function(){
+  var dataNode = document.getElementById('js-data');
+  var panelBaseUrl = dataNode.getAttribute('data-panel-url') || '';
+
+  var inputFecha = document.getElementById('fecha');
+  var btnHoy = document.getElementById('btnHoy');
+  var filtroServicio = document.getElementById('filtroServicio');
+  var filtroEmpleado = document.getElementById('filtroEmpleado');
+  var tabla = document.getElementById('tablaAgenda');
+
+  inputFecha.addEventListener('change', function(){
+    var v = this.value;
+    if (v) window.location.href = panelBaseUrl + '?fecha=' + encodeURIComponent(v);
+  });
+
+  btnHoy.addEventListener('click', function(){
+    var tz = (new Date()).getTimezoneOffset()*60000;
+    var hoy = (new Date(Date.now()-tz)).toISOString().slice(0,10);
+    window.location.href = panelBaseUrl + '?fecha=' + hoy;
+  });
+
+  // ----- Cambios en vivo (SSE): solo altas/bajas del día mostrado -----
+  var streamUrl = dataNode.getAttribute('data-stream-url') || '';
+  var gestionUrl = dataNode.getAttribute('data-gestion-url') || '';
+  var cancelarUrl = dataNode.getAttribute('data-cancelar-url') || '';
+  var fechaActual = dataNode.getAttribute('data-fecha') || '';
+  var estadoVivo = document.getElementById('estadoVivo');
+
+  function clave(h){
+    var p = String(h).split(':');
+    return parseInt(p[0], 10) * 60 + parseInt(p[1] || '0', 10);
+  }
+  var filas = {};
+  if (tabla) {
+    tabla.querySelectorAll('tbody tr').forEach(function(tr){
+      filas[clave(tr.getAttribute('data-hora'))] = tr;
+    });
+  }
+
+  function el(tag, clase, texto){
+    var n = document.createElement(tag);
+    if (clase) n.className = clase;
+    if (texto !== undefined) n.textContent = texto;
+    return n;
+  }
+
+  function celdaVacia(tr){
+    var hora = tr.getAttribute('data-hora');
+    var td = el('td');
+    td.colSpan = 4;
+    if (tr.getAttribute('data-bloqueo')) {
+      td.className = 'bloqueada'; td.textContent = '-- Bloqueada --';
+    } else {
+      td.className = 'disponible'; td.textContent = '-- Disponible -- ';
+      var a = el('a', 'btn btn-secondary', 'Bloquear');
+      a.style.marginLeft = '8px';
+      a.href = gestionUrl + '?fecha=' + fechaActual + '#slot-' + hora;
+      td.appendChild(a);
+    }
+    return td;
+  }
+
+  function itemCita(c){
+    var empleado = c.empleado_nombre || 'No asignado';
+    var item = el('div', 'stack-item');
+    item.setAttribute('data-cita-id', c.id);
+    item.setAttribute('data-servicio', c.servicio_nombre || '');
+    item.setAttribute('data-empleado', empleado);
+    item.appendChild(el('div', '', c.nombre_cliente || ''));
+    item.appendChild(el('div', '', c.servicio_nombre || ''));
+    item.appendChild(el('div', '', empleado));
+    var form = el('form');
+    form.method = 'post';
+    form.action = cancelarUrl.replace('/cancelar/0/', '/cancelar/' + c.id + '/');
+    form.onsubmit = function(){ return confirm('¿Seguro que quieres cancelar esta cita?'); };
+    var oculto = el('input'); oculto.type = 'hidden'; oculto.name = 'fecha_actual'; oculto.value = fechaActual;
+    form.appendChild(oculto);
+    form.appendChild(el('button', 'btn btn-danger', 'Cancelar'));
+    var acciones = el('div'); acciones.appendChild(form);
+    item.appendChild(acciones);
+    return item;
+  }
+
+  function altaCita(tr, c){
+    if (tr.querySelector('.stack-item[data-cita-id="' + c.id + '"]')) return;
+    var stack = tr.querySelector('.stack');
+    if (!stack) {
+      tr.removeChild(tr.children[1]);
+      var td = el('td'); td.colSpan = 4;
+      stack = el('div', 'stack'); td.appendChild(stack); tr.appendChild(td);
+    }
+    stack.appendChild(itemCita(c));
+  }
+
+  function bajaCita(tr, id){
+    var item = tr.querySelector('.stack-item[data-cita-id="' + id + '"]');
+    if (!item) return;
+    var stack = item.parentNode;
+    stack.removeChild(item);
+    if (!stack.children.length) tr.replaceChild(celdaVacia(tr), tr.children[1]);
+  }
+
+  function aplicarCambio(ev){
+    var tr = filas[clave(ev.hora)];
+    if (!tr) return;
+    if (ev.tabla === 'citas') {
+      if (ev.op === 'alta') altaCita(tr, ev); else bajaCita(tr, ev.id);
+      tr.setAttribute('data-status', tr.querySelector('.stack-item') ? 'ocupada'
+        : (tr.getAttribute('data-bloqueo') ? 'bloqueada' : 'disponible'));
+    } else if (ev.empleado_id === null) {
+      // El panel solo muestra los bloqueos de todo el negocio
+      if (ev.op === 'alta') tr.setAttribute('data-bloqueo', '1'); else tr.removeAttribute('data-bloqueo');
+      if (!tr.querySelector('.stack-item')) {
+        tr.setAttribute('data-status', ev.op === 'alta' ? 'bloqueada' : 'disponible');
+        tr.replaceChild(celdaVacia(tr), tr.children[1]);
+      }
+    }
+    poblar(); aplicar();
+  }
+
+  Object.keys(filas).forEach(function(k){
+    if (filas[k].getAttribute('data-status') === 'bloqueada') filas[k].setAttribute('data-bloqueo', '1');
+  });
+
+  if (window.EventSource && streamUrl) {
+    var fuente = new EventSource(streamUrl);
+    fuente.addEventListener('cambio', function(e){ aplicarCambio(JSON.parse(e.data)); });
+    fuente.addEventListener('recargar', function(){ location.reload(); });
+    fuente.onopen = function(){ estadoVivo.textContent = 'Actualización en vivo'; };
+    fuente.onerror = function(){ estadoVivo.textContent = 'Reconectando…'; };
+  } else {
+    estadoVivo.textContent = 'Actualizando cada 15 s…';
+    setInterval(function(){
+      if (document.visibilityState === 'visible') location.reload();
+    }, 15000);
+  }
+
+  // Filtros (a partir de las citas visibles)
+  function poblar(){
+    if (!tabla) return;
+    var servicios={}, empleados={};
+    tabla.querySelectorAll('.stack-item').forEach(function(row){
+      var s=row.getAttribute('data-servicio')||'';
+      var e=row.getAttribute('data-empleado')||'';
+      if(s) servicios[s]=true;
+      if(e) empleados[e]=true;
+    });
+    var previos={};
+    filtroServicio.querySelectorAll('option').forEach(function(o){ previos['s:'+o.value]=true; });
+    filtroEmpleado.querySelectorAll('option').forEach(function(o){ previos['e:'+o.value]=true; });
+    Object.keys(servicios).sort().forEach(function(s){
+      if (previos['s:'+s]) return;
+      var o=document.createElement('option'); o.value=s;o.textContent=s; filtroServicio.appendChild(o);
+    });
+    Object.keys(empleados).sort().forEach(function(e){
+      if (previos['e:'+e]) return;
+      var o=document.createElement('option'); o.value=e;o.textContent=e; filtroEmpleado.appendChild(o);
+    });
+  }
+  function aplicar(){
+    var fs=filtroServicio.value, fe=filtroEmpleado.value;
+    document.querySelectorAll('.stack-item').forEach(function(it){
+      var okS=!fs || it.getAttribute('data-servicio')===fs;
+      var okE=!fe || it.getAttribute('data-empleado')===fe;
+      it.style.display=(okS&&okE)?'grid':'none';
+    });
+  }
+  filtroServicio.addEventListener('change',aplicar);
+  filtroEmpleado.addEventListener('change',aplicar);
+  poblar();
+})();
@@ -0,0 +1,77 @@
+# tests/conftest.py
+import os
+import secrets
+import pytest
+
+# Base de datos de pruebas (p.ej. postgresql://postgres@localhost/pruebas). Cada
+# test trabaja en un esquema propio que se borra al terminar: no toca datos.
+TEST_DATABASE_URL = os.getenv("TEST_DATABASE_URL")
+
+_TABLAS = """
+    CREATE TABLE citas (
+        id SERIAL PRIMARY KEY, negocio_id INTEGER NOT NULL, fecha DATE NOT NULL, hora TIME NOT NULL,
+        empleado_id INTEGER, duracion_min SMALLINT, recursos JSONB
+    );
+    CREATE TABLE bloqueos (
+        id SERIAL PRIMARY KEY, negocio_id INTEGER NOT NULL, fecha DATE NOT NULL, hora TIME NOT NULL,
+        empleado_id INTEGER
+    );
+    CREATE TABLE reservas_temporales (
+        id SERIAL PRIMARY KEY, negocio_id INTEGER NOT NULL, empleado_id INTEGER, fecha DATE NOT NULL,
+        hora TIME NOT NULL, titular TEXT NOT NULL, expira_at TIMESTAMP NOT NULL,
+        duracion_min SMALLINT, recursos JSONB
+    );
+    CREATE TABLE recursos (id INTEGER PRIMARY KEY, capacidad INTEGER NOT NULL);
+"""
+
+@pytest.fixture
+def pg():
+    """Cursor en un esquema vacío con las tablas de agenda (salta sin TEST_DATABASE_URL)."""
+    if not TEST_DATABASE_URL:
+        pytest.skip("TEST_DATABASE_URL no definida")
+    psycopg2 = pytest.importorskip("psycopg2")
+    conn = psycopg2.connect(TEST_DATABASE_URL)
+    esquema = f"prueba_{secrets.token_hex(4)}"
+    try:
+        with conn.cursor() as cur:
+            cur.execute(f"CREATE SCHEMA {esquema}; SET search_path TO {esquema};")
+            cur.execute(_TABLAS)
+            yield cur
+    finally:
+        conn.rollback()
+        with conn.cursor() as cur:
+            cur.execute(f"DROP SCHEMA IF EXISTS {esquema} CASCADE;")
+        conn.commit()
+        conn.close()
+
+@pytest.fixture
+def pg_esquema(monkeypatch):
+    """
+    Esquema vacío ya confirmado y database.get_db_connection apuntando a él:
+    para probar funciones de database que abren y cierran sus conexiones.
+    Da una función que ejecuta SQL en su propia conexión y devuelve las filas.
+    """
+    if not TEST_DATABASE_URL:
+        pytest.skip("TEST_DATABASE_URL no definida")
+    psycopg2 = pytest.importorskip("psycopg2")
+    import database
+    esquema = f"prueba_{secrets.token_hex(4)}"
+    conn = psycopg2.connect(TEST_DATABASE_URL)
+    conn.autocommit = True
+    with conn.cursor() as cur:
+        cur.execute(f"CREATE SCHEMA {esquema};")
+    monkeypatch.setattr(database, "get_db_connection",
+                        lambda: psycopg2.connect(TEST_DATABASE_URL, options=f"-c search_path={esquema}"))
+
+    def sql(consulta, params=None):
+        with conn.cursor() as cur:
+            cur.execute(f"SET search_path TO {esquema};")
+            cur.execute(consulta, params)
+            return cur.fetchall() if cur.description else None
+
+    try:
+        yield sql
+    finally:
+        with conn.cursor() as cur:
+            cur.execute(f"DROP SCHEMA IF EXISTS {esquema} CASCADE;")
+        conn.close()
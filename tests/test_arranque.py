@@ -0,0 +1,27 @@
+# tests/test_arranque.py
+import os
+import subprocess
+import sys
+import pytest
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Se importa en un proceso limpio: en este no cuenta lo que ya hayan cargado otros tests
+_MEDIR = """
+import sys, app
+print(app._importacion_ms)
+cargados = [m for m in ("twilio", "psycopg2.extras") if m in sys.modules]
+if app.email_manager._env is not None:
+    cargados.append("Jinja de emails")
+print(",".join(cargados))
+"""
+
+def test_importar_app_cabe_en_el_presupuesto():
+    pytest.importorskip("flask")
+    pytest.importorskip("psycopg2")
+    proceso = subprocess.run([sys.executable, "-c", _MEDIR], cwd=RAIZ, capture_output=True, text=True, timeout=60)
+    assert proceso.returncode == 0, proceso.stderr
+    ms, cargados = proceso.stdout.splitlines()[-2:]
+    presupuesto = float(os.getenv("ARRANQUE_PRESUPUESTO_MS", 500))
+    assert float(ms) <= presupuesto, f"Importar app llevó {float(ms):.0f} ms (presupuesto {presupuesto:.0f} ms)"
+    assert not cargados, f"Cargados al importar app: {cargados}"
@@ -0,0 +1,26 @@
+# tests/test_fechas.py
+from datetime import date
+import pytest
+import fechas
+
+JUEVES = date(2030, 1, 3)
+
+@pytest.mark.parametrize("escrito, hora", [
+    ("a las 12 de la noche", "00:00"),
+    ("a las 10 de la noche", "22:00"),
+    ("a las 12 de la tarde", "12:00"),
+    ("a las 5 y media", "17:30"),
+    ("12am", "00:00"),
+])
+def test_horas(escrito, hora):
+    assert fechas.interpretar(escrito, JUEVES).hora == hora
+
+@pytest.mark.parametrize("escrito, fecha", [
+    ("la semana que viene", date(2030, 1, 7)),
+    ("la proxima semana por la tarde", date(2030, 1, 7)),
+    ("el martes de la semana que viene", date(2030, 1, 8)),
+    ("el martes", date(2030, 1, 8)),
+    ("el viernes", date(2030, 1, 4)),
+])
+def test_fechas(escrito, fecha):
+    assert fechas.interpretar(escrito, JUEVES).fecha == fecha
@@ -0,0 +1,63 @@
+# tests/test_horarios.py
+from datetime import date
+import pytest
+import horarios
+
+LUNES = date(2030, 1, 7)
+
+def test_parsear_tramos():
+    assert horarios.parsear_tramos("09:00-14:00, 16:00-20:00/30") == [(540, 840, 60), (960, 1200, 30)]
+    assert horarios.parsear_tramos("") == []
+    assert horarios.parsear_tramos("Cerrado") == []
+
+def test_parsear_tramos_formato_antiguo():
+    # Horas sueltas: se agrupan en tramos de paso constante
+    assert horarios.parsear_tramos("09:00,10:00,11:00, 16:30,17:00") == [(540, 720, 60), (990, 1050, 30)]
+
+@pytest.mark.parametrize("texto", ["14:00-09:00", "09:00-25:00", "09:00-14:00/0", "9h", "09:70"])
+def test_parsear_tramos_no_valido(texto):
+    with pytest.raises(ValueError):
+        horarios.parsear_tramos(texto)
+
+def test_tramos_ida_y_vuelta():
+    texto = "09:00-14:00, 16:00-20:00/30"
+    assert horarios.formatear_tramos(horarios.parsear_tramos(texto)) == texto
+
+def test_parsear_semana():
+    semana = horarios.parsear_semana("lunes-viernes 10:00-14:00; sábado 10:00-13:00/30")
+    assert sorted(semana) == [0, 1, 2, 3, 4, 5]
+    assert semana[0] == [(600, 840, 60)] and semana[5] == [(600, 780, 30)]
+    assert horarios.parsear_semana("") == {}
+    # Rango que da la vuelta a la semana
+    assert sorted(horarios.parsear_semana("sabado-lunes 10:00-12:00")) == [0, 5, 6]
+
+def test_parsear_semana_dia_no_valido():
+    with pytest.raises(ValueError):
+        horarios.parsear_semana("lunes-festivo 10:00-12:00")
+
+def _horario():
+    reglas = [
+        (0, None, (540, 840, 60)),      # lunes 09-14
+        (0, None, (960, 1080, 60)),     # y 16-18: pausa de comida
+        (0, 1, (480, 720, 60)),         # profesional 1: 08-12, recortado al negocio
+    ]
+    excepciones = [
+        (date(2030, 1, 14), None, None),            # ese lunes cerrado
+        (date(2030, 1, 21), 1, (600, 660, 30)),     # ese lunes el 1 solo 10-11 cada media hora
+    ]
+    return horarios.Horario(reglas, excepciones)
+
+def test_jornada_del_negocio_con_pausa():
+    assert _horario().horas(LUNES) == ("09:00", "10:00", "11:00", "12:00", "13:00", "16:00", "17:00")
+
+def test_jornada_propia_dentro_del_negocio():
+    h = _horario()
+    assert h.horas(LUNES, 1) == ("09:00", "10:00", "11:00")
+    assert h.horas(LUNES, 2) == h.horas(LUNES)  # sin reglas propias: las del negocio
+    assert h.trabaja(LUNES, "10:00", 1) and not h.trabaja(LUNES, "16:00", 1)
+
+def test_jornada_con_excepciones():
+    h = _horario()
+    assert h.horas(date(2030, 1, 14)) == () and h.horas(date(2030, 1, 14), 1) == ()
+    assert h.horas(date(2030, 1, 21), 1) == ("10:00", "10:30")
+    assert h.horas(date(2030, 1, 8)) == ()  # martes sin reglas
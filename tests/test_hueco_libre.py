@@ -0,0 +1,100 @@
+# tests/test_hueco_libre.py
+import json
+from datetime import date
+import pytest
+from psycopg2.extensions import adapt
+import database
+import ocupacion
+
+pglast = pytest.importorskip("pglast")
+
+def _sql(consulta, params):
+    """La consulta tal como llega a PostgreSQL (lo que haría cursor.mogrify)."""
+    assert consulta.count("%s") == len(params)
+    return consulta % tuple(adapt(p).getquoted().decode() for p in params)
+
+@pytest.mark.parametrize("empleado_id, duracion, recursos, cita_id", [
+    (None, None, None, None),
+    (3, 45, None, None),
+    (None, 30, {1: 1}, None),
+    (3, 30, {1: 2, 4: 1}, 99),
+])
+def test_hueco_libre_es_sql_valido(empleado_id, duracion, recursos, cita_id):
+    params = database._params_hueco_libre(7, date(2030, 1, 3), "10:15", empleado_id, "titular'x",
+                                          duracion, recursos, cita_id)
+    pglast.parse_sql(_sql("SELECT " + database._SQL_HUECO_LIBRE + ";", params))
+
+# -------------------------
+# Mismo veredicto que el índice en memoria (ocupacion.Vista)
+# -------------------------
+
+NEGOCIO, DIA, YO = 7, date(2030, 1, 3), "yo"
+CAPACIDADES = {1: 2, 2: 1}
+CITAS = [  # hora, empleado_id, duracion_min, recursos
+    ("09:30", 1, 30, {1: 1}),
+    ("10:00", None, 45, {1: 1}),
+    ("10:15", 2, None, None),
+    ("11:00", 2, 60, {2: 1}),
+    ("11:30", None, None, None),
+]
+BLOQUEOS = [("09:00", None), ("10:45", 1)]
+RETENCIONES = [  # hora, empleado_id, duracion_min, recursos, titular, vigente
+    ("09:45", 2, 30, {1: 1}, "otro", True),
+    ("11:15", None, 15, None, "otro", True),
+    ("10:30", 1, 30, {1: 2}, "otro", False),
+    ("10:30", 1, 30, {1: 2}, YO, True),
+]
+
+def _cargar(cur):
+    for hora, empleado_id, duracion, recursos in CITAS:
+        cur.execute("INSERT INTO citas (negocio_id, fecha, hora, empleado_id, duracion_min, recursos)"
+                    " VALUES (%s, %s, %s, %s, %s, %s);",
+                    (NEGOCIO, DIA, hora, empleado_id, duracion, json.dumps(recursos) if recursos else None))
+    for hora, empleado_id in BLOQUEOS:
+        cur.execute("INSERT INTO bloqueos (negocio_id, fecha, hora, empleado_id) VALUES (%s, %s, %s, %s);",
+                    (NEGOCIO, DIA, hora, empleado_id))
+    for hora, empleado_id, duracion, recursos, titular, vigente in RETENCIONES:
+        cur.execute("INSERT INTO reservas_temporales (negocio_id, empleado_id, fecha, hora, titular, expira_at,"
+                    " duracion_min, recursos) VALUES (%s, %s, %s, %s, %s, NOW() + %s * INTERVAL '1 hour', %s, %s);",
+                    (NEGOCIO, empleado_id, DIA, hora, titular, 1 if vigente else -1, duracion,
+                     json.dumps(recursos) if recursos else None))
+    for recurso_id, capacidad in CAPACIDADES.items():
+        cur.execute("INSERT INTO recursos (id, capacidad) VALUES (%s, %s);", (recurso_id, capacidad))
+
+def _vista():
+    dia = ocupacion._Dia()
+    for hora, empleado_id, duracion, recursos in CITAS:
+        dia.aplicar('cita', hora, empleado_id, 1, duracion, recursos)
+    for hora, empleado_id in BLOQUEOS:
+        dia.aplicar('bloqueo', hora, empleado_id)
+    vista = ocupacion.Vista(dia, CAPACIDADES)
+    for hora, empleado_id, duracion, recursos, titular, vigente in RETENCIONES:
+        if vigente and titular != YO:
+            vista.retener(hora, empleado_id, duracion, recursos)
+    return vista
+
+@pytest.mark.parametrize("empleado_id", [None, 1, 2])
+@pytest.mark.parametrize("duracion", [None, 30, 45])
+@pytest.mark.parametrize("necesidades", [None, {1: 1}, {1: 2}, {2: 1}, {1: 3}])
+def test_hueco_libre_coincide_con_la_vista(pg, empleado_id, duracion, necesidades):
+    _cargar(pg)
+    vista = _vista()
+    distintas = []
+    for minuto in range(8 * 60 + 30, 12 * 60 + 30, ocupacion.MINUTOS_HUECO):
+        hora = f"{minuto // 60:02d}:{minuto % 60:02d}"
+        pg.execute("SELECT " + database._SQL_HUECO_LIBRE + ";",
+                   database._params_hueco_libre(NEGOCIO, DIA, hora, empleado_id, YO, duracion, necesidades))
+        en_sql = pg.fetchone()[0]
+        en_memoria = vista.libre(hora, empleado_id, ocupacion.huecos_de(duracion), necesidades)
+        if en_sql != en_memoria:
+            distintas.append((hora, en_sql, en_memoria))
+    assert not distintas
+
+def test_hueco_libre_no_cuenta_la_cita_que_se_modifica(pg):
+    _cargar(pg)
+    pg.execute("SELECT id FROM citas WHERE hora = '10:15';")
+    cita_id = pg.fetchone()[0]
+    for excluida, libre in ((None, False), (cita_id, True)):
+        pg.execute("SELECT " + database._SQL_HUECO_LIBRE + ";",
+                   database._params_hueco_libre(NEGOCIO, DIA, "10:15", 2, YO, None, None, excluida))
+        assert pg.fetchone()[0] is libre
@@ -0,0 +1,54 @@
+# tests/test_limitador.py
+import pytest
+import limitador
+
+class _Reloj:
+    def __init__(self):
+        self.t = 1000.0
+
+    def __call__(self):
+        return self.t
+
+@pytest.fixture
+def reloj(monkeypatch):
+    r = _Reloj()
+    monkeypatch.setattr(limitador.time, "monotonic", r)
+    return r
+
+def test_rafaga_y_recarga(reloj):
+    cubos = limitador._CubosLocales(1)
+    assert [cubos.consumir("ip:1", 60, 3) for _ in range(3)] == [0, 0, 0]
+    assert cubos.consumir("ip:1", 60, 3) == pytest.approx(1.0)  # 1 ficha/s
+    reloj.t += 0.5
+    assert cubos.consumir("ip:1", 60, 3) == pytest.approx(0.5)
+    reloj.t += 0.5
+    assert cubos.consumir("ip:1", 60, 3) == 0
+    # Otra clave tiene su propio cubo
+    assert cubos.consumir("ip:2", 60, 3) == 0
+
+def test_recarga_no_pasa_de_la_rafaga(reloj):
+    cubos = limitador._CubosLocales(1)
+    cubos.consumir("ip:1", 60, 2)
+    reloj.t += 3600
+    assert [cubos.consumir("ip:1", 60, 2) for _ in range(3)][-1] > 0
+
+def test_reparto_entre_workers(reloj):
+    # Con 2 workers cada uno admite la mitad de la ráfaga y recarga a la mitad de la tasa
+    cubos = limitador._CubosLocales(2)
+    assert [cubos.consumir("negocio:1", 60, 4) for _ in range(3)][:2] == [0, 0]
+    assert cubos.consumir("negocio:1", 60, 4) == pytest.approx(2.0)
+
+def test_purga_cubos_viejos(reloj, monkeypatch):
+    monkeypatch.setattr(limitador, "MAX_CLAVES_LOCALES", 2)
+    cubos = limitador._CubosLocales(1)
+    cubos.consumir("a", 60, 1)
+    cubos.consumir("b", 60, 1)
+    reloj.t += 601
+    cubos.consumir("c", 60, 1)
+    assert set(cubos._cubos) == {"c"}
+
+def test_slug_resuelto_comparte_cubo_con_el_id(monkeypatch):
+    monkeypatch.setattr(limitador, "_ids_por_slug", {})
+    assert limitador.id_de_slug("peluqueria-ana") is None
+    limitador.recordar_slug("peluqueria-ana", 12)
+    assert limitador.id_de_slug("peluqueria-ana") == 12
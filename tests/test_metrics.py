@@ -0,0 +1,87 @@
+# tests/test_metrics.py
+import os
+import json
+import pytest
+import metrics
+
+MUERTO = 999999
+
+@pytest.fixture
+def registro(tmp_path, monkeypatch):
+    monkeypatch.setattr(metrics, "METRICS_DIR", str(tmp_path))
+    monkeypatch.setattr(metrics, "_registro", {})
+    monkeypatch.setattr(metrics, "_fichero_propio", False)
+    monkeypatch.setattr(metrics, "_proceso_vivo", lambda pid: pid == os.getpid())
+    return tmp_path
+
+def _fichero(directorio, pid, metricas, id_proceso=None):
+    datos = {"pid": pid, "id": id_proceso or f"proc-{pid}", "metricas": metricas}
+    (directorio / f"proc_{pid}.json").write_text(json.dumps(datos))
+
+def _valor(texto, linea):
+    return [l for l in texto.splitlines() if l.startswith(linea + " ")][0].split()[-1]
+
+def test_agregar_suma_workers(registro):
+    c = metrics.contador("prueba_total", "Prueba.", ("resultado",))
+    h = metrics.histograma("prueba_segundos", "Prueba.", buckets=(0.1, 1.0))
+    g = metrics.gauge("prueba_en_uso", "Prueba.")
+    m = metrics.gauge("prueba_backlog", "Prueba.", agregacion="max")
+    vivo = {"pid": os.getpid(), "metricas": {
+        c.nombre: [[["ok"], 2]], h.nombre: [[[], [[1, 0, 0], 0.05, 1]]],
+        g.nombre: [[[], 3]], m.nombre: [[[], 4]]}}
+    muerto = {"pid": MUERTO, "metricas": {
+        c.nombre: [[["ok"], 5], [["error"], 1]], h.nombre: [[[], [[0, 1, 1], 2.5, 2]]],
+        g.nombre: [[[], 7]], m.nombre: [[[], 9]], "desconocida": [[[], 1]]}}
+    agregado = metrics._agregar([vivo, muerto])
+    assert agregado[c.nombre] == {("ok",): 7, ("error",): 1}
+    assert agregado[h.nombre] == {(): [[1, 1, 1], 2.55, 3]}
+    # Los gauges de un worker muerto no cuentan
+    assert agregado[g.nombre] == {(): 3} and agregado[m.nombre] == {(): 4}
+    assert "desconocida" not in agregado
+
+def test_exportar_formato(registro):
+    c = metrics.contador("prueba_total", "Prueba.", ("ruta",))
+    h = metrics.histograma("prueba_segundos", "Prueba.", buckets=(0.1, 1.0))
+    c.inc('/a"b')
+    h.observar(0.05)
+    h.observar(0.5)
+    h.observar(3)
+    texto = metrics.exportar()
+    assert "# TYPE prueba_total counter" in texto
+    assert 'prueba_total{ruta="/a\\"b"} 1' in texto
+    assert _valor(texto, 'prueba_segundos_bucket{le="0.1"}') == "1"
+    assert _valor(texto, 'prueba_segundos_bucket{le="1.0"}') == "2"
+    assert _valor(texto, 'prueba_segundos_bucket{le="+Inf"}') == "3"
+    assert _valor(texto, "prueba_segundos_count") == "3"
+
+def test_worker_muerto_se_suma_al_agregado(registro):
+    c = metrics.contador("prueba_total", "Prueba.")
+    g = metrics.gauge("prueba_en_uso", "Prueba.")
+    c.inc()
+    _fichero(registro, MUERTO, {c.nombre: [[[], 5]], g.nombre: [[[], 2]]})
+    assert _valor(metrics.exportar(), "prueba_total") == "6"
+    assert not (registro / f"proc_{MUERTO}.json").exists()
+    assert (registro / "agregado.json").exists()
+    # Sin duplicar en la siguiente lectura, y sin el gauge del muerto
+    texto = metrics.exportar()
+    assert _valor(texto, "prueba_total") == "6"
+    assert "\nprueba_en_uso " not in texto
+
+def test_pid_reutilizado_no_hace_retroceder(registro):
+    # Un proceso anterior con nuestro pid dejó su fichero: se suma antes de pisarlo
+    c = metrics.contador("prueba_total", "Prueba.")
+    _fichero(registro, os.getpid(), {c.nombre: [[[], 7]]}, id_proceso="anterior")
+    c.inc()
+    assert _valor(metrics.exportar(), "prueba_total") == "8"
+    c.inc()
+    assert _valor(metrics.exportar(), "prueba_total") == "9"
+
+def test_fichero_ya_sumado_no_se_suma_dos_veces(registro):
+    # Caída entre escribir agregado.json y borrar el fichero del muerto
+    c = metrics.contador("prueba_total", "Prueba.")
+    _fichero(registro, MUERTO, {c.nombre: [[[], 5]]})
+    with metrics._cerrojo_directorio():
+        metrics._plegar_muertos()
+    _fichero(registro, MUERTO, {c.nombre: [[[], 5]]})
+    assert _valor(metrics.exportar(), "prueba_total") == "5"
+    assert not (registro / f"proc_{MUERTO}.json").exists()
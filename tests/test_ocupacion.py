@@ -0,0 +1,92 @@
+# tests/test_ocupacion.py
+from datetime import date
+import pytest
+import database
+import eventos
+import ocupacion
+
+DIA = date(2030, 1, 3)
+
+def _bits(*huecos):
+    return sum(1 << h for h in huecos)
+
+def test_tramos_libres():
+    ocupados = ~_bits(*range(10, 14), *range(20, 30)) & ocupacion.MASCARA_DIA
+    assert ocupacion.tramos_libres(ocupados, 1) == _bits(*range(10, 14), *range(20, 30))
+    assert ocupacion.tramos_libres(ocupados, 4) == _bits(10, *range(20, 27))
+    assert ocupacion.tramos_libres(ocupados, 5) == _bits(*range(20, 26))
+    assert ocupacion.tramos_libres(ocupados, 11) == 0
+
+def test_tramos_libres_al_final_del_dia():
+    # Un tramo no puede salirse del día
+    assert ocupacion.tramos_libres(0, 3) >> (ocupacion.HUECOS_DIA - 3) == 1
+
+def test_aplicar_cuenta_por_hueco():
+    dia = ocupacion._Dia()
+    dia.aplicar('cita', '10:00', 1, duracion=15, recursos={"2": 1})
+    dia.aplicar('cita', '10:05', 1, recursos={2: 2})
+    h = ocupacion.hueco('10:00')
+    assert dia.por_empleado[1].conteo == {h: 1, h + 1: 2, h + 2: 1}
+    assert dia.por_recurso[2].conteo == {h: 1, h + 1: 3, h + 2: 1}
+    assert dia.carga == {1: 2}
+    # Quitar una de dos ocupaciones del mismo hueco no lo libera
+    dia.aplicar('cita', '10:05', 1, signo=-1, recursos={2: 2})
+    assert dia.por_empleado[1].bits == _bits(h, h + 1, h + 2)
+    assert dia.por_recurso[2].conteo == {h: 1, h + 1: 1, h + 2: 1}
+    dia.aplicar('cita', '10:00', 1, signo=-1, duracion=15, recursos={"2": 1})
+    assert dia.todas.bits == 0 and not dia.por_recurso[2].conteo and dia.carga == {1: 0}
+
+def test_aplicar_separa_bloqueos_y_citas_sin_profesional():
+    dia = ocupacion._Dia()
+    dia.aplicar('bloqueo', '09:00', None)
+    dia.aplicar('cita', '09:30', None)
+    assert dia.global_.bits == _bits(ocupacion.hueco('09:00'))
+    assert dia.sin_empleado.bits == _bits(ocupacion.hueco('09:30'))
+    assert dia.bloqueos.bits == dia.global_.bits
+    assert dia.todas.bits == dia.global_.bits | dia.sin_empleado.bits
+
+def test_libres_alguno_descuenta_citas_sin_profesional():
+    dia = ocupacion._Dia()
+    vista = ocupacion.Vista(dia)
+    horas = ['10:00', '10:30']
+    assert vista.libres_alguno([1, 2], horas) == horas
+    dia.aplicar('cita', '10:00', None, duracion=30)
+    assert vista.libres_alguno([1, 2], horas) == horas  # queda un profesional libre
+    dia.aplicar('cita', '10:00', None)
+    assert vista.libres_alguno([1, 2], horas) == ['10:30']
+    # Con uno de los dos ocupado, una cita sin profesional a esa hora se lleva al otro
+    dia.aplicar('cita', '10:30', 1)
+    assert vista.libres_alguno([1, 2], horas) == ['10:30']
+    dia.aplicar('cita', '10:30', None)
+    assert vista.libres_alguno([1, 2], horas) == []
+
+@pytest.fixture
+def cache(monkeypatch):
+    monkeypatch.setattr(eventos, "escuchando", lambda: True)
+    monkeypatch.setattr(eventos, "al_cambiar", lambda funcion: None)
+    ocupacion._dias.clear()
+    ocupacion._cargando.clear()
+    yield
+    ocupacion._dias.clear()
+
+def _aviso(op, version, hora='10:00'):
+    return {"tipo": "cambio", "tabla": "citas", "op": op, "version": version, "negocio_id": 5,
+            "fecha": DIA.isoformat(), "hora": hora, "empleado_id": 1}
+
+def test_aviso_ya_leido_no_se_aplica_dos_veces(cache, monkeypatch):
+    filas = [
+        {"fecha": DIA, "hora": "10:00", "empleado_id": 1, "origen": "cita",
+         "duracion_min": None, "recursos": None, "version": None},
+        {"fecha": DIA, "hora": None, "empleado_id": None, "origen": "version",
+         "duracion_min": None, "recursos": None, "version": 7},
+    ]
+    monkeypatch.setattr(database, "obtener_ocupacion_fija_rango", lambda *a: filas)
+    dia = ocupacion._dias_indexados(5, DIA, DIA)[DIA]
+    assert dia.version == 7
+    h = ocupacion.hueco('10:00')
+    ocupacion._al_cambiar(_aviso('alta', 7))  # el alta que ya trajo la lectura
+    assert dia.por_empleado[1].conteo == {h: 1}
+    ocupacion._al_cambiar(_aviso('baja', 8))
+    assert not dia.por_empleado[1].conteo and dia.version == 8
+    ocupacion._al_cambiar(_aviso('baja', 8))  # repetido
+    assert not dia.por_empleado[1].conteo
@@ -0,0 +1,35 @@
+# tests/test_recursos.py
+import pytest
+import recursos
+
+def test_parsear_recursos():
+    assert recursos.parsear_recursos("Silla: 3\n\n  Láser\n") == [("Silla", 3), ("Láser", 1)]
+    assert recursos.parsear_recursos("") == []
+
+@pytest.mark.parametrize("texto", ["Silla: 0", "Silla: tres", ": 2", "Silla: 2\nSilla: 1"])
+def test_parsear_recursos_no_valido(texto):
+    with pytest.raises(ValueError):
+        recursos.parsear_recursos(texto)
+
+def test_parsear_necesidades():
+    nombres = ("Silla", "Láser")
+    assert recursos.parsear_necesidades("Silla x2, Láser", nombres) == [("Silla", 2), ("Láser", 1)]
+    assert recursos.parsear_necesidades("Silla ×3", nombres) == [("Silla", 3)]
+    assert recursos.parsear_necesidades("", nombres) == []
+
+@pytest.mark.parametrize("texto", ["Cabina", "Silla x0"])
+def test_parsear_necesidades_no_valido(texto):
+    with pytest.raises(ValueError):
+        recursos.parsear_necesidades(texto, ("Silla",))
+
+def test_necesidades_de_varios_servicios():
+    r = recursos.Recursos(
+        [{"id": 1, "nombre": "Silla", "capacidad": 3}, {"id": 2, "nombre": "Láser", "capacidad": 1}],
+        [{"servicio": "Corte", "recurso_id": 1, "cantidad": 1},
+         {"servicio": "Tinte", "recurso_id": 1, "cantidad": 2},
+         {"servicio": "Depilación", "recurso_id": 2, "cantidad": 1}],
+    )
+    # Por recurso, el máximo entre los servicios: se atienden uno detrás de otro
+    assert r.necesidades(["Corte", "Tinte", "Depilación"]) == {1: 2, 2: 1}
+    assert r.necesidades(["Manicura"]) == {}
+    assert r.textos()["servicios"]["Tinte"] == "Silla x2"
@@ -0,0 +1,35 @@
+# tests/test_sesion.py
+from datetime import date, datetime, timezone
+import pytest
+
+pytest.importorskip("flask")
+pytest.importorskip("msgpack")
+from flask.json.tag import TaggedJSONSerializer
+import sesion
+
+def test_ida_y_vuelta():
+    s = sesion.SerializadorMsgpack()
+    valor = {"estado": "pidiendo_hora", "negocio_id": 3, "servicios": ["Corte", "Barba"],
+             "fecha": date(2030, 1, 3), "creada": datetime(2030, 1, 3, 9, 30), "es_recurrente": True,
+             "empleado_id": None}
+    datos = s.dumps(valor)
+    assert isinstance(datos, bytes)
+    assert s.loads(datos) == valor
+    assert s.loads(datos.decode("latin1").encode("latin1")) == valor
+
+def test_mas_corta_que_json():
+    valor = {"estado": "pidiendo_hora", "huecos_sugeridos": [f"2030-01-0{d} 1{h}:00" for d in range(1, 8) for h in range(8)]}
+    assert len(sesion.SerializadorMsgpack().dumps(valor)) < len(TaggedJSONSerializer().dumps(valor))
+
+def test_lee_cookies_json_antiguas():
+    valor = {"estado": "inicio", "creada": datetime(2030, 1, 3, 9, 30, tzinfo=timezone.utc), "lista": [1, 2], "_flashes": [("ok", "Hecho")]}
+    antigua = TaggedJSONSerializer().dumps(valor)
+    assert sesion.SerializadorMsgpack().loads(antigua) == valor
+    assert sesion.SerializadorMsgpack().loads(antigua.encode()) == valor
+
+def test_no_serializable():
+    with pytest.raises(TypeError):
+        sesion.SerializadorMsgpack().dumps({"x": object()})
+
+def test_interfaz_usa_msgpack():
+    assert isinstance(sesion.SesionCompacta.serializer, sesion.SerializadorMsgpack)
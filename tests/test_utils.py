@@ -0,0 +1,21 @@
+# tests/test_utils.py
+import pytest
+import utils
+
+@pytest.mark.parametrize("escrito", [
+    "600 11 22 33",
+    "+34 600-11-22-33",
+    "0034600112233",
+    "34600112233",
+    "(+34) 600112233",
+    "+3434600112233",
+])
+def test_telefono_e164_misma_identidad(escrito):
+    assert utils.telefono_e164(escrito) == "+34600112233"
+
+def test_telefono_e164_otro_pais():
+    assert utils.telefono_e164("+44 7911 123456") == "+447911123456"
+
+@pytest.mark.parametrize("escrito", ["", None, "abc", "12"])
+def test_telefono_e164_no_valido(escrito):
+    assert utils.telefono_e164(escrito) is None
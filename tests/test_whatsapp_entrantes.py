@@ -0,0 +1,57 @@
+# tests/test_whatsapp_entrantes.py
+import pytest
+import database
+
+@pytest.fixture
+def bandeja(pg_esquema, monkeypatch):
+    monkeypatch.setattr(database, "WHATSAPP_INTENTOS", 2)
+    database.ensure_tabla_whatsapp_entrantes()
+    database.guardar_whatsapp_entrante("wa:+34600000001", "hola", "peluqueria")
+    database.guardar_whatsapp_entrante("wa:+34600000002", "buenas", "")
+    database.guardar_whatsapp_entrante("wa:+34600000001", "2", "peluqueria", sid="SM1")
+    database.guardar_whatsapp_entrante("wa:+34600000001", "2", "peluqueria", sid="SM1")  # reintento de Twilio
+    return pg_esquema
+
+def _pendientes(sql):
+    return sql("SELECT conversacion, texto, intentos, abandonado_at IS NOT NULL FROM whatsapp_entrantes ORDER BY id;")
+
+def test_toma_la_mas_antigua_y_la_borra_al_terminar(bandeja):
+    with database.conversacion_whatsapp_pendiente() as pendiente:
+        assert pendiente == ("wa:+34600000001", [("hola", "peluqueria"), ("2", "peluqueria")])
+        # Tomada con un plazo ya confirmado: la conexión no sigue abierta y otro hilo pasa a la siguiente
+        assert bandeja("SELECT count(*) FROM pg_stat_activity WHERE state LIKE 'idle in transaction%%';") == [(0,)]
+        database.guardar_whatsapp_entrante("wa:+34600000001", "otro", "peluqueria")
+        with database.conversacion_whatsapp_pendiente() as otra:
+            assert otra == ("wa:+34600000002", [("buenas", "")])
+        with database.conversacion_whatsapp_pendiente() as ninguna:
+            assert ninguna is None
+    # Solo se borran los mensajes procesados; el que llegó mientras tanto queda
+    assert _pendientes(bandeja) == [("wa:+34600000001", "otro", 0, False)]
+
+def test_fallo_espera_y_abandona_tras_los_intentos(bandeja):
+    with pytest.raises(RuntimeError):
+        with database.conversacion_whatsapp_pendiente(candidatas=1):
+            raise RuntimeError("Twilio caído")
+    assert _pendientes(bandeja)[0] == ("wa:+34600000001", "hola", 1, False)
+    espera = bandeja("""SELECT EXTRACT(EPOCH FROM procesando_hasta - NOW()) FROM whatsapp_entrantes
+                        WHERE conversacion = 'wa:+34600000001';""")
+    assert all(0 < s <= 2 for (s,) in espera)
+    with database.conversacion_whatsapp_pendiente(candidatas=1) as pendiente:
+        assert pendiente[0] == "wa:+34600000002"  # esperando: no se reintenta en seguida
+
+    # Segundo fallo, y al tercero ya no se entrega: queda abandonado
+    bandeja("UPDATE whatsapp_entrantes SET procesando_hasta = NULL;")
+    with pytest.raises(RuntimeError):
+        with database.conversacion_whatsapp_pendiente(candidatas=1):
+            raise RuntimeError("Twilio caído")
+    bandeja("UPDATE whatsapp_entrantes SET procesando_hasta = NULL;")
+    with database.conversacion_whatsapp_pendiente() as pendiente:
+        assert pendiente is None
+    assert _pendientes(bandeja) == [("wa:+34600000001", "hola", 2, True), ("wa:+34600000001", "2", 2, True)]
+
+def test_plazo_vencido_se_retoma(bandeja):
+    # Un worker que murió con la conversación tomada no la bloquea para siempre
+    bandeja("UPDATE whatsapp_entrantes SET procesando_hasta = NOW() - interval '1 second', intentos = 1;")
+    with database.conversacion_whatsapp_pendiente() as pendiente:
+        assert pendiente[0] == "wa:+34600000001"
+    assert bandeja("SELECT conversacion FROM whatsapp_entrantes;") == [("wa:+34600000002",)]
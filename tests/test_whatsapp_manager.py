@@ -0,0 +1,67 @@
+# tests/test_whatsapp_manager.py
+import pytest
+import whatsapp_manager
+
+# Ejemplo de la documentación de Twilio (auth token "12345")
+URL = "https://mycompany.com/myapp.php?foo=1&bar=2"
+PARAMS = {"CallSid": "CA1234567890ABCDE", "Caller": "+12349013030", "Digits": "1234",
+          "From": "+12349013030", "To": "+18005551212"}
+FIRMA = "0/KCTR6DLpKmkAf8muzZqo1nDgQ="
+
+@pytest.fixture
+def token(monkeypatch):
+    monkeypatch.setattr(whatsapp_manager, "TW_TOK", "12345")
+
+def test_firma_valida(token):
+    assert whatsapp_manager.firma_valida(URL, PARAMS, FIRMA)
+
+def test_firma_valida_con_multidict(token):
+    werkzeug = pytest.importorskip("werkzeug.datastructures")
+    assert whatsapp_manager.firma_valida(URL, werkzeug.MultiDict(PARAMS), FIRMA)
+
+@pytest.mark.parametrize("url, params, firma", [
+    (URL, {**PARAMS, "Digits": "1235"}, FIRMA),
+    (URL.replace("https", "http"), PARAMS, FIRMA),
+    (URL, PARAMS, ""),
+    (URL, PARAMS, None),
+])
+def test_firma_no_valida(token, url, params, firma):
+    assert not whatsapp_manager.firma_valida(url, params, firma)
+
+def test_formatear_respuesta_con_botones():
+    texto, valores = whatsapp_manager.formatear_respuesta({
+        "respuesta": "¿Qué día te viene **mejor**?",
+        "ui_component": {"type": "day_selector", "days": [
+            {"display": "Lunes 7", "value": "2030-01-07"}, {"display": "Martes 8", "value": "2030-01-08"}]},
+    })
+    assert texto == "¿Qué día te viene *mejor*?\n\n1. Lunes 7\n2. Martes 8"
+    assert valores == ["2030-01-07", "2030-01-08"]
+
+def test_formatear_respuesta_multiple_y_post_respuesta():
+    texto, valores = whatsapp_manager.formatear_respuesta({
+        "respuesta": "Hecho.",
+        "post_respuesta": {"respuesta": "¿Qué servicios?",
+                           "ui_component": {"type": "multi_choice", "choices": ["Corte", "Barba"]}},
+    })
+    assert texto == "Hecho.\n\n¿Qué servicios?\n\n1. Corte\n2. Barba\n\nPuedes elegir varios a la vez, por ejemplo: 1+3"
+    assert valores == ["Corte", "Barba"]
+
+def test_formatear_respuesta_sin_opciones():
+    assert whatsapp_manager.formatear_respuesta({"respuesta": "Hola"}) == ("Hola", [])
+
+@pytest.mark.parametrize("texto, esperado", [
+    ("2", "10:30"),
+    ("1.", "10:00"),
+    ("1+3", "10:00 + 11:00"),
+    ("1, 3", "10:00 + 11:00"),
+    ("1 y 2", "10:00 + 10:30"),
+    ("4", "4"),
+    ("0", "0"),
+    ("a las 10", "a las 10"),
+])
+def test_traducir_opcion(texto, esperado):
+    assert whatsapp_manager.traducir_opcion(texto, ["10:00", "10:30", "11:00"]) == esperado
+
+def test_traducir_opcion_sin_opciones():
+    assert whatsapp_manager.traducir_opcion("2", None) == "2"
+    assert whatsapp_manager.traducir_opcion("2", []) == "2"
@@ -1,17 +1,27 @@
 # utils.py
+import os
 import unicodedata
 from datetime import datetime
 from difflib import get_close_matches
 import locale
 import re # Importamos la librería de expresiones regulares
+import config
+import log_manager
 
+# Prefijo de los teléfonos escritos sin él (España por defecto)
+DEFAULT_COUNTRY_CODE = getattr(config, "DEFAULT_COUNTRY_CODE", os.getenv("DEFAULT_COUNTRY_CODE", "+34"))
+# Cifras de un número nacional de ese país (sin prefijo): distingue "600112233" de "34600112233"
+TELEFONO_NACIONAL_DIGITOS = int(getattr(config, "TELEFONO_NACIONAL_DIGITOS", os.getenv("TELEFONO_NACIONAL_DIGITOS", 9)))
+
+# Locale español (si está disponible). Único sitio donde se fija: setlocale es
+# global al proceso, así que basta con hacerlo una vez al importar utils.
 try:
     locale.setlocale(locale.LC_TIME, 'es_ES.UTF-8')
 except locale.Error:
     try:
         locale.setlocale(locale.LC_TIME, 'esp')
     except locale.Error:
-        print("Advertencia: No se pudo establecer el locale en español.")
+        log_manager.get_logger("utils").warning("No se pudo establecer el locale en español.")
 
 def normalizar_texto(texto):
     # Transforma "Miércoles" en "miercoles"
@@ -32,6 +42,33 @@ def encontrar_servicio_mas_cercano(texto, lista_servicios):
         return servicios_norm[mejores_coincidencias[0]]
     return None
 
+def telefono_e164(telefono):
+    """
+    Teléfono en E.164 ("+34600112233") a partir de lo escrito: "600 11 22 33",
+    "+34 600-11-22-33", "(+34) 600112233", "0034600112233", "34600112233".
+    Sin prefijo se antepone DEFAULT_COUNTRY_CODE, salvo que las cifras ya
+    empiecen por él y sobren justo TELEFONO_NACIONAL_DIGITOS (y
+    "+3434600112233", guardado así por error, se queda con uno). None si no
+    parece un teléfono.
+    """
+    texto = (telefono or "").strip()
+    if not texto or not re.fullmatch(r"[+\d\s().\-]+", texto):
+        return None
+    digitos = re.sub(r"\D+", "", texto)
+    prefijo = re.sub(r"\D+", "", DEFAULT_COUNTRY_CODE)
+    con_prefijo = len(digitos) == len(prefijo) + TELEFONO_NACIONAL_DIGITOS and digitos.startswith(prefijo)
+    if texto.lstrip("( ").startswith("+"):
+        if digitos.startswith(prefijo * 2) and len(digitos) == 2 * len(prefijo) + TELEFONO_NACIONAL_DIGITOS:
+            digitos = digitos[len(prefijo):]
+        e164 = "+" + digitos
+    elif digitos.startswith("00"):
+        e164 = "+" + digitos[2:]
+    elif con_prefijo:
+        e164 = "+" + digitos
+    else:
+        e164 = DEFAULT_COUNTRY_CODE + digitos
+    return e164 if re.fullmatch(r"\+[1-9]\d{7,14}", e164) else None
+
 def now_spain():
     return datetime.now()
 
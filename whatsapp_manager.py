@@ -1,46 +1,74 @@
 # whatsapp_manager.py
 import os
 import re
+import hmac
+import time
+import base64
+import hashlib
 from datetime import datetime
 import config
+import metrics
+import utils
+import log_manager
 
-# Twilio
-try:
-    from twilio.rest import Client
-except Exception:
-    Client = None
+log = log_manager.get_logger("whatsapp_manager")
 
 TW_SID  = getattr(config, "TWILIO_ACCOUNT_SID", os.getenv("TWILIO_ACCOUNT_SID", ""))
 TW_TOK  = getattr(config, "TWILIO_AUTH_TOKEN",  os.getenv("TWILIO_AUTH_TOKEN", ""))
 # Sandbox / número verificado de WhatsApp Business
 TW_FROM = getattr(config, "TWILIO_WHATSAPP_FROM", os.getenv("TWILIO_WHATSAPP_FROM", "whatsapp:+14155238886"))
 
-DEFAULT_CC = getattr(config, "DEFAULT_COUNTRY_CODE", os.getenv("DEFAULT_COUNTRY_CODE", "+34"))
+
+# Cliente Twilio: el SDK (pesado) se importa con el primer envío y el cliente se
+# reutiliza entre recordatorios. False = SDK no instalado (no reintentar).
+_cliente = None
+
+def _obtener_cliente():
+    global _cliente
+    if _cliente is None:
+        try:
+            from twilio.rest import Client
+        except ImportError:
+            _cliente = False
+        else:
+            _cliente = Client(TW_SID, TW_TOK)
+    return _cliente or None
 
 def _to_e164(telefono: str) -> str | None:
-    if not telefono:
-        return None
-    tel = re.sub(r"\D+", "", telefono)  # quitar no dígitos
-    if telefono.strip().startswith("+"):
-        return "+" + tel
-    # Si no empieza por +, anteponer país (España por defecto)
-    return DEFAULT_CC + tel
+    # Los teléfonos ya se guardan en E.164; esto cubre los datos antiguos y el webhook
+    return utils.telefono_e164(telefono)
+
+def _enviar(to: str, body: str, que: str):
+    """Envía 'body' al número E.164 'to'. Sin Twilio solo se registra (útil en local)."""
+    cliente = _obtener_cliente()
+    if cliente is None:
+        log.warning("Twilio SDK no disponible. Instala 'twilio' en requirements.txt")
+        log.debug("WhatsApp no enviado a %s: %s", to, body)
+        return
+
+    t0 = time.perf_counter()
+    try:
+        cliente.messages.create(
+            from_=TW_FROM,
+            to=f"whatsapp:{to}",
+            body=body
+        )
+        log.info("%s enviado a %s", que, to)
+    except Exception as e:
+        metrics.NOTIFICACION_FALLOS.inc("whatsapp")
+        log.error("Error enviando a %s: %s", to, e)
+    finally:
+        metrics.NOTIFICACION_LATENCIA.observar(time.perf_counter() - t0, "whatsapp")
 
 def enviar_recordatorio_whatsapp(datos: dict):
     """
     Envía un mensaje de WhatsApp 2h antes de la cita.
     Requiere credenciales de Twilio y que el destinatario esté autorizado (sandbox/prod).
     """
-    if not Client:
-        print("[WhatsApp] Twilio SDK no disponible. Instala 'twilio' en requirements.txt")
-        return
-
     to = _to_e164(datos.get("telefono"))
     if not to:
         return
 
-    cliente = Client(TW_SID, TW_TOK)
-
     negocio = datos.get("negocio_nombre") or "Tu negocio"
     servicio = datos.get("servicio") or "Cita"
     hora     = datos.get("hora")
@@ -57,13 +85,91 @@ def enviar_recordatorio_whatsapp(datos: dict):
         f"{'Dirección: ' + direccion if direccion else ''}\n\n"
         f"Si no puedes asistir, responde a este mensaje para reprogramar. ¡Gracias!"
     )
+    _enviar(to, body, "Recordatorio")
 
-    try:
-        cliente.messages.create(
-            from_=TW_FROM,
-            to=f"whatsapp:{to}",
-            body=body
-        )
-        print(f"[WhatsApp] Recordatorio enviado a {to}")
-    except Exception as e:
-        print(f"[WhatsApp] Error enviando a {to}: {e}")
+def enviar_oferta_lista_espera(datos: dict):
+    """Avisa por WhatsApp de un hueco liberado para quien estaba en la lista de espera."""
+    to = _to_e164(datos.get("telefono"))
+    if not to:
+        return
+
+    negocio = datos.get("negocio_nombre") or "Tu negocio"
+    servicio = datos.get("servicio") or "Cita"
+    empleado = datos.get("empleado_nombre") or "nuestro equipo"
+
+    body = (
+        f"🔔 Se ha liberado un hueco\n"
+        f"{negocio}\n"
+        f"Servicio: {servicio}\n"
+        f"Profesional: {empleado}\n"
+        f"{datos.get('fecha')} a las {datos.get('hora')}\n\n"
+        f"Te lo guardamos hasta las {datos.get('expira')}. Para reservarlo: {datos.get('enlace')}"
+    )
+    _enviar(to, body, "Oferta de lista de espera")
+
+# -------------------------
+# Mensajes entrantes (webhook de Twilio)
+# -------------------------
+
+def firma_valida(url: str, params, firma: str) -> bool:
+    """
+    Comprueba X-Twilio-Signature: HMAC-SHA1 (clave = auth token) de la URL del
+    webhook seguida de cada parámetro POST ordenado como nombre+valor, en base64.
+    """
+    datos = url
+    for nombre in sorted(set(params)):
+        valores = params.getlist(nombre) if hasattr(params, "getlist") else [params[nombre]]
+        for valor in sorted(set(valores)):
+            datos += nombre + valor
+    esperada = base64.b64encode(hmac.new(TW_TOK.encode(), datos.encode(), hashlib.sha1).digest()).decode()
+    return hmac.compare_digest(esperada, firma or "")
+
+def _opciones(componente) -> list[tuple[str, str]]:
+    """[(texto mostrado, valor que espera el handler)] de un ui_component del chat web."""
+    if not componente:
+        return []
+    tipo = componente.get("type")
+    if tipo == "day_selector":
+        return [(d["display"], d["value"]) for d in componente.get("days", [])]
+    if tipo == "hour_selector":
+        return [(h, h) for h in componente.get("hours", [])]
+    if tipo in ("choice_buttons", "multi_choice"):
+        return [(c, c) for c in componente.get("choices", [])]
+    return []
+
+def formatear_respuesta(respuesta: dict) -> tuple[str, list[str]]:
+    """
+    Texto plano de WhatsApp para una respuesta del chat: los botones pasan a
+    opciones numeradas y el **negrita** del chat web al *negrita* de WhatsApp.
+    Devuelve (texto, valores de las opciones) para traducir luego "2" con
+    traducir_opcion().
+    """
+    partes, valores = [], []
+    for r in (respuesta, respuesta.get("post_respuesta")):
+        if not r:
+            continue
+        if r.get("respuesta"):
+            partes.append(re.sub(r"\*\*(.+?)\*\*", r"*\1*", r["respuesta"]))
+        opciones = _opciones(r.get("ui_component"))
+        if opciones:
+            partes.append("\n".join(f"{i}. {texto}" for i, (texto, _) in enumerate(opciones, 1)))
+            if r["ui_component"].get("type") == "multi_choice":
+                partes.append("Puedes elegir varios a la vez, por ejemplo: 1+3")
+            valores = [valor for _, valor in opciones]
+    return "\n\n".join(partes), valores
+
+def traducir_opcion(texto: str, valores: list[str] | None) -> str:
+    """
+    '2' -> valor de la segunda opción mostrada; '1+3' (o '1, 3', '1 y 3') ->
+    esos valores unidos con ' + ' (selección múltiple). Cualquier otro texto
+    se deja igual.
+    """
+    numeros = [n.strip().rstrip(".)") for n in re.split(r"\+|,|\by\b", texto)]
+    if valores and all(n.isdigit() and 1 <= int(n) <= len(valores) for n in numeros):
+        return " + ".join(valores[int(n) - 1] for n in numeros)
+    return texto
+
+def enviar_respuestas(datos: dict):
+    """Envía en orden las respuestas del bot ('mensajes') a 'telefono' (E.164)."""
+    for body in datos.get("mensajes", []):
+        _enviar(datos["telefono"], body, "Respuesta")